@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import logging
-from typing import Any, List, Optional, Sequence, Tuple, cast
+from typing import List, Optional, cast
 
 import simplejson as json
 from flask import Flask, Response, g, jsonify, make_response, request
@@ -215,7 +215,7 @@ def configs() -> Response:
     else:
         descriptions = state.get_all_config_descriptions()
 
-        raw_configs: Sequence[Tuple[str, Any]] = state.get_raw_configs().items()
+        raw_configs = state.get_raw_configs().items()
 
         sorted_configs = sorted(raw_configs, key=lambda c: c[0])
 
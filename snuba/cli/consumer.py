@@ -8,6 +8,7 @@ from arroyo import configure_metrics
 
 from snuba import environment, settings
 from snuba.consumers.consumer_builder import (
+    AdaptiveBatchingParameters,
     ConsumerBuilder,
     KafkaParameters,
     ProcessingParameters,
@@ -88,6 +89,35 @@ logger = logging.getLogger(__name__)
     is_flag=True,
     default=True,
 )
+@click.option(
+    "--max-insert-batches-in-flight",
+    type=int,
+    help="Enables pipelined inserts: how many batches can be written to ClickHouse at the same time while the next batch is being filled. Offsets are committed in order once each insert is acknowledged.",
+)
+@click.option(
+    "--adaptive-batching",
+    is_flag=True,
+    default=False,
+    help="Adjusts the batch size and time between the min and max values: batches grow while the consumer lags behind and shrink when the write latency is above the target.",
+)
+@click.option(
+    "--min-batch-size",
+    default=settings.DEFAULT_MIN_BATCH_SIZE,
+    type=int,
+    help="Min number of messages to batch in memory when adaptive batching is enabled.",
+)
+@click.option(
+    "--min-batch-time-ms",
+    default=settings.DEFAULT_MIN_BATCH_TIME_MS,
+    type=int,
+    help="Min length of time to buffer messages in memory when adaptive batching is enabled.",
+)
+@click.option(
+    "--target-latency-ms",
+    default=settings.DEFAULT_TARGET_LATENCY_MS,
+    type=int,
+    help="Latency adaptive batching aims for. Batches grow when the consumer lags more than this behind.",
+)
 @click.option("--log-level", help="Logging level to use.")
 @click.option(
     "--processes",
@@ -126,6 +156,11 @@ def consumer(
     queued_max_messages_kbytes: int,
     queued_min_messages: int,
     parallel_collect: bool,
+    max_insert_batches_in_flight: Optional[int],
+    adaptive_batching: bool,
+    min_batch_size: int,
+    min_batch_time_ms: int,
+    target_latency_ms: int,
     processes: Optional[int],
     input_block_size: Optional[int],
     output_block_size: Optional[int],
@@ -175,6 +210,14 @@ def consumer(
         stats_callback=stats_callback,
         parallel_collect=parallel_collect,
         cooperative_rebalancing=cooperative_rebalancing,
+        max_insert_batches_in_flight=max_insert_batches_in_flight,
+        adaptive_batching=AdaptiveBatchingParameters(
+            min_batch_size=min_batch_size,
+            min_batch_time_ms=min_batch_time_ms,
+            target_latency_ms=target_latency_ms,
+        )
+        if adaptive_batching
+        else None,
     )
 
     consumer = consumer_builder.build_base_consumer()
@@ -12,6 +12,10 @@ from confluent_kafka import Producer as ConfluentKafkaProducer
 
 from snuba import environment, settings
 from snuba.consumers.consumer import MultistorageConsumerProcessingStrategyFactory
+from snuba.consumers.consumer_builder import (
+    AdaptiveBatchingParameters,
+    build_adaptive_batch_size_policy,
+)
 from snuba.datasets.storages import StorageKey
 from snuba.datasets.storages.factory import WRITABLE_STORAGES, get_writable_storage
 from snuba.environment import setup_logging, setup_sentry
@@ -86,6 +90,30 @@ logger = logging.getLogger(__name__)
     is_flag=True,
     default=True,
 )
+@click.option(
+    "--adaptive-batching",
+    is_flag=True,
+    default=False,
+    help="Adjusts the batch size and time between the min and max values: batches grow while the consumer lags behind and shrink when the write latency is above the target.",
+)
+@click.option(
+    "--min-batch-size",
+    default=settings.DEFAULT_MIN_BATCH_SIZE,
+    type=int,
+    help="Min number of messages to batch in memory when adaptive batching is enabled.",
+)
+@click.option(
+    "--min-batch-time-ms",
+    default=settings.DEFAULT_MIN_BATCH_TIME_MS,
+    type=int,
+    help="Min length of time to buffer messages in memory when adaptive batching is enabled.",
+)
+@click.option(
+    "--target-latency-ms",
+    default=settings.DEFAULT_TARGET_LATENCY_MS,
+    type=int,
+    help="Latency adaptive batching aims for. Batches grow when the consumer lags more than this behind.",
+)
 @click.option("--processes", type=int)
 @click.option(
     "--input-block-size",
@@ -117,6 +145,10 @@ def multistorage_consumer(
     queued_max_messages_kbytes: int,
     queued_min_messages: int,
     parallel_collect: bool,
+    adaptive_batching: bool,
+    min_batch_size: int,
+    min_batch_time_ms: int,
+    target_latency_ms: int,
     processes: Optional[int],
     input_block_size: Optional[int],
     output_block_size: Optional[int],
@@ -302,6 +334,18 @@ def multistorage_consumer(
             metrics=metrics,
             producer=dead_letter_producer,
             topic=dead_letter_queue,
+            batch_size_policy=build_adaptive_batch_size_policy(
+                AdaptiveBatchingParameters(
+                    min_batch_size=min_batch_size,
+                    min_batch_time_ms=min_batch_time_ms,
+                    target_latency_ms=target_latency_ms,
+                ),
+                max_batch_size,
+                max_batch_time_ms,
+                metrics,
+            )
+            if adaptive_batching
+            else None,
         ),
     )
 
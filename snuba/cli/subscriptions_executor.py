@@ -12,7 +12,10 @@ from snuba import environment, state
 from snuba.datasets.entities import EntityKey
 from snuba.datasets.entities.factory import get_entity
 from snuba.environment import setup_logging, setup_sentry
-from snuba.subscriptions.executor_consumer import build_executor_consumer
+from snuba.subscriptions.executor_consumer import (
+    AsyncQueryRunner,
+    build_executor_consumer,
+)
 from snuba.utils.metrics.wrapper import MetricsWrapper
 from snuba.utils.streams.configuration_builder import build_kafka_producer_configuration
 from snuba.utils.streams.metrics_adapter import StreamMetricsAdapter
@@ -45,6 +48,15 @@ from snuba.utils.streams.metrics_adapter import StreamMetricsAdapter
     type=int,
     help="Max concurrent ClickHouse queries",
 )
+@click.option(
+    "--max-async-queries",
+    type=int,
+    help=(
+        "Executes the queries asynchronously, with at most this many "
+        "concurrent ClickHouse queries. The threads of the executor only "
+        "prepare the queries."
+    ),
+)
 @click.option(
     "--auto-offset-reset",
     default="error",
@@ -75,6 +87,7 @@ def subscriptions_executor(
     entity_names: Sequence[str],
     consumer_group: str,
     max_concurrent_queries: int,
+    max_async_queries: Optional[int],
     auto_offset_reset: str,
     no_strict_offset_reset: bool,
     log_level: Optional[str],
@@ -116,6 +129,10 @@ def subscriptions_executor(
 
     executor = ThreadPoolExecutor(max_concurrent_queries)
 
+    async_runner = (
+        AsyncQueryRunner(max_async_queries) if max_async_queries is not None else None
+    )
+
     # TODO: Consider removing and always passing via CLI.
     # If a value provided via config, it overrides the one provided via CLI.
     # This is so we can quickly change this in an emergency.
@@ -135,6 +152,7 @@ def subscriptions_executor(
         executor,
         stale_threshold_seconds,
         cooperative_rebalancing,
+        async_runner,
     )
 
     def handler(signum: int, frame: Any) -> None:
@@ -148,7 +166,11 @@ def subscriptions_executor(
     signal.signal(signal.SIGTERM, handler)
 
     with executor, closing(producer), flush_querylog():
-        processor.run()
+        try:
+            processor.run()
+        finally:
+            if async_runner is not None:
+                async_runner.close()
 
 
 @contextmanager
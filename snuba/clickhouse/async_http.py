@@ -0,0 +1,318 @@
+"""
+Executes queries on the HTTP interface of ClickHouse with asyncio, so a
+single thread running an event loop can keep many queries in flight at
+once. Only the requests and the responses go through the event loop:
+building the query and processing the result is up to the caller.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+from datetime import date, datetime
+from typing import Any, List, Mapping, MutableMapping, Optional, Sequence, Tuple
+from urllib.parse import urlencode
+
+import rapidjson
+from clickhouse_driver import errors
+
+from snuba import environment
+from snuba.clickhouse.errors import ClickhouseError
+from snuba.clickhouse.formatter.nodes import FormattedQuery
+from snuba.clickhouse.native import (
+    ClickhouseProfile,
+    ClickhouseResult,
+    transform_date,
+    transform_datetime,
+)
+from snuba.reader import Result, Row, build_result_transformer
+from snuba.utils.metrics.wrapper import MetricsWrapper
+
+logger = logging.getLogger("snuba.clickhouse")
+
+metrics = MetricsWrapper(environment.metrics, "clickhouse.async_http")
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class AsyncClickhousePool:
+    """
+    Runs queries on the HTTP interface of a ClickHouse server over a pool
+    of keep-alive connections. It can only be used from the event loop
+    that runs its first query.
+
+    At most `max_pool_size` queries are executed at the same time, the
+    following ones wait for a connection to be released. As in
+    `ClickhousePool`, queries are retried a couple of times on connection
+    failures, which smooths over server restarts and connections closed
+    by the server while idle.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str,
+        password: str,
+        database: str,
+        max_pool_size: int,
+        connect_timeout: int = 1,
+        send_receive_timeout: Optional[int] = 300,
+        client_settings: Mapping[str, Any] = {},
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.database = database
+        self.max_pool_size = max_pool_size
+        self.connect_timeout = connect_timeout
+        self.send_receive_timeout = send_receive_timeout
+        self.client_settings = client_settings
+
+        # Created on first use so that they belong to the loop running the
+        # queries.
+        self.__semaphore: Optional[asyncio.Semaphore] = None
+        self.__idle: List[Connection] = []
+
+    def __build_request(
+        self,
+        query: str,
+        query_id: Optional[str],
+        settings: Optional[Mapping[str, Any]],
+    ) -> bytes:
+        params: MutableMapping[str, Any] = {
+            **self.client_settings,
+            **(settings or {}),
+            "database": self.database,
+            "default_format": "JSONCompact",
+            "output_format_json_quote_64bit_integers": 0,
+            # NaN and infinite values are returned as null otherwise, the
+            # native driver returns them as floats.
+            "output_format_json_quote_denormals": 1,
+            # Buffers the result on the server, so errors are reported
+            # with the status of the response instead of in its body.
+            "wait_end_of_query": 1,
+        }
+        if query_id is not None:
+            params["query_id"] = query_id
+
+        body = query.encode("utf-8")
+        head = (
+            f"POST /?{urlencode(params)} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"X-ClickHouse-User: {self.user}\r\n"
+            f"X-ClickHouse-Key: {self.password}\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        )
+        return head.encode("latin-1") + body
+
+    async def __read_response(
+        self, reader: asyncio.StreamReader
+    ) -> Tuple[int, Mapping[str, str], bytes]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        status = int(status_line.split(b" ", 2)[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if size == 0:
+                    # Skips the trailers up to the final empty line.
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+
+        return status, headers, body
+
+    async def __connect(self) -> Connection:
+        metrics.increment("connect")
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.connect_timeout
+        )
+
+    async def __request(self, connection: Connection, request: bytes) -> Any:
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+        status, headers, body = await self.__read_response(reader)
+
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self.__idle.append(connection)
+
+        if status != 200:
+            code = headers.get("x-clickhouse-exception-code")
+            raise ClickhouseError(
+                body.decode("utf-8", errors="replace").strip(),
+                code=int(code) if code is not None else -1,
+            )
+
+        return rapidjson.loads(body)
+
+    async def execute(
+        self,
+        query: str,
+        query_id: Optional[str] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+    ) -> ClickhouseResult:
+        """
+        Executes a query and returns its rows, followed by the totals row
+        if the query has one, like the native driver does.
+        """
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_pool_size)
+
+        request = self.__build_request(query, query_id, settings)
+        async with self.__semaphore:
+            attempts_remaining = 3
+            while True:
+                attempts_remaining -= 1
+                connection = self.__idle.pop() if self.__idle else None
+                try:
+                    if connection is None:
+                        connection = await self.__connect()
+                    payload = await asyncio.wait_for(
+                        self.__request(connection, request),
+                        self.send_receive_timeout,
+                    )
+                    break
+                except (OSError, EOFError, asyncio.TimeoutError) as e:
+                    metrics.increment("connection_error")
+                    if connection is not None:
+                        connection[1].close()
+
+                    if attempts_remaining <= 0:
+                        code = (
+                            errors.ErrorCodes.SOCKET_TIMEOUT
+                            if isinstance(e, asyncio.TimeoutError)
+                            else errors.ErrorCodes.NETWORK_ERROR
+                        )
+                        raise ClickhouseError(
+                            f"{type(e).__name__}: {e}", code=code
+                        ) from e
+                    # Short sleep to make sure we give the load balancer a
+                    # chance to mark a bad host as down.
+                    await asyncio.sleep(0.1)
+
+        results = payload["data"]
+        if "totals" in payload:
+            results = [*results, payload["totals"]]
+        statistics = payload.get("statistics", {})
+        return ClickhouseResult(
+            results=results,
+            meta=[(column["name"], column["type"]) for column in payload["meta"]],
+            profile=ClickhouseProfile(
+                bytes=statistics.get("bytes_read", 0),
+                blocks=0,
+                rows=statistics.get("rows_read", 0),
+                elapsed=statistics.get("elapsed", 0.0),
+            ),
+        )
+
+    async def close(self) -> None:
+        while self.__idle:
+            _, writer = self.__idle.pop()
+            writer.close()
+
+
+def _parse_date(value: str) -> str:
+    return transform_date(date.fromisoformat(value))
+
+
+def _parse_datetime(value: str) -> str:
+    # The server returns the time in its time zone, which is UTC.
+    return transform_datetime(datetime.fromisoformat(value))
+
+
+def _parse_float(value: Any) -> Any:
+    # NaN and infinite values are quoted, as "nan", "inf" and "-inf".
+    return float(value) if isinstance(value, str) else value
+
+
+def _parse_float_array(value: Sequence[Any]) -> Sequence[Any]:
+    return [_parse_float(item) for item in value]
+
+
+transform_column_types = build_result_transformer(
+    [
+        (re.compile(r"^Date(\(.+\))?$"), _parse_date),
+        (re.compile(r"^DateTime(\(.+\))?$"), _parse_datetime),
+        (re.compile(r"^Float(32|64)$"), _parse_float),
+        (
+            re.compile(r"^Array\((Float(32|64)|Nullable\(Float(32|64)\))\)$"),
+            _parse_float_array,
+        ),
+    ]
+)
+
+
+class AsyncHTTPReader:
+    """
+    Reads results through `AsyncClickhousePool` and transforms them into
+    the same results `NativeDriverReader` returns for the same queries.
+    """
+
+    def __init__(self, cache_partition_id: Optional[str], client: AsyncClickhousePool):
+        self.cache_partition_id = cache_partition_id
+        self.__client = client
+
+    async def execute(
+        self,
+        query: FormattedQuery,
+        settings: Optional[Mapping[str, str]] = None,
+        with_totals: bool = False,
+    ) -> Result:
+        settings = {**settings} if settings is not None else {}
+        query_id = settings.pop("query_id", None)
+
+        result = await self.__client.execute(
+            query.get_sql(), query_id=query_id, settings=settings
+        )
+
+        meta = result.meta if result.meta is not None else []
+        # Duplicated names are discarded, as in NativeDriverReader.
+        columns = {c[0]: i for i, c in enumerate(meta)}
+        rows: List[Row] = [
+            {column: row[index] for column, index in columns.items()}
+            for row in result.results
+        ]
+
+        transformed: Result = {
+            "data": rows,
+            "meta": [
+                {"name": meta[i][0], "type": meta[i][1]} for i in columns.values()
+            ],
+            "profile": result.profile,
+            "trace_output": "",
+        }
+        if with_totals:
+            assert len(rows) > 0
+            transformed["totals"] = rows.pop(-1)
+
+        transform_column_types(transformed)
+        return transformed
+
+    async def close(self) -> None:
+        await self.__client.close()
@@ -0,0 +1,118 @@
+"""
+Compression of the body of the HTTP requests sent to Clickhouse.
+
+The body of an insert is produced as a stream of chunks, which is
+compressed on the fly with a streaming compressor and sent with the
+matching Content-Encoding header. Clickhouse decompresses the body
+before parsing the rows, so compression is transparent to the format
+of the insert.
+"""
+from __future__ import annotations
+
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, Mapping, cast
+
+import lz4.frame
+import zstandard
+
+
+class StreamCompressor(ABC):
+    """
+    Compresses a stream of chunks. Every call to `compress` can return
+    an empty buffer if the compressor is still accumulating data. The
+    remaining data is returned by `flush`, which ends the stream.
+    """
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def flush(self) -> bytes:
+        raise NotImplementedError
+
+
+class LZ4StreamCompressor(StreamCompressor):
+    def __init__(self) -> None:
+        self.__compressor = lz4.frame.LZ4FrameCompressor()
+        self.__header = cast(bytes, self.__compressor.begin())
+
+    def compress(self, data: bytes) -> bytes:
+        compressed = cast(bytes, self.__compressor.compress(data))
+        if self.__header:
+            compressed = self.__header + compressed
+            self.__header = b""
+        return compressed
+
+    def flush(self) -> bytes:
+        return self.__header + cast(bytes, self.__compressor.flush())
+
+
+class ZstdStreamCompressor(StreamCompressor):
+    def __init__(self) -> None:
+        self.__compressor = zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.__compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.__compressor.flush()
+
+
+# Maps the Content-Encoding values supported by Clickhouse to the
+# compressor that produces them.
+COMPRESSORS: Mapping[str, Callable[[], StreamCompressor]] = {
+    "lz4": LZ4StreamCompressor,
+    "zstd": ZstdStreamCompressor,
+}
+
+
+def get_compressor(encoding: str) -> StreamCompressor:
+    try:
+        return COMPRESSORS[encoding]()
+    except KeyError:
+        raise ValueError(f"unsupported compression: {encoding}")
+
+
+class CompressionStats:
+    """
+    Keeps track of the size of a stream before and after compression and
+    of the CPU time spent compressing it.
+    """
+
+    def __init__(self) -> None:
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_time = 0.0
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__}: {self.uncompressed_bytes} -> {self.compressed_bytes} bytes in {self.cpu_time:0.4f}s>"
+
+    def get_ratio(self) -> float:
+        if not self.compressed_bytes:
+            return 1.0
+        return self.uncompressed_bytes / self.compressed_bytes
+
+
+def compress_stream(
+    chunks: Iterable[bytes], compressor: StreamCompressor, stats: CompressionStats
+) -> Iterator[bytes]:
+    """
+    Compresses the chunks as they are consumed. The CPU time is measured
+    on the thread consuming the stream, which is the one compressing it.
+    """
+    for chunk in chunks:
+        start = time.thread_time()
+        compressed = compressor.compress(chunk)
+        stats.cpu_time += time.thread_time() - start
+        stats.uncompressed_bytes += len(chunk)
+        if compressed:
+            stats.compressed_bytes += len(compressed)
+            yield compressed
+
+    start = time.thread_time()
+    compressed = compressor.flush()
+    stats.cpu_time += time.thread_time() - start
+    stats.compressed_bytes += len(compressed)
+    yield compressed
@@ -1,7 +1,7 @@
 import re
 from abc import ABC, abstractmethod
 from datetime import date, datetime
-from typing import Optional, Sequence, cast
+from typing import Callable, MutableMapping, Optional, Sequence, Tuple, cast
 
 from snuba.clickhouse.escaping import escape_alias, escape_identifier, escape_string
 from snuba.query.conditions import (
@@ -33,6 +33,12 @@ class ExpressionFormatterBase(ExpressionVisitor[str], ABC):
     The only state maintained is the ParsingContext, which allows us to resolve
     aliases and can be reused when formatting multiple expressions.
 
+    Since expressions are immutable, function calls are formatted only once
+    per formatter. Subtrees whose alias was already defined are replaced by
+    the alias without visiting them, and the fragments that cannot change
+    anymore are cached by node identity. This matters when the same
+    expression (like a tag expansion) is used in more than one clause.
+
     When passing an instance of this class to the accept method of
     the visited expression, the return value is the formatted string.
     """
@@ -41,6 +47,27 @@ class ExpressionFormatterBase(ExpressionVisitor[str], ABC):
         self._parsing_context = (
             parsing_context if parsing_context is not None else ParsingContext()
         )
+        self.__fragments: MutableMapping[int, Tuple[Expression, str]] = {}
+
+    def __memoize(self, exp: Expression, format: Callable[[], str]) -> str:
+        if exp.alias and self._parsing_context.is_alias_present(exp.alias):
+            # _alias would discard the formatted subtree and return the alias.
+            ret = escape_alias(exp.alias)
+            assert ret is not None
+            return ret
+
+        cached = self.__fragments.get(id(exp))
+        if cached is not None and cached[0] is exp:
+            return cached[1]
+
+        aliases_count = self._parsing_context.get_aliases_count()
+        formatted = format()
+        # Formatting a subtree the first time defines its aliases, the
+        # following times they are only referenced. We can only reuse the
+        # fragment once it does not define any alias.
+        if self._parsing_context.get_aliases_count() == aliases_count:
+            self.__fragments[id(exp)] = (exp, formatted)
+        return formatted
 
     def _alias(self, formatted_exp: str, alias: Optional[str]) -> str:
         if not alias:
@@ -131,6 +158,13 @@ class ExpressionFormatterBase(ExpressionVisitor[str], ABC):
         return f"{self.visit_column(exp.column)}[{self.visit_literal(exp.key)}]"
 
     def visit_function_call(self, exp: FunctionCall) -> str:
+        if exp.function_name in (BooleanFunctions.AND, BooleanFunctions.OR):
+            # Boolean functions drop their alias, so they cannot be replaced
+            # by it.
+            return self.__format_function_call(exp)
+        return self.__memoize(exp, lambda: self.__format_function_call(exp))
+
+    def __format_function_call(self, exp: FunctionCall) -> str:
         if exp.function_name == "array":
             # Workaround for https://github.com/ClickHouse/ClickHouse/issues/11622
             # Some distributed queries fail when arrays are passed as array(1,2,3)
@@ -156,6 +190,9 @@ class ExpressionFormatterBase(ExpressionVisitor[str], ABC):
         return self._alias(ret, exp.alias)
 
     def visit_curried_function_call(self, exp: CurriedFunctionCall) -> str:
+        return self.__memoize(exp, lambda: self.__format_curried_function_call(exp))
+
+    def __format_curried_function_call(self, exp: CurriedFunctionCall) -> str:
         int_func = exp.internal_function.accept(self)
         ret = f"{int_func}({self.__visit_params(exp.parameters)})"
         return self._alias(ret, exp.alias)
@@ -1,5 +1,6 @@
 from abc import ABC
 from dataclasses import dataclass
+from functools import cached_property
 from typing import Any, Optional, Sequence, Union
 
 
@@ -86,8 +87,15 @@ class FormattedQuery(SequenceNode):
     differently for different usages (running the query or tracing).
     """
 
+    @cached_property
+    def __sql(self) -> str:
+        # The SQL is needed many times during the execution of a query
+        # (size check, cache key, execution, query log). The nodes are
+        # immutable so it is only built once.
+        return str(self)
+
     def get_sql(self, format: Optional[str] = None) -> str:
-        query = str(self)
+        query = self.__sql
         if format is not None:
             query = f"{query} FORMAT {format}"
 
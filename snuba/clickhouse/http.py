@@ -2,10 +2,23 @@ from __future__ import annotations
 
 import logging
 import re
+from array import array
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import accumulate
 from queue import Queue, SimpleQueue
-from typing import Any, Iterable, Iterator, Mapping, Optional, Sequence, Union, cast
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Iterable,
+    Iterator,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Union,
+    cast,
+)
 from urllib.parse import urlencode
 
 import rapidjson
@@ -14,9 +27,19 @@ from urllib3.exceptions import HTTPError
 
 from snuba import settings
 from snuba.clickhouse import DATETIME_FORMAT
+from snuba.clickhouse.columns import FlattenedColumn
+from snuba.clickhouse.compression import (
+    CompressionStats,
+    compress_stream,
+    get_compressor,
+)
 from snuba.clickhouse.errors import ClickhouseWriterError
+from snuba.clickhouse.escaping import escape_identifier, escape_string
 from snuba.clickhouse.formatter.expression import ClickhouseExpressionFormatter
 from snuba.clickhouse.query import Expression
+from snuba.clickhouse.row_binary import RowBinaryRowBuilder
+from snuba.query.conditions import BooleanFunctions
+from snuba.query.expressions import FunctionCall, Literal
 from snuba.utils.codecs import Encoder
 from snuba.utils.iterators import chunked
 from snuba.utils.metrics import MetricsBackend
@@ -33,8 +56,41 @@ CLICKHOUSE_ERROR_RE = re.compile(
 
 JSONRow = bytes  # a single row in JSONEachRow format
 
+# The end offset of each row in a buffer of encoded rows, an array("I").
+if TYPE_CHECKING:
+    RowOffsets = array[int]
+else:
+    RowOffsets = array
+
+# Boolean functions are flattened by the expression formatter, so they
+# cannot be formatted as plain function calls.
+_VISITOR_ONLY_FUNCTIONS = frozenset([BooleanFunctions.AND, BooleanFunctions.OR])
+
+
+class RowEncoder(Encoder[bytes, WriterTableRow]):
+    """
+    Encodes rows for an insert statement. On top of encoding one row at
+    a time, a RowEncoder can encode a sequence of rows into one buffer,
+    which is what is sent to Clickhouse in the end. Encoders override
+    `encode_batch` when that can be done cheaper than encoding each row
+    independently and concatenating the results. Both methods must
+    produce the same bytes for the same rows.
+
+    When an `offsets` array is provided to `encode_batch`, the end offset
+    of each row in the returned buffer is appended to it, so rows can be
+    told apart later without being encoded separately.
+    """
+
+    def encode_batch(
+        self, rows: Sequence[WriterTableRow], offsets: Optional[RowOffsets] = None
+    ) -> bytes:
+        encoded = [self.encode(row) for row in rows]
+        if offsets is not None:
+            offsets.extend(accumulate(map(len, encoded)))
+        return b"".join(encoded)
 
-class JSONRowEncoder(Encoder[bytes, WriterTableRow]):
+
+class JSONRowEncoder(RowEncoder):
     def __default(self, value: Any) -> Any:
         if isinstance(value, datetime):
             return value.strftime(DATETIME_FORMAT)
@@ -46,24 +102,122 @@ class JSONRowEncoder(Encoder[bytes, WriterTableRow]):
             bytes, rapidjson.dumps(value, default=self.__default).encode("utf-8")
         )
 
+    def encode_batch(
+        self, rows: Sequence[WriterTableRow], offsets: Optional[RowOffsets] = None
+    ) -> bytes:
+        # JSONEachRow does not need any separator between rows, so rows
+        # are joined as strings and encoded once.
+        encoded = [rapidjson.dumps(row, default=self.__default) for row in rows]
+        if offsets is not None:
+            # Non ASCII characters are escaped by rapidjson, so the length
+            # of the string is the length of the encoded row.
+            offsets.extend(accumulate(map(len, encoded)))
+        return "".join(encoded).encode("utf-8")
+
+
+class ValuesRowEncoder(RowEncoder):
+    """
+    Encodes rows of Clickhouse expressions for an insert in the VALUES
+    format.
+
+    The aggregate processors only produce literals and plain function
+    calls (array, toDateTime, arrayReduce, ...) without aliases. These are
+    formatted directly, producing the same output as the
+    ClickhouseExpressionFormatter without dispatching every node through
+    the visitor. Any other expression is formatted by the visitor.
+    """
 
-class ValuesRowEncoder(Encoder[bytes, WriterTableRow]):
     def __init__(self, columns: Iterable[str]) -> None:
         self.__columns = columns
         self.__formatter = ClickhouseExpressionFormatter()
+        self.__function_names: MutableMapping[str, Optional[str]] = {}
+
+    def __format_function_name(self, name: str) -> Optional[str]:
+        escaped = self.__function_names.get(name)
+        if escaped is None:
+            escaped = self.__function_names[name] = escape_identifier(name)
+        return escaped
+
+    def __format_parameters(self, parameters: Sequence[Expression]) -> str:
+        return ", ".join([self.encode_value(p) for p in parameters])
 
     def encode_value(self, value: Any) -> str:
+        value_type = type(value)
+        if value_type is Literal and value.alias is None:
+            literal = value.value
+            literal_type = type(literal)
+            if literal_type is int or literal_type is float:
+                return str(literal)
+            elif literal_type is str:
+                return escape_string(literal)
+            elif literal is None:
+                return "NULL"
+        elif value_type is FunctionCall and value.alias is None:
+            name = value.function_name
+            if name == "array":
+                return f"[{self.__format_parameters(value.parameters)}]"
+            elif name == "tuple":
+                if len(value.parameters) > 1:
+                    return f"({self.__format_parameters(value.parameters)})"
+            elif name not in _VISITOR_ONLY_FUNCTIONS:
+                return f"{self.__format_function_name(name)}({self.__format_parameters(value.parameters)})"
+
         if isinstance(value, Expression):
             return value.accept(self.__formatter)
         else:
             raise TypeError("unknown Clickhouse value type", value.__class__)
 
+    def __encode_row(self, row: WriterTableRow) -> str:
+        ordered_columns_str = ",".join(
+            [self.encode_value(row.get(column)) for column in self.__columns]
+        )
+        return f"({ordered_columns_str})"
+
     def encode(self, row: WriterTableRow) -> bytes:
-        ordered_columns = [
-            self.encode_value(row.get(column)) for column in self.__columns
-        ]
-        ordered_columns_str = ",".join(ordered_columns)
-        return f"({ordered_columns_str})".encode("utf-8")
+        return self.__encode_row(row).encode("utf-8")
+
+    def encode_batch(
+        self, rows: Sequence[WriterTableRow], offsets: Optional[RowOffsets] = None
+    ) -> bytes:
+        encoded = [self.__encode_row(row) for row in rows]
+        data = "".join(encoded).encode("utf-8")
+        if offsets is not None:
+            if len(data) == sum(map(len, encoded)):
+                # Only ASCII characters, the length of each string is the
+                # length of the encoded row.
+                offsets.extend(accumulate(map(len, encoded)))
+            else:
+                offsets.extend(accumulate(len(row.encode("utf-8")) for row in encoded))
+        return data
+
+
+class RowBinaryRowEncoder(RowEncoder):
+    """
+    Encodes a row in the RowBinary format. The columns must be the same,
+    in the same order, as the ones of the insert statement the rows are
+    sent with.
+    """
+
+    def __init__(self, columns: Sequence[FlattenedColumn]) -> None:
+        self.__builder = RowBinaryRowBuilder(columns)
+
+    def get_column_names(self) -> Sequence[str]:
+        return self.__builder.get_column_names()
+
+    def encode(self, value: WriterTableRow) -> bytes:
+        buffer = bytearray()
+        self.__builder.write_row(buffer, value)
+        return bytes(buffer)
+
+    def encode_batch(
+        self, rows: Sequence[WriterTableRow], offsets: Optional[RowOffsets] = None
+    ) -> bytes:
+        buffer = bytearray()
+        for row in rows:
+            self.__builder.write_row(buffer, row)
+            if offsets is not None:
+                offsets.append(len(buffer))
+        return bytes(buffer)
 
 
 class InsertStatement:
@@ -134,6 +288,11 @@ class HTTPWriteBatch:
     case.
     If the buffer size is higher and the buffer is full, the `append`
     command will block while the value is sent to the server.
+
+    `encoding` is the Content-Encoding of data that is appended already
+    encoded. `compression` instead compresses the chunks on the fly with
+    one of the supported compressions (lz4 or zstd) before they are sent.
+    The two cannot be used together.
     """
 
     def __init__(
@@ -147,6 +306,7 @@ class HTTPWriteBatch:
         buffer_size: int,  # 0 means unbounded
         options: Mapping[str, Any],  # should be ``Mapping[str, str]``?
         chunk_size: Optional[int] = None,
+        compression: Optional[str] = None,
     ) -> None:
         if chunk_size is None:
             chunk_size = settings.CLICKHOUSE_HTTP_CHUNK_SIZE
@@ -161,6 +321,16 @@ class HTTPWriteBatch:
         elif not chunk_size > 0:
             raise ValueError("chunk size must be greater than zero")
 
+        self.__compression_stats: Optional[CompressionStats] = None
+        if compression is not None:
+            if encoding is not None:
+                raise ValueError("an encoded body cannot be compressed again")
+            self.__compression_stats = CompressionStats()
+            body = compress_stream(
+                body, get_compressor(compression), self.__compression_stats
+            )
+            encoding = compression
+
         headers = {
             "X-ClickHouse-User": user,
             "Connection": "keep-alive",
@@ -206,6 +376,13 @@ class HTTPWriteBatch:
         self.__queue.put(None)
         self.__closed = True
 
+    def get_compression_stats(self) -> Optional[CompressionStats]:
+        """
+        Returns the compression stats of the body if it is compressed.
+        These are complete only once the batch has been joined.
+        """
+        return self.__compression_stats
+
     def join(self, timeout: Optional[float] = None) -> None:
         response = self.__result.result(timeout)
         logger.debug("Received response for %r.", self)
@@ -233,15 +410,18 @@ class HTTPBatchWriter(BatchWriter[bytes]):
         port: int,
         user: str,
         password: str,
-        metrics: MetricsBackend,  # deprecated
+        metrics: MetricsBackend,
         statement: InsertStatement,
         encoding: Optional[str],
         options: Optional[Mapping[str, Any]] = None,
         chunk_size: Optional[int] = None,
         buffer_size: int = 0,
+        compression: Optional[str] = None,
     ):
         self.__pool = HTTPConnectionPool(host, port)
         self.__executor = ThreadPoolExecutor()
+        self.__metrics = metrics
+        self.__compression = compression
 
         self.__options = options if options is not None else {}
         self.__user = user
@@ -265,6 +445,7 @@ class HTTPBatchWriter(BatchWriter[bytes]):
             self.__buffer_size,
             self.__options,
             self.__chunk_size,
+            self.__compression,
         )
 
         for value in values:
@@ -272,3 +453,13 @@ class HTTPBatchWriter(BatchWriter[bytes]):
 
         batch.close()
         batch.join()
+
+        compression_stats = batch.get_compression_stats()
+        if compression_stats is not None:
+            self.__metrics.gauge("compression_ratio", compression_stats.get_ratio())
+            self.__metrics.timing(
+                "compression_cpu_ms", compression_stats.cpu_time * 1000
+            )
+            self.__metrics.increment(
+                "compressed_bytes", compression_stats.compressed_bytes
+            )
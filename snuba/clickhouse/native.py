@@ -5,17 +5,22 @@ import queue
 import random
 import re
 import time
+from abc import ABC, abstractmethod
 from contextlib import contextmanager
 from dataclasses import dataclass, field
 from datetime import date, datetime
 from functools import partial
 from io import StringIO
+from threading import Lock
 from typing import (
     Any,
     Generator,
+    Iterator,
     Mapping,
+    MutableSequence,
     Optional,
     Sequence,
+    Set,
     Tuple,
     TypedDict,
     Union,
@@ -29,7 +34,15 @@ from dateutil.tz import tz
 from snuba import environment, settings, state
 from snuba.clickhouse.errors import ClickhouseError
 from snuba.clickhouse.formatter.nodes import FormattedQuery
-from snuba.reader import Reader, Result, build_result_transformer
+from snuba.reader import (
+    ColumnarRows,
+    Reader,
+    Result,
+    Row,
+    StreamedRows,
+    build_result_transformer,
+)
+from snuba.utils.clock import Clock, SystemClock
 from snuba.utils.metrics.gauge import ThreadSafeGauge
 from snuba.utils.metrics.wrapper import MetricsWrapper
 
@@ -57,6 +70,12 @@ class ClickhouseResult:
     trace_output: str = ""
 
 
+@dataclass(frozen=True)
+class ClickhouseRowStream:
+    meta: Sequence[Any]
+    rows: Iterator[Sequence[Any]]
+
+
 @contextmanager
 def capture_logging() -> Generator[StringIO, None, None]:
     buffer = StringIO()
@@ -69,7 +88,134 @@ def capture_logging() -> Generator[StringIO, None, None]:
     buffer.close()
 
 
-class ClickhousePool(object):
+class ClickhouseQueryPool(ABC):
+    """
+    Executes queries over the native protocol. Implemented by the pool of
+    connections to a single host and by the pool that spreads the queries
+    over several replicas.
+    """
+
+    @abstractmethod
+    def execute(
+        self,
+        query: str,
+        params: Params = None,
+        with_column_types: bool = False,
+        query_id: Optional[str] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+        types_check: bool = False,
+        columnar: bool = False,
+        capture_trace: bool = False,
+    ) -> ClickhouseResult:
+        """
+        Execute a clickhouse query, retrying it if the connection fails.
+        """
+        raise NotImplementedError
+
+    def execute_robust(
+        self,
+        query: str,
+        params: Params = None,
+        with_column_types: bool = False,
+        query_id: Optional[str] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+        types_check: bool = False,
+        columnar: bool = False,
+        capture_trace: bool = False,
+    ) -> ClickhouseResult:
+        """
+        Execute a clickhouse query with a bit more tenacity. Make more retry
+        attempts, (infinite in the case of too many simultaneous queries
+        errors) and wait a second between retries.
+
+        This is by components which need to either complete their current
+        query successfully or else quit altogether. Note that each retry in this
+        loop will be doubled by the retry in execute()
+        """
+        total_attempts = 3
+        attempts_remaining = total_attempts
+
+        while True:
+            try:
+                return self.execute(
+                    query,
+                    params=params,
+                    with_column_types=with_column_types,
+                    query_id=query_id,
+                    settings=settings,
+                    types_check=types_check,
+                    columnar=columnar,
+                    capture_trace=capture_trace,
+                )
+            except (errors.NetworkError, errors.SocketTimeoutError, EOFError) as e:
+                # Try 3 times on connection issues.
+                logger.warning(
+                    "ClickHouse query execution failed: %s (%d tries left)",
+                    str(e),
+                    attempts_remaining,
+                )
+                attempts_remaining -= 1
+                if attempts_remaining <= 0:
+                    if isinstance(e, errors.Error):
+                        raise ClickhouseError(e.message, code=e.code) from e
+                    else:
+                        raise e
+                time.sleep(1)
+                continue
+            except ClickhouseError as e:
+                logger.warning(
+                    "ClickHouse query execution failed: %s (%d tries left)",
+                    str(e),
+                    attempts_remaining,
+                )
+                if e.code == errors.ErrorCodes.TOO_MANY_SIMULTANEOUS_QUERIES:
+                    attempts_remaining -= 1
+                    if attempts_remaining <= 0:
+                        raise e
+                    sleep_interval_seconds = state.get_config(
+                        "simultaneous_queries_sleep_seconds", 1
+                    )
+                    assert sleep_interval_seconds is not None
+                    # Linear backoff. Adds one second at each iteration.
+                    time.sleep(
+                        float(
+                            (total_attempts - attempts_remaining)
+                            * sleep_interval_seconds
+                        )
+                    )
+                    continue
+                else:
+                    # Quit immediately for other types of server errors.
+                    raise e
+            except errors.Error as e:
+                raise ClickhouseError(e.message, code=e.code) from e
+
+    @abstractmethod
+    def execute_iter(
+        self,
+        query: str,
+        query_id: Optional[str] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+    ) -> ClickhouseRowStream:
+        """
+        Execute a clickhouse query and return its rows as they are received.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def kill_query(self, query_id: str) -> None:
+        """
+        Ask the server to stop the query running with the given id, without
+        waiting for the query to stop.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def close(self) -> None:
+        raise NotImplementedError
+
+
+class ClickhousePool(ClickhouseQueryPool):
     FALLBACK_POOL_SIZE = 3
 
     def __init__(
@@ -270,83 +416,59 @@ class ClickhousePool(object):
 
         return ClickhouseResult()
 
-    def execute_robust(
+    def execute_iter(
         self,
         query: str,
-        params: Params = None,
-        with_column_types: bool = False,
         query_id: Optional[str] = None,
         settings: Optional[Mapping[str, Any]] = None,
-        types_check: bool = False,
-        columnar: bool = False,
-        capture_trace: bool = False,
-    ) -> ClickhouseResult:
+    ) -> ClickhouseRowStream:
         """
-        Execute a clickhouse query with a bit more tenacity. Make more retry
-        attempts, (infinite in the case of too many simultaneous queries
-        errors) and wait a second between retries.
+        Execute a clickhouse query and return its rows as they are received,
+        without any retry.
 
-        This is by components which need to either complete their current
-        query successfully or else quit altogether. Note that each retry in this
-        loop will be doubled by the retry in execute()
+        This returns once the column types are received. The connection is
+        held until all the rows have been read or the stream is closed. A
+        stream that is not read to the end leaves the remaining rows on its
+        connection, which is then disconnected.
         """
-        total_attempts = 3
-        attempts_remaining = total_attempts
+        stream = self.__stream_query(query, query_id, settings)
+        # Runs the query until its column types are received, from then on
+        # closing the stream returns the connection to the pool.
+        meta = next(stream)
+        return ClickhouseRowStream(meta=meta, rows=stream)
 
-        while True:
-            try:
-                return self.execute(
-                    query,
-                    params=params,
-                    with_column_types=with_column_types,
-                    query_id=query_id,
-                    settings=settings,
-                    types_check=types_check,
-                    columnar=columnar,
-                    capture_trace=capture_trace,
-                )
-            except (errors.NetworkError, errors.SocketTimeoutError, EOFError) as e:
-                # Try 3 times on connection issues.
-                logger.warning(
-                    "ClickHouse query execution failed: %s (%d tries left)",
-                    str(e),
-                    attempts_remaining,
-                )
-                attempts_remaining -= 1
-                if attempts_remaining <= 0:
-                    if isinstance(e, errors.Error):
-                        raise ClickhouseError(e.message, code=e.code) from e
-                    else:
-                        raise e
-                time.sleep(1)
-                continue
-            except ClickhouseError as e:
-                logger.warning(
-                    "ClickHouse query execution failed: %s (%d tries left)",
-                    str(e),
-                    attempts_remaining,
-                )
-                if e.code == errors.ErrorCodes.TOO_MANY_SIMULTANEOUS_QUERIES:
-                    attempts_remaining -= 1
-                    if attempts_remaining <= 0:
-                        raise e
-                    sleep_interval_seconds = state.get_config(
-                        "simultaneous_queries_sleep_seconds", 1
-                    )
-                    assert sleep_interval_seconds is not None
-                    # Linear backoff. Adds one second at each iteration.
-                    time.sleep(
-                        float(
-                            (total_attempts - attempts_remaining)
-                            * sleep_interval_seconds
-                        )
-                    )
-                    continue
-                else:
-                    # Quit immediately for other types of server errors.
-                    raise e
-            except errors.Error as e:
-                raise ClickhouseError(e.message, code=e.code) from e
+    def __stream_query(
+        self,
+        query: str,
+        query_id: Optional[str],
+        settings: Optional[Mapping[str, Any]],
+    ) -> Iterator[Any]:
+        conn = self.pool.get(block=True)
+        completed = False
+        try:
+            if conn is None:
+                self.__gauge.increment()
+                conn = self._create_conn()
+
+            rows = conn.execute_iter(
+                query, with_column_types=True, query_id=query_id, settings=settings
+            )
+            # The column types come before the rows.
+            yield next(rows, [])
+            yield from rows
+            completed = True
+        except errors.Error as e:
+            raise ClickhouseError(e.message, code=e.code) from e
+        finally:
+            if conn is not None and not completed:
+                conn.disconnect()
+            self.pool.put(conn, block=False)
+
+    def kill_query(self, query_id: str) -> None:
+        # Read only users can kill their own queries.
+        self.execute(
+            "KILL QUERY WHERE query_id = %(query_id)s ASYNC", {"query_id": query_id}
+        )
 
     def _create_conn(self, use_fallback_host: bool = False) -> Client:
         if use_fallback_host:
@@ -372,6 +494,281 @@ class ClickhousePool(object):
             pass
 
 
+# Errors that tell us the replica is down or overloaded, as opposed to
+# errors caused by the query itself.
+REPLICA_FAILURE_CODES = {
+    errors.ErrorCodes.NETWORK_ERROR,
+    errors.ErrorCodes.SOCKET_TIMEOUT,
+    errors.ErrorCodes.TOO_MANY_SIMULTANEOUS_QUERIES,
+}
+
+
+class ReplicaHealth:
+    """
+    What the ReplicaBalancedPool knows about one replica. Latency and error
+    rate are exponentially weighted moving averages so that recent queries
+    weigh more than old ones.
+    """
+
+    def __init__(self, pool: ClickhousePool) -> None:
+        self.pool = pool
+        self.name = f"{pool.host}:{pool.port}"
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.ejected = False
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.in_flight_gauge = ThreadSafeGauge(
+            metrics, "replica.in_flight", tags={"replica": self.name}
+        )
+
+    def get_admission_ratio(self, now: float, readmission_seconds: float) -> float:
+        """
+        Share of the queries the replica can receive. It grows linearly from
+        0 to 1 once an ejection is over, so a replica that comes back is not
+        flooded right away.
+        """
+        if self.ejections == 0 or readmission_seconds <= 0:
+            return 1.0
+        return min(1.0, max(0.0, (now - self.ejected_until) / readmission_seconds))
+
+    def get_score(self) -> float:
+        # Lower is better. The constant keeps replicas without any measured
+        # latency comparable on the queries in flight.
+        return (
+            (self.latency + 0.001)
+            * (self.in_flight + 1)
+            / max(1.0 - self.error_rate, 0.01)
+        )
+
+
+class ReplicaBalancedPool(ClickhouseQueryPool):
+    """
+    Spreads the queries over several replicas, each one with its own
+    ClickhousePool, instead of sending them all to a single host.
+
+    Each query goes to the best of two randomly picked replicas (power of two
+    choices), based on the latency, the error rate and the queries in flight
+    of each one. A replica whose error rate goes beyond max_error_rate is
+    ejected for ejection_seconds, doubled at every consecutive ejection up to
+    max_ejection_seconds, then gets a growing share of the traffic for
+    readmission_seconds. If a read only query fails because its replica is
+    down or overloaded, it is retried once on another replica. Other
+    statements are never retried, as they may have been applied already.
+    """
+
+    def __init__(
+        self,
+        replicas: Sequence[ClickhousePool],
+        clock: Clock = SystemClock(),
+        latency_decay: float = 0.2,
+        error_decay: float = 0.25,
+        max_error_rate: float = 0.5,
+        ejection_seconds: float = 5.0,
+        max_ejection_seconds: float = 300.0,
+        readmission_seconds: float = 30.0,
+    ) -> None:
+        assert replicas, "at least one replica is needed"
+        self.__replicas = [ReplicaHealth(replica) for replica in replicas]
+        self.__lock = Lock()
+        self.__clock = clock
+        self.__latency_decay = latency_decay
+        self.__error_decay = error_decay
+        self.__max_error_rate = max_error_rate
+        self.__ejection_seconds = ejection_seconds
+        self.__max_ejection_seconds = max_ejection_seconds
+        self.__readmission_seconds = readmission_seconds
+        # Only the statements that cannot have been applied are retried.
+        self.__read_only = all(
+            replica.client_settings.get("readonly") for replica in replicas
+        )
+
+        self.__available_gauge = ThreadSafeGauge(metrics, "replicas.available")
+        self.__available_gauge.increment(len(self.__replicas))
+
+    def __select(self, excluded: Set[str]) -> ReplicaHealth:
+        now = self.__clock.time()
+        with self.__lock:
+            candidates = []
+            for replica in self.__replicas:
+                if replica.ejected and now >= replica.ejected_until:
+                    replica.ejected = False
+                    self.__available_gauge.increment()
+                if (
+                    replica.name not in excluded
+                    and not replica.ejected
+                    and random.random()
+                    < replica.get_admission_ratio(now, self.__readmission_seconds)
+                ):
+                    candidates.append(replica)
+
+            if not candidates:
+                # Rather than failing, use the replica that was supposed to
+                # come back first.
+                candidates = [
+                    min(
+                        [r for r in self.__replicas if r.name not in excluded]
+                        or self.__replicas,
+                        key=lambda r: r.ejected_until,
+                    )
+                ]
+
+            if len(candidates) == 1:
+                selected = candidates[0]
+            else:
+                selected = min(
+                    random.sample(candidates, 2), key=ReplicaHealth.get_score
+                )
+            selected.in_flight += 1
+
+        selected.in_flight_gauge.increment()
+        return selected
+
+    def __record(
+        self, replica: ReplicaHealth, failed: bool, latency: Optional[float]
+    ) -> None:
+        now = self.__clock.time()
+        with self.__lock:
+            replica.in_flight -= 1
+            replica.error_rate += self.__error_decay * (
+                (1.0 if failed else 0.0) - replica.error_rate
+            )
+            if latency is not None:
+                replica.latency = (
+                    latency
+                    if replica.latency == 0.0
+                    else replica.latency
+                    + self.__latency_decay * (latency - replica.latency)
+                )
+
+            if failed and not replica.ejected:
+                if replica.error_rate >= self.__max_error_rate:
+                    replica.ejections += 1
+                    replica.ejected = True
+                    replica.ejected_until = now + min(
+                        self.__ejection_seconds * 2 ** min(replica.ejections - 1, 10),
+                        self.__max_ejection_seconds,
+                    )
+                    self.__available_gauge.decrement()
+                    metrics.increment("replica.ejected", tags={"replica": replica.name})
+                    logger.warning(
+                        "Ejecting ClickHouse replica %s until %s",
+                        replica.name,
+                        replica.ejected_until,
+                    )
+            elif (
+                not failed
+                and replica.ejections
+                and replica.error_rate < self.__max_error_rate / 2
+                and replica.get_admission_ratio(now, self.__readmission_seconds) >= 1.0
+            ):
+                # The replica is fully back, the next ejection starts from
+                # the shortest one again.
+                replica.ejections = 0
+
+        replica.in_flight_gauge.decrement()
+
+    def execute(
+        self,
+        query: str,
+        params: Params = None,
+        with_column_types: bool = False,
+        query_id: Optional[str] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+        types_check: bool = False,
+        columnar: bool = False,
+        capture_trace: bool = False,
+    ) -> ClickhouseResult:
+        excluded: Set[str] = set()
+        while True:
+            replica = self.__select(excluded)
+            start = self.__clock.time()
+            try:
+                result = replica.pool.execute(
+                    query,
+                    params=params,
+                    with_column_types=with_column_types,
+                    query_id=query_id,
+                    settings=settings,
+                    types_check=types_check,
+                    columnar=columnar,
+                    capture_trace=capture_trace,
+                )
+            except (
+                errors.NetworkError,
+                errors.SocketTimeoutError,
+                EOFError,
+                ClickhouseError,
+            ) as e:
+                if (
+                    isinstance(e, ClickhouseError)
+                    and e.code not in REPLICA_FAILURE_CODES
+                ):
+                    # The replica is fine, the query is not.
+                    self.__record(replica, False, None)
+                    raise
+
+                self.__record(replica, True, None)
+                excluded.add(replica.name)
+                if (
+                    not self.__read_only
+                    or len(excluded) > 1
+                    or len(excluded) == len(self.__replicas)
+                ):
+                    raise
+                metrics.increment("replica.failover", tags={"replica": replica.name})
+            except Exception:
+                self.__record(replica, False, None)
+                raise
+            else:
+                self.__record(replica, False, self.__clock.time() - start)
+                return result
+
+    def execute_iter(
+        self,
+        query: str,
+        query_id: Optional[str] = None,
+        settings: Optional[Mapping[str, Any]] = None,
+    ) -> ClickhouseRowStream:
+        # Streams are never retried on another replica, as some rows may
+        # have been sent already. The latency is the one of the first block.
+        replica = self.__select(set())
+        start = self.__clock.time()
+        try:
+            stream = replica.pool.execute_iter(
+                query, query_id=query_id, settings=settings
+            )
+        except (errors.NetworkError, errors.SocketTimeoutError, EOFError) as e:
+            self.__record(replica, True, None)
+            raise e
+        except ClickhouseError as e:
+            self.__record(replica, e.code in REPLICA_FAILURE_CODES, None)
+            raise e
+        except Exception:
+            self.__record(replica, False, None)
+            raise
+        else:
+            self.__record(replica, False, self.__clock.time() - start)
+            return stream
+
+    def kill_query(self, query_id: str) -> None:
+        # The replica running the query is not tracked, killing a query on
+        # the replicas that do not run it does nothing. A replica that is down
+        # does not prevent the query from being killed on the others.
+        for replica in self.__replicas:
+            try:
+                replica.pool.kill_query(query_id)
+            except Exception as e:
+                logger.warning(
+                    "Failed to kill query %s on %s: %s", query_id, replica.name, e
+                )
+
+    def close(self) -> None:
+        for replica in self.__replicas:
+            replica.pool.close()
+
+
 def transform_date(value: date) -> str:
     """
     Convert a timezone-naive date object into an ISO 8601 formatted date and
@@ -381,6 +778,9 @@ def transform_date(value: date) -> str:
     # just assume UTC. (Ideally, we'd have just left these as timezone naive to
     # begin with and not done this transformation at all, since the time
     # portion has no benefit or significance here.)
+    if type(value) is date:
+        # Same as formatting the UTC midnight datetime, without building it.
+        return f"{value.isoformat()}T00:00:00+00:00"
     return datetime(*value.timetuple()[:6]).replace(tzinfo=tz.tzutc()).isoformat()
 
 
@@ -390,7 +790,9 @@ def transform_datetime(value: datetime) -> str:
     and time string representation.
     """
     if value.tzinfo is None:
-        value = value.replace(tzinfo=tz.tzutc())
+        # Same as formatting the value with a UTC time zone, which is slow
+        # as the offset of the time zone is computed in Python.
+        return f"{value.isoformat()}+00:00"
     else:
         value = value.astimezone(tz.tzutc())
     return value.isoformat()
@@ -413,13 +815,34 @@ transform_column_types = build_result_transformer(
 
 
 class NativeDriverReader(Reader):
+    """
+    Reads results through the native protocol.
+
+    In columnar mode the driver returns a sequence of values per column
+    instead of a tuple per row. The types of the values are transformed
+    one column at a time and the rows are only built when the result is
+    serialized with `dump_result`. Columnar mode is enabled through the
+    `native_reader_columnar` runtime config unless `columnar` is given.
+    """
+
     def __init__(
-        self, cache_partition_id: Optional[str], client: ClickhousePool
+        self,
+        cache_partition_id: Optional[str],
+        client: ClickhouseQueryPool,
+        columnar: Optional[bool] = None,
     ) -> None:
         super().__init__(cache_partition_id=cache_partition_id)
         self.__client = client
+        self.__columnar = columnar
+
+    def __is_columnar(self) -> bool:
+        if self.__columnar is not None:
+            return self.__columnar
+        return state.get_config("native_reader_columnar", 0) == 1
 
-    def __transform_result(self, result: ClickhouseResult, with_totals: bool) -> Result:
+    def __transform_result(
+        self, result: ClickhouseResult, with_totals: bool, columnar: bool
+    ) -> Result:
         """
         Transform a native driver response into a response that is
         structurally similar to a ClickHouse-flavored JSON response.
@@ -433,20 +856,37 @@ class NativeDriverReader(Reader):
         # duplicated names are discarded at this stage.
         columns = {c[0]: i for i, c in enumerate(meta)}
 
-        data = [
-            {column: row[index] for column, index in columns.items()} for row in data
-        ]
+        totals: Optional[Row] = None
+        if columnar:
+            # The driver returns no column at all for an empty result.
+            values = [data[index] if data else () for index in columns.values()]
+            length = len(data[0]) if data else 0
+            if with_totals:
+                assert length > 0
+                totals = {
+                    column: column_values[-1]
+                    for column, column_values in zip(columns, values)
+                }
+                values = [column_values[:-1] for column_values in values]
+                length -= 1
+            rows: MutableSequence[Row] = ColumnarRows(list(columns), values, length)
+        else:
+            rows = [
+                {column: row[index] for column, index in columns.items()}
+                for row in data
+            ]
+            if with_totals:
+                assert len(rows) > 0
+                totals = rows.pop(-1)
 
         meta = [
             {"name": m[0], "type": m[1]} for m in [meta[i] for i in columns.values()]
         ]
 
         new_result: Result = {}
-        if with_totals:
-            assert len(data) > 0
-            totals = data.pop(-1)
+        if totals is not None:
             new_result = {
-                "data": data,
+                "data": rows,
                 "meta": meta,
                 "totals": totals,
                 "profile": profile,
@@ -454,7 +894,7 @@ class NativeDriverReader(Reader):
             }
         else:
             new_result = {
-                "data": data,
+                "data": rows,
                 "meta": meta,
                 "profile": profile,
                 "trace_output": result.trace_output,
@@ -483,6 +923,7 @@ class NativeDriverReader(Reader):
             self.__client.execute_robust if robust is True else self.__client.execute
         )
 
+        columnar = self.__is_columnar()
         return self.__transform_result(
             execute_func(
                 query.get_sql(),
@@ -490,6 +931,36 @@ class NativeDriverReader(Reader):
                 query_id=query_id,
                 settings=settings,
                 capture_trace=capture_trace,
+                columnar=columnar,
             ),
             with_totals=with_totals,
+            columnar=columnar,
+        )
+
+    def kill_query(self, query_id: str) -> None:
+        self.__client.kill_query(query_id)
+
+    def execute_stream(
+        self,
+        query: FormattedQuery,
+        settings: Optional[Mapping[str, str]] = None,
+    ) -> Result:
+        settings = {**settings} if settings is not None else {}
+        query_id = settings.pop("query_id", None)
+
+        stream = self.__client.execute_iter(
+            query.get_sql(), query_id=query_id, settings=settings
         )
+        # Duplicated names are discarded like in __transform_result.
+        columns = {c[0]: i for i, c in enumerate(stream.meta)}
+        result: Result = {
+            "data": StreamedRows(list(columns.items()), stream.rows),
+            "meta": [
+                {"name": stream.meta[i][0], "type": stream.meta[i][1]}
+                for i in columns.values()
+            ],
+            "profile": None,
+            "trace_output": "",
+        }
+        transform_column_types(result)
+        return result
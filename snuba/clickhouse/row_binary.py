@@ -0,0 +1,322 @@
+"""
+Serialization of rows in the Clickhouse RowBinary format.
+
+RowBinary is a positional format: every row contains all the columns of
+the insert statement, in order, and no column name or separator is sent
+on the wire. This makes each row far smaller and far cheaper to parse
+than JSONEachRow, but it also means the encoder has to know the exact
+type of each column in advance.
+
+Missing keys and None values for non nullable columns are encoded as
+the zero value of the column type (empty string, 0, epoch, zero UUID),
+which mirrors what Clickhouse does with JSONEachRow when it receives a
+null or omitted field. Columns relying on a server side DEFAULT
+expression are not supported, as that expression cannot be evaluated
+by the client.
+"""
+from __future__ import annotations
+
+import calendar
+import ipaddress
+import uuid
+from datetime import date, datetime
+from struct import Struct
+from struct import error as StructError
+from struct import pack
+from typing import Any, Callable, Mapping, Sequence
+
+from snuba.clickhouse import DATETIME_FORMAT
+from snuba.clickhouse.columns import (
+    UUID,
+    Array,
+    ColumnType,
+    Date,
+    DateTime,
+    FixedString,
+    FlattenedColumn,
+    Float,
+    IPv4,
+    IPv6,
+    Nullable,
+    String,
+    UInt,
+)
+
+ColumnWriter = Callable[[bytearray, Any], None]
+
+_UINT_STRUCTS: Mapping[int, Struct] = {
+    8: Struct("<B"),
+    16: Struct("<H"),
+    32: Struct("<I"),
+    64: Struct("<Q"),
+}
+
+_FLOAT_STRUCTS: Mapping[int, Struct] = {
+    32: Struct("<f"),
+    64: Struct("<d"),
+}
+
+_UINT32 = _UINT_STRUCTS[32]
+_UINT16 = _UINT_STRUCTS[16]
+_UUID = Struct("<QQ")
+_UINT64_MASK = (1 << 64) - 1
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def write_varint(buffer: bytearray, value: int) -> None:
+    """
+    Appends an unsigned LEB128 integer, which is how RowBinary encodes
+    string lengths and array sizes.
+    """
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _encode_string(value: Any) -> bytes:
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+
+def _write_string(buffer: bytearray, value: Any) -> None:
+    if value is None:
+        buffer.append(0)
+        return
+
+    encoded = _encode_string(value)
+    length = len(encoded)
+    if length < 0x80:
+        buffer.append(length)
+    else:
+        write_varint(buffer, length)
+    buffer += encoded
+
+
+def _build_struct_writer(
+    packer: Struct, convert: Callable[[Any], Any], default: Any
+) -> ColumnWriter:
+    pack_value = packer.pack
+
+    def write(buffer: bytearray, value: Any) -> None:
+        buffer += pack_value(convert(value) if value is not None else default)
+
+    return write
+
+
+def _to_timestamp(value: Any) -> int:
+    if isinstance(value, datetime):
+        # Naive datetimes are formatted as they are for JSONEachRow,
+        # which means Clickhouse interprets them in UTC.
+        return calendar.timegm(value.utctimetuple())
+    if isinstance(value, str):
+        return calendar.timegm(datetime.strptime(value, DATETIME_FORMAT).timetuple())
+    return int(value)
+
+
+def _to_day_number(value: Any) -> int:
+    if isinstance(value, date):
+        return value.toordinal() - _EPOCH_ORDINAL
+    if isinstance(value, str):
+        return date.fromisoformat(value).toordinal() - _EPOCH_ORDINAL
+    return int(value)
+
+
+def _write_uuid(buffer: bytearray, value: Any) -> None:
+    if value is None:
+        buffer += _UUID.pack(0, 0)
+        return
+
+    as_int = (value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))).int
+    # Clickhouse stores a UUID as two little endian UInt64, the most
+    # significant half first.
+    buffer += _UUID.pack(as_int >> 64, as_int & _UINT64_MASK)
+
+
+def _write_ipv6(buffer: bytearray, value: Any) -> None:
+    if value is None:
+        buffer += bytes(16)
+    else:
+        buffer += ipaddress.IPv6Address(value).packed
+
+
+def _build_fixed_string_writer(length: int) -> ColumnWriter:
+    def write(buffer: bytearray, value: Any) -> None:
+        if value is None:
+            buffer += bytes(length)
+            return
+
+        encoded = value if isinstance(value, bytes) else str(value).encode("utf-8")
+        if len(encoded) > length:
+            raise ValueError(f"value too long for FixedString({length})", value)
+        buffer += encoded.ljust(length, b"\x00")
+
+    return write
+
+
+def _build_array_writer(inner: ColumnWriter) -> ColumnWriter:
+    def write(buffer: bytearray, value: Any) -> None:
+        if not value:
+            buffer.append(0)
+            return
+
+        write_varint(buffer, len(value))
+        for item in value:
+            inner(buffer, item)
+
+    return write
+
+
+def _write_nullable_string(buffer: bytearray, value: Any) -> None:
+    if value is None:
+        buffer.append(1)
+        return
+
+    encoded = _encode_string(value)
+    length = len(encoded)
+    if length < 0x80:
+        buffer += b"\x00"
+        buffer.append(length)
+    else:
+        buffer.append(0)
+        write_varint(buffer, length)
+    buffer += encoded
+
+
+def _build_string_array_writer(nullable: bool) -> ColumnWriter:
+    # Arrays of strings are the bulk of most rows (tags, contexts, stack
+    # frames), so the string writer is inlined here.
+    null_value = 1 if nullable else 0
+
+    def write(buffer: bytearray, value: Any) -> None:
+        if not value:
+            buffer.append(0)
+            return
+
+        write_varint(buffer, len(value))
+        for item in value:
+            if item is None:
+                buffer.append(null_value)
+                continue
+            if nullable:
+                buffer.append(0)
+            encoded = _encode_string(item)
+            length = len(encoded)
+            if length < 0x80:
+                buffer.append(length)
+            else:
+                write_varint(buffer, length)
+            buffer += encoded
+
+    return write
+
+
+def _build_numeric_array_writer(format: str, fallback: ColumnWriter) -> ColumnWriter:
+    def write(buffer: bytearray, value: Any) -> None:
+        if not value:
+            buffer.append(0)
+            return
+
+        length = len(value)
+        write_varint(buffer, length)
+        try:
+            buffer += pack(f"<{length}{format}", *value)
+        except (StructError, TypeError):
+            # Values that need a conversion (strings, None) go through
+            # the type specific writer.
+            for item in value:
+                fallback(buffer, item)
+
+    return write
+
+
+def _build_nullable_writer(inner: ColumnWriter) -> ColumnWriter:
+    def write(buffer: bytearray, value: Any) -> None:
+        if value is None:
+            buffer.append(1)
+        else:
+            buffer.append(0)
+            inner(buffer, value)
+
+    return write
+
+
+def _build_raw_writer(column_type: ColumnType[Any]) -> ColumnWriter:
+    if isinstance(column_type, String):
+        return _write_string
+    if isinstance(column_type, UInt):
+        return _build_struct_writer(_UINT_STRUCTS[column_type.size], int, 0)
+    if isinstance(column_type, Float):
+        return _build_struct_writer(_FLOAT_STRUCTS[column_type.size], float, 0.0)
+    if isinstance(column_type, DateTime):
+        return _build_struct_writer(_UINT32, _to_timestamp, 0)
+    if isinstance(column_type, Date):
+        return _build_struct_writer(_UINT16, _to_day_number, 0)
+    if isinstance(column_type, UUID):
+        return _write_uuid
+    if isinstance(column_type, IPv4):
+        return _build_struct_writer(
+            _UINT32, lambda value: int(ipaddress.IPv4Address(value)), 0
+        )
+    if isinstance(column_type, IPv6):
+        return _write_ipv6
+    if isinstance(column_type, FixedString):
+        return _build_fixed_string_writer(column_type.length)
+    if isinstance(column_type, Array):
+        inner_type = column_type.inner_type
+        if isinstance(inner_type, String):
+            return _build_string_array_writer(inner_type.has_modifier(Nullable))
+        inner_writer = build_column_writer(inner_type)
+        if inner_type.has_modifier(Nullable):
+            return _build_array_writer(inner_writer)
+        if isinstance(inner_type, UInt):
+            return _build_numeric_array_writer(
+                _UINT_STRUCTS[inner_type.size].format[1:], inner_writer
+            )
+        if isinstance(inner_type, Float):
+            return _build_numeric_array_writer(
+                _FLOAT_STRUCTS[inner_type.size].format[1:], inner_writer
+            )
+        return _build_array_writer(inner_writer)
+
+    raise TypeError("column type not supported by RowBinary encoding", column_type)
+
+
+def build_column_writer(column_type: ColumnType[Any]) -> ColumnWriter:
+    """
+    Builds the function that appends a value of the provided column type
+    to a RowBinary buffer.
+    """
+    if column_type.has_modifier(Nullable):
+        if isinstance(column_type, String):
+            return _write_nullable_string
+        return _build_nullable_writer(_build_raw_writer(column_type))
+    return _build_raw_writer(column_type)
+
+
+class RowBinaryRowBuilder:
+    """
+    Encodes rows as a sequence of typed values following the order of
+    the columns provided. That order has to be the same as the one of
+    the columns in the insert statement.
+    """
+
+    def __init__(self, columns: Sequence[FlattenedColumn]) -> None:
+        self.__columns = columns
+        self.__writers = [
+            (column.flattened, build_column_writer(column.type)) for column in columns
+        ]
+
+    def __reduce__(self) -> Any:
+        # The column writers are closures, which cannot be pickled. They
+        # are rebuilt from the columns instead when an encoder is sent to
+        # a subprocess.
+        return (type(self), (self.__columns,))
+
+    def get_column_names(self) -> Sequence[str]:
+        return [name for name, _ in self.__writers]
+
+    def write_row(self, buffer: bytearray, row: Mapping[str, Any]) -> None:
+        for name, writer in self.__writers:
+            writer(buffer, row.get(name))
@@ -17,9 +17,15 @@ from typing import (
 )
 
 from snuba import settings
+from snuba.clickhouse.async_http import AsyncClickhousePool, AsyncHTTPReader
 from snuba.clickhouse.escaping import escape_string
 from snuba.clickhouse.http import HTTPBatchWriter, InsertStatement, JSONRow
-from snuba.clickhouse.native import ClickhousePool, NativeDriverReader
+from snuba.clickhouse.native import (
+    ClickhousePool,
+    ClickhouseQueryPool,
+    NativeDriverReader,
+    ReplicaBalancedPool,
+)
 from snuba.clusters.storage_sets import DEV_STORAGE_SETS, StorageSetKey
 from snuba.reader import Reader
 from snuba.utils.metrics import MetricsBackend
@@ -139,11 +145,17 @@ ClickhouseWriterOptions = Optional[Mapping[str, Any]]
 
 
 CacheKey = Tuple[ClickhouseNode, ClickhouseClientSettings, str, str, str]
+ReplicasCacheKey = Tuple[
+    Tuple[ClickhouseNode, ...], ClickhouseClientSettings, str, str, str
+]
 
 
 class ConnectionCache:
     def __init__(self) -> None:
         self.__cache: MutableMapping[CacheKey, ClickhousePool] = {}
+        self.__replicas_cache: MutableMapping[
+            ReplicasCacheKey, ClickhouseQueryPool
+        ] = {}
         self.__lock = Lock()
 
     def get_node_connection(
@@ -170,6 +182,25 @@ class ConnectionCache:
 
             return self.__cache[cache_key]
 
+    def get_replicas_connection(
+        self,
+        client_settings: ClickhouseClientSettings,
+        nodes: Sequence[ClickhouseNode],
+        user: str,
+        password: str,
+        database: str,
+    ) -> ClickhouseQueryPool:
+        replicas = [
+            self.get_node_connection(client_settings, node, user, password, database)
+            for node in nodes
+        ]
+        with self.__lock:
+            cache_key = (tuple(nodes), client_settings, user, password, database)
+            if cache_key not in self.__replicas_cache:
+                self.__replicas_cache[cache_key] = ReplicaBalancedPool(replicas)
+
+            return self.__replicas_cache[cache_key]
+
 
 connection_cache = ConnectionCache()
 
@@ -191,6 +222,12 @@ class ClickhouseCluster(Cluster[ClickhouseWriterOptions]):
     If we are operating a multi node cluster we need to know the full set of shards
     and replicas on which to run our commands. This is provided by the `get_local_nodes()`
     and `get_distributed_nodes()` methods.
+
+    When `query_replicas` ("host:port" strings) are provided, the queries of
+    the reader are spread over them with a ReplicaBalancedPool instead of
+    being sent to the query node. The connections returned by
+    `get_query_connection`, used by migrations, replacements, cleanups and
+    optimizations, keep using the query node.
     """
 
     def __init__(
@@ -207,6 +244,9 @@ class ClickhouseCluster(Cluster[ClickhouseWriterOptions]):
         cluster_name: Optional[str] = None,
         distributed_cluster_name: Optional[str] = None,
         cache_partition_id: Optional[str] = None,
+        # Compression (lz4 or zstd) of the inserts sent over HTTP.
+        insert_compression: Optional[str] = None,
+        query_replicas: Optional[Sequence[str]] = None,
     ):
         super().__init__(storage_sets)
         self.__query_node = ClickhouseNode(host, port)
@@ -220,6 +260,11 @@ class ClickhouseCluster(Cluster[ClickhouseWriterOptions]):
         self.__reader: Optional[Reader] = None
         self.__connection_cache = connection_cache
         self.__cache_partition_id = cache_partition_id
+        self.__insert_compression = insert_compression
+        self.__query_replicas = [
+            ClickhouseNode(host, int(port))
+            for host, port in (replica.split(":") for replica in query_replicas or [])
+        ]
 
     def __str__(self) -> str:
         return str(self.__query_node)
@@ -235,10 +280,25 @@ class ClickhouseCluster(Cluster[ClickhouseWriterOptions]):
         client_settings: ClickhouseClientSettings,
     ) -> ClickhousePool:
         """
-        Get a connection to the query node
+        Get a connection to the query node.
         """
         return self.get_node_connection(client_settings, self.__query_node)
 
+    def get_reader_connection(self) -> ClickhouseQueryPool:
+        """
+        Get the connection the reader executes its queries on: the query
+        replicas if any, the query node otherwise.
+        """
+        if self.__query_replicas:
+            return self.__connection_cache.get_replicas_connection(
+                ClickhouseClientSettings.QUERY,
+                self.__query_replicas,
+                self.__user,
+                self.__password,
+                self.__database,
+            )
+        return self.get_query_connection(ClickhouseClientSettings.QUERY)
+
     def get_node_connection(
         self,
         client_settings: ClickhouseClientSettings,
@@ -262,10 +322,30 @@ class ClickhouseCluster(Cluster[ClickhouseWriterOptions]):
         if not self.__reader:
             self.__reader = NativeDriverReader(
                 cache_partition_id=self.__cache_partition_id,
-                client=self.get_query_connection(ClickhouseClientSettings.QUERY),
+                client=self.get_reader_connection(),
             )
         return self.__reader
 
+    def build_async_reader(self, max_pool_size: int) -> AsyncHTTPReader:
+        """
+        Builds a reader executing queries asynchronously on the query node,
+        through the HTTP interface, over at most `max_pool_size` connections.
+        """
+        client_settings, timeout = ClickhouseClientSettings.QUERY.value
+        return AsyncHTTPReader(
+            cache_partition_id=self.__cache_partition_id,
+            client=AsyncClickhousePool(
+                self.__query_node.host_name,
+                self.__http_port,
+                self.__user,
+                self.__password,
+                self.__database,
+                max_pool_size,
+                send_receive_timeout=timeout,
+                client_settings=client_settings,
+            ),
+        )
+
     def get_batch_writer(
         self,
         metrics: MetricsBackend,
@@ -286,6 +366,9 @@ class ClickhouseCluster(Cluster[ClickhouseWriterOptions]):
             options=options,
             chunk_size=chunk_size,
             buffer_size=buffer_size,
+            # Data that is already encoded (like bulk loads of gzipped
+            # files) is sent as it is.
+            compression=self.__insert_compression if encoding is None else None,
         )
 
     def is_single_node(self) -> bool:
@@ -354,6 +437,8 @@ CLUSTERS = [
         if "distributed_cluster_name" in cluster
         else None,
         cache_partition_id=cluster.get("cache_partition_id"),
+        insert_compression=cluster.get("insert_compression"),
+        query_replicas=cluster.get("query_replicas"),
     )
     for cluster in settings.CLUSTERS
 ]
@@ -391,6 +476,16 @@ class UndefinedClickhouseCluster(SerializableException):
     pass
 
 
+def get_reader_cluster(reader: Reader) -> Optional[ClickhouseCluster]:
+    """
+    Returns the cluster the reader was obtained from, if any.
+    """
+    for cluster in CLUSTERS:
+        if cluster.get_reader() is reader:
+            return cluster
+    return None
+
+
 def get_cluster(storage_set_key: StorageSetKey) -> ClickhouseCluster:
     """Return a clickhouse cluster for a storage set key.
 
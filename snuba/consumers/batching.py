@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+from snuba.utils.metrics import MetricsBackend
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BatchLimits:
+    """
+    A batch is closed as soon as it reaches either of these limits.
+    """
+
+    max_batch_size: int
+    max_batch_time: float  # seconds
+
+
+@dataclass(frozen=True)
+class BatchObservation:
+    """
+    What was observed while writing a batch.
+
+    `latency` is the time between the oldest message of the batch being
+    produced and the batch being written. `lag` is the time between the
+    newest message of the batch being produced and the batch being
+    closed, which is how far behind the consumer was at that point.
+    """
+
+    size: int
+    write_time: float
+    latency: float
+    lag: float
+
+
+class BatchSizePolicy(ABC):
+    """
+    Decides the limits of the batches a collect step builds. The limits
+    are read when a batch is created and every written batch is reported
+    back to the policy.
+    """
+
+    @abstractmethod
+    def get_limits(self) -> BatchLimits:
+        raise NotImplementedError
+
+    @abstractmethod
+    def record(self, observation: BatchObservation) -> None:
+        raise NotImplementedError
+
+
+class FixedBatchSizePolicy(BatchSizePolicy):
+    def __init__(self, limits: BatchLimits) -> None:
+        self.__limits = limits
+
+    def get_limits(self) -> BatchLimits:
+        return self.__limits
+
+    def record(self, observation: BatchObservation) -> None:
+        pass
+
+
+class AdaptiveBatchSizePolicy(BatchSizePolicy):
+    """
+    Grows and shrinks the batch limits between a lower and an upper bound
+    depending on how the consumer keeps up with the topic.
+
+    When the consumer lags behind by more than the target latency, the
+    limits are multiplied by `growth_factor`, since larger batches make
+    inserts cheaper per row and the consumer catches up faster. When it
+    keeps up but batches are written with a latency higher than the
+    target, or take longer to write than to collect, the limits are
+    multiplied by `shrink_factor`. Otherwise they are left as they are.
+
+    The policy starts from the lower bound, which is what a consumer that
+    keeps up with the topic is expected to need.
+    """
+
+    def __init__(
+        self,
+        min_limits: BatchLimits,
+        max_limits: BatchLimits,
+        target_latency: float,
+        metrics: MetricsBackend,
+        growth_factor: float = 2.0,
+        shrink_factor: float = 0.5,
+    ) -> None:
+        assert min_limits.max_batch_size <= max_limits.max_batch_size
+        assert min_limits.max_batch_time <= max_limits.max_batch_time
+        assert growth_factor > 1.0 and 0.0 < shrink_factor < 1.0
+
+        self.__min_limits = min_limits
+        self.__max_limits = max_limits
+        self.__target_latency = target_latency
+        self.__metrics = metrics
+        self.__growth_factor = growth_factor
+        self.__shrink_factor = shrink_factor
+        self.__limits = min_limits
+
+    def get_limits(self) -> BatchLimits:
+        return self.__limits
+
+    def __scale(self, factor: float) -> BatchLimits:
+        return BatchLimits(
+            max_batch_size=min(
+                max(
+                    int(self.__limits.max_batch_size * factor),
+                    self.__min_limits.max_batch_size,
+                ),
+                self.__max_limits.max_batch_size,
+            ),
+            max_batch_time=min(
+                max(
+                    self.__limits.max_batch_time * factor,
+                    self.__min_limits.max_batch_time,
+                ),
+                self.__max_limits.max_batch_time,
+            ),
+        )
+
+    def record(self, observation: BatchObservation) -> None:
+        if observation.lag > self.__target_latency:
+            decision, reason = "grow", "lag"
+            limits = self.__scale(self.__growth_factor)
+        elif observation.latency > self.__target_latency:
+            decision, reason = "shrink", "latency"
+            limits = self.__scale(self.__shrink_factor)
+        elif observation.write_time > self.__limits.max_batch_time:
+            decision, reason = "shrink", "write_time"
+            limits = self.__scale(self.__shrink_factor)
+        else:
+            decision, reason = "hold", "none"
+            limits = self.__limits
+
+        if limits != self.__limits:
+            logger.debug(
+                "Changing batch limits from %r to %r (%s)",
+                self.__limits,
+                limits,
+                reason,
+            )
+            self.__limits = limits
+
+        self.__metrics.increment(
+            "decision", tags={"decision": decision, "reason": reason}
+        )
+        self.__metrics.timing("observed_lag_ms", observation.lag * 1000)
+        self.__metrics.timing("observed_latency_ms", observation.latency * 1000)
+        self.__metrics.gauge("max_batch_size", limits.max_batch_size)
+        self.__metrics.gauge("max_batch_time_ms", limits.max_batch_time * 1000)
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Mapping, MutableMapping, Optional, Tuple
+
+from arroyo import Message, Partition
+from arroyo.processing.strategies import ProcessingStrategy as ProcessingStep
+from arroyo.types import Position, TPayload
+
+from snuba.consumers.batching import BatchLimits, BatchObservation, BatchSizePolicy
+from snuba.utils.metrics import MetricsBackend
+
+logger = logging.getLogger(__name__)
+
+
+class PipelinedBatch:
+    """
+    Keeps track of the step a batch is written with, its limits, its size
+    and the offsets that can be committed once the step has been joined.
+    """
+
+    def __init__(self, step: ProcessingStep[TPayload], limits: BatchLimits) -> None:
+        self.step = step
+        self.limits = limits
+        self.created = time.time()
+        self.length = 0
+        self.offsets: MutableMapping[Partition, Position] = {}
+        self.oldest_timestamp: Optional[float] = None
+        self.newest_timestamp: Optional[float] = None
+        self.lag = 0.0
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__}: {self.length} messages>"
+
+    def submit(self, message: Message[TPayload]) -> None:
+        self.step.submit(message)
+        self.length += 1
+        self.offsets[message.partition] = Position(
+            message.next_offset, message.timestamp
+        )
+        timestamp = message.timestamp.timestamp()
+        if self.oldest_timestamp is None or timestamp < self.oldest_timestamp:
+            self.oldest_timestamp = timestamp
+        if self.newest_timestamp is None or timestamp > self.newest_timestamp:
+            self.newest_timestamp = timestamp
+
+    def close(self) -> None:
+        if self.newest_timestamp is not None:
+            self.lag = max(time.time() - self.newest_timestamp, 0.0)
+
+    def duration(self) -> float:
+        return time.time() - self.created
+
+
+class PipelinedCollectStep(ProcessingStep[TPayload]):
+    """
+    Collects messages into batches like the arroyo CollectStep, but closes
+    and joins the batch steps on a thread pool so that up to
+    `max_batches_in_flight` batches are written concurrently while the
+    following batch keeps being filled.
+
+    Offsets are only committed once the batch they belong to and all the
+    batches that came before it have been joined successfully. Batches are
+    always completed in order, so a slow write never lets the offsets of a
+    later batch be committed first. If `join` times out or the step is
+    terminated, the batches that are still being written are not committed.
+
+    When the maximum number of batches is in flight, closing the next batch
+    blocks until the oldest one is done. The time spent waiting is the back
+    pressure the writes exercise on the consumer and it is recorded as
+    `backpressure_wait_ms`.
+
+    The size and time limits of each batch are provided by the batch size
+    policy when the batch is created, and every completed batch is
+    reported back to the policy.
+    """
+
+    def __init__(
+        self,
+        step_factory: Callable[[], ProcessingStep[TPayload]],
+        commit_function: Callable[[Mapping[Partition, Position]], None],
+        batch_size_policy: BatchSizePolicy,
+        max_batches_in_flight: int,
+        metrics: MetricsBackend,
+    ) -> None:
+        assert max_batches_in_flight > 0, "at least one batch must be in flight"
+
+        self.__step_factory = step_factory
+        self.__commit_function = commit_function
+        self.__batch_size_policy = batch_size_policy
+        self.__max_batches_in_flight = max_batches_in_flight
+        self.__metrics = metrics
+
+        self.__batch: Optional[PipelinedBatch] = None
+        self.__in_flight: Deque[Tuple[PipelinedBatch, Future[float]]] = deque()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max_batches_in_flight,
+            thread_name_prefix="pipelined-collect",
+        )
+        self.__closed = False
+        self.__terminated = False
+
+    @staticmethod
+    def __write_batch(batch: PipelinedBatch) -> float:
+        start = time.time()
+        batch.step.close()
+        batch.step.join()
+        return time.time() - start
+
+    def __complete_oldest_batch(self, timeout: Optional[float] = None) -> None:
+        batch, future = self.__in_flight[0]
+        # If the write failed the exception is raised here and neither this
+        # batch nor any of the following ones gets committed.
+        duration = future.result(timeout)
+        if self.__terminated:
+            # The step was terminated while this thread was waiting on the
+            # write, the batch must not be committed anymore.
+            return
+        self.__in_flight.popleft()
+
+        assert batch.oldest_timestamp is not None
+        self.__batch_size_policy.record(
+            BatchObservation(
+                size=batch.length,
+                write_time=duration,
+                latency=max(time.time() - batch.oldest_timestamp, 0.0),
+                lag=batch.lag,
+            )
+        )
+
+        logger.debug("Committing offsets: %r", batch.offsets)
+        self.__commit_function(batch.offsets)
+        logger.info("Completed processing %r in %0.4f seconds.", batch, duration)
+
+    def __complete_done_batches(self) -> None:
+        while self.__in_flight and self.__in_flight[0][1].done():
+            self.__complete_oldest_batch()
+
+    def __close_and_reset_batch(self) -> None:
+        assert self.__batch is not None
+
+        self.__batch.close()
+        self.__complete_done_batches()
+        if len(self.__in_flight) >= self.__max_batches_in_flight:
+            wait_start = time.time()
+            while len(self.__in_flight) >= self.__max_batches_in_flight:
+                self.__complete_oldest_batch()
+            self.__metrics.timing(
+                "backpressure_wait_ms", (time.time() - wait_start) * 1000
+            )
+
+        self.__in_flight.append(
+            (self.__batch, self.__executor.submit(self.__write_batch, self.__batch))
+        )
+        self.__metrics.gauge("batches_in_flight", len(self.__in_flight))
+        self.__batch = None
+
+    def poll(self) -> None:
+        self.__complete_done_batches()
+
+        if self.__batch is None:
+            return
+
+        self.__batch.step.poll()
+
+        if self.__batch.length >= self.__batch.limits.max_batch_size:
+            logger.debug("Size limit reached, closing %r...", self.__batch)
+            self.__close_and_reset_batch()
+        elif self.__batch.duration() >= self.__batch.limits.max_batch_time:
+            logger.debug("Time limit reached, closing %r...", self.__batch)
+            self.__close_and_reset_batch()
+
+    def submit(self, message: Message[TPayload]) -> None:
+        assert not self.__closed
+
+        if self.__batch is None:
+            self.__batch = PipelinedBatch(
+                self.__step_factory(), self.__batch_size_policy.get_limits()
+            )
+
+        self.__batch.submit(message)
+
+    def close(self) -> None:
+        self.__closed = True
+
+        if self.__batch is not None:
+            logger.debug("Closing %r...", self.__batch)
+            self.__close_and_reset_batch()
+
+    def terminate(self) -> None:
+        if self.__terminated:
+            return
+
+        self.__closed = True
+        self.__terminated = True
+
+        if self.__batch is not None:
+            self.__batch.step.terminate()
+            self.__batch = None
+
+        in_flight = list(self.__in_flight)
+        self.__in_flight.clear()
+        for batch, future in in_flight:
+            future.cancel()
+            batch.step.terminate()
+
+        self.__executor.shutdown(wait=False)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        start = time.time()
+
+        while self.__in_flight and not self.__terminated:
+            if timeout is not None:
+                remaining: Optional[float] = max(timeout - (time.time() - start), 0)
+            else:
+                remaining = None
+
+            try:
+                self.__complete_oldest_batch(remaining)
+            except concurrent.futures.TimeoutError:
+                logger.warning(
+                    "Timed out waiting for %d batches to be written, "
+                    "their offsets are not committed.",
+                    len(self.__in_flight),
+                )
+                return
+            except concurrent.futures.CancelledError:
+                if self.__terminated:
+                    return
+                raise
+
+        if not self.__terminated:
+            self.__executor.shutdown()
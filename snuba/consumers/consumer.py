@@ -1,8 +1,11 @@
+from __future__ import annotations
+
 import itertools
 import logging
 import time
+from array import array
 from collections import defaultdict, deque
-from concurrent.futures import Future
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from pickle import PickleBuffer
@@ -10,6 +13,7 @@ from typing import (
     Any,
     Callable,
     Deque,
+    Iterator,
     List,
     Mapping,
     MutableMapping,
@@ -31,15 +35,22 @@ from arroyo.processing.strategies import ProcessingStrategy
 from arroyo.processing.strategies import ProcessingStrategy as ProcessingStep
 from arroyo.processing.strategies import ProcessingStrategyFactory
 from arroyo.processing.strategies.streaming import FilterStep, TransformStep
-from arroyo.processing.strategies.streaming.factory import (
-    ConsumerStrategyFactory,
-    StreamMessageFilter,
-)
+from arroyo.processing.strategies.streaming.factory import StreamMessageFilter
 from arroyo.types import Position
 from confluent_kafka import Producer as ConfluentKafkaProducer
 
-from snuba.clickhouse.http import JSONRow, JSONRowEncoder, ValuesRowEncoder
+from snuba.clickhouse.http import (
+    JSONRow,
+    JSONRowEncoder,
+    RowBinaryRowEncoder,
+    RowEncoder,
+    RowOffsets,
+    ValuesRowEncoder,
+)
+from snuba.consumers.batching import BatchSizePolicy
+from snuba.consumers.strategy_factory import PipelinedConsumerStrategyFactory
 from snuba.consumers.types import KafkaMessageMetadata
+from snuba.datasets.schemas.tables import WriteFormat
 from snuba.datasets.storage import WritableTableStorage
 from snuba.datasets.storages import StorageKey, are_writes_identical
 from snuba.datasets.storages.factory import get_writable_storage
@@ -51,27 +62,60 @@ from snuba.processor import (
     ReplacementBatch,
 )
 from snuba.utils.metrics import MetricsBackend
+from snuba.utils.metrics.backends.dummy import DummyMetricsBackend
 from snuba.utils.metrics.wrapper import MetricsWrapper
 from snuba.utils.streams.configuration_builder import build_kafka_producer_configuration
-from snuba.writer import BatchWriter, MockBatchWriter
+from snuba.writer import BatchWriter, MockBatchWriter, WriterTableRow
 
 logger = logging.getLogger("snuba.consumer")
 
 
 class BytesInsertBatch(NamedTuple):
-    rows: Sequence[bytes]
+    """
+    The rows produced by processing one message, already encoded in the
+    insert format of the storage and packed in a single buffer. `offsets`
+    holds the end offset of each row in the buffer, so the buffer can be
+    written as it is and still be split into rows when needed.
+    """
+
+    data: bytes
+    offsets: RowOffsets
     origin_timestamp: Optional[datetime]
 
+    @classmethod
+    def encode(
+        cls,
+        encoder: RowEncoder,
+        rows: Sequence[WriterTableRow],
+        origin_timestamp: Optional[datetime],
+    ) -> "BytesInsertBatch":
+        offsets = array("I")
+        data = encoder.encode_batch(rows, offsets)
+        return cls(data, offsets, origin_timestamp)
+
+    @property
+    def row_count(self) -> int:
+        return len(self.offsets)
+
+    def iter_rows(self) -> Iterator[bytes]:
+        start = 0
+        for end in self.offsets:
+            yield self.data[start:end]
+            start = end
+
     def __reduce_ex__(
         self, protocol: int
-    ) -> Tuple[Any, Tuple[Sequence[Any], Optional[datetime]]]:
+    ) -> Tuple[Any, Tuple[Any, RowOffsets, Optional[datetime]]]:
+        # The offsets are small and pickled in band, the data is sent as
+        # a single out of band buffer, which the parallel transform step
+        # copies through its shared memory blocks.
         if protocol >= 5:
             return (
                 type(self),
-                ([PickleBuffer(row) for row in self.rows], self.origin_timestamp),
+                (PickleBuffer(self.data), self.offsets, self.origin_timestamp),
             )
         else:
-            return type(self), (self.rows, self.origin_timestamp)
+            return type(self), (self.data, self.offsets, self.origin_timestamp)
 
 
 class InsertBatchWriter(ProcessingStep[BytesInsertBatch]):
@@ -97,11 +141,7 @@ class InsertBatchWriter(ProcessingStep[BytesInsertBatch]):
             return
 
         write_start = time.time()
-        self.__writer.write(
-            itertools.chain.from_iterable(
-                message.payload.rows for message in self.__messages
-            )
-        )
+        self.__writer.write(message.payload.data for message in self.__messages)
         write_finish = time.time()
 
         max_latency: Optional[float] = None
@@ -139,7 +179,7 @@ class InsertBatchWriter(ProcessingStep[BytesInsertBatch]):
             )
 
         self.__metrics.timing("batch_write_ms", (write_finish - write_start) * 1000)
-        rows = sum(len(message.payload.rows) for message in self.__messages)
+        rows = sum(message.payload.row_count for message in self.__messages)
         self.__metrics.increment("batch_write_msgs", rows)
 
         logger.debug(
@@ -322,6 +362,35 @@ def get_values_row_encoder(storage_key: StorageKey) -> ValuesRowEncoder:
     return values_row_encoders[storage_key]
 
 
+row_binary_encoders: MutableMapping[StorageKey, RowBinaryRowEncoder] = dict()
+
+
+def get_row_binary_encoder(storage_key: StorageKey) -> RowBinaryRowEncoder:
+    from snuba.datasets.storages.factory import get_writable_storage
+
+    if storage_key not in row_binary_encoders:
+        table_writer = get_writable_storage(storage_key).get_table_writer()
+        row_binary_encoders[storage_key] = RowBinaryRowEncoder(
+            table_writer.get_writeable_flattened_columns()
+        )
+
+    return row_binary_encoders[storage_key]
+
+
+def get_insert_row_encoder(storage_key: StorageKey) -> RowEncoder:
+    """
+    Returns the encoder for the rows of an InsertBatch that matches the
+    format of the insert statement built by the storage table writer.
+    """
+    from snuba.datasets.storages.factory import get_writable_storage
+
+    table_writer = get_writable_storage(storage_key).get_table_writer()
+    if table_writer.get_write_format() == WriteFormat.ROW_BINARY:
+        return get_row_binary_encoder(storage_key)
+    else:
+        return json_row_encoder
+
+
 def build_batch_writer(
     table_writer: TableWriter,
     metrics: MetricsBackend,
@@ -332,15 +401,14 @@ def build_batch_writer(
     assert not (replacements_producer is None) ^ (replacements_topic is None)
     supports_replacements = replacements_producer is not None
 
+    insert_metrics = MetricsWrapper(metrics, "insertions")
     writer = table_writer.get_batch_writer(
-        metrics,
+        insert_metrics,
         {"load_balancing": "in_order", "insert_distributed_sync": 1},
     )
 
     def build_writer() -> ProcessedMessageBatchWriter:
-        insert_batch_writer = InsertBatchWriter(
-            writer, MetricsWrapper(metrics, "insertions")
-        )
+        insert_batch_writer = InsertBatchWriter(writer, insert_metrics)
 
         replacement_batch_writer: Optional[ReplacementBatchWriter]
         if supports_replacements:
@@ -419,7 +487,7 @@ class DeadLetterStep(
         kafka_payloads: List[KafkaPayload] = []
         storage_key, payload = message.payload
         if isinstance(payload, BytesInsertBatch):
-            for row in payload.rows:
+            for row in payload.iter_rows():
                 kafka_payloads.append(
                     KafkaPayload(storage_key.value.encode("utf-8"), row, [])
                 )
@@ -477,11 +545,34 @@ class DeadLetterStep(
                     )
 
 
+def build_multistorage_executor(storages: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=max(storages, 1),
+        thread_name_prefix="multistorage-collector",
+    )
+
+
 class MultistorageCollector(
     ProcessingStep[
         Sequence[Tuple[StorageKey, Union[None, BytesInsertBatch, ReplacementBatch]]]
     ]
 ):
+    """
+    Routes the processed messages to the writer of each storage.
+
+    The writers of all the storages are closed (which is when the inserts
+    are sent) and joined at the same time on a thread pool, so flushing a
+    batch takes as long as the slowest storage rather than the sum of all
+    of them. A collector is built for every batch, so the pool is usually
+    provided by the strategy factory and shared by all of them. Without an
+    `executor` the collector creates a pool with a thread per storage and
+    shuts it down once it is joined or terminated, or when closing it fails.
+
+    Errors are only handled once all the writers are done. Messages of a
+    storage in `ignore_errors` that failed to be written are sent to the
+    dead letter step from the consumer thread, any other error is raised.
+    """
+
     def __init__(
         self,
         steps: Mapping[
@@ -494,9 +585,12 @@ class MultistorageCollector(
             ]
         ],
         ignore_errors: Optional[Set[StorageKey]] = None,
+        metrics: Optional[MetricsBackend] = None,
+        executor: Optional[Executor] = None,
     ):
         self.__steps = steps
         self.__closed = False
+        self.__failed = False
         self.__ignore_errors = ignore_errors
         self.__dead_letter_step = dead_letter_step
         self.__messages: MutableMapping[
@@ -508,6 +602,15 @@ class MultistorageCollector(
             ],
         ] = defaultdict(list)
 
+        self.__owns_executor = executor is None
+        self.__executor = (
+            executor
+            if executor is not None
+            else build_multistorage_executor(len(steps))
+        )
+        self.__metrics = metrics if metrics is not None else DummyMetricsBackend()
+        self.__flush_times: MutableMapping[StorageKey, float] = defaultdict(float)
+
     def poll(self) -> None:
         for step in self.__steps.values():
             step.poll()
@@ -544,24 +647,59 @@ class MultistorageCollector(
 
             self.__messages[storage_key].append(other_message)
 
+    def __shutdown_executor(self, wait: bool = True) -> None:
+        if self.__owns_executor:
+            self.__executor.shutdown(wait=wait)
+
+    def __run_timed(self, function: Callable[[], None]) -> Future[float]:
+        def run() -> float:
+            start = time.time()
+            function()
+            return time.time() - start
+
+        return self.__executor.submit(run)
+
+    def __wait(
+        self, futures: Mapping[StorageKey, Future[float]]
+    ) -> Mapping[StorageKey, BaseException]:
+        errors: MutableMapping[StorageKey, BaseException] = {}
+        for storage_key, future in futures.items():
+            try:
+                self.__flush_times[storage_key] += future.result()
+            except Exception as e:
+                errors[storage_key] = e
+        return errors
+
     def close(self) -> None:
         self.__closed = True
 
-        for storage_key, step in self.__steps.items():
+        errors = self.__wait(
+            {
+                storage_key: self.__run_timed(step.close)
+                for storage_key, step in self.__steps.items()
+            }
+        )
+
+        if any(
+            not (self.__ignore_errors and storage_key in self.__ignore_errors)
+            for storage_key in errors
+        ):
+            # The error is raised below and there is nothing left to join.
+            self.__failed = True
+            self.__shutdown_executor(wait=False)
+
+        for storage_key, error in errors.items():
             if self.__ignore_errors and storage_key in self.__ignore_errors:
-                try:
-                    step.close()
-                except Exception as e:
-                    messages = self.__messages[storage_key]
-                    if self.__dead_letter_step and messages:
-                        logger.info(
-                            f"Submitting {len(messages)} {storage_key.value} messages to dead letter step..."
-                        )
-                        for message in self.__messages[storage_key]:
-                            self.__dead_letter_step.submit(message)
-                    logger.warning("Error while writing data to clickhouse", exc_info=e)
+                messages = self.__messages[storage_key]
+                if self.__dead_letter_step and messages:
+                    logger.info(
+                        f"Submitting {len(messages)} {storage_key.value} messages to dead letter step..."
+                    )
+                    for message in self.__messages[storage_key]:
+                        self.__dead_letter_step.submit(message)
+                logger.warning("Error while writing data to clickhouse", exc_info=error)
             else:
-                step.close()
+                raise error
 
     def terminate(self) -> None:
         self.__closed = True
@@ -572,18 +710,40 @@ class MultistorageCollector(
         if self.__dead_letter_step:
             self.__dead_letter_step.terminate()
 
+        self.__shutdown_executor(wait=False)
+
     def join(self, timeout: Optional[float] = None) -> None:
-        start = time.time()
+        if self.__failed:
+            return
 
-        for step in self.__steps.values():
-            if timeout is not None:
-                timeout_remaining: Optional[float] = max(
-                    timeout - (time.time() - start), 0
-                )
-            else:
-                timeout_remaining = None
+        # All the steps are joined at the same time, so each one of them
+        # gets the whole timeout rather than what is left by the previous
+        # ones.
+        deadline = time.time() + timeout if timeout is not None else None
+
+        def join_step(
+            step: ProcessingStep[Union[None, BytesInsertBatch, ReplacementBatch]]
+        ) -> None:
+            step.join(max(deadline - time.time(), 0) if deadline is not None else None)
+
+        errors = self.__wait(
+            {
+                storage_key: self.__run_timed(partial(join_step, step))
+                for storage_key, step in self.__steps.items()
+            }
+        )
+
+        for storage_key, flush_time in self.__flush_times.items():
+            self.__metrics.timing(
+                "storage_flush_ms",
+                flush_time * 1000,
+                tags={"storage": storage_key.value},
+            )
 
-            step.join(timeout_remaining)
+        self.__shutdown_executor()
+
+        if errors:
+            raise next(iter(errors.values()))
 
         self.__messages = {}
         if self.__dead_letter_step:
@@ -602,7 +762,9 @@ MultistorageProcessedMessage = Sequence[
 
 
 def process_message(
-    processor: MessageProcessor, message: Message[KafkaPayload]
+    processor: MessageProcessor,
+    message: Message[KafkaPayload],
+    row_encoder: RowEncoder = json_row_encoder,
 ) -> Union[None, BytesInsertBatch, ReplacementBatch]:
     result = processor.process_message(
         rapidjson.loads(message.payload.value),
@@ -612,9 +774,8 @@ def process_message(
     )
 
     if isinstance(result, InsertBatch):
-        return BytesInsertBatch(
-            [json_row_encoder.encode(row) for row in result.rows],
-            result.origin_timestamp,
+        return BytesInsertBatch.encode(
+            row_encoder, result.rows, result.origin_timestamp
         )
     else:
         return result
@@ -633,14 +794,13 @@ def _process_message_multistorage_work(
 
     if isinstance(result, AggregateInsertBatch):
         values_row_encoder = get_values_row_encoder(storage_key)
-        return BytesInsertBatch(
-            [values_row_encoder.encode(row) for row in result.rows],
-            result.origin_timestamp,
+        return BytesInsertBatch.encode(
+            values_row_encoder, result.rows, result.origin_timestamp
         )
     elif isinstance(result, InsertBatch):
-        return BytesInsertBatch(
-            [json_row_encoder.encode(row) for row in result.rows],
-            result.origin_timestamp,
+        row_encoder = get_insert_row_encoder(storage_key)
+        return BytesInsertBatch.encode(
+            row_encoder, result.rows, result.origin_timestamp
         )
     else:
         return result
@@ -754,17 +914,18 @@ def build_multistorage_batch_writer(
     else:
         replacement_batch_writer = None
 
+    insert_metrics = MetricsWrapper(
+        metrics,
+        "insertions",
+        {"storage": storage.get_storage_key().value},
+    )
     return ProcessedMessageBatchWriter(
         InsertBatchWriter(
             storage.get_table_writer().get_batch_writer(
-                metrics,
+                insert_metrics,
                 {"load_balancing": "in_order", "insert_distributed_sync": 1},
             ),
-            MetricsWrapper(
-                metrics,
-                "insertions",
-                {"storage": storage.get_storage_key().value},
-            ),
+            insert_metrics,
         ),
         replacement_batch_writer,
     )
@@ -775,6 +936,7 @@ def build_collector(
     storages: Sequence[WritableTableStorage],
     topic: Optional[Topic],
     producer: Optional[ConfluentKafkaProducer] = None,
+    executor: Optional[Executor] = None,
 ) -> ProcessingStep[MultistorageProcessedMessage]:
     dead_letter_step: Optional[DeadLetterStep] = None
     if producer and topic:
@@ -794,6 +956,8 @@ def build_collector(
             if storage.get_is_write_error_ignorable() is True
         },
         dead_letter_step=dead_letter_step,
+        metrics=MetricsWrapper(metrics, "multistorage_collector"),
+        executor=executor,
     )
 
 
@@ -818,6 +982,7 @@ class MultistorageConsumerProcessingStrategyFactory(
         producer: Optional[AbstractProducer[KafkaPayload]],
         topic: Optional[Topic],
         initialize_parallel_transform: Optional[Callable[[], None]] = None,
+        batch_size_policy: Optional[BatchSizePolicy] = None,
     ):
         if processes is not None:
             assert input_block_size is not None, "input block size required"
@@ -842,7 +1007,11 @@ class MultistorageConsumerProcessingStrategyFactory(
         ):
             self.__process_message_fn = process_message_multistorage_identical_storages
 
-        self.__inner_factory = ConsumerStrategyFactory(
+        # The collectors of all the batches share the same pool, its idle
+        # threads are kept for the lifetime of the consumer.
+        self.__collector_executor = build_multistorage_executor(len(storages))
+
+        self.__inner_factory = PipelinedConsumerStrategyFactory(
             prefilter=MultiStorageStreamFilter(),
             process_message=self.__process_message_fn,
             collector=partial(
@@ -851,6 +1020,7 @@ class MultistorageConsumerProcessingStrategyFactory(
                 self.__storages,
                 self.__topic,
                 self.__producer,
+                self.__collector_executor,
             ),
             max_batch_size=max_batch_size,
             max_batch_time=max_batch_time,
@@ -859,6 +1029,8 @@ class MultistorageConsumerProcessingStrategyFactory(
             output_block_size=output_block_size,
             initialize_parallel_transform=initialize_parallel_transform,
             parallel_collect=parallel_collect,
+            batch_size_policy=batch_size_policy,
+            metrics=MetricsWrapper(self.__metrics, "pipelined_collect"),
         )
 
     def create(
@@ -7,22 +7,29 @@ from arroyo import Topic
 from arroyo.backends.kafka import KafkaConsumer, KafkaPayload
 from arroyo.processing import StreamProcessor
 from arroyo.processing.strategies import ProcessingStrategyFactory
-from arroyo.processing.strategies.streaming import KafkaConsumerStrategyFactory
 from arroyo.utils.profiler import ProcessingStrategyProfilerWrapperFactory
 from arroyo.utils.retries import BasicRetryPolicy, RetryPolicy
 from confluent_kafka import KafkaError, KafkaException, Producer
 
+from snuba.consumers.batching import (
+    AdaptiveBatchSizePolicy,
+    BatchLimits,
+    BatchSizePolicy,
+)
 from snuba.consumers.consumer import (
     build_batch_writer,
     build_mock_batch_writer,
+    get_insert_row_encoder,
     process_message,
 )
+from snuba.consumers.strategy_factory import KafkaPipelinedConsumerStrategyFactory
 from snuba.datasets.storages import StorageKey
 from snuba.datasets.storages.factory import get_writable_storage
 from snuba.environment import setup_sentry
 from snuba.processor import MessageProcessor
 from snuba.state import get_config
 from snuba.utils.metrics import MetricsBackend
+from snuba.utils.metrics.wrapper import MetricsWrapper
 from snuba.utils.streams.configuration_builder import (
     build_kafka_consumer_configuration,
     build_kafka_producer_configuration,
@@ -55,12 +62,42 @@ class ProcessingParameters:
     output_block_size: Optional[int]
 
 
+@dataclass(frozen=True)
+class AdaptiveBatchingParameters:
+    """
+    Bounds of the batch limits of a consumer using adaptive batching. The
+    upper bounds are the max batch size and time of the consumer.
+    """
+
+    min_batch_size: int
+    min_batch_time_ms: int
+    target_latency_ms: int
+
+
 @dataclass(frozen=True)
 class MockParameters:
     avg_write_latency: int
     std_deviation: int
 
 
+def build_adaptive_batch_size_policy(
+    parameters: AdaptiveBatchingParameters,
+    max_batch_size: int,
+    max_batch_time_ms: int,
+    metrics: MetricsBackend,
+) -> BatchSizePolicy:
+    # The lower bounds can never be higher than the max batch limits.
+    return AdaptiveBatchSizePolicy(
+        min_limits=BatchLimits(
+            min(parameters.min_batch_size, max_batch_size),
+            min(parameters.min_batch_time_ms, max_batch_time_ms) / 1000.0,
+        ),
+        max_limits=BatchLimits(max_batch_size, max_batch_time_ms / 1000.0),
+        target_latency=parameters.target_latency_ms / 1000.0,
+        metrics=MetricsWrapper(metrics, "adaptive_batching"),
+    )
+
+
 class ConsumerBuilder:
     """
     Simplifies the initialization of a consumer by merging parameters that
@@ -82,6 +119,8 @@ class ConsumerBuilder:
         profile_path: Optional[str] = None,
         mock_parameters: Optional[MockParameters] = None,
         cooperative_rebalancing: bool = False,
+        max_insert_batches_in_flight: Optional[int] = None,
+        adaptive_batching: Optional[AdaptiveBatchingParameters] = None,
     ) -> None:
         self.storage = get_writable_storage(storage_key)
         self.bootstrap_servers = kafka_params.bootstrap_servers
@@ -154,6 +193,8 @@ class ConsumerBuilder:
         self.__mock_parameters = mock_parameters
         self.__parallel_collect = parallel_collect
         self.__cooperative_rebalancing = cooperative_rebalancing
+        self.__max_insert_batches_in_flight = max_insert_batches_in_flight
+        self.__adaptive_batching = adaptive_batching
 
         if commit_retry_policy is None:
             commit_retry_policy = BasicRetryPolicy(
@@ -230,11 +271,31 @@ class ConsumerBuilder:
         if processor_wrapper is not None:
             processor = processor_wrapper(processor)
 
+        max_batches_in_flight = self.__max_insert_batches_in_flight
+        if max_batches_in_flight is not None and self.replacements_topic is not None:
+            # Replacements are produced once the batch they belong to is
+            # written. They must not reach the replacer while the inserts
+            # of the previous batches are still pending.
+            max_batches_in_flight = 1
+
+        batch_size_policy: Optional[BatchSizePolicy] = None
+        if self.__adaptive_batching is not None:
+            batch_size_policy = build_adaptive_batch_size_policy(
+                self.__adaptive_batching,
+                self.max_batch_size,
+                self.max_batch_time_ms,
+                self.metrics,
+            )
+
         strategy_factory: ProcessingStrategyFactory[
             KafkaPayload
-        ] = KafkaConsumerStrategyFactory(
+        ] = KafkaPipelinedConsumerStrategyFactory(
             prefilter=stream_loader.get_pre_filter(),
-            process_message=functools.partial(process_message, processor),
+            process_message=functools.partial(
+                process_message,
+                processor,
+                row_encoder=get_insert_row_encoder(self.storage.get_storage_key()),
+            ),
             collector=build_batch_writer(
                 table_writer,
                 metrics=self.metrics,
@@ -259,6 +320,9 @@ class ConsumerBuilder:
             initialize_parallel_transform=setup_sentry,
             dead_letter_queue_policy_closure=stream_loader.get_dead_letter_queue_policy_closure(),
             parallel_collect=self.__parallel_collect,
+            max_batches_in_flight=max_batches_in_flight,
+            batch_size_policy=batch_size_policy,
+            metrics=MetricsWrapper(self.metrics, "pipelined_collect"),
         )
 
         if self.__profile_path is not None:
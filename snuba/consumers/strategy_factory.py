@@ -0,0 +1,154 @@
+from typing import Any, Callable, Mapping, Optional, TypeVar
+
+from arroyo.backends.kafka import KafkaPayload
+from arroyo.processing.strategies import ProcessingStrategy
+from arroyo.processing.strategies.dead_letter_queue.dead_letter_queue import (
+    DeadLetterQueue,
+)
+from arroyo.processing.strategies.dead_letter_queue.policies.abstract import (
+    DeadLetterQueuePolicy,
+)
+from arroyo.processing.strategies.streaming.factory import (
+    ConsumerStrategyFactory,
+    StreamMessageFilter,
+)
+from arroyo.processing.strategies.streaming.filter import FilterStep
+from arroyo.processing.strategies.streaming.transform import (
+    ParallelTransformStep,
+    TransformStep,
+)
+from arroyo.types import Message, Partition, Position
+
+from snuba.consumers.batching import BatchLimits, BatchSizePolicy, FixedBatchSizePolicy
+from snuba.consumers.collect import PipelinedCollectStep
+from snuba.utils.metrics import MetricsBackend
+from snuba.utils.metrics.backends.dummy import DummyMetricsBackend
+
+TPayload = TypeVar("TPayload")
+TProcessed = TypeVar("TProcessed")
+
+
+class PipelinedConsumerStrategyFactory(ConsumerStrategyFactory[TPayload]):
+    """
+    Extends the arroyo ConsumerStrategyFactory so that batches can be
+    collected by the PipelinedCollectStep.
+
+    When `max_batches_in_flight` is provided, the PipelinedCollectStep
+    writes up to that many batches at the same time and commits their
+    offsets in order once each write is complete.
+
+    When a `batch_size_policy` is provided, the limits of each batch come
+    from the policy instead of `max_batch_size` and `max_batch_time`. This
+    also requires the PipelinedCollectStep, which is used with a single
+    batch in flight if `max_batches_in_flight` is not set.
+
+    Without either option the strategy is the one built by the arroyo
+    factory.
+    """
+
+    def __init__(
+        self,
+        prefilter: Optional[StreamMessageFilter[TPayload]],
+        process_message: Callable[[Message[TPayload]], TProcessed],
+        collector: Callable[[], ProcessingStrategy[TProcessed]],
+        max_batch_size: int,
+        max_batch_time: float,
+        processes: Optional[int],
+        input_block_size: Optional[int],
+        output_block_size: Optional[int],
+        initialize_parallel_transform: Optional[Callable[[], None]] = None,
+        dead_letter_queue_policy_closure: Optional[
+            Callable[[], DeadLetterQueuePolicy]
+        ] = None,
+        parallel_collect: bool = False,
+        max_batches_in_flight: Optional[int] = None,
+        batch_size_policy: Optional[BatchSizePolicy] = None,
+        metrics: Optional[MetricsBackend] = None,
+    ) -> None:
+        super().__init__(
+            prefilter,
+            process_message,
+            collector,
+            max_batch_size,
+            max_batch_time,
+            processes,
+            input_block_size,
+            output_block_size,
+            initialize_parallel_transform,
+            dead_letter_queue_policy_closure,
+            parallel_collect,
+        )
+
+        # The arroyo factory keeps its configuration private, the pipelined
+        # strategy needs it to wrap its own collect step.
+        self.__prefilter = prefilter
+        self.__process_message = process_message
+        self.__collector = collector
+        self.__max_batch_size = max_batch_size
+        self.__max_batch_time = max_batch_time
+        self.__processes = processes
+        self.__input_block_size = input_block_size
+        self.__output_block_size = output_block_size
+        self.__initialize_parallel_transform = initialize_parallel_transform
+        self.__dead_letter_queue_policy_closure = dead_letter_queue_policy_closure
+        self.__max_batches_in_flight = max_batches_in_flight
+        self.__batch_size_policy = batch_size_policy
+        self.__metrics = metrics if metrics is not None else DummyMetricsBackend()
+
+    def __should_accept(self, message: Message[TPayload]) -> bool:
+        assert self.__prefilter is not None
+        return not self.__prefilter.should_drop(message)
+
+    def create(
+        self, commit: Callable[[Mapping[Partition, Position]], None]
+    ) -> ProcessingStrategy[TPayload]:
+        if self.__max_batches_in_flight is None and self.__batch_size_policy is None:
+            return super().create(commit)
+
+        # TProcessed is not a parameter of the factory, so it cannot be
+        # bound in the type of the collect step.
+        collect: ProcessingStrategy[Any] = PipelinedCollectStep(
+            self.__collector,
+            commit,
+            self.__batch_size_policy
+            or FixedBatchSizePolicy(
+                BatchLimits(self.__max_batch_size, self.__max_batch_time)
+            ),
+            self.__max_batches_in_flight or 1,
+            self.__metrics,
+        )
+
+        strategy: ProcessingStrategy[TPayload]
+        if self.__processes is None:
+            strategy = TransformStep(self.__process_message, collect)
+        else:
+            assert self.__input_block_size is not None
+            assert self.__output_block_size is not None
+            strategy = ParallelTransformStep(
+                self.__process_message,
+                collect,
+                self.__processes,
+                max_batch_size=self.__max_batch_size,
+                max_batch_time=self.__max_batch_time,
+                input_block_size=self.__input_block_size,
+                output_block_size=self.__output_block_size,
+                initializer=self.__initialize_parallel_transform,
+            )
+
+        if self.__prefilter is not None:
+            strategy = FilterStep(self.__should_accept, strategy)
+
+        if self.__dead_letter_queue_policy_closure is not None:
+            # The policy is instantiated here so that any producer it holds
+            # is recreated on rebalance.
+            strategy = DeadLetterQueue(
+                strategy, self.__dead_letter_queue_policy_closure()
+            )
+
+        return strategy
+
+
+class KafkaPipelinedConsumerStrategyFactory(
+    PipelinedConsumerStrategyFactory[KafkaPayload]
+):
+    pass
@@ -8,9 +8,10 @@ import time
 import uuid
 from abc import abstractmethod
 from collections import deque
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from datetime import datetime
 from functools import cached_property
+from threading import Lock
 from typing import (
     Any,
     Deque,
@@ -135,10 +136,46 @@ class LegacyReplacement(Replacement):
     query_time_flags: LegacyQueryTimeFlags
     replacement_type: ReplacementType
     replacement_message_metadata: ReplacementMessageMetadata
+    # The query arg holding the list of ids the replacement applies to.
+    # Replacements that only differ by this list can be merged.
+    mergeable_arg: Optional[str] = None
 
     def get_project_id(self) -> int:
         return self.query_time_flags[1]
 
+    def merge(self, other: ReplacementBase) -> Optional[Replacement]:
+        key = self.mergeable_arg
+        if (
+            key is None
+            or not isinstance(other, LegacyReplacement)
+            or other.mergeable_arg != key
+            or other.replacement_type != self.replacement_type
+            or other.count_query_template != self.count_query_template
+            or other.insert_query_template != self.insert_query_template
+            or other.query_time_flags[:2] != self.query_time_flags[:2]
+            or {k: v for k, v in other.query_args.items() if k != key}
+            != {k: v for k, v in self.query_args.items() if k != key}
+        ):
+            return None
+
+        query_time_flags: LegacyQueryTimeFlags = self.query_time_flags
+        if self.query_time_flags[0] == EXCLUDE_GROUPS:
+            query_time_flags = (
+                EXCLUDE_GROUPS,
+                self.query_time_flags[1],
+                [*self.query_time_flags[2], *other.query_time_flags[2]],  # type: ignore
+            )
+
+        return replace(
+            self,
+            query_args={
+                **self.query_args,
+                key: f"{self.query_args[key]}, {other.query_args[key]}",
+            },
+            query_time_flags=query_time_flags,
+            replacement_message_metadata=other.replacement_message_metadata,
+        )
+
     def get_query_time_flags(self) -> Optional[QueryTimeFlags]:
         if self.query_time_flags[0] == NEEDS_FINAL:
             return NeedsFinal()
@@ -204,6 +241,7 @@ def set_project_exclude_groups(
     p.zremrangebyscore(type_key, -1, now - settings.REPLACER_KEY_TTL)
     p.expire(type_key, int(settings.REPLACER_KEY_TTL))
 
+    _bump_flags_version(p, state_name)
     p.execute()
 
 
@@ -218,9 +256,25 @@ def set_project_needs_final(
     p = redis_client.pipeline()
     p.set(key, time.time(), ex=settings.REPLACER_KEY_TTL)
     p.set(type_key, replacement_type, ex=settings.REPLACER_KEY_TTL)
+    _bump_flags_version(p, state_name)
     p.execute()
 
 
+def _bump_flags_version(
+    p: StrictClusterPipeline, state_name: Optional[ReplacerState]
+) -> None:
+    """
+    Invalidates the flags cached by `ProjectsQueryFlags.load_from_cache`.
+    The version is random rather than incremented, so that it cannot go
+    back to a value seen before if the key is lost.
+    """
+    p.set(
+        ProjectsQueryFlags._build_flags_version_key(state_name),
+        uuid.uuid4().hex,
+        ex=settings.REPLACER_KEY_TTL,
+    )
+
+
 @dataclass
 class ProjectsQueryFlags:
     """
@@ -253,11 +307,63 @@ class ProjectsQueryFlags:
         - Splits up results from pipeline into something that makes sense
         """
         s_project_ids = set(project_ids)
+        projects_flags = cls._load_projects(list(s_project_ids), state_name)
 
+        with sentry_sdk.start_span(
+            op="function", description="process_redis_results"
+        ) as span:
+            flags = cls.merge(projects_flags)
+            span.set_tag("projects", s_project_ids)
+            span.set_tag("exclude_groups", flags.group_ids_to_exclude)
+            span.set_tag("len(exclude_groups)", len(flags.group_ids_to_exclude))
+            span.set_tag("latest_replacement_time", flags.latest_replacement_time)
+            span.set_tag("replacement_types", flags.replacement_types)
+
+        return flags
+
+    @classmethod
+    def load_from_cache(
+        cls,
+        project_ids: Sequence[int],
+        state_name: Optional[ReplacerState],
+        ttl: float,
+    ) -> ProjectsQueryFlags:
+        """
+        Same as `load_from_redis`, but the flags of each project are cached
+        for `ttl` seconds, as long as no replacement happens in the meantime.
+        """
+        return _flags_cache.load(project_ids, state_name, ttl)
+
+    @classmethod
+    def merge(cls, flags: Sequence[ProjectsQueryFlags]) -> ProjectsQueryFlags:
+        """
+        Combines the flags of several sets of projects into the flags of
+        all of them.
+        """
+        latest_replacement_times = [
+            f.latest_replacement_time
+            for f in flags
+            if f.latest_replacement_time is not None
+        ]
+        return cls(
+            any(f.needs_final for f in flags),
+            {group_id for f in flags for group_id in f.group_ids_to_exclude},
+            {t for f in flags for t in f.replacement_types},
+            max(latest_replacement_times) if latest_replacement_times else None,
+        )
+
+    @classmethod
+    def _load_projects(
+        cls, project_ids: Sequence[int], state_name: Optional[ReplacerState]
+    ) -> Sequence[ProjectsQueryFlags]:
+        """
+        Loads the flags of each project, in the order of `project_ids`,
+        with a single pipeline.
+        """
         p = redis_client.pipeline()
 
         with sentry_sdk.start_span(op="function", description="build_redis_pipeline"):
-            cls._query_redis(s_project_ids, state_name, p)
+            cls._query_redis(project_ids, state_name, p)
 
         with sentry_sdk.start_span(
             op="function", description="execute_redis_pipeline"
@@ -266,17 +372,11 @@ class ProjectsQueryFlags:
             # getting size of str(results) since sys.getsizeof() doesn't count recursively
             span.set_tag("results_size", sys.getsizeof(str(results)))
 
-        with sentry_sdk.start_span(
-            op="function", description="process_redis_results"
-        ) as span:
-            flags = cls._process_redis_results(results, len(s_project_ids))
-            span.set_tag("projects", s_project_ids)
-            span.set_tag("exclude_groups", flags.group_ids_to_exclude)
-            span.set_tag("len(exclude_groups)", len(flags.group_ids_to_exclude))
-            span.set_tag("latest_replacement_time", flags.latest_replacement_time)
-            span.set_tag("replacement_types", flags.replacement_types)
-
-        return flags
+        len_projects = len(project_ids)
+        return [
+            cls._process_redis_results(results[i::len_projects], 1)
+            for i in range(len_projects)
+        ]
 
     @classmethod
     def _process_redis_results(
@@ -288,22 +388,19 @@ class ProjectsQueryFlags:
         `results` is a flat list of all the redis call results of _query_redis
         [
             needs_final: Sequence[timestamp]...,
-            _: Sequence[num_removed_elements]...,
             exclude_groups: Sequence[List[group_id]]...,
             needs_final_replacement_types: Sequence[Optional[str]]...,
-            _: Sequence[num_removed_elements]...,
             groups_replacement_types: Sequence[List[str]]...,
             latest_exclude_groups_replacements: Sequence[Optional[Tuple[group_id, datetime]]]...
         ]
-        - The _ slices are the results of `zremrangebyscore` calls, unecessary data
         - Since the Redis commands are built to result in something per project per command,
         the results can be split up with multiples of `len_projects` as indices
         """
         needs_final_result = results[:len_projects]
-        exclude_groups_results = results[len_projects * 2 : len_projects * 3]
-        projects_replacment_types_result = results[len_projects * 3 : len_projects * 4]
-        groups_replacement_types_results = results[len_projects * 5 : len_projects * 6]
-        latest_exclude_groups_result = results[len_projects * 6 : len_projects * 7]
+        exclude_groups_results = results[len_projects : len_projects * 2]
+        projects_replacment_types_result = results[len_projects * 2 : len_projects * 3]
+        groups_replacement_types_results = results[len_projects * 3 : len_projects * 4]
+        latest_exclude_groups_result = results[len_projects * 4 : len_projects * 5]
 
         needs_final = any(needs_final_result)
 
@@ -340,7 +437,7 @@ class ProjectsQueryFlags:
 
     @staticmethod
     def _query_redis(
-        project_ids: Set[int],
+        project_ids: Sequence[int],
         state_name: Optional[ReplacerState],
         p: StrictClusterPipeline,
     ) -> None:
@@ -368,7 +465,7 @@ class ProjectsQueryFlags:
             for project_id in project_ids
         ]
 
-        ProjectsQueryFlags._remove_stale_and_load_new_sorted_set_data(
+        ProjectsQueryFlags._load_new_sorted_set_data(
             p,
             [groups_key for groups_key, _ in exclude_groups_keys_and_types],
         )
@@ -376,7 +473,7 @@ class ProjectsQueryFlags:
         for _, needs_final_type_key in needs_final_keys_and_type_keys:
             p.get(needs_final_type_key)
 
-        ProjectsQueryFlags._remove_stale_and_load_new_sorted_set_data(
+        ProjectsQueryFlags._load_new_sorted_set_data(
             p, [type_key for _, type_key in exclude_groups_keys_and_types]
         )
 
@@ -390,20 +487,13 @@ class ProjectsQueryFlags:
             )
 
     @staticmethod
-    def _remove_stale_and_load_new_sorted_set_data(
-        p: StrictClusterPipeline, keys: List[str]
-    ) -> None:
+    def _load_new_sorted_set_data(p: StrictClusterPipeline, keys: List[str]) -> None:
         """
-        Remove stale data per key according to TTL.
-        Get latest data per key.
-
-        Split across two loops to avoid intertwining Redis calls and
-        consequentially, their results.
+        Get the data per key that is not stale according to TTL. The stale
+        data is removed by the replacer when it adds new data.
         """
         now = time.time()
 
-        for key in keys:
-            p.zremrangebyscore(key, float("-inf"), now - settings.REPLACER_KEY_TTL)
         for key in keys:
             p.zrevrangebyscore(key, float("inf"), now - settings.REPLACER_KEY_TTL)
 
@@ -454,6 +544,82 @@ class ProjectsQueryFlags:
         key = f"project_exclude_groups:{f'{state_name.value}:' if state_name else ''}{project_id}"
         return key, f"{key}-type"
 
+    @staticmethod
+    def _build_flags_version_key(state_name: Optional[ReplacerState]) -> str:
+        return f"project_flags_version{f':{state_name.value}' if state_name else ''}"
+
+
+class ProjectsQueryFlagsCache:
+    """
+    Caches the flags of each project in the process, for each replacer
+    state.
+
+    Every replacement changes the version of the flags of its replacer
+    state, so a single Redis command tells whether the cached flags are
+    still valid. The flags are also reloaded after a ttl, since the data
+    of a replacement is discarded by Redis once it is stale.
+    """
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.__max_size = max_size
+        self.__lock = Lock()
+        # state -> (version, {project_id: (loaded_at, flags)})
+        self.__entries: MutableMapping[
+            Optional[ReplacerState],
+            Tuple[
+                Optional[bytes], MutableMapping[int, Tuple[float, ProjectsQueryFlags]]
+            ],
+        ] = {}
+
+    def load(
+        self,
+        project_ids: Sequence[int],
+        state_name: Optional[ReplacerState],
+        ttl: float,
+    ) -> ProjectsQueryFlags:
+        # The version has to be read before the flags, so that flags loaded
+        # after a replacement are never cached with the version of before.
+        version = redis_client.get(
+            ProjectsQueryFlags._build_flags_version_key(state_name)
+        )
+        now = time.time()
+
+        cached: List[ProjectsQueryFlags] = []
+        missing: List[int] = []
+        with self.__lock:
+            entry = self.__entries.get(state_name)
+            if entry is None or entry[0] != version:
+                entry = self.__entries[state_name] = (version, {})
+            projects = entry[1]
+
+            for project_id in set(project_ids):
+                project = projects.get(project_id)
+                if project is not None and now < project[0] + ttl:
+                    cached.append(project[1])
+                else:
+                    missing.append(project_id)
+
+        metrics.increment("flags_cache.hit", len(cached))
+        metrics.increment("flags_cache.miss", len(missing))
+        if not missing:
+            return ProjectsQueryFlags.merge(cached)
+
+        loaded = ProjectsQueryFlags._load_projects(missing, state_name)
+
+        with self.__lock:
+            if self.__entries.get(state_name) is entry:
+                if len(projects) + len(missing) > self.__max_size:
+                    projects.clear()
+                projects.update(
+                    (project_id, (now, flags))
+                    for project_id, flags in zip(missing, loaded)
+                )
+
+        return ProjectsQueryFlags.merge([*cached, *loaded])
+
+
+_flags_cache = ProjectsQueryFlagsCache()
+
 
 class ErrorsReplacer(ReplacerProcessor[Replacement]):
     def __init__(
@@ -578,6 +744,7 @@ def _build_event_tombstone_replacement(
     where: str,
     query_args: Mapping[str, str],
     query_time_flags: LegacyQueryTimeFlags,
+    mergeable_arg: Optional[str] = None,
 ) -> Replacement:
     select_columns = map(lambda i: i if i != "deleted" else "1", required_columns)
     count_query_template = (
@@ -611,6 +778,7 @@ def _build_event_tombstone_replacement(
         query_time_flags,
         replacement_type=message.action_type,
         replacement_message_metadata=message.metadata,
+        mergeable_arg=mergeable_arg,
     )
 
 
@@ -621,6 +789,7 @@ def _build_group_replacement(
     query_args: Mapping[str, str],
     query_time_flags: LegacyQueryTimeFlags,
     all_columns: Sequence[FlattenedColumn],
+    mergeable_arg: Optional[str] = None,
 ) -> Optional[Replacement]:
     # HACK: We were sending duplicates of the `end_merge` message from Sentry,
     # this is only for performance of the backlog.
@@ -668,6 +837,7 @@ def _build_group_replacement(
         query_time_flags,
         replacement_type=message.action_type,
         replacement_message_metadata=message.metadata,
+        mergeable_arg=mergeable_arg,
     )
 
 
@@ -746,6 +916,7 @@ def process_replace_group(
         query_args,
         query_time_flags,
         all_columns,
+        mergeable_arg="event_ids",
     )
 
 
@@ -776,7 +947,12 @@ def process_delete_groups(
     query_time_flags = (EXCLUDE_GROUPS, message.data["project_id"], group_ids)
 
     return _build_event_tombstone_replacement(
-        message, required_columns, where, query_args, query_time_flags
+        message,
+        required_columns,
+        where,
+        query_args,
+        query_time_flags,
+        mergeable_arg="group_ids",
     )
 
 
@@ -811,7 +987,12 @@ def process_tombstone_events(
     full_where = f"PREWHERE {' AND '.join(prewhere)} WHERE {' AND '.join(where)}"
 
     return _build_event_tombstone_replacement(
-        message, required_columns, full_where, query_args, query_time_flags
+        message,
+        required_columns,
+        full_where,
+        query_args,
+        query_time_flags,
+        mergeable_arg="event_ids",
     )
 
 
@@ -867,6 +1048,20 @@ class ExcludeGroupsReplacement(Replacement):
     def get_count_query(self, table_name: str) -> Optional[str]:
         return None
 
+    def merge(self, other: ReplacementBase) -> Optional[Replacement]:
+        if (
+            not isinstance(other, ExcludeGroupsReplacement)
+            or other.project_id != self.project_id
+            or other.replacement_type != self.replacement_type
+        ):
+            return None
+
+        return replace(
+            self,
+            group_ids=[*self.group_ids, *other.group_ids],
+            replacement_message_metadata=other.replacement_message_metadata,
+        )
+
     def get_message_metadata(self) -> ReplacementMessageMetadata:
         return self.replacement_message_metadata
 
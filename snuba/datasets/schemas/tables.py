@@ -15,6 +15,7 @@ from snuba.query.expressions import FunctionCall
 class WriteFormat(Enum):
     JSON = "json"
     VALUES = "values"
+    ROW_BINARY = "row_binary"
 
 
 @dataclass(frozen=True)
@@ -52,8 +52,18 @@ class PostReplacementConsistencyEnforcer(QueryProcessor):
             self._set_query_final(query, False)
             return
 
-        flags: ProjectsQueryFlags = ProjectsQueryFlags.load_from_redis(
-            list(project_ids), self.__replacer_state_name
+        flags_cache_ttl = get_config(
+            "replacer_flags_cache_ttl", settings.REPLACER_FLAGS_CACHE_TTL
+        )
+        assert isinstance(flags_cache_ttl, (int, float))
+        flags: ProjectsQueryFlags = (
+            ProjectsQueryFlags.load_from_cache(
+                list(project_ids), self.__replacer_state_name, flags_cache_ttl
+            )
+            if flags_cache_ttl > 0
+            else ProjectsQueryFlags.load_from_redis(
+                list(project_ids), self.__replacer_state_name
+            )
         )
 
         query_overlaps_replacement = self._query_overlaps_replacements(
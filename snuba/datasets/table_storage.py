@@ -6,6 +6,7 @@ from arroyo.processing.strategies.dead_letter_queue.policies.abstract import (
 )
 
 from snuba import settings
+from snuba.clickhouse.columns import FlattenedColumn
 from snuba.clickhouse.http import InsertStatement, JSONRow
 from snuba.clusters.cluster import (
     ClickhouseClientSettings,
@@ -236,6 +237,12 @@ class TableWriter:
                 .with_format("VALUES")
                 .with_columns(column_names)
             )
+        elif self.__write_format == WriteFormat.ROW_BINARY:
+            insert_statement = (
+                InsertStatement(table_name)
+                .with_format("RowBinary")
+                .with_columns(self.get_writeable_columns())
+            )
         else:
             raise TypeError("unknown table format", self.__write_format)
         options = self.__update_writer_options(options)
@@ -249,9 +256,15 @@ class TableWriter:
             buffer_size=0,
         )
 
+    def get_write_format(self) -> WriteFormat:
+        return self.__write_format
+
     def get_writeable_columns(self) -> Sequence[str]:
+        return [column.flattened for column in self.get_writeable_flattened_columns()]
+
+    def get_writeable_flattened_columns(self) -> Sequence[FlattenedColumn]:
         return [
-            column.flattened
+            column
             for column in self.get_schema().get_columns()
             if not column.type.has_modifier(ReadOnly)
         ]
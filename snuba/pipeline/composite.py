@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+from dataclasses import replace
 from typing import Mapping, NamedTuple, Optional, Sequence, Tuple, Union
 
 import sentry_sdk
 
+from snuba import environment, state
 from snuba.clickhouse.processors import CompositeQueryProcessor, QueryProcessor
 from snuba.clickhouse.query import Query as ClickhouseQuery
 from snuba.clusters.cluster import ClickhouseCluster, get_cluster
@@ -20,16 +22,30 @@ from snuba.pipeline.plans_selector import select_best_plans
 from snuba.pipeline.query_pipeline import QueryExecutionPipeline, QueryPlanner
 from snuba.query import ProcessableQuery
 from snuba.query.composite import CompositeQuery
-from snuba.query.data_source.join import IndividualNode, JoinClause, JoinVisitor
+from snuba.query.conditions import in_condition
+from snuba.query.data_source.join import (
+    IndividualNode,
+    JoinClause,
+    JoinModifier,
+    JoinNode,
+    JoinType,
+    JoinVisitor,
+)
 from snuba.query.data_source.simple import Entity, Table
 from snuba.query.data_source.visitor import DataSourceVisitor
+from snuba.query.expressions import Column, Expression, Literal
 from snuba.query.joins.equivalence_adder import add_equivalent_conditions
 from snuba.query.joins.semi_joins import SemiJoinOptimizer
 from snuba.query.joins.subquery_generator import generate_subqueries
 from snuba.query.logical import Query as LogicalQuery
+from snuba.reader import Reader
 from snuba.request.request_settings import RequestSettings
+from snuba.utils.metrics.wrapper import MetricsWrapper
+from snuba.utils.schemas import UUID, String, UInt
 from snuba.web import QueryResult
 
+metrics = MetricsWrapper(environment.metrics, "query.composite")
+
 
 class CompositeQueryPlanner(QueryPlanner[CompositeQueryPlan]):
     """
@@ -432,7 +448,148 @@ class CompositeExecutionStrategy(QueryPlanExecutionStrategy[CompositeQuery[Table
         for p in self.__composite_processors:
             p.process_query(query, request_settings)
 
-        return runner(query, request_settings, self.__cluster.get_reader())
+        reader = self.__cluster.get_reader()
+        max_inlined_rows = state.get_config("composite_inline_subquery_max_rows", 0)
+        if max_inlined_rows:
+            with sentry_sdk.start_span(description="inline_semi_joins", op="db"):
+                while _inline_semi_join(
+                    query, request_settings, runner, reader, int(max_inlined_rows)
+                ):
+                    metrics.increment("semi_join_inlined")
+
+        return runner(query, request_settings, reader)
+
+
+def _find_individual_node(
+    node: JoinNode[Table], alias: str
+) -> Optional[IndividualNode[Table]]:
+    if isinstance(node, IndividualNode):
+        return node if node.alias == alias else None
+    assert isinstance(node, JoinClause)
+    return _find_individual_node(node.left_node, alias) or _find_individual_node(
+        node.right_node, alias
+    )
+
+
+def _inline_semi_join(
+    query: CompositeQuery[Table],
+    request_settings: RequestSettings,
+    runner: QueryRunner,
+    reader: Reader,
+    max_rows: int,
+) -> bool:
+    """
+    Runs on its own the right subquery of the last join in the query if
+    the SemiJoinOptimizer turned it into a semi join with a single key,
+    and replaces the join with an IN condition on the left subquery that
+    lists the keys returned.
+
+    The subquery goes through the same runner as the main query, so the
+    result cache and the rate limits apply to it.
+
+    Returns False, leaving the query untouched, when the join cannot be
+    inlined or when the subquery returns no rows or more than max_rows
+    rows. In that case the join is executed by ClickHouse as usual.
+    """
+    join = query.get_from_clause()
+    if (
+        not isinstance(join, JoinClause)
+        or (join.join_type, join.join_modifier)
+        not in (
+            (JoinType.INNER, JoinModifier.ANY),
+            (JoinType.LEFT, JoinModifier.SEMI),
+        )
+        or len(join.keys) != 1
+    ):
+        return False
+
+    right_node = join.right_node
+    # Semi joins can still reference the join key of the right table.
+    # We do not rewrite those references.
+    if any(
+        c.table_name == right_node.alias for c in query.get_all_ast_referenced_columns()
+    ):
+        return False
+
+    key = join.keys[0]
+    right_key, left_key = (
+        (key.left, key.right)
+        if key.left.table_alias == right_node.alias
+        else (key.right, key.left)
+    )
+    left_node = _find_individual_node(join.left_node, left_key.table_alias)
+    assert left_node is not None and isinstance(left_node.data_source, ClickhouseQuery)
+    assert isinstance(right_node.data_source, ClickhouseQuery)
+
+    left_key_expression: Optional[Expression] = next(
+        (
+            selected.expression
+            for selected in left_node.data_source.get_selected_columns()
+            if selected.name == left_key.column
+        ),
+        None,
+    )
+    right_key_column = next(
+        (
+            selected
+            for selected in right_node.data_source.get_selected_columns()
+            if selected.name == right_key.column
+        ),
+        None,
+    )
+    if left_key_expression is None or right_key_column is None:
+        return False
+
+    # Values of types like DateTime come back from the reader as strings
+    # that would not compare equal to the column in ClickHouse, so only
+    # keys whose values map directly to a literal are inlined.
+    right_key_expression = right_key_column.expression
+    if not isinstance(right_key_expression, Column):
+        return False
+    right_key_schema = right_node.data_source.get_from_clause().schema.get(
+        right_key_expression.column_name
+    )
+    if right_key_schema is None or not isinstance(
+        right_key_schema.type, (UInt, UUID, String)
+    ):
+        metrics.increment("semi_join_not_inlined", tags={"reason": "type"})
+        return False
+
+    subquery = right_node.data_source.clone()
+    subquery.set_ast_selected_columns([right_key_column])
+    subquery_limit = subquery.get_limit()
+    subquery.set_limit(
+        max_rows + 1 if subquery_limit is None else min(subquery_limit, max_rows + 1)
+    )
+    rows = runner(subquery, request_settings, reader).result["data"]
+    if not rows or len(rows) > max_rows:
+        metrics.increment("semi_join_not_inlined", tags={"reason": "rows"})
+        return False
+
+    values = list(dict.fromkeys(row[right_key.column] for row in rows))
+    if not all(isinstance(v, (str, int)) for v in values):
+        metrics.increment("semi_join_not_inlined", tags={"reason": "type"})
+        return False
+
+    left_node.data_source.add_condition_to_ast(
+        in_condition(left_key_expression, [Literal(None, v) for v in values])
+    )
+
+    if isinstance(join.left_node, IndividualNode):
+        # The join is gone, the left subquery becomes a plain nested query
+        # whose columns are not qualified by the table alias anymore.
+        left_alias = join.left_node.alias
+        query.set_from_clause(join.left_node.data_source)
+        query.transform_expressions(
+            lambda e: replace(e, table_name=None)
+            if isinstance(e, Column) and e.table_name == left_alias
+            else e
+        )
+    else:
+        assert isinstance(join.left_node, JoinClause)
+        query.set_from_clause(join.left_node)
+
+    return True
 
 
 class CompositeExecutionPipeline(QueryExecutionPipeline):
@@ -1,4 +1,3 @@
-import copy
 from dataclasses import replace
 from functools import partial
 from typing import Callable, List, Mapping, Optional, Tuple
@@ -108,7 +107,7 @@ class MultipleConcurrentPipeline(QueryExecutionPipeline):
             query = (
                 request.query
                 if _is_query_copying_disallowed(request.settings.referrer)
-                else copy.deepcopy(request.query)
+                else request.query.clone()
             )
 
             if not get_config("pipeline_split_rate_limiter", 0):
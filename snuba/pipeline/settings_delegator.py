@@ -61,6 +61,9 @@ class RateLimiterDelegate(RequestSettings):
     def get_legacy(self) -> bool:
         return self.__delegate.get_legacy()
 
+    def get_stream_response(self) -> bool:
+        return self.__delegate.get_stream_response()
+
     def get_team(self) -> str:
         return self.__delegate.get_team()
 
@@ -83,3 +86,9 @@ class RateLimiterDelegate(RequestSettings):
 
     def set_resource_quota(self, quota: ResourceQuota) -> None:
         self.__delegate.set_resource_quota(quota)
+
+    def get_query_id(self) -> Optional[str]:
+        return self.__delegate.get_query_id()
+
+    def set_query_id(self, query_id: Optional[str]) -> None:
+        self.__delegate.set_query_id(query_id)
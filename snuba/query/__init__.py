@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import copy
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, replace
 from enum import Enum
@@ -57,6 +58,7 @@ class SelectedExpression:
 
 
 TExp = TypeVar("TExp", bound=Expression)
+TQuery = TypeVar("TQuery", bound="Query")
 
 
 class Query(DataSource, ABC):
@@ -230,6 +232,23 @@ class Query(DataSource, ABC):
     def get_experiment_value(self, name: str) -> AnyType:
         return self.__experiments.get(name)
 
+    def clone(self: TQuery) -> TQuery:
+        """
+        Returns a copy of this query that can be modified without affecting
+        the original one. This is much cheaper than a deepcopy since
+        expressions are immutable and are shared between the two queries.
+        Only the containers that hold them are copied.
+        """
+        cloned = copy.copy(self)
+        cloned.__selected_columns = list(self.__selected_columns)
+        cloned.__array_join = (
+            list(self.__array_join) if self.__array_join is not None else None
+        )
+        cloned.__groupby = list(self.__groupby)
+        cloned.__order_by = list(self.__order_by)
+        cloned.__experiments = dict(self.__experiments)
+        return cloned
+
     @abstractmethod
     def _get_expressions_impl(self) -> Iterable[Expression]:
         """
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from dataclasses import replace
 from typing import Callable, Generic, Iterable, Optional, Sequence, Union, cast
 
 from snuba.query import (
@@ -10,7 +11,7 @@ from snuba.query import (
     SelectedExpression,
     TSimpleDataSource,
 )
-from snuba.query.data_source.join import JoinClause
+from snuba.query.data_source.join import IndividualNode, JoinClause, JoinNode
 from snuba.query.data_source.simple import SimpleDataSource
 from snuba.query.expressions import Expression, ExpressionVisitor
 
@@ -106,6 +107,21 @@ class CompositeQuery(Query, Generic[TSimpleDataSource]):
     ) -> None:
         self.__from_clause = from_clause
 
+    def clone(self) -> CompositeQuery[TSimpleDataSource]:
+        """
+        Clones this query together with the nested queries in the from
+        clause since they are mutable as well.
+        """
+        cloned = super().clone()
+        if self.__from_clause is not None:
+            if isinstance(self.__from_clause, JoinClause):
+                cloned_join = _clone_join_node(self.__from_clause)
+                assert isinstance(cloned_join, JoinClause)
+                cloned.__from_clause = cloned_join
+            else:
+                cloned.__from_clause = self.__from_clause.clone()
+        return cloned
+
     def get_final(self) -> bool:
         return self.__final
 
@@ -125,3 +141,20 @@ class CompositeQuery(Query, Generic[TSimpleDataSource]):
 
     def _eq_functions(self) -> Sequence[str]:
         return tuple(super()._eq_functions()) + ("get_from_clause",)
+
+
+def _clone_join_node(node: JoinNode[TSimpleDataSource]) -> JoinNode[TSimpleDataSource]:
+    if isinstance(node, IndividualNode):
+        if isinstance(node.data_source, Query):
+            return replace(node, data_source=node.data_source.clone())
+        return node
+
+    assert isinstance(node, JoinClause)
+    assert isinstance(node.right_node, IndividualNode)
+    right_node = _clone_join_node(node.right_node)
+    assert isinstance(right_node, IndividualNode)
+    return replace(
+        node,
+        left_node=_clone_join_node(node.left_node),
+        right_node=right_node,
+    )
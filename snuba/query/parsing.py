@@ -1,4 +1,4 @@
-from typing import List
+from typing import Set
 
 
 class ParsingContext:
@@ -9,10 +9,13 @@ class ParsingContext:
     """
 
     def __init__(self) -> None:
-        self.__alias_cache: List[str] = []
+        self.__alias_cache: Set[str] = set()
 
     def add_alias(self, alias: str) -> None:
-        self.__alias_cache.append(alias)
+        self.__alias_cache.add(alias)
 
     def is_alias_present(self, alias: str) -> bool:
         return alias in self.__alias_cache
+
+    def get_aliases_count(self) -> int:
+        return len(self.__alias_cache)
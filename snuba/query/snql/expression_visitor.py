@@ -134,21 +134,28 @@ def visit_high_pri_arithmetic(
     return get_arithmetic_expression(term, exp)
 
 
-def visit_numeric_literal(node: Node, visited_children: Iterable[Any]) -> Literal:
+def parse_numeric_literal(text: str) -> Union[int, float]:
     try:
-        return Literal(None, int(node.text))
+        return int(text)
     except Exception:
-        return Literal(None, float(node.text))
+        return float(text)
+
+
+def visit_numeric_literal(node: Node, visited_children: Iterable[Any]) -> Literal:
+    return Literal(None, parse_numeric_literal(node.text))
 
 
 newline_re = re.compile("((?:\\{2})*)(\\n)")
 
 
-def visit_quoted_literal(node: Node, visited_children: Tuple[Any]) -> Literal:
-    text = node.text[1:-1]
+def parse_quoted_literal(text: str) -> str:
+    text = text[1:-1]
     text = newline_re.sub(text, "\n")
-    match = text.replace("\\'", "'")
-    return Literal(None, match)
+    return text.replace("\\'", "'")
+
+
+def visit_quoted_literal(node: Node, visited_children: Tuple[Any]) -> Literal:
+    return Literal(None, parse_quoted_literal(node.text))
 
 
 def visit_parameter(
@@ -0,0 +1,265 @@
+"""
+Caches the result of parsing SnQL queries that only differ by the value
+of their literals.
+
+Most of the queries we receive are generated from a handful of shapes,
+where only the values compared against change from one query to the
+other (project ids, time ranges, tag values, ...). Before being parsed, the
+string and numeric literals of the body are replaced with placeholders,
+which turns it into a template shared by all the queries of the same
+shape. The template is parsed once and the resulting AST is cached. For
+the following queries built from the same template the cached AST is
+copied and the placeholders are replaced with the literals of the query,
+which produces the same AST a full parse of the body would. Since the
+names of the selected expressions and some aliases are taken from the
+text of the query, the placeholders they contain are replaced with the
+original text of the literals.
+
+Only the parsing is cached. Everything that happens afterwards (post
+processing, entity selection and validation) depends on the value of the
+literals or on runtime configuration and runs on every query.
+"""
+from __future__ import annotations
+
+import copy
+import logging
+import re
+from collections import OrderedDict
+from dataclasses import replace
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    List,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from snuba.query.composite import CompositeQuery
+from snuba.query.data_source.simple import Entity as QueryEntity
+from snuba.query.expressions import Expression, Literal
+from snuba.query.logical import Query as LogicalQuery
+from snuba.query.snql.expression_visitor import (
+    parse_numeric_literal,
+    parse_quoted_literal,
+)
+from snuba.utils.metrics import MetricsBackend
+
+logger = logging.getLogger(__name__)
+
+SnQLQuery = Union[CompositeQuery[QueryEntity], LogicalQuery]
+
+# Strings are matched with the same expression as the quoted literals of the
+# grammar. Backtick identifiers, tag names and relationships are matched so
+# that what they contain is never mistaken for a literal. Numbers cannot be
+# part of an identifier.
+TOKEN_RE = re.compile(
+    r"(?P<string>(?<!\\)'(?:(?<!\\)(?:\\{2})*\\'|[^'])*(?<!\\)(?:\\{2})*')"
+    r"|(?P<identifier>`[^`]*`|\[[^\[\]]*\])"
+    r"|(?P<number>(?<![\w.])-?[0-9]+(?:\.[0-9]+)?(?:e[\+\-][0-9]+)?)"
+)
+
+# Numbers following these keywords are part of the query clauses, not
+# literal expressions, and are kept in the template.
+CLAUSE_KEYWORDS = ("LIMIT", "OFFSET", "GRANULARITY", "SAMPLE")
+
+# A minus sign following any of these is part of the number, otherwise it is
+# the subtraction operator.
+SIGN_PRECEDING = set("(,=<>")
+
+PLACEHOLDER_PREFIX = "\x00"
+PLACEHOLDER_RE = re.compile(f"'{PLACEHOLDER_PREFIX}([0-9]+)'")
+
+
+class NormalizedBody(NamedTuple):
+    template: str
+    # The value and the original text of each literal, in the order of
+    # the placeholders.
+    values: Sequence[Any]
+    texts: Sequence[str]
+
+
+def normalize_literals(body: str) -> Optional[NormalizedBody]:
+    """
+    Replaces the string and numeric literals of a query body with
+    placeholders. Returns None if the body cannot be turned into a
+    template.
+    """
+    if PLACEHOLDER_PREFIX in body:
+        return None
+
+    parts = []
+    values: List[Any] = []
+    texts: List[str] = []
+    position = 0
+    for match in TOKEN_RE.finditer(body):
+        kind = match.lastgroup
+        if kind == "identifier":
+            continue
+
+        start, end = match.span()
+        text = match.group()
+        # Only the end of the preceding text matters: the last character
+        # or the keyword right before the literal.
+        preceding = body[max(start - 32, 0) : start].rstrip()
+        if kind == "string":
+            value: Any = parse_quoted_literal(text)
+        else:
+            if preceding.endswith(CLAUSE_KEYWORDS):
+                continue
+            if text.startswith("-") and preceding[-1:] not in SIGN_PRECEDING:
+                start += 1
+                text = text[1:]
+            value = parse_numeric_literal(text)
+
+        parts.append(body[position:start])
+        parts.append(f"'{PLACEHOLDER_PREFIX}{len(values)}'")
+        values.append(value)
+        texts.append(text)
+        position = end
+
+    parts.append(body[position:])
+    return NormalizedBody("".join(parts), values, texts)
+
+
+def _get_placeholder(exp: Expression) -> Optional[int]:
+    if (
+        isinstance(exp, Literal)
+        and isinstance(exp.value, str)
+        and exp.value.startswith(PLACEHOLDER_PREFIX)
+    ):
+        return int(exp.value[len(PLACEHOLDER_PREFIX) :])
+    return None
+
+
+def _get_placeholders(query: SnQLQuery) -> Set[int]:
+    placeholders = set()
+    for exp in query.get_all_expressions():
+        for node in exp:
+            index = _get_placeholder(node)
+            if index is not None:
+                placeholders.add(index)
+
+    if isinstance(query, CompositeQuery):
+        from_clause = query.get_from_clause()
+        if isinstance(from_clause, (LogicalQuery, CompositeQuery)):
+            placeholders |= _get_placeholders(from_clause)
+
+    return placeholders
+
+
+def _fill_placeholders(query: SnQLQuery, normalized: NormalizedBody) -> SnQLQuery:
+    """
+    Returns a copy of the query with the placeholders replaced by the
+    literals. The expressions are immutable and the query containers are
+    all rebuilt by transform_expressions, so a shallow copy of each query
+    is enough to never change the cached one.
+    """
+
+    def restore_text(text: str) -> str:
+        return PLACEHOLDER_RE.sub(
+            lambda match: normalized.texts[int(match.group(1))], text
+        )
+
+    def fill(exp: Expression) -> Expression:
+        index = _get_placeholder(exp)
+        if index is not None:
+            exp = replace(exp, value=normalized.values[index])
+        if exp.alias is not None and PLACEHOLDER_PREFIX in exp.alias:
+            exp = replace(exp, alias=restore_text(exp.alias))
+        return exp
+
+    filled = copy.copy(query)
+    filled.set_experiments({**query.get_experiments()})
+    filled.transform_expressions(fill)
+    filled.set_ast_selected_columns(
+        [
+            replace(selected, name=restore_text(selected.name))
+            if selected.name is not None and PLACEHOLDER_PREFIX in selected.name
+            else selected
+            for selected in filled.get_selected_columns()
+        ]
+    )
+
+    if isinstance(filled, CompositeQuery):
+        from_clause = filled.get_from_clause()
+        if isinstance(from_clause, (LogicalQuery, CompositeQuery)):
+            filled.set_from_clause(_fill_placeholders(from_clause, normalized))
+
+    return filled
+
+
+class ParseTemplateCache:
+    """
+    A bounded LRU cache of the ASTs of query templates.
+
+    A template that cannot be parsed, or whose AST does not contain
+    every placeholder exactly as a literal, is remembered as not cacheable
+    and the queries built from it are always parsed in full.
+    """
+
+    def __init__(
+        self,
+        parse: Callable[[str], SnQLQuery],
+        max_size: int,
+        metrics: MetricsBackend,
+    ) -> None:
+        self.__parse = parse
+        self.__max_size = max_size
+        self.__metrics = metrics
+        self.__entries: MutableMapping[
+            Tuple[str, str], Optional[SnQLQuery]
+        ] = OrderedDict()
+        self.__lock = Lock()
+
+    def __parse_template(
+        self, template: str, literals_count: int
+    ) -> Optional[SnQLQuery]:
+        try:
+            query = self.__parse(template)
+        except Exception:
+            return None
+
+        if _get_placeholders(query) != set(range(literals_count)):
+            logger.debug("Template is not cacheable: %s", template)
+            return None
+
+        return query
+
+    def parse(self, body: str, namespace: str) -> SnQLQuery:
+        if self.__max_size <= 0:
+            return self.__parse(body)
+
+        normalized = normalize_literals(body)
+        if normalized is None:
+            self.__metrics.increment("not_cacheable")
+            return self.__parse(body)
+
+        key = (namespace, normalized.template)
+        with self.__lock:
+            cached = key in self.__entries
+            if cached:
+                self.__entries.move_to_end(key)  # type: ignore
+                query = self.__entries[key]
+
+        if not cached:
+            self.__metrics.increment("miss")
+            query = self.__parse_template(normalized.template, len(normalized.values))
+            with self.__lock:
+                self.__entries[key] = query
+                while len(self.__entries) > self.__max_size:
+                    self.__entries.popitem(last=False)  # type: ignore
+        elif query is not None:
+            self.__metrics.increment("hit")
+
+        if query is None:
+            if cached:
+                self.__metrics.increment("not_cacheable")
+            return self.__parse(body)
+
+        return _fill_placeholders(query, normalized)
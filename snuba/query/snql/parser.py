@@ -23,7 +23,7 @@ from parsimonious.exceptions import IncompleteParseError
 from parsimonious.grammar import Grammar
 from parsimonious.nodes import Node, NodeVisitor
 
-from snuba import state
+from snuba import environment, settings, state
 from snuba.clickhouse.columns import Array
 from snuba.clickhouse.query_dsl.accessors import get_time_range_expressions
 from snuba.datasets.dataset import Dataset
@@ -98,7 +98,9 @@ from snuba.query.snql.expression_visitor import (
     visit_quoted_literal,
 )
 from snuba.query.snql.joins import RelationshipTuple, build_join_clause
+from snuba.query.snql.parse_cache import ParseTemplateCache
 from snuba.util import parse_datetime
+from snuba.utils.metrics.wrapper import MetricsWrapper
 
 logger = logging.getLogger("snuba.snql.parser")
 
@@ -1462,13 +1464,20 @@ CustomProcessors = Sequence[
 ]
 
 
+parse_template_cache = ParseTemplateCache(
+    lambda body: parse_snql_query_initial(body),
+    settings.SNQL_PARSE_TEMPLATE_CACHE_SIZE,
+    MetricsWrapper(environment.metrics, "snql.parse_template_cache"),
+)
+
+
 def parse_snql_query(
     body: str,
     dataset: Dataset,
     custom_processing: Optional[CustomProcessors] = None,
 ) -> Tuple[Union[CompositeQuery[QueryEntity], LogicalQuery], str]:
     with sentry_sdk.start_span(op="parser", description="parse_snql_query_initial"):
-        query = parse_snql_query_initial(body)
+        query = parse_template_cache.parse(body, get_dataset_name(dataset))
 
     with sentry_sdk.start_span(op="parser", description="anonymize_snql_query"):
         snql_anonymized = format_snql_anonymized(query).get_sql()
@@ -1,3 +1,4 @@
+from contextvars import ContextVar
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
@@ -135,3 +136,12 @@ class SnubaQueryMetadata:
         # If we do not have any recorded query and we did not specifically log
         # invalid_query, we assume there was an error somewhere.
         return self.query_list[-1].status if self.query_list else QueryStatus.ERROR
+
+
+# The metadata the queries executed by the current context are recorded in,
+# set while the query pipeline of a request runs. Work done on other threads
+# on behalf of the request, like the speculative windows of a split query,
+# records in metadata of its own that is only merged if the work is used.
+current_query_metadata: ContextVar[Optional[SnubaQueryMetadata]] = ContextVar(
+    "current_query_metadata", default=None
+)
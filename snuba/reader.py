@@ -1,12 +1,14 @@
 from __future__ import annotations
 
 import itertools
+import json
 import re
 from abc import ABC, abstractmethod
 from typing import (
     Any,
     Callable,
     Iterator,
+    List,
     Mapping,
     MutableMapping,
     MutableSequence,
@@ -18,7 +20,11 @@ from typing import (
     TypeVar,
 )
 
+from snuba import environment
 from snuba.clickhouse.formatter.nodes import FormattedQuery
+from snuba.utils.metrics.wrapper import MetricsWrapper
+
+metrics = MetricsWrapper(environment.metrics, "reader")
 
 Column = TypedDict("Column", {"name": str, "type": str})
 Row = MutableMapping[str, Any]
@@ -35,6 +41,294 @@ Result = TypedDict(
 )
 
 
+class LazyRows(MutableSequence[Row], ABC):
+    """
+    The rows of a result in a representation that builds them only when
+    they are needed.
+
+    Columns can be transformed and renamed as a whole while the rows have
+    not been built. Results are serialized through `dump_result`, which
+    goes over the rows without keeping them. Any other access builds the
+    whole list of rows, from then on this behaves like a list of rows and
+    `lazy_rows_materialized` is recorded, so code that loses the benefit
+    of the lazy representation does not go unnoticed.
+    """
+
+    def __init__(self) -> None:
+        self.__rows: Optional[List[Row]] = None
+
+    def __repr__(self) -> str:
+        if self.__rows is None:
+            return f"<{type(self).__name__}>"
+        return repr(self.__rows)
+
+    @abstractmethod
+    def _build_rows(self) -> Iterator[Row]:
+        """
+        Builds the rows from the lazy representation, which is not used
+        anymore once this has been called.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _transform_lazy_column(
+        self, name: str, function: Callable[[Any], Any]
+    ) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _rename_lazy_columns(self, mapping: Mapping[str, Sequence[str]]) -> None:
+        raise NotImplementedError
+
+    def is_materialized(self) -> bool:
+        return self.__rows is not None
+
+    def __materialize(self) -> List[Row]:
+        if self.__rows is None:
+            metrics.increment(
+                "lazy_rows_materialized", tags={"type": type(self).__name__}
+            )
+            self.__rows = list(self._build_rows())
+        return self.__rows
+
+    def transform_column(self, name: str, function: Callable[[Any], Any]) -> None:
+        """
+        Replaces every value of a column with the one returned by the
+        function.
+        """
+        if self.__rows is None:
+            self._transform_lazy_column(name, function)
+        else:
+            for row in self.__rows:
+                row[name] = function(row[name])
+
+    def rename_columns(self, mapping: Mapping[str, Sequence[str]]) -> None:
+        """
+        Renames the columns according to the mapping. A column can be
+        mapped to multiple names, in which case its values are repeated
+        under each one of them.
+        """
+        if self.__rows is None:
+            self._rename_lazy_columns(mapping)
+        else:
+            self.__rows = [
+                {
+                    new_name: value
+                    for name, value in row.items()
+                    for new_name in mapping.get(name, [name])
+                }
+                for row in self.__rows
+            ]
+
+    def to_list(self) -> List[Row]:
+        return self.__materialize()
+
+    def iter_rows(self) -> Iterator[Row]:
+        """
+        Iterates over the rows without keeping them around if they have
+        not been built yet, which is what serializers should use. Changes
+        to the rows returned here are not reflected in the sequence.
+        """
+        if self.__rows is not None:
+            return iter(self.__rows)
+        return self._build_rows()
+
+    def __len__(self) -> int:
+        return len(self.__materialize())
+
+    def __iter__(self) -> Iterator[Row]:
+        return iter(self.__materialize())
+
+    def __getitem__(self, index: Any) -> Any:
+        return self.__materialize()[index]
+
+    def __setitem__(self, index: Any, value: Any) -> None:
+        self.__materialize()[index] = value
+
+    def __delitem__(self, index: Any) -> None:
+        del self.__materialize()[index]
+
+    def insert(self, index: int, value: Row) -> None:
+        self.__materialize().insert(index, value)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, LazyRows):
+            other = other.to_list()
+        return self.__materialize() == other
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Copies and pickles are plain lists of rows.
+        return (list, (self.__materialize(),))
+
+
+class ColumnarRows(LazyRows):
+    """
+    The rows of a result stored as one sequence of values per column, as
+    they are returned by the native driver when reading in columnar mode.
+    """
+
+    def __init__(
+        self, names: Sequence[str], columns: Sequence[Sequence[Any]], length: int
+    ) -> None:
+        assert len(names) == len(columns)
+        super().__init__()
+        self.__names = list(names)
+        self.__columns: List[Sequence[Any]] = list(columns)
+        self.__length = length
+
+    def __repr__(self) -> str:
+        if self.is_materialized():
+            return super().__repr__()
+        return f"<{type(self).__name__}: {self.__length} rows>"
+
+    def _build_rows(self) -> Iterator[Row]:
+        names = self.__names
+        if not names:
+            return ({} for _ in range(self.__length))
+        return (dict(zip(names, values)) for values in zip(*self.__columns))
+
+    def _transform_lazy_column(
+        self, name: str, function: Callable[[Any], Any]
+    ) -> None:
+        for index, column_name in enumerate(self.__names):
+            if column_name == name:
+                self.__columns[index] = list(map(function, self.__columns[index]))
+
+    def _rename_lazy_columns(self, mapping: Mapping[str, Sequence[str]]) -> None:
+        names: List[str] = []
+        columns: List[Sequence[Any]] = []
+        for name, column in zip(self.__names, self.__columns):
+            for new_name in mapping.get(name, [name]):
+                names.append(new_name)
+                columns.append(column)
+        self.__names = names
+        self.__columns = columns
+
+    def __len__(self) -> int:
+        if self.is_materialized():
+            return super().__len__()
+        return self.__length
+
+
+class StreamedRows(LazyRows):
+    """
+    The rows of a result read from the database while they are iterated
+    over, so a result can be sent before all its rows are received. The
+    stream can only be read once, and its length is not known before it
+    has been read, so asking for it builds the whole list of rows.
+
+    Column transformations and renames are applied to each row as it is
+    read from the stream.
+    """
+
+    def __init__(
+        self, columns: Sequence[Tuple[str, int]], values: Iterator[Sequence[Any]]
+    ) -> None:
+        super().__init__()
+        # The name of each column with the position of its value in the
+        # values read from the stream.
+        self.__columns = list(columns)
+        self.__values = values
+        self.__transforms: List[Tuple[int, Callable[[Any], Any]]] = []
+        self.__consumed = False
+
+    def _build_rows(self) -> Iterator[Row]:
+        assert not self.__consumed, "the rows of a stream can only be read once"
+        self.__consumed = True
+        return self.__read_rows()
+
+    def __read_rows(self) -> Iterator[Row]:
+        columns = self.__columns
+        transforms = self.__transforms
+        for values in self.__values:
+            if transforms:
+                values = list(values)
+                for index, function in transforms:
+                    values[index] = function(values[index])
+            yield {name: values[index] for name, index in columns}
+
+    def _transform_lazy_column(
+        self, name: str, function: Callable[[Any], Any]
+    ) -> None:
+        for column_name, index in self.__columns:
+            if column_name == name:
+                self.__transforms.append((index, function))
+
+    def _rename_lazy_columns(self, mapping: Mapping[str, Sequence[str]]) -> None:
+        self.__columns = [
+            (new_name, index)
+            for name, index in self.__columns
+            for new_name in mapping.get(name, [name])
+        ]
+
+
+class SharedRows(LazyRows):
+    """
+    Rows that are shared with other results, like the ones of a result
+    kept in a cache. The shared rows are never modified, each row is
+    copied when it is built, with the column transformations and renames
+    applied to it, so results that are only serialized are not copied.
+    """
+
+    def __init__(self, rows: Sequence[Row]) -> None:
+        super().__init__()
+        self.__shared = rows
+        self.__operations: List[Callable[[Row], Row]] = []
+
+    def __repr__(self) -> str:
+        if self.is_materialized():
+            return super().__repr__()
+        return f"<{type(self).__name__}: {len(self.__shared)} rows>"
+
+    def _build_rows(self) -> Iterator[Row]:
+        operations = self.__operations
+        for shared_row in self.__shared:
+            row: Row = {**shared_row}
+            for operation in operations:
+                row = operation(row)
+            yield row
+
+    def _transform_lazy_column(
+        self, name: str, function: Callable[[Any], Any]
+    ) -> None:
+        def transform(row: Row) -> Row:
+            if name in row:
+                row[name] = function(row[name])
+            return row
+
+        self.__operations.append(transform)
+
+    def _rename_lazy_columns(self, mapping: Mapping[str, Sequence[str]]) -> None:
+        def rename(row: Row) -> Row:
+            return {
+                new_name: value
+                for name, value in row.items()
+                for new_name in mapping.get(name, [name])
+            }
+
+        self.__operations.append(rename)
+
+    def __len__(self) -> int:
+        if self.is_materialized():
+            return super().__len__()
+        return len(self.__shared)
+
+
+def _encode_rows(value: Any) -> Any:
+    if isinstance(value, LazyRows):
+        return list(value.iter_rows())
+    raise TypeError(f"{value!r} is not JSON serializable")
+
+
+def dump_result(value: Any, dumps: Callable[..., str] = json.dumps) -> str:
+    """
+    Serializes a result, or any value that holds one, with the `dumps`
+    function of a JSON library. Results must be dumped through here since
+    their rows are not always a plain list.
+    """
+    return dumps(value, default=_encode_rows)
+
+
 def iterate_rows(result: Result) -> Iterator[Row]:
     if "totals" in result:
         return itertools.chain(result["data"], [result["totals"]])
@@ -110,8 +404,15 @@ def build_result_transformer(
                 transformer = transform_nullable(transformer)
 
             name = column["name"]
-            for row in iterate_rows(result):
-                row[name] = transformer(row[name])
+            data = result["data"]
+            if isinstance(data, LazyRows):
+                data.transform_column(name, transformer)
+                if "totals" in result:
+                    totals = result["totals"]
+                    totals[name] = transformer(totals[name])
+            else:
+                for row in iterate_rows(result):
+                    row[name] = transformer(row[name])
 
     return transform_result
 
@@ -132,6 +433,25 @@ class Reader(ABC):
         """Execute a query."""
         raise NotImplementedError
 
+    def execute_stream(
+        self,
+        query: FormattedQuery,
+        settings: Optional[Mapping[str, str]] = None,
+    ) -> Result:
+        """
+        Execute a query and return a result whose rows are read while
+        they are iterated over. Readers that cannot stream results read
+        them whole.
+        """
+        return self.execute(query, settings)
+
+    def kill_query(self, query_id: str) -> None:
+        """
+        Stop the query running with the given id, without waiting for it to
+        stop. Readers that cannot stop queries let them complete.
+        """
+        pass
+
     @property
     def cache_partition_id(self) -> Optional[str]:
         """
@@ -2,10 +2,19 @@ import logging
 import time
 from abc import ABC, abstractmethod
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from functools import partial
-from typing import Callable, List, Mapping, MutableMapping, Optional, Sequence
+from typing import (
+    Callable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 import simplejson as json
 from arroyo import Message
@@ -39,6 +48,8 @@ NODES_REFRESH_PERIOD = 10
 
 RESET_CHECK_CONFIG = "consumer_groups_to_reset_offset_check"
 
+T = TypeVar("T")
+
 
 class ShardedConnectionPool(ABC):
     """
@@ -129,11 +140,19 @@ class RoundRobinConnectionPool(ShardedConnectionPool):
 
 class InsertExecutor(ABC):
     """
-    Executes the Replacement insert query.
+    Executes the Replacement count and insert queries.
 
     Each implementation provides a different execution policy.
     """
 
+    @abstractmethod
+    def count(self, replacement: Replacement) -> Optional[int]:
+        """
+        Counts the rows the replacement applies to. Returns None if the
+        replacement has no count query.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def execute(self, replacement: Replacement, record_counts: int) -> int:
         """
@@ -169,6 +188,12 @@ class QueryNodeExecutor(InsertExecutor):
         self.__metrics = metrics
         self.__runner = runner
 
+    def count(self, replacement: Replacement) -> Optional[int]:
+        query = replacement.get_count_query(self.__table)
+        if query is None:
+            return None
+        return int(self.__connection.execute_robust(query).results[0][0])
+
     def execute(self, replacement: Replacement, records_count: int) -> int:
         query = replacement.get_insert_query(self.__table)
         if query is None:
@@ -181,6 +206,10 @@ class ShardedExecutor(InsertExecutor):
     """
     Executes a replacement query on each individual shard in parallel.
 
+    The rows are counted on each shard as well, so that the insert query
+    only runs on the shards that have rows to replace. The count and the
+    insert of a replacement run on the same replicas.
+
     It implements some basic retry logic by trying a different replica
     if the first attempt fails.
     It also falls back on a DistributedExecutor if everything fails.
@@ -203,14 +232,17 @@ class ShardedExecutor(InsertExecutor):
         self.__backup_executor = backup_executor
         self.__metrics = metrics
         self.__runner = runner
+        # The last replacement counted, with the nodes and the number of
+        # rows to replace of each shard that has any.
+        self.__counted: Optional[
+            Tuple[Replacement, Mapping[int, Tuple[Sequence[ClickhouseNode], int]]]
+        ] = None
 
     def __run_multiple_replicas(
         self,
         nodes: Sequence[ClickhouseNode],
-        query: str,
-        records_count: int,
-        metrics: MetricsBackend,
-    ) -> None:
+        run: Callable[[ClickhousePool], T],
+    ) -> T:
         """
         Makes multiple attempts to run the query.
         One per connection provided.
@@ -221,13 +253,7 @@ class ShardedExecutor(InsertExecutor):
                     ClickhouseClientSettings.REPLACE,
                     nodes[len(nodes) - remaining_attempts],
                 )
-                self.__runner(
-                    connection,
-                    query,
-                    records_count,
-                    metrics,
-                )
-                return
+                return run(connection)
             except Exception as e:
                 if remaining_attempts == 1:
                     raise
@@ -235,29 +261,87 @@ class ShardedExecutor(InsertExecutor):
                     "Replacement processing failed on the main connection",
                     exc_info=e,
                 )
+        raise AssertionError("No nodes to run the query on")
+
+    def __run_on_shards(
+        self,
+        shards: Mapping[int, Sequence[ClickhouseNode]],
+        run: Callable[[int, ClickhousePool], T],
+    ) -> Mapping[int, T]:
+        """
+        Runs the query on every shard in parallel and returns the result
+        for each shard.
+        """
+        result_futures: Mapping[int, Future[T]] = {
+            shard: self.__thread_pool.submit(
+                self.__run_multiple_replicas, nodes, partial(run, shard)
+            )
+            for shard, nodes in shards.items()
+        }
+        for result in as_completed(result_futures.values()):
+            e = result.exception()
+            if e is not None:
+                raise e
+        return {shard: future.result() for shard, future in result_futures.items()}
+
+    def count(self, replacement: Replacement) -> Optional[int]:
+        query = replacement.get_count_query(self.__local_table_name)
+        if query is None:
+            return None
+
+        shards = self.__connection_pool.get_connections()
+
+        def run_count(shard: int, connection: ClickhousePool) -> int:
+            assert query is not None
+            return int(connection.execute_robust(query).results[0][0])
+
+        try:
+            counts = self.__run_on_shards(shards, run_count)
+        except Exception as e:
+            logger.warning(
+                "Replacement count failed on the main connection",
+                exc_info=e,
+            )
+            self.__counted = None
+            return self.__backup_executor.count(replacement)
+
+        self.__counted = (
+            replacement,
+            {
+                shard: (shards[shard], count)
+                for shard, count in counts.items()
+                if count > 0
+            },
+        )
+        return sum(counts.values())
 
     def execute(self, replacement: Replacement, records_count: int) -> int:
         try:
             query = replacement.get_insert_query(self.__local_table_name)
             if query is None:
                 return 0
-            result_futures = []
-            for nodes in self.__connection_pool.get_connections().values():
-                result_futures.append(
-                    self.__thread_pool.submit(
-                        partial(
-                            self.__run_multiple_replicas,
-                            nodes=nodes,
-                            query=query,
-                            records_count=records_count,
-                            metrics=self.__metrics,
-                        )
-                    )
+
+            shards: Mapping[int, Sequence[ClickhouseNode]]
+            if self.__counted is not None and self.__counted[0] is replacement:
+                counted_shards = self.__counted[1]
+                shards = {shard: nodes for shard, (nodes, _) in counted_shards.items()}
+                shard_counts = {
+                    shard: count for shard, (_, count) in counted_shards.items()
+                }
+            else:
+                shards = self.__connection_pool.get_connections()
+                shard_counts = {}
+
+            def run_insert(shard: int, connection: ClickhousePool) -> None:
+                assert query is not None
+                self.__runner(
+                    connection,
+                    query,
+                    shard_counts.get(shard, records_count),
+                    self.__metrics,
                 )
-            for result in as_completed(result_futures):
-                e = result.exception()
-                if e is not None:
-                    raise e
+
+            self.__run_on_shards(shards, run_insert)
             return records_count
 
         except Exception as e:
@@ -391,32 +475,57 @@ class ReplacerWorker(AbstractBatchWorker[KafkaPayload, Replacement]):
         else:
             raise InvalidMessageVersion("Unknown message format: " + str(seq_message))
 
+    def __coalesce(self, batch: Sequence[Replacement]) -> Sequence[Replacement]:
+        """
+        Merges the consecutive replacements of the batch that can be run
+        with a single count and insert query, up to
+        `max_merged_replacements` of them. Only consecutive replacements are
+        merged, so they are still applied in the order of the batch.
+        """
+        max_merged = get_config("max_merged_replacements", 20)
+        assert isinstance(max_merged, int)
+
+        coalesced: List[Replacement] = []
+        merged_count = 0
+        for replacement in batch:
+            if coalesced and merged_count < max_merged:
+                merged = coalesced[-1].merge(replacement)
+                if merged is not None:
+                    coalesced[-1] = merged
+                    merged_count += 1
+                    continue
+            coalesced.append(replacement)
+            merged_count = 1
+
+        if batch:
+            self.metrics.increment("replacements.received", len(batch))
+            self.metrics.increment("replacements.executed", len(coalesced))
+            self.metrics.timing(
+                "replacements.coalescing_ratio", len(batch) / len(coalesced)
+            )
+        return coalesced
+
     def flush_batch(self, batch: Sequence[Replacement]) -> None:
         need_optimize = False
         clickhouse_read = self.__storage.get_cluster().get_query_connection(
             ClickhouseClientSettings.REPLACE
         )
 
-        for replacement in batch:
+        for replacement in self.__coalesce(batch):
 
             start_time = time.time()
 
-            table_name = self.__replacer_processor.get_schema().get_table_name()
-            count_query = replacement.get_count_query(table_name)
-
-            if count_query is not None:
-                count = clickhouse_read.execute_robust(count_query).results[0][0]
-                if count == 0:
-                    continue
-            else:
-                count = 0
+            query_executor = self.__get_insert_executor(replacement)
+            counted = query_executor.count(replacement)
+            if counted == 0:
+                continue
+            count = counted or 0
 
             need_optimize = (
                 self.__replacer_processor.pre_replacement(replacement, count)
                 or need_optimize
             )
 
-            query_executor = self.__get_insert_executor(replacement)
             with self.__rate_limiter as state:
                 self.metrics.increment("insert_state", tags={"state": state[0].value})
                 count = query_executor.execute(replacement, count)
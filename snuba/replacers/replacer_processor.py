@@ -50,6 +50,14 @@ class Replacement(ABC):
     def get_message_metadata(self) -> ReplacementMessageMetadata:
         raise NotImplementedError()
 
+    def merge(self, other: "Replacement") -> Optional["Replacement"]:
+        """
+        Returns a single replacement with the same effect as running this
+        replacement followed by `other`, if there is one that can be run
+        with a single count and insert query.
+        """
+        return None
+
 
 R = TypeVar("R", bound=Replacement)
 
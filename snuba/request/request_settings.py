@@ -43,6 +43,10 @@ class RequestSettings(ABC):
     def get_legacy(self) -> bool:
         pass
 
+    @abstractmethod
+    def get_stream_response(self) -> bool:
+        pass
+
     @abstractmethod
     def get_team(self) -> str:
         pass
@@ -71,6 +75,17 @@ class RequestSettings(ABC):
     def set_resource_quota(self, quota: ResourceQuota) -> None:
         pass
 
+    # The id the query is run with on ClickHouse, if it should not be the
+    # one derived from its SQL, so that it can be killed without affecting
+    # identical queries.
+    @abstractmethod
+    def get_query_id(self) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set_query_id(self, query_id: Optional[str]) -> None:
+        pass
+
 
 class HTTPRequestSettings(RequestSettings):
     """
@@ -88,6 +103,7 @@ class HTTPRequestSettings(RequestSettings):
         parent_api: str = "<unknown>",
         dry_run: bool = False,
         legacy: bool = False,
+        stream_response: bool = False,
         team: str = "<unknown>",
         feature: str = "<unknown>",
         app_id: str = "default",
@@ -99,11 +115,13 @@ class HTTPRequestSettings(RequestSettings):
         self.__parent_api = parent_api
         self.__dry_run = dry_run
         self.__legacy = legacy
+        self.__stream_response = stream_response
         self.__team = team
         self.__feature = feature
         self.__app_id = app_id
         self.__rate_limit_params: List[RateLimitParameters] = []
         self.__resource_quota: Optional[ResourceQuota] = None
+        self.__query_id: Optional[str] = None
 
     def get_turbo(self) -> bool:
         return self.__turbo
@@ -123,6 +141,9 @@ class HTTPRequestSettings(RequestSettings):
     def get_legacy(self) -> bool:
         return self.__legacy
 
+    def get_stream_response(self) -> bool:
+        return self.__stream_response
+
     def get_team(self) -> str:
         return self.__team
 
@@ -144,6 +165,12 @@ class HTTPRequestSettings(RequestSettings):
     def set_resource_quota(self, quota: ResourceQuota) -> None:
         self.__resource_quota = quota
 
+    def get_query_id(self) -> Optional[str]:
+        return self.__query_id
+
+    def set_query_id(self, query_id: Optional[str]) -> None:
+        self.__query_id = query_id
+
 
 class SubscriptionRequestSettings(RequestSettings):
     """
@@ -166,6 +193,7 @@ class SubscriptionRequestSettings(RequestSettings):
         self.__team = team
         self.__feature = feature
         self.__app_id = app_id
+        self.__query_id: Optional[str] = None
 
     def get_turbo(self) -> bool:
         return False
@@ -185,6 +213,9 @@ class SubscriptionRequestSettings(RequestSettings):
     def get_legacy(self) -> bool:
         return False
 
+    def get_stream_response(self) -> bool:
+        return False
+
     def get_team(self) -> str:
         return self.__team
 
@@ -205,3 +236,9 @@ class SubscriptionRequestSettings(RequestSettings):
 
     def set_resource_quota(self, quota: ResourceQuota) -> None:
         pass
+
+    def get_query_id(self) -> Optional[str]:
+        return self.__query_id
+
+    def set_query_id(self, query_id: Optional[str]) -> None:
+        self.__query_id = query_id
@@ -133,6 +133,11 @@ SETTINGS_SCHEMAS: Mapping[Type[RequestSettings], Schema] = {
             "dry_run": {"type": "boolean", "default": False},
             # Flags if this a legacy query that was automatically generated by the SnQL SDK
             "legacy": {"type": "boolean", "default": False},
+            # Serialize the response incrementally, a chunk of rows at a time,
+            # as the rows are read from ClickHouse, instead of building the
+            # whole JSON document in memory. Such results are not cached and
+            # an error after the first rows aborts the response.
+            "stream_response": {"type": "boolean", "default": False},
             # Team and feature are used for resource attribution
             "team": {"type": "string", "default": "<unknown>"},
             "feature": {"type": "string", "default": "<unknown>"},
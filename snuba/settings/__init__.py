@@ -53,6 +53,9 @@ CLUSTERS: Sequence[Mapping[str, Any]] = [
             "profiles",
         },
         "single_node": True,
+        # Optional compression of the inserts sent over HTTP, either "lz4"
+        # or "zstd". Inserts are sent uncompressed when it is not set.
+        "insert_compression": os.environ.get("CLICKHOUSE_INSERT_COMPRESSION"),
     },
 ]
 
@@ -85,12 +88,18 @@ REDIS_DB = int(os.environ.get("REDIS_DB", 1))
 REDIS_INIT_MAX_RETRIES = 3
 
 USE_RESULT_CACHE = True
+# Size in bytes of the in-process tier of each query result cache partition,
+# 0 disables it.
+LOCAL_RESULT_CACHE_MAX_BYTES = 0
 
 # Query Recording Options
 RECORD_QUERIES = False
 
 # Runtime Config Options
 CONFIG_MEMOIZE_TIMEOUT = 10
+# The configs are read again after this many seconds even if their version
+# did not change.
+CONFIG_RELOAD_TIMEOUT = 300
 
 # Sentry Options
 SENTRY_DSN = None
@@ -126,6 +135,10 @@ KAFKA_BROKER_CONFIG: Mapping[str, Mapping[str, Any]] = {}
 
 DEFAULT_MAX_BATCH_SIZE = 50000
 DEFAULT_MAX_BATCH_TIME_MS = 2 * 1000
+# Lower bounds and latency target of consumers using adaptive batching.
+DEFAULT_MIN_BATCH_SIZE = 1000
+DEFAULT_MIN_BATCH_TIME_MS = 200
+DEFAULT_TARGET_LATENCY_MS = 5 * 1000
 DEFAULT_QUEUED_MAX_MESSAGE_KBYTES = 10000
 DEFAULT_QUEUED_MIN_MESSAGES = 10000
 DISCARD_OLD_EVENTS = True
@@ -141,6 +154,10 @@ RETENTION_OVERRIDES: Mapping[int, int] = {}
 MAX_PREWHERE_CONDITIONS = 1
 
 STATS_IN_RESPONSE = False
+# Number of rows serialized at a time in streaming query responses.
+STREAMING_RESPONSE_CHUNK_ROWS = 1000
+# Number of parsed SnQL query templates cached per process, 0 disables it.
+SNQL_PARSE_TEMPLATE_CACHE_SIZE = 0
 
 PAYLOAD_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
@@ -151,6 +168,9 @@ REPLACER_MAX_MEMORY_USAGE = 10 * (1024**3)  # 10GB
 # to queries.
 REPLACER_KEY_TTL = 12 * 60 * 60
 REPLACER_MAX_GROUP_IDS_TO_EXCLUDE = 256
+# Seconds the replacement flags of a project are cached by the query
+# processors, as long as no replacement happens. 0 disables the cache.
+REPLACER_FLAGS_CACHE_TTL = 10
 REPLACER_IMMEDIATE_OPTIMIZE = False
 REPLACER_PROCESSING_TIMEOUT_THRESHOLD = 2 * 60  # 2 minutes in seconds
 REPLACER_PROCESSING_TIMEOUT_THRESHOLD_KEY_TTL = 60 * 60  # 1 hour in seconds
@@ -166,6 +186,9 @@ COLUMN_SPLIT_MIN_COLS = 6
 COLUMN_SPLIT_MAX_LIMIT = 1000
 COLUMN_SPLIT_MAX_RESULTS = 5000
 
+# Size of the pool running the time split windows executed speculatively.
+SPLIT_SPECULATION_THREADS = 8
+
 # Migrations in skipped groups will not be run
 SKIPPED_MIGRATION_GROUPS: Set[str] = {"querylog", "profiles"}
 
@@ -189,6 +212,10 @@ ENABLE_METRICS_SUBSCRIPTIONS = os.environ.get("ENABLE_METRICS_SUBSCRIPTIONS", Fa
 SUBSCRIPTIONS_DEFAULT_BUFFER_SIZE = 10000
 SUBSCRIPTIONS_ENTITY_BUFFER_SIZE: Mapping[str, int] = {}  # (entity name, buffer size)
 
+# Number of changed subscriptions each partition keeps track of, schedulers
+# further behind reload the whole partition.
+SUBSCRIPTIONS_CHANGELOG_SIZE = 10000
+
 TRANSACTIONS_DIRECT_TO_READONLY_REFERRERS: Set[str] = set()
 
 # Used for migrating to/from writing metrics directly to aggregate tables
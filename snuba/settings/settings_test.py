@@ -26,3 +26,6 @@ REPLACER_PROCESSING_TIMEOUT_THRESHOLD = 0  # ms
 
 # Set enforce retention to true for tests
 ENFORCE_RETENTION = True
+
+# Exercise the SnQL parse template cache in every test that parses a query
+SNQL_PARSE_TEMPLATE_CACHE_SIZE = 1000
@@ -52,11 +52,16 @@ def validate_settings(locals: Mapping[str, Any]) -> None:
             raise ValueError(f"Invalid topic value {key}")
 
     # Validate cluster configuration
+    from snuba.clickhouse.compression import COMPRESSORS
     from snuba.clusters.storage_sets import JOINABLE_STORAGE_SETS, StorageSetKey
 
     storage_set_to_cluster: MutableMapping[StorageSetKey, Any] = {}
 
     for cluster in locals["CLUSTERS"]:
+        insert_compression = cluster.get("insert_compression")
+        if insert_compression is not None and insert_compression not in COMPRESSORS:
+            raise ValueError(f"Invalid insert compression {insert_compression}")
+
         for cluster_storage_set in cluster["storage_sets"]:
             try:
                 storage_set_to_cluster[StorageSetKey(cluster_storage_set)] = cluster
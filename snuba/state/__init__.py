@@ -2,8 +2,9 @@ from __future__ import absolute_import
 
 import logging
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from functools import partial
+from threading import Lock
 from typing import (
     Any,
     Callable,
@@ -36,6 +37,7 @@ rds = redis_client
 ratelimit_prefix = "snuba-ratelimit:"
 query_lock_prefix = "snuba-query-lock:"
 config_hash = "snuba-config"
+config_version_key = "snuba-config-version"
 config_description_hash = "snuba-config-description"
 config_history_hash = "snuba-config-history"
 config_changes_list = "snuba-config-changes"
@@ -170,7 +172,11 @@ def set_config(
             p.hset(config_history_hash, key, json.dumps(change_record))
         p.lpush(config_changes_list, json.dumps((key, change_record)))
         p.ltrim(config_changes_list, 0, config_changes_list_limit)
+        p.incr(config_version_key)
         p.execute()
+        # The change is visible in this process right away, the others
+        # get it on their next refresh.
+        _config_store.refresh(force=True)
         logger.info(f"Successfully changed option {key} to {value}")
     except MismatchedTypeException as exc:
         logger.exception(
@@ -188,33 +194,123 @@ def set_configs(
         set_config(k, v, user=user, force=force)
 
 
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    The runtime configuration as of a version of the config hash. The
+    version is incremented by every change, and is None until the first
+    change.
+    """
+
+    version: Optional[int]
+    configs: Mapping[str, Optional[Any]]
+    # When the configs were read from Redis.
+    loaded_at: float
+    # When the version was last checked against Redis.
+    checked_at: float
+
+
+class ConfigStore:
+    """
+    Holds the snapshot of the runtime configuration of the process.
+
+    Reading it requires no lock and no copy. Once the snapshot is older
+    than `timeout`, the first thread reading it refreshes it while the
+    others keep reading the current one. Refreshing only reads the
+    version from Redis, the whole config hash is read only when the
+    version changed or when the snapshot is older than `reload_timeout`.
+    """
+
+    def __init__(self, timeout: float, reload_timeout: float) -> None:
+        self.__timeout = timeout
+        self.__reload_timeout = reload_timeout
+        self.__snapshot: Optional[ConfigSnapshot] = None
+        self.__lock = Lock()
+
+    def get(self) -> ConfigSnapshot:
+        snapshot = self.__snapshot
+        if snapshot is not None and time.time() <= snapshot.checked_at + self.__timeout:
+            return snapshot
+
+        # Nothing can be returned before the first snapshot is loaded.
+        if not self.__lock.acquire(blocking=snapshot is None):
+            assert snapshot is not None
+            return snapshot
+        try:
+            if self.__snapshot is snapshot:
+                self.__snapshot = self.__load(snapshot, force=False)
+            assert self.__snapshot is not None
+            return self.__snapshot
+        finally:
+            self.__lock.release()
+
+    def refresh(self, force: bool = False) -> None:
+        with self.__lock:
+            self.__snapshot = self.__load(self.__snapshot, force)
+
+    def __load(self, snapshot: Optional[ConfigSnapshot], force: bool) -> ConfigSnapshot:
+        now = time.time()
+        try:
+            version = rds.get(config_version_key)
+            if version is not None:
+                version = int(version)
+            if (
+                not force
+                and snapshot is not None
+                and version == snapshot.version
+                and now <= snapshot.loaded_at + self.__reload_timeout
+            ):
+                return replace(snapshot, checked_at=now)
+
+            metrics.increment("config.load")
+            all_configs = rds.hgetall(config_hash)
+            return ConfigSnapshot(
+                version,
+                {
+                    k.decode("utf-8"): get_typed_value(v.decode("utf-8"))
+                    for k, v in all_configs.items()
+                    if v is not None
+                },
+                now,
+                now,
+            )
+        except Exception as ex:
+            logger.exception(ex)
+            if snapshot is not None:
+                return replace(snapshot, checked_at=now)
+            return ConfigSnapshot(None, {}, float("-inf"), now)
+
+
+_config_store = ConfigStore(
+    settings.CONFIG_MEMOIZE_TIMEOUT, settings.CONFIG_RELOAD_TIMEOUT
+)
+
+
 def get_config(key: str, default: Optional[Any] = None) -> Optional[Any]:
-    return get_all_configs().get(key, default)
+    return _config_store.get().configs.get(key, default)
 
 
 def get_configs(
     key_defaults: Iterable[Tuple[str, Optional[Any]]]
 ) -> Sequence[Optional[Any]]:
-    all_confs = get_all_configs()
+    all_confs = _config_store.get().configs
     return [all_confs.get(k, d) for k, d in key_defaults]
 
 
 def get_all_configs() -> Mapping[str, Optional[Any]]:
-    return {k: v for k, v in get_raw_configs().items()}
+    """
+    Returns the configs of the current snapshot, which must not be
+    modified.
+    """
+    return _config_store.get().configs
 
 
-@memoize(settings.CONFIG_MEMOIZE_TIMEOUT)
 def get_raw_configs() -> Mapping[str, Optional[Any]]:
-    try:
-        all_configs = rds.hgetall(config_hash)
-        return {
-            k.decode("utf-8"): get_typed_value(v.decode("utf-8"))
-            for k, v in all_configs.items()
-            if v is not None
-        }
-    except Exception as ex:
-        logger.exception(ex)
-        return {}
+    return _config_store.get().configs
+
+
+def get_config_snapshot() -> ConfigSnapshot:
+    return _config_store.get()
 
 
 def delete_config(key: str, user: Optional[Any] = None) -> None:
@@ -1,11 +1,16 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Generic, Optional, TypeVar
+from typing import Callable, Generic, Optional, Tuple, TypeVar
 
 from snuba.utils.metrics.timer import Timer
 from snuba.utils.serializable_exception import SerializableException
 
 TValue = TypeVar("TValue")
 
+# The types of cache hits reported by ``Cache.get_readthrough``.
+RESULT_VALUE = 0
+RESULT_EXECUTE = 1
+RESULT_WAIT = 2
+
 
 class ExecutionError(SerializableException):
     pass
@@ -27,6 +32,13 @@ class Cache(Generic[TValue], ABC):
         """
         raise NotImplementedError
 
+    def get_with_ttl(self, key: str) -> Tuple[Optional[TValue], Optional[float]]:
+        """
+        Gets a value from the cache together with the number of seconds it
+        remains in the cache for, or None if that is not known.
+        """
+        return self.get(key), None
+
     @abstractmethod
     def set(self, key: str, value: TValue) -> None:
         """
@@ -75,3 +87,22 @@ class Cache(Generic[TValue], ABC):
         the full timeout duration.
         """
         raise NotImplementedError
+
+    def get_readthrough_with_ttl(
+        self,
+        key: str,
+        function: Callable[[], TValue],
+        record_cache_hit_type: Callable[[int], None],
+        timeout: int,
+        timer: Optional[Timer] = None,
+    ) -> Tuple[TValue, Optional[float]]:
+        """
+        Same as ``get_readthrough``, also returning the number of seconds
+        the value remains in the cache for, or None if that is not known.
+        """
+        return (
+            self.get_readthrough(
+                key, function, record_cache_hit_type, timeout, timer
+            ),
+            None,
+        )
@@ -0,0 +1,151 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Generic, Optional
+
+from snuba.state import get_config
+from snuba.state.cache.abstract import RESULT_VALUE, Cache, TValue
+from snuba.utils.metrics import MetricsBackend
+from snuba.utils.metrics.timer import Timer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class LocalCacheEntry(Generic[TValue]):
+    value: TValue
+    size: int
+    expires_at: float
+
+
+class LocalCache(Cache[TValue]):
+    """
+    An in-process cache tier in front of another cache.
+
+    Values read from or written to the inner cache are kept in memory, so
+    that the following reads of the same key on this process neither go
+    to the inner cache nor decode the value again. Values expire after
+    ``cache_expiry_sec``, like the ones of the inner cache, or when they
+    expire in the inner cache if that is earlier. The least recently used
+    ones are evicted when the total size of the values goes beyond
+    ``max_size``. The size of each value is measured with
+    ``get_size``, values larger than ``max_size`` are never kept.
+
+    Callers are free to mutate the values they get from a cache. Values
+    are copied with ``copy`` when they are stored, since the caller keeps
+    the original, and returned through ``share``, which must keep the
+    changes made by the caller away from the stored value. ``share`` is
+    called on every hit, so it should avoid copying what the callers do
+    not change.
+
+    On a miss, ``get_readthrough`` is delegated to the inner cache, which
+    keeps the read-through and deduplication semantics of the inner cache
+    across processes with a single lookup.
+    """
+
+    def __init__(
+        self,
+        inner: Cache[TValue],
+        max_size: int,
+        get_size: Callable[[TValue], int],
+        copy: Callable[[TValue], TValue],
+        share: Callable[[TValue], TValue],
+        metrics: MetricsBackend,
+    ) -> None:
+        assert max_size > 0
+        self.__inner = inner
+        self.__max_size = max_size
+        self.__get_size = get_size
+        self.__copy = copy
+        self.__share = share
+        self.__metrics = metrics
+
+        self.__entries: OrderedDict[str, LocalCacheEntry[TValue]] = OrderedDict()
+        self.__size = 0
+        self.__lock = Lock()
+
+    def __pop(self, key: str) -> LocalCacheEntry[TValue]:
+        entry = self.__entries.pop(key)
+        self.__size -= entry.size
+        return entry
+
+    def __get_local(self, key: str) -> Optional[TValue]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry.expires_at > time.time():
+                    self.__entries.move_to_end(key)
+                else:
+                    self.__pop(key)
+                    entry = None
+
+        if entry is None:
+            self.__metrics.increment("miss")
+            return None
+
+        self.__metrics.increment("hit")
+        return self.__share(entry.value)
+
+    def __set_local(self, key: str, value: TValue, ttl: Optional[float] = None) -> None:
+        size = self.__get_size(value)
+        if size > self.__max_size:
+            self.__metrics.increment("too_large")
+            return
+
+        expiry = get_config("cache_expiry_sec", 1)
+        assert expiry is not None
+        if ttl is not None:
+            expiry = min(expiry, ttl)
+        entry = LocalCacheEntry(self.__copy(value), size, time.time() + expiry)
+        evictions = 0
+        with self.__lock:
+            if key in self.__entries:
+                self.__pop(key)
+            self.__entries[key] = entry
+            self.__size += size
+            while self.__size > self.__max_size:
+                self.__pop(next(iter(self.__entries)))
+                evictions += 1
+            total_size = self.__size
+
+        if evictions:
+            self.__metrics.increment("eviction", evictions)
+        self.__metrics.gauge("size_bytes", total_size)
+
+    def get(self, key: str) -> Optional[TValue]:
+        value = self.__get_local(key)
+        if value is not None:
+            return value
+
+        value, ttl = self.__inner.get_with_ttl(key)
+        if value is not None:
+            self.__set_local(key, value, ttl)
+        return value
+
+    def set(self, key: str, value: TValue) -> None:
+        self.__inner.set(key, value)
+        self.__set_local(key, value)
+
+    def get_readthrough(
+        self,
+        key: str,
+        function: Callable[[], TValue],
+        record_cache_hit_type: Callable[[int], None],
+        timeout: int,
+        timer: Optional[Timer] = None,
+    ) -> TValue:
+        value = self.__get_local(key)
+        if value is not None:
+            if timer is not None:
+                timer.mark("cache_get")
+            record_cache_hit_type(RESULT_VALUE)
+            return value
+
+        # Errors are raised by the inner cache and never stored locally.
+        value, ttl = self.__inner.get_readthrough_with_ttl(
+            key, function, record_cache_hit_type, timeout, timer
+        )
+        self.__set_local(key, value, ttl)
+        return value
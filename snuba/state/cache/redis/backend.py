@@ -2,7 +2,7 @@ import concurrent.futures
 import logging
 import uuid
 from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Optional, Type
+from typing import Callable, Optional, Tuple, Type
 
 from pkg_resources import resource_string
 
@@ -10,6 +10,9 @@ from redis.exceptions import ResponseError
 from snuba.redis import RedisClientType
 from snuba.state import get_config
 from snuba.state.cache.abstract import (
+    RESULT_EXECUTE,
+    RESULT_VALUE,
+    RESULT_WAIT,
     Cache,
     ExecutionError,
     ExecutionTimeoutError,
@@ -22,11 +25,6 @@ from snuba.utils.serializable_exception import SerializableException
 logger = logging.getLogger(__name__)
 
 
-RESULT_VALUE = 0
-RESULT_EXECUTE = 1
-RESULT_WAIT = 2
-
-
 class RedisCache(Cache[TValue]):
     def __init__(
         self,
@@ -65,6 +63,18 @@ class RedisCache(Cache[TValue]):
 
         return self.__codec.decode(value)
 
+    def get_with_ttl(self, key: str) -> Tuple[Optional[TValue], Optional[float]]:
+        result_key = self.__build_key(key)
+        pipe = self.__client.pipeline()
+        pipe.get(result_key)
+        pipe.pttl(result_key)
+        value, ttl_ms = pipe.execute()
+        if value is None:
+            return None, None
+
+        # A negative TTL means that the key has no expiry.
+        return self.__codec.decode(value), ttl_ms / 1000 if ttl_ms >= 0 else None
+
     def set(self, key: str, value: TValue) -> None:
         self.__client.set(
             self.__build_key(key),
@@ -80,6 +90,19 @@ class RedisCache(Cache[TValue]):
         timeout: int,
         timer: Optional[Timer] = None,
     ) -> TValue:
+        value, _ = self.get_readthrough_with_ttl(
+            key, function, record_cache_hit_type, timeout, timer
+        )
+        return value
+
+    def get_readthrough_with_ttl(
+        self,
+        key: str,
+        function: Callable[[], TValue],
+        record_cache_hit_type: Callable[[int], None],
+        timeout: int,
+        timer: Optional[Timer] = None,
+    ) -> Tuple[TValue, Optional[float]]:
         # This method is designed with the following goals in mind:
         # 1. The value generation function is only executed when no value
         # already exists for the key.
@@ -145,7 +168,12 @@ class RedisCache(Cache[TValue]):
         if result[0] == RESULT_VALUE:
             # If we got a cache hit, this is easy -- we just return it.
             logger.debug("Immediately returning result from cache hit.")
-            return self.__codec.decode(result[1])
+            # A negative TTL means that the key has no expiry.
+            ttl_ms = int(result[2])
+            return (
+                self.__codec.decode(result[1]),
+                ttl_ms / 1000 if ttl_ms >= 0 else None,
+            )
         elif result[0] == RESULT_EXECUTE:
 
             # If we were the first in line, we need to execute the function.
@@ -211,7 +239,7 @@ class RedisCache(Cache[TValue]):
                 else:
                     if timer is not None:
                         timer.mark("cache_set")
-            return value
+            return value, None
         elif result[0] == RESULT_WAIT:
             # If we were not the first in line, we need to wait for the first
             # client to finish and populate the cache with the result value.
@@ -245,13 +273,13 @@ class RedisCache(Cache[TValue]):
                 # for generating the cache value errored while generating it.
                 if raw_value is None:
                     if upsteam_error_payload:
-                        return self.__codec.decode(upsteam_error_payload)
+                        return self.__codec.decode(upsteam_error_payload), None
 
                     raise ExecutionError(
                         "no value at key: this means the original process executing the query crashed before the exception could be handled or an error was thrown setting the cache result"
                     )
                 else:
-                    return self.__codec.decode(raw_value)
+                    return self.__codec.decode(raw_value), None
             else:
                 # We timed out waiting for the notification -- something went
                 # wrong with the client that was generating the cache value.
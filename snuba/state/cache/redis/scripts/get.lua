@@ -14,10 +14,11 @@ local CODE_RESULT_EXECUTE = 1
 local CODE_RESULT_WAIT = 2
 
 -- Check to see if a value already exists at the result key. If one does, we
--- don't have to do anything other than return it and exit.
+-- don't have to do anything other than return it, with the number of
+-- milliseconds it remains in the cache for, and exit.
 local value = redis.call('GET', value_key)
 if value then
-    return {CODE_RESULT_VALUE, value}
+    return {CODE_RESULT_VALUE, value, redis.call('PTTL', value_key)}
 end
 
 -- Check to see if a waiting queue has already been established. If we are the
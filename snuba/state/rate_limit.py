@@ -2,12 +2,24 @@ import logging
 import sys
 import time
 import uuid
+from bisect import bisect_left, insort
 from collections import ChainMap, namedtuple
-from contextlib import AbstractContextManager, ExitStack, contextmanager
+from contextlib import AbstractContextManager, contextmanager
 from dataclasses import dataclass
+from threading import Lock
 from types import TracebackType
+from typing import Any
 from typing import ChainMap as TypingChainMap
-from typing import Iterator, Mapping, MutableMapping, Optional, Sequence, Type
+from typing import (
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
 
 from snuba import environment, state
 from snuba.redis import redis_client as rds
@@ -90,54 +102,24 @@ class RateLimitStatsContainer:
         return ChainMap(*grouped_stats)
 
 
-@contextmanager
-def rate_limit(
-    rate_limit_params: RateLimitParameters,
-) -> Iterator[Optional[RateLimitStats]]:
-    """
-    A context manager for rate limiting that allows for limiting based on:
-        * a rolling-window per-second rate
-        * the number of queries concurrently running.
-
-    It uses one redis sorted set to keep track of both of these limits
-    The following mapping is kept in redis:
-
-        bucket: SortedSet([(timestamp1, query_id1), (timestamp2, query_id2) ...])
-
+Reason = namedtuple("Reason", "scope name val limit")
 
-    Queries are thrown ahead in time when they start so we can count them
-    as concurrent, and thrown back to their start time once they finish so
-    we can count them towards the historical rate. See the comments for
-    an example.
 
-               time >>----->
-    +-----------------------------+--------------------------------+
-    | historical query window     | currently executing queries    |
-    +-----------------------------+--------------------------------+
-                                  ^
-                                 now
+def _add_to_pipeline(
+    pipe: Any,
+    bucket: str,
+    query_id: uuid.UUID,
+    rate_limit_params: RateLimitParameters,
+    now: float,
+    rate_history_s: float,
+) -> None:
+    """
+    Queues the four commands counting the query in the bucket and
+    returning the number of stale, historical and concurrent queries
+    in it, in that order.
     """
-
-    bucket = "{}{}".format(state.ratelimit_prefix, rate_limit_params.bucket)
-    query_id = uuid.uuid4()
-
-    now = time.time()
-    bypass_rate_limit, rate_history_s = state.get_configs(
-        [("bypass_rate_limit", 0), ("rate_history_sec", 3600)]
-        #                               ^ number of seconds the timestamps are kept
-    )
-    assert isinstance(rate_history_s, (int, float))
-
-    if bypass_rate_limit == 1:
-        yield None
-        return
-
-    pipe = rds.pipeline(transaction=False)
     # cleanup old query timestamps past our retention window
-    stale_queries = pipe.zremrangebyscore(
-        bucket, "-inf", "({:f}".format(now - rate_history_s)
-    )
-    metrics.increment("rate_limit.stale", stale_queries, tags={"bucket": bucket})
+    pipe.zremrangebyscore(bucket, "-inf", "({:f}".format(now - rate_history_s))
 
     # Now for the tricky bit:
     # ======================
@@ -168,7 +150,7 @@ def rate_limit(
     #              ^
     #              | current time
 
-    pipe.zadd(bucket, now + state.max_query_duration_s, query_id)  # type: ignore
+    pipe.zadd(bucket, now + state.max_query_duration_s, query_id)
     if rate_limit_params.per_second_limit is None:
         pipe.exists("nosuchkey")  # no-op if we don't need per-second
     else:
@@ -181,37 +163,100 @@ def rate_limit(
         # of concurrent queries
         pipe.zcount(bucket, "({:f}".format(now), "+inf")
 
-    try:
-        _, _, historical, concurrent = pipe.execute()
-        historical = int(historical)
-        concurrent = int(concurrent)
-    except Exception as ex:
-        logger.exception(ex)
-        yield None  # fail open if redis is having issues
-        return
 
-    per_second = historical / float(state.rate_lookback_s)
+def _build_stats(historical: int, concurrent: int) -> RateLimitStats:
+    return RateLimitStats(
+        rate=int(historical) / float(state.rate_lookback_s),
+        concurrent=int(concurrent),
+    )
 
-    stats = RateLimitStats(rate=per_second, concurrent=concurrent)
 
+def _get_exceeded_limit(
+    rate_limit_params: RateLimitParameters, stats: RateLimitStats
+) -> Optional[str]:
+    """
+    Returns the description of the first limit of `rate_limit_params`
+    exceeded according to `stats`, if any.
+    """
     rate_limit_name = rate_limit_params.rate_limit_name
-
-    Reason = namedtuple("Reason", "scope name val limit")
     reasons = [
         Reason(
             rate_limit_name,
             "concurrent",
-            concurrent,
+            stats.concurrent,
             rate_limit_params.concurrent_limit,
         ),
         Reason(
             rate_limit_name,
             "per-second",
-            per_second,
+            stats.rate,
             rate_limit_params.per_second_limit,
         ),
     ]
     reason = next((r for r in reasons if r.limit is not None and r.val > r.limit), None)
+    if reason is None:
+        return None
+    return "{r.scope} {r.name} of {r.val:.0f} exceeds limit of {r.limit:.0f}".format(
+        r=reason
+    )
+
+
+@contextmanager
+def rate_limit(
+    rate_limit_params: RateLimitParameters,
+) -> Iterator[Optional[RateLimitStats]]:
+    """
+    A context manager for rate limiting that allows for limiting based on:
+        * a rolling-window per-second rate
+        * the number of queries concurrently running.
+
+    It uses one redis sorted set to keep track of both of these limits
+    The following mapping is kept in redis:
+
+        bucket: SortedSet([(timestamp1, query_id1), (timestamp2, query_id2) ...])
+
+
+    Queries are thrown ahead in time when they start so we can count them
+    as concurrent, and thrown back to their start time once they finish so
+    we can count them towards the historical rate. See the comments for
+    an example.
+
+               time >>----->
+    +-----------------------------+--------------------------------+
+    | historical query window     | currently executing queries    |
+    +-----------------------------+--------------------------------+
+                                  ^
+                                 now
+    """
+
+    bucket = "{}{}".format(state.ratelimit_prefix, rate_limit_params.bucket)
+    query_id = uuid.uuid4()
+
+    now = time.time()
+    bypass_rate_limit, rate_history_s = state.get_configs(
+        [("bypass_rate_limit", 0), ("rate_history_sec", 3600)]
+        #                               ^ number of seconds the timestamps are kept
+    )
+    assert isinstance(rate_history_s, (int, float))
+
+    if bypass_rate_limit == 1:
+        yield None
+        return
+
+    pipe = rds.pipeline(transaction=False)
+    _add_to_pipeline(pipe, bucket, query_id, rate_limit_params, now, rate_history_s)
+
+    try:
+        stale, _, historical, concurrent = pipe.execute()
+    except Exception as ex:
+        logger.exception(ex)
+        yield None  # fail open if redis is having issues
+        return
+
+    metrics.increment("rate_limit.stale", stale, tags={"bucket": bucket})
+    stats = _build_stats(historical, concurrent)
+
+    reason = _get_exceeded_limit(rate_limit_params, stats)
     if reason:
         try:
             # Remove the query from the sorted set
@@ -221,11 +266,7 @@ def rate_limit(
         except Exception as ex:
             logger.exception(ex)
 
-        raise RateLimitExceeded(
-            "{r.scope} {r.name} of {r.val:.0f} exceeds limit of {r.limit:.0f}".format(
-                r=reason
-            )
-        )
+        raise RateLimitExceeded(reason)
 
     rate_limited = False
     try:
@@ -267,40 +308,208 @@ def get_global_rate_limit_params() -> RateLimitParameters:
     )
 
 
+class LocalRateLimiter:
+    """
+    A process-local admission check run before the Redis rate limiter.
+
+    It only rejects the queries that would exceed their limits based on
+    the queries of this process alone, which the Redis rate limiter would
+    reject anyway since it counts the queries of every process, so the
+    queries it rejects never reach Redis.
+
+    The limits are evaluated like the Redis rate limiter does. The per
+    second rate is the number of completed queries that started over the
+    lookback window, queries still running are not part of it. The
+    concurrent count is the number of queries running in this process,
+    including the one being admitted. Queries rate limited after being
+    admitted are not counted, as Redis does not count them either.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        # bucket -> sorted start times of the completed queries
+        self.__completed: MutableMapping[str, List[float]] = {}
+        self.__concurrent: MutableMapping[str, int] = {}
+
+    def acquire(
+        self, rate_limit_params: Sequence[RateLimitParameters], now: float
+    ) -> None:
+        """
+        Counts a query against every rate limit of `rate_limit_params`,
+        or raises RateLimitExceeded without counting it if one of them
+        is exceeded. Queries that are counted must be released.
+        """
+        with self.__lock:
+            for params in rate_limit_params:
+                historical = (
+                    self.__count_completed(params.bucket, now)
+                    if params.per_second_limit is not None
+                    else 0
+                )
+                reason = _get_exceeded_limit(
+                    params,
+                    _build_stats(
+                        historical, self.__concurrent.get(params.bucket, 0) + 1
+                    ),
+                )
+                if reason is not None:
+                    raise RateLimitExceeded(reason)
+
+            for params in rate_limit_params:
+                self.__concurrent[params.bucket] = (
+                    self.__concurrent.get(params.bucket, 0) + 1
+                )
+
+    def __count_completed(self, bucket: str, now: float) -> int:
+        completed = self.__completed.get(bucket)
+        if not completed:
+            return 0
+        # Queries that started before the lookback window are not counted
+        # anymore.
+        del completed[: bisect_left(completed, now - state.rate_lookback_s)]
+        return len(completed)
+
+    def release(
+        self,
+        rate_limit_params: Sequence[RateLimitParameters],
+        started: float,
+        rate_limited: bool = False,
+    ) -> None:
+        """
+        Releases a query counted by `acquire` at `started`. Unless it was
+        rate limited afterwards, it now counts towards the per second rate
+        from the time it started.
+        """
+        with self.__lock:
+            for params in rate_limit_params:
+                concurrent = self.__concurrent.get(params.bucket, 0) - 1
+                if concurrent > 0:
+                    self.__concurrent[params.bucket] = concurrent
+                else:
+                    self.__concurrent.pop(params.bucket, None)
+
+                if not rate_limited and params.per_second_limit is not None:
+                    insort(self.__completed.setdefault(params.bucket, []), started)
+
+
+local_rate_limiter = LocalRateLimiter()
+
+
 class RateLimitAggregator(AbstractContextManager):  # type: ignore
     """
     Runs the rate limits provided by the `rate_limit_params` configuration object.
 
-    It runs the rate limits in the order described by `rate_limit_params`.
+    All the rate limits are evaluated with a single Redis pipeline when
+    entering the context, and the query is returned to its start time in
+    all the buckets with a single pipeline when exiting it. If a rate limit
+    is exceeded, the first one in the order of `rate_limit_params` is
+    reported and the query is removed from all the buckets.
+
+    When the `rate_limit_local_precheck` runtime config is set, the rate
+    limits are checked by the `local_rate_limiter` first.
     """
 
     def __init__(self, rate_limit_params: Sequence[RateLimitParameters]) -> None:
         self.rate_limit_params = rate_limit_params
-        self.stack = ExitStack()
+        # The buckets the query was added to, with the id of the query.
+        self.__query_ids: List[Tuple[str, uuid.UUID]] = []
+        # When the query was admitted by the local rate limiter.
+        self.__local_started: Optional[float] = None
 
     def __enter__(self) -> RateLimitStatsContainer:
         stats = RateLimitStatsContainer()
+        if not self.rate_limit_params:
+            return stats
+
+        now = time.time()
+        bypass_rate_limit, rate_history_s, local_precheck = state.get_configs(
+            [
+                ("bypass_rate_limit", 0),
+                ("rate_history_sec", 3600),
+                ("rate_limit_local_precheck", 0),
+            ]
+        )
+        assert isinstance(rate_history_s, (int, float))
+
+        if bypass_rate_limit == 1:
+            return stats
 
-        for rate_limit_param in self.rate_limit_params:
+        if local_precheck:
             try:
-                child_stats = self.stack.enter_context(rate_limit(rate_limit_param))
-                if child_stats:
-                    stats.add_stats(rate_limit_param.rate_limit_name, child_stats)
-            except RateLimitExceeded as e:
-                # If an exception occurs in one of the rate limiters, the __exit__ callbacks are not
-                # called since the error happened in the __enter__ method and not in the context
-                # block itself. In the case that one of the rate limiters caught a limit, we need
-                # these exit functions to be called so we can roll back any limits that were set
-                # earlier in the stack.
-                self.__exit__(*sys.exc_info())
-                raise e
+                local_rate_limiter.acquire(self.rate_limit_params, now)
+            except RateLimitExceeded:
+                metrics.increment("rate_limit.local_rejected")
+                raise
+            self.__local_started = now
+
+        query_ids = []
+        pipe = rds.pipeline(transaction=False)
+        for params in self.rate_limit_params:
+            bucket = "{}{}".format(state.ratelimit_prefix, params.bucket)
+            query_id = uuid.uuid4()
+            _add_to_pipeline(pipe, bucket, query_id, params, now, rate_history_s)
+            query_ids.append((bucket, query_id))
+
+        try:
+            results = pipe.execute()
+        except Exception as ex:
+            logger.exception(ex)
+            return stats  # fail open if redis is having issues
+
+        self.__query_ids = query_ids
+
+        reason = None
+        for i, params in enumerate(self.rate_limit_params):
+            stale, _, historical, concurrent = results[i * 4 : i * 4 + 4]
+            metrics.increment(
+                "rate_limit.stale", stale, tags={"bucket": query_ids[i][0]}
+            )
+            child_stats = _build_stats(historical, concurrent)
+            stats.add_stats(params.rate_limit_name, child_stats)
+            if reason is None:
+                reason = _get_exceeded_limit(params, child_stats)
+
+        if reason is not None:
+            # The query is removed from all the buckets since it was rate
+            # limited. It should not count towards rate limiting future
+            # queries.
+            self.__release(rate_limited=True)
+            raise RateLimitExceeded(reason)
 
         return stats
 
+    def __release(self, rate_limited: bool) -> None:
+        query_ids, self.__query_ids = self.__query_ids, []
+        if self.__local_started is not None:
+            local_rate_limiter.release(
+                self.rate_limit_params, self.__local_started, rate_limited
+            )
+            self.__local_started = None
+
+        if not query_ids:
+            return
+
+        try:
+            pipe = rds.pipeline(transaction=False)
+            for bucket, query_id in query_ids:
+                if rate_limited:
+                    pipe.zrem(bucket, query_id)  # not allowed / not counted
+                else:
+                    # return the query to its start time
+                    pipe.zincrby(bucket, query_id, -float(state.max_query_duration_s))
+            pipe.execute()
+        except Exception as ex:
+            logger.exception(ex)
+
     def __exit__(
         self,
         exc_type: Optional[Type[BaseException]],
         exc_val: Optional[BaseException],
         exc_tb: Optional[TracebackType],
     ) -> None:
-        self.stack.pop_all().close()
+        # If another rate limiter nested in this context rejected the
+        # query, it should not be counted against these limits either.
+        self.__release(
+            rate_limited=exc_type is not None
+            and issubclass(exc_type, RateLimitExceeded)
+        )
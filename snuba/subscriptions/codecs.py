@@ -7,6 +7,7 @@ from arroyo.backends.kafka import KafkaPayload
 
 from snuba.datasets.entities import EntityKey
 from snuba.query.exceptions import InvalidQueryException
+from snuba.reader import dump_result
 from snuba.subscriptions.data import (
     ScheduledSubscriptionTask,
     Subscription,
@@ -41,7 +42,7 @@ class SubscriptionTaskResultEncoder(Encoder[KafkaPayload, SubscriptionTaskResult
         request, result = value.result
         return KafkaPayload(
             subscription_id.encode("utf-8"),
-            json.dumps(
+            dump_result(
                 {
                     "version": 3,
                     "payload": {
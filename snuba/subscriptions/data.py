@@ -8,7 +8,9 @@ from datetime import datetime, timedelta
 from functools import partial
 from typing import (
     Any,
+    Callable,
     Iterator,
+    List,
     Mapping,
     NamedTuple,
     NewType,
@@ -22,16 +24,26 @@ from uuid import UUID
 from snuba.datasets.dataset import Dataset
 from snuba.datasets.entities import EntityKey
 from snuba.datasets.entities.factory import get_entity
+from snuba.query import SelectedExpression
 from snuba.query.composite import CompositeQuery
 from snuba.query.conditions import (
     BooleanFunctions,
     ConditionFunctions,
     binary_condition,
     combine_and_conditions,
+    in_condition,
 )
 from snuba.query.data_source.simple import Entity
-from snuba.query.expressions import Column, Expression, Literal
+from snuba.query.expressions import (
+    Column,
+    CurriedFunctionCall,
+    Expression,
+    FunctionCall,
+    Literal,
+)
 from snuba.query.logical import Query
+from snuba.query.parser.exceptions import ParsingException
+from snuba.query.snql.parser import parse_snql_query_initial
 from snuba.reader import Result
 from snuba.request import Request
 from snuba.request.request_settings import SubscriptionRequestSettings
@@ -48,6 +60,10 @@ from snuba.utils.metrics.timer import Timer
 
 SUBSCRIPTION_REFERRER = "subscription"
 
+# The name of the project id column added to the queries of subscriptions
+# executed together for several projects.
+GROUPED_PROJECT_ID = "project_id"
+
 logger = logging.getLogger("snuba.subscriptions")
 
 
@@ -85,6 +101,7 @@ class SubscriptionData:
         timestamp: datetime,
         offset: Optional[int],
         query: Union[CompositeQuery[Entity], Query],
+        project_ids: Optional[Sequence[int]] = None,
     ) -> None:
         # TODO: Support composite queries with multiple entities.
         from_clause = query.get_from_clause()
@@ -102,6 +119,11 @@ class SubscriptionData:
                 ConditionFunctions.EQ,
                 Column(None, None, "project_id"),
                 Literal(None, self.project_id),
+            )
+            if project_ids is None
+            else in_condition(
+                Column(None, None, "project_id"),
+                [Literal(None, project_id) for project_id in project_ids],
             ),
             binary_condition(
                 ConditionFunctions.GTE,
@@ -142,6 +164,51 @@ class SubscriptionData:
                 "Resolution must be greater than or equal to 1 minute"
             )
 
+    def can_group_by_project(self) -> bool:
+        """
+        Whether the query of this subscription can run for several projects
+        at once, grouped by project, and return for each project the row
+        it would return on its own. This is the case of queries that only
+        select aggregations, without any clause that applies across the
+        groups or that could filter out the row of a project.
+        """
+        try:
+            query = parse_snql_query_initial(self.query)
+        except ParsingException:
+            return False
+
+        return (
+            isinstance(query, Query)
+            and not query.get_groupby()
+            and not query.get_orderby()
+            and query.get_having() is None
+            and query.get_limitby() is None
+            # Without a group by the query returns a single row, which any
+            # limit keeps. The limit of the grouped query is set to the
+            # number of projects.
+            and query.get_limit() != 0
+            and not query.get_offset()
+            and all(
+                isinstance(selected.expression, (FunctionCall, CurriedFunctionCall))
+                and selected.name != GROUPED_PROJECT_ID
+                for selected in query.get_selected_columns()
+            )
+        )
+
+    @staticmethod
+    def __group_by_project(
+        project_ids: Sequence[int], query: Union[CompositeQuery[Entity], Query]
+    ) -> None:
+        project_id = Column(f"_snuba_{GROUPED_PROJECT_ID}", None, "project_id")
+        query.set_ast_groupby([project_id])
+        query.set_ast_selected_columns(
+            [
+                *query.get_selected_columns(),
+                SelectedExpression(GROUPED_PROJECT_ID, project_id),
+            ]
+        )
+        query.set_limit(len(project_ids))
+
     def build_request(
         self,
         dataset: Dataset,
@@ -150,9 +217,26 @@ class SubscriptionData:
         timer: Timer,
         metrics: Optional[MetricsBackend] = None,
         referrer: str = SUBSCRIPTION_REFERRER,
+        project_ids: Optional[Sequence[int]] = None,
     ) -> Request:
+        """
+        Builds the request of the subscription query at a timestamp. When
+        project ids are provided, the query runs for all of them instead
+        of the project of the subscription, and returns one row per
+        project with its id in the GROUPED_PROJECT_ID column. This requires
+        the query to be groupable by project.
+        """
         schema = RequestSchema.build(SubscriptionRequestSettings)
 
+        custom_processing: List[
+            Callable[[Union[CompositeQuery[Entity], Query]], None]
+        ] = [
+            self.entity_subscription.validate_query,
+            partial(self.add_conditions, timestamp, offset, project_ids=project_ids),
+        ]
+        if project_ids is not None:
+            custom_processing.append(partial(self.__group_by_project, project_ids))
+
         request = build_request(
             {"query": self.query},
             parse_snql_query,
@@ -161,10 +245,7 @@ class SubscriptionData:
             dataset,
             timer,
             referrer,
-            [
-                self.entity_subscription.validate_query,
-                partial(self.add_conditions, timestamp, offset),
-            ],
+            custom_processing,
         )
         return request
 
@@ -4,8 +4,21 @@ import logging
 import time
 from collections import deque
 from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Callable, Deque, Mapping, MutableMapping, Optional, Sequence, Tuple
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
 
 import rapidjson
 from arroyo import Message, Partition, Topic
@@ -17,12 +30,14 @@ from arroyo.processing.strategies.abstract import ProcessingStrategyFactory
 from arroyo.types import Position
 
 from snuba import state
+from snuba.clickhouse.async_http import AsyncHTTPReader
+from snuba.clusters.cluster import ClickhouseCluster, get_reader_cluster
 from snuba.datasets.dataset import Dataset
 from snuba.datasets.entities import EntityKey
 from snuba.datasets.entities.factory import ENTITY_NAME_LOOKUP, get_entity
 from snuba.datasets.factory import get_dataset
 from snuba.datasets.table_storage import KafkaTopicSpec
-from snuba.reader import Result
+from snuba.reader import Reader, Result
 from snuba.request import Request
 from snuba.state import get_config
 from snuba.subscriptions.codecs import (
@@ -30,21 +45,100 @@ from snuba.subscriptions.codecs import (
     SubscriptionTaskResultEncoder,
 )
 from snuba.subscriptions.data import (
+    GROUPED_PROJECT_ID,
     ScheduledSubscriptionTask,
     SubscriptionTaskResult,
     SubscriptionTaskResultFuture,
 )
 from snuba.subscriptions.utils import run_new_pipeline
+from snuba.utils.event_loop import EventLoopThread
 from snuba.utils.metrics import MetricsBackend
 from snuba.utils.metrics.gauge import Gauge, ThreadSafeGauge
 from snuba.utils.metrics.timer import Timer
 from snuba.utils.streams.configuration_builder import build_kafka_consumer_configuration
-from snuba.web.query import parse_and_run_query
+from snuba.web import QueryResult
+from snuba.web.query import (
+    PreparedQuery,
+    parse_and_run_query,
+    prepare_query,
+    run_prepared_query,
+)
 
 logger = logging.getLogger(__name__)
 
 COMMIT_FREQUENCY_SEC = 1
 
+# Maximum number of distinct subscription queries whose groupability is
+# remembered. Deciding whether a query can be grouped by project means
+# parsing it, and the same queries come back on every tick. This is well
+# above the number of distinct queries a single executor sees, so the
+# memo is only cleared if that grows unexpectedly.
+MAX_GROUPABLE_QUERIES = 10000
+
+# The subscriptions sharing all of these can be executed in a single query
+# grouped by project.
+BatchKey = Tuple[Any, ...]
+
+
+@dataclass
+class QueryBatch:
+    """
+    Scheduled tasks waiting to be executed together, and the futures their
+    results are delivered through.
+    """
+
+    created: float
+    tasks: List[
+        Tuple[ScheduledSubscriptionTask, Future[Tuple[Request, Result]]]
+    ] = field(default_factory=list)
+
+
+class AsyncQueryRunner:
+    """
+    Executes queries asynchronously on an event loop running on a
+    dedicated thread, so that many queries can be in flight without
+    keeping a thread blocked for each of them. The queries are prepared
+    by the caller, only their execution runs on the event loop.
+
+    Each cluster gets its own pool of at most `max_concurrent_queries`
+    connections to its HTTP interface.
+    """
+
+    def __init__(self, max_concurrent_queries: int) -> None:
+        self.max_concurrent_queries = max_concurrent_queries
+        self.__loop = EventLoopThread("subscriptions-executor")
+        self.__readers: MutableMapping[ClickhouseCluster, AsyncHTTPReader] = {}
+        self.__lock = Lock()
+
+    def get_reader(self, reader: Reader) -> Optional[AsyncHTTPReader]:
+        """
+        Returns the asynchronous reader querying the same cluster as
+        `reader`, if there is one.
+        """
+        cluster = get_reader_cluster(reader)
+        if cluster is None:
+            return None
+
+        with self.__lock:
+            async_reader = self.__readers.get(cluster)
+            if async_reader is None:
+                async_reader = self.__readers[cluster] = cluster.build_async_reader(
+                    self.max_concurrent_queries
+                )
+            return async_reader
+
+    def submit(
+        self, prepared: PreparedQuery, reader: AsyncHTTPReader
+    ) -> Future[QueryResult]:
+        return self.__loop.submit(run_prepared_query(prepared, reader))
+
+    async def __close_readers(self) -> None:
+        for reader in self.__readers.values():
+            await reader.close()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        self.__loop.close(self.__close_readers(), timeout)
+
 
 def build_executor_consumer(
     dataset_name: str,
@@ -58,6 +152,7 @@ def build_executor_consumer(
     executor: ThreadPoolExecutor,
     stale_threshold_seconds: Optional[int],
     cooperative_rebalancing: bool = False,
+    async_runner: Optional[AsyncQueryRunner] = None,
 ) -> StreamProcessor[KafkaPayload]:
     # Validate that a valid dataset/entity pair was passed in
     dataset = get_dataset(dataset_name)
@@ -142,6 +237,7 @@ def build_executor_consumer(
             metrics,
             stale_threshold_seconds,
             result_topic_spec.topic_name,
+            async_runner,
         ),
     )
 
@@ -157,6 +253,7 @@ class SubscriptionExecutorProcessingFactory(ProcessingStrategyFactory[KafkaPaylo
         metrics: MetricsBackend,
         stale_threshold_seconds: Optional[int],
         result_topic: str,
+        async_runner: Optional[AsyncQueryRunner] = None,
     ) -> None:
         self.__executor = executor
         self.__max_concurrent_queries = max_concurrent_queries
@@ -166,6 +263,7 @@ class SubscriptionExecutorProcessingFactory(ProcessingStrategyFactory[KafkaPaylo
         self.__metrics = metrics
         self.__stale_threshold_seconds = stale_threshold_seconds
         self.__result_topic = result_topic
+        self.__async_runner = async_runner
 
     def create(
         self, commit: Callable[[Mapping[Partition, Position]], None]
@@ -179,6 +277,7 @@ class SubscriptionExecutorProcessingFactory(ProcessingStrategyFactory[KafkaPaylo
             self.__metrics,
             ProduceResult(self.__producer, self.__result_topic, commit),
             commit,
+            self.__async_runner,
         )
 
 
@@ -186,6 +285,21 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
     """
     Decodes a scheduled subscription task from the Kafka payload, builds
     the request and executes the ClickHouse query.
+
+    When the `executor_batch_queries` runtime config is enabled, tasks
+    that only differ by their project are held for up to
+    `executor_batch_window_ms` and executed with a single query grouped
+    by project, whose rows are handed out to each task. Projects without
+    any row get the result of the query for one of them, which is the
+    same for all of them since it aggregates no rows. If the grouped query
+    fails, each task is executed on its own.
+
+    When an `AsyncQueryRunner` is provided, the threads of the executor
+    only build and prepare the queries, which are then executed by the
+    runner. The number of queries in flight is bounded by the concurrency
+    of the runner instead of by the number of threads. Queries that
+    cannot be prepared as a single storage query, and grouped queries, are
+    executed on the threads as usual.
     """
 
     def __init__(
@@ -201,6 +315,7 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
         # Commit is only passed here because we are temporarily
         # skipping executions during the transition phase.
         commit: Callable[[Mapping[Partition, Position]], None],
+        async_runner: Optional[AsyncQueryRunner] = None,
     ) -> None:
         self.__dataset = dataset
         self.__entity_names = set(entity_names)
@@ -209,6 +324,7 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
         self.__stale_threshold_seconds = stale_threshold_seconds
         self.__metrics = metrics
         self.__next_step = next_step
+        self.__async_runner = async_runner
 
         self.__commit = commit
         self.__commit_data: MutableMapping[Partition, Position] = {}
@@ -230,8 +346,31 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
             self.__metrics, "executor.concurrent.clickhouse"
         )
 
+        self.__batches: MutableMapping[BatchKey, QueryBatch] = {}
+        self.__groupable_queries: MutableMapping[str, bool] = {}
+
+    def __build_request(
+        self,
+        task: ScheduledSubscriptionTask,
+        tick_upper_offset: int,
+        timer: Timer,
+        project_ids: Optional[Sequence[int]] = None,
+    ) -> Request:
+        return task.task.subscription.data.build_request(
+            self.__dataset,
+            task.timestamp,
+            tick_upper_offset,
+            timer,
+            self.__metrics,
+            "subscriptions_executor",
+            project_ids=project_ids,
+        )
+
     def __execute_query(
-        self, task: ScheduledSubscriptionTask, tick_upper_offset: int
+        self,
+        task: ScheduledSubscriptionTask,
+        tick_upper_offset: int,
+        project_ids: Optional[Sequence[int]] = None,
     ) -> Tuple[Request, Result]:
         # Measure the amount of time that took between the task's scheduled
         # time and it beginning to execute.
@@ -242,14 +381,7 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
         timer = Timer("query")
 
         with self.__concurrent_gauge:
-            request = task.task.subscription.data.build_request(
-                self.__dataset,
-                task.timestamp,
-                tick_upper_offset,
-                timer,
-                self.__metrics,
-                "subscriptions_executor",
-            )
+            request = self.__build_request(task, tick_upper_offset, timer, project_ids)
 
             result = parse_and_run_query(
                 self.__dataset,
@@ -261,7 +393,177 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
 
             return (request, result)
 
+    def __execute_query_async(
+        self,
+        task: ScheduledSubscriptionTask,
+        tick_upper_offset: int,
+        future: Future[Tuple[Request, Result]],
+    ) -> None:
+        """
+        Prepares the query of the task and hands it over to the async
+        runner, which delivers the result through `future`.
+        """
+        assert self.__async_runner is not None
+        self.__metrics.timing(
+            "executor.latency", (time.time() - task.timestamp.timestamp()) * 1000
+        )
+
+        try:
+            timer = Timer("query")
+            request = self.__build_request(task, tick_upper_offset, timer)
+            prepared = prepare_query(self.__dataset, request, timer)
+            reader = (
+                self.__async_runner.get_reader(prepared.reader)
+                if prepared is not None
+                else None
+            )
+        except Exception as error:
+            future.set_exception(error)
+            return
+
+        if prepared is None or reader is None:
+            self.__metrics.increment("executor.async.fallback")
+            # Preparing the query processed the request, which has to be
+            # built again.
+            self.__run_task(task, future)
+            return
+
+        self.__concurrent_gauge.increment()
+        self.__concurrent_clickhouse_gauge.increment()
+
+        def deliver(query_future: Future[QueryResult]) -> None:
+            self.__concurrent_gauge.decrement()
+            self.__concurrent_clickhouse_gauge.decrement()
+            try:
+                future.set_result((request, query_future.result().result))
+            except Exception as error:
+                future.set_exception(error)
+
+        self.__async_runner.submit(prepared, reader).add_done_callback(deliver)
+
+    def __run_task(
+        self,
+        task: ScheduledSubscriptionTask,
+        future: Future[Tuple[Request, Result]],
+    ) -> None:
+        try:
+            future.set_result(self.__execute_query(task, task.task.tick_upper_offset))
+        except Exception as error:
+            future.set_exception(error)
+
+    def __execute_batch(
+        self,
+        tasks: Sequence[
+            Tuple[ScheduledSubscriptionTask, Future[Tuple[Request, Result]]]
+        ],
+    ) -> None:
+        self.__metrics.increment("executor.batch.tasks", len(tasks))
+        self.__metrics.timing("executor.batch.size", len(tasks))
+        if len(tasks) == 1:
+            self.__metrics.increment("executor.batch.queries")
+            self.__run_task(*tasks[0])
+            return
+
+        first = tasks[0][0]
+        project_ids = sorted(
+            {task.task.subscription.data.project_id for task, _ in tasks}
+        )
+        self.__metrics.increment("executor.batch.queries")
+        try:
+            request, result = self.__execute_query(
+                first, first.task.tick_upper_offset, project_ids
+            )
+        except Exception:
+            logger.warning("Grouped subscription query failed", exc_info=True)
+            self.__metrics.increment(
+                "executor.batch.fallback", len(tasks), tags={"reason": "error"}
+            )
+            for task, future in tasks:
+                self.__executor.submit(self.__run_task, task, future)
+            return
+
+        rows = {
+            row[GROUPED_PROJECT_ID]: {
+                name: value for name, value in row.items() if name != GROUPED_PROJECT_ID
+            }
+            for row in result["data"]
+        }
+        meta = [
+            column for column in result["meta"] if column["name"] != GROUPED_PROJECT_ID
+        ]
+
+        missing = []
+        for task, future in tasks:
+            row = rows.get(task.task.subscription.data.project_id)
+            if row is None:
+                missing.append((task, future))
+            else:
+                project_result = cast(Result, {**result})
+                project_result["meta"] = meta
+                project_result["data"] = [row]
+                future.set_result((request, project_result))
+
+        if not missing:
+            return
+
+        # None of the rows of these projects matched the query. The result
+        # of the query for any of them is the result for all of them.
+        self.__metrics.increment("executor.batch.queries")
+        task, future = missing[0]
+        self.__run_task(task, future)
+        try:
+            request, result = future.result()
+        except Exception:
+            self.__metrics.increment(
+                "executor.batch.fallback", len(missing) - 1, tags={"reason": "error"}
+            )
+            for task, future in missing[1:]:
+                self.__executor.submit(self.__run_task, task, future)
+            return
+
+        for _, future in missing[1:]:
+            copied_result = cast(Result, {**result})
+            copied_result["data"] = [dict(row) for row in result["data"]]
+            future.set_result((request, copied_result))
+
+    def __get_batch_key(self, task: ScheduledSubscriptionTask) -> Optional[BatchKey]:
+        """
+        Returns the key of the batch the task can be executed with, or None
+        if its query cannot be grouped by project.
+        """
+        entity, subscription, tick_upper_offset = task.task
+        data = subscription.data
+
+        groupable = self.__groupable_queries.get(data.query)
+        if groupable is None:
+            if len(self.__groupable_queries) >= MAX_GROUPABLE_QUERIES:
+                self.__groupable_queries.clear()
+            groupable = data.can_group_by_project()
+            self.__groupable_queries[data.query] = groupable
+        if not groupable:
+            return None
+
+        return (
+            entity,
+            task.timestamp,
+            tick_upper_offset,
+            data.query,
+            data.time_window_sec,
+            type(data.entity_subscription),
+            tuple(sorted(data.entity_subscription.to_dict().items())),
+        )
+
+    def __dispatch_batches(self, force: bool = False) -> None:
+        window = (state.get_config("executor_batch_window_ms", 1000) or 0) / 1000.0
+        now = time.time()
+        for key, batch in list(self.__batches.items()):
+            if force or now - batch.created >= window:
+                del self.__batches[key]
+                self.__executor.submit(self.__execute_batch, batch.tasks)
+
     def poll(self) -> None:
+        self.__dispatch_batches()
+
         while self.__queue:
             if not self.__queue[0][1].future.done():
                 break
@@ -292,7 +594,11 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
         assert (
             queue_size_factor is not None
         ), "Invalid executor_queue_size_factor config"
-        max_queue_size = self.__max_concurrent_queries * queue_size_factor
+        max_queue_size = (
+            self.__async_runner.max_concurrent_queries
+            if self.__async_runner is not None
+            else self.__max_concurrent_queries
+        ) * queue_size_factor
 
         # Tell the consumer to pause until we have removed some futures from
         # the queue
@@ -318,7 +624,32 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
         ):
             should_execute = False
 
-        if should_execute:
+        batch_key = (
+            self.__get_batch_key(task)
+            if should_execute and state.get_config("executor_batch_queries", 0)
+            else None
+        )
+
+        if batch_key is not None:
+            future: Future[Tuple[Request, Result]] = Future()
+            batch = self.__batches.get(batch_key)
+            if batch is None:
+                batch = self.__batches[batch_key] = QueryBatch(time.time())
+            batch.tasks.append((task, future))
+            if len(batch.tasks) >= (
+                state.get_config("executor_batch_max_size", 1000) or 1
+            ):
+                del self.__batches[batch_key]
+                self.__executor.submit(self.__execute_batch, batch.tasks)
+
+            self.__queue.append((message, SubscriptionTaskResultFuture(task, future)))
+        elif should_execute and self.__async_runner is not None:
+            future = Future()
+            self.__executor.submit(
+                self.__execute_query_async, task, tick_upper_offset, future
+            )
+            self.__queue.append((message, SubscriptionTaskResultFuture(task, future)))
+        elif should_execute:
             self.__queue.append(
                 (
                     message,
@@ -359,6 +690,8 @@ class ExecuteQuery(ProcessingStrategy[KafkaPayload]):
     def join(self, timeout: Optional[float] = None) -> None:
         start = time.time()
 
+        self.__dispatch_batches(force=True)
+
         while self.__queue:
             remaining = timeout - (time.time() - start) if timeout is not None else None
 
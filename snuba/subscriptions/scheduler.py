@@ -3,8 +3,8 @@ from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import (
+    Iterable,
     Iterator,
-    List,
     Mapping,
     MutableMapping,
     Optional,
@@ -12,6 +12,7 @@ from typing import (
     Tuple,
     TypeVar,
 )
+from uuid import UUID
 
 from snuba import settings, state
 from snuba.datasets.entities import EntityKey
@@ -19,6 +20,7 @@ from snuba.subscriptions.data import (
     PartitionId,
     ScheduledSubscriptionTask,
     Subscription,
+    SubscriptionData,
     SubscriptionIdentifier,
 )
 from snuba.subscriptions.data import SubscriptionScheduler as SubscriptionSchedulerBase
@@ -32,6 +34,17 @@ TSubscription = TypeVar("TSubscription")
 Tags = Mapping[str, str]
 
 
+def get_jitter(subscription: Subscription) -> int:
+    """
+    The offset in the resolution interval a subscription is scheduled at
+    by the jittered task builder.
+    """
+    resolution = subscription.data.resolution_sec
+    if resolution > settings.MAX_RESOLUTION_FOR_JITTER:
+        return 0
+    return subscription.identifier.uuid.int % resolution
+
+
 class TaskBuilder(ABC):
     """
     Takes a Subscription and a timestamp, decides whether we should
@@ -122,7 +135,7 @@ class JitteredTaskBuilder(TaskBuilder):
             else:
                 return None
 
-        jitter = subscription.identifier.uuid.int % resolution
+        jitter = get_jitter(subscription)
         if timestamp % resolution == jitter:
             self.__count += 1
             return ScheduledSubscriptionTask(
@@ -278,6 +291,113 @@ class DelegateTaskBuilder(TaskBuilder):
         ]
 
 
+class SubscriptionIndex:
+    """
+    Buckets the subscriptions of a partition by resolution and jitter, so
+    that finding the subscriptions that may be due at a timestamp only
+    visits one bucket per resolution instead of every subscription.
+
+    The index is updated in place when the subscriptions are refreshed:
+    only the subscriptions that were created or deleted in the meantime
+    move between buckets.
+    """
+
+    def __init__(self) -> None:
+        self.__buckets: MutableMapping[
+            int, MutableMapping[int, MutableMapping[UUID, Subscription]]
+        ] = {}
+        self.__slots: MutableMapping[UUID, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.__slots)
+
+    def __add(self, subscription: Subscription) -> None:
+        resolution = subscription.data.resolution_sec
+        jitter = get_jitter(subscription)
+        self.__buckets.setdefault(resolution, {}).setdefault(jitter, {})[
+            subscription.identifier.uuid
+        ] = subscription
+        self.__slots[subscription.identifier.uuid] = (resolution, jitter)
+
+    def __remove(self, uuid: UUID) -> None:
+        resolution, jitter = self.__slots.pop(uuid)
+        jitters = self.__buckets[resolution]
+        bucket = jitters[jitter]
+        del bucket[uuid]
+        if not bucket:
+            del jitters[jitter]
+            if not jitters:
+                del self.__buckets[resolution]
+
+    def __put(self, subscription: Subscription) -> bool:
+        """
+        Adds or replaces a subscription. Returns whether it moved to a new
+        bucket.
+        """
+        uuid = subscription.identifier.uuid
+        slot = self.__slots.get(uuid)
+        if slot is not None and slot[0] == subscription.data.resolution_sec:
+            self.__buckets[slot[0]][slot[1]][uuid] = subscription
+            return False
+        if slot is not None:
+            self.__remove(uuid)
+        self.__add(subscription)
+        return True
+
+    def update(self, subscriptions: Iterable[Subscription]) -> Tuple[int, int]:
+        """
+        Makes the index contain exactly the subscriptions provided.
+        Returns how many subscriptions were added and removed.
+        """
+        added = 0
+        seen = set()
+        for subscription in subscriptions:
+            seen.add(subscription.identifier.uuid)
+            added += self.__put(subscription)
+
+        removed = [uuid for uuid in self.__slots if uuid not in seen]
+        for uuid in removed:
+            self.__remove(uuid)
+
+        return added, len(removed)
+
+    def apply(
+        self, changes: Iterable[Tuple[UUID, Optional[Subscription]]]
+    ) -> Tuple[int, int]:
+        """
+        Applies the changes of the subscriptions store, where deleted
+        subscriptions have no value. Returns how many subscriptions were
+        added and removed.
+        """
+        added = removed = 0
+        for uuid, subscription in changes:
+            if subscription is not None:
+                added += self.__put(subscription)
+            elif uuid in self.__slots:
+                self.__remove(uuid)
+                removed += 1
+
+        return added, removed
+
+    def get_candidates(
+        self, timestamp: int, jittered: bool, immediate: bool
+    ) -> Iterator[Subscription]:
+        """
+        Returns the subscriptions the jittered and/or the immediate task
+        builders may schedule at the timestamp. The task builder still has
+        the last word on whether each of them is due.
+        """
+        for resolution, jitters in self.__buckets.items():
+            offset = timestamp % resolution
+            if immediate and offset == 0:
+                for bucket in jitters.values():
+                    yield from bucket.values()
+            elif jittered:
+                jittered_bucket = jitters.get(offset)
+                if jittered_bucket is not None:
+                    yield from jittered_bucket.values()
+
+
 class SubscriptionScheduler(SubscriptionSchedulerBase):
     def __init__(
         self,
@@ -293,7 +413,10 @@ class SubscriptionScheduler(SubscriptionSchedulerBase):
         self.__partition_id = partition_id
         self.__metrics = metrics
 
-        self.__subscriptions: List[Subscription] = []
+        self.__index = SubscriptionIndex()
+        # The version of the store the index is up to date with, when the
+        # store keeps track of its changes.
+        self.__version: Optional[int] = None
         self.__last_refresh: Optional[datetime] = None
 
         self.__delegate_builder = DelegateTaskBuilder()
@@ -320,44 +443,72 @@ class SubscriptionScheduler(SubscriptionSchedulerBase):
         else:
             # We are transitioning between jittered and immediate mode. We must use the delegate builder.
             self.__builder = self.__delegate_builder
+        self.__mode = general_mode
+
+    def __build_subscription(self, uuid: UUID, data: SubscriptionData) -> Subscription:
+        return Subscription(SubscriptionIdentifier(self.__partition_id, uuid), data)
 
-    def __get_subscriptions(self) -> List[Subscription]:
+    def __get_subscriptions(self) -> SubscriptionIndex:
         current_time = datetime.now()
 
         if (
             self.__last_refresh is None
             or (current_time - self.__last_refresh) > self.__cache_ttl
         ):
-            self.__subscriptions = [
-                Subscription(SubscriptionIdentifier(self.__partition_id, uuid), data)
-                for uuid, data in self.__store.all()
-            ]
-            self.__last_refresh = current_time
-            self.__metrics.gauge(
-                "schedule.size",
-                len(self.__subscriptions),
-                tags={"partition": str(self.__partition_id)},
+            changes = (
+                self.__store.changes(self.__version)
+                if self.__version is not None
+                else None
             )
+            if changes is not None:
+                self.__version, updated = changes
+                added, removed = self.__index.apply(
+                    (
+                        uuid,
+                        self.__build_subscription(uuid, data)
+                        if data is not None
+                        else None,
+                    )
+                    for uuid, data in updated
+                )
+                refresh = "incremental"
+            else:
+                self.__version, subscriptions = self.__store.snapshot()
+                added, removed = self.__index.update(
+                    self.__build_subscription(uuid, data)
+                    for uuid, data in subscriptions
+                )
+                refresh = "full"
+            self.__last_refresh = current_time
+            tags = {"partition": str(self.__partition_id)}
+            self.__metrics.increment("schedule.refresh", tags={**tags, "type": refresh})
+            self.__metrics.gauge("schedule.size", len(self.__index), tags=tags)
+            self.__metrics.increment("schedule.added", added, tags=tags)
+            self.__metrics.increment("schedule.removed", removed, tags=tags)
 
         self.__metrics.timing(
             "schedule.staleness",
             (current_time - self.__last_refresh).total_seconds() * 1000.0,
             tags={"partition": str(self.__partition_id)},
         )
-        return self.__subscriptions
+        return self.__index
 
     def find(self, tick: Tick) -> Iterator[ScheduledSubscriptionTask]:
         self.__reset_builder()
 
         interval = tick.timestamps
 
-        subscriptions = self.__get_subscriptions()
+        index = self.__get_subscriptions()
+        # While transitioning between modes the delegate builder may use
+        # either of them for each subscription.
+        jittered = self.__mode != TaskBuilderMode.IMMEDIATE
+        immediate = self.__mode != TaskBuilderMode.JITTERED
 
         for timestamp in range(
             math.ceil(interval.lower.timestamp()),
             math.ceil(interval.upper.timestamp()),
         ):
-            for subscription in subscriptions:
+            for subscription in index.get_candidates(timestamp, jittered, immediate):
                 task = self.__builder.get_task(
                     SubscriptionWithMetadata(
                         self.__entity_key, subscription, tick.offsets.upper
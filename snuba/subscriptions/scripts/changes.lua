@@ -0,0 +1,37 @@
+-- KEYS[1]: The subscriptions hash key.
+-- KEYS[2]: The version key.
+-- KEYS[3]: The changelog key.
+-- KEYS[4]: The trimmed version key.
+local subscriptions_key = KEYS[1]
+local version_key = KEYS[2]
+local changelog_key = KEYS[3]
+local trimmed_key = KEYS[4]
+
+-- ARGV[1]: The version the reader is at.
+local since = tonumber(ARGV[1])
+
+local version = tonumber(redis.call('GET', version_key) or 0)
+local trimmed = tonumber(redis.call('GET', trimmed_key) or 0)
+
+-- Some of the changes were dropped from the changelog, or the version went
+-- backwards, which means the keys were reset. The reader has to reload all
+-- the subscriptions.
+if since < trimmed or since > version then
+    return {version}
+end
+
+local keys = redis.call('ZRANGEBYSCORE', changelog_key, '(' .. since, '+inf')
+if #keys == 0 then
+    return {version, {}, {}}
+end
+
+-- Deleted subscriptions do not have a value anymore. Keys are fetched in
+-- chunks since unpack is limited by the size of the Lua stack.
+local values = {}
+for start = 1, #keys, 1000 do
+    local chunk = redis.call('HMGET', subscriptions_key, unpack(keys, start, math.min(start + 999, #keys)))
+    for i = 1, #chunk do
+        values[start + i - 1] = chunk[i]
+    end
+end
+return {version, keys, values}
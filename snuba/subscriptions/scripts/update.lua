@@ -0,0 +1,37 @@
+-- KEYS[1]: The subscriptions hash key.
+-- KEYS[2]: The version key.
+-- KEYS[3]: The changelog key.
+-- KEYS[4]: The trimmed version key.
+local subscriptions_key = KEYS[1]
+local version_key = KEYS[2]
+local changelog_key = KEYS[3]
+local trimmed_key = KEYS[4]
+
+-- ARGV[1]: The maximum number of subscriptions kept in the changelog.
+-- ARGV[2]: The subscription key.
+-- ARGV[3]: The encoded subscription. (absent when deleting it)
+local changelog_size = tonumber(ARGV[1])
+local key = ARGV[2]
+local value = ARGV[3]
+
+if value ~= nil then
+    redis.call('HSET', subscriptions_key, key, value)
+else
+    redis.call('HDEL', subscriptions_key, key)
+end
+
+-- Every change gets a new version. The changelog only keeps the latest
+-- version each subscription changed at.
+local version = redis.call('INCR', version_key)
+redis.call('ZADD', changelog_key, version, key)
+
+-- Drop the oldest changes beyond the changelog size and remember the last
+-- version dropped, readers behind it cannot catch up from the changelog.
+local excess = redis.call('ZCARD', changelog_key) - changelog_size
+if excess > 0 then
+    local dropped = redis.call('ZRANGE', changelog_key, excess - 1, excess - 1, 'WITHSCORES')
+    redis.call('SET', trimmed_key, dropped[2])
+    redis.call('ZREMRANGEBYRANK', changelog_key, 0, excess - 1)
+end
+
+return version
@@ -1,12 +1,19 @@
 import abc
-from typing import Iterable, Tuple
+from typing import Iterable, Optional, Sequence, Tuple
 from uuid import UUID
 
+from pkg_resources import resource_string
+
+from snuba import settings
 from snuba.datasets.entities import EntityKey
 from snuba.redis import RedisClientType
 from snuba.subscriptions.codecs import SubscriptionDataCodec
 from snuba.subscriptions.data import PartitionId, SubscriptionData
 
+# The subscriptions that changed since a version of the store and the
+# version they bring the store to. Deleted subscriptions have no data.
+SubscriptionChanges = Tuple[int, Sequence[Tuple[UUID, Optional[SubscriptionData]]]]
+
 
 class SubscriptionDataStore(abc.ABC):
     @abc.abstractmethod
@@ -32,35 +39,80 @@ class SubscriptionDataStore(abc.ABC):
         """
         pass
 
+    def snapshot(self) -> Tuple[Optional[int], Iterable[Tuple[UUID, SubscriptionData]]]:
+        """
+        Fetches all `Subscriptions` from the store together with the version
+        of the store they were fetched at, if the store keeps track of its
+        changes.
+        """
+        return None, self.all()
+
+    def changes(self, since: int) -> Optional[SubscriptionChanges]:
+        """
+        Fetches the `Subscriptions` that changed since a version of the
+        store. Returns None if the changes are not available anymore, in
+        which case all the subscriptions have to be fetched again.
+        """
+        return None
+
 
 class RedisSubscriptionDataStore(SubscriptionDataStore):
     """
     A Redis backed store for subscription data. Stores subscriptions using
     `SubscriptionDataCodec`. Each instance of the store operates on a
     partition of data, defined by the `key` constructor param.
+
+    Every change bumps the version of the partition and records the
+    subscription in a changelog, so that readers can fetch what changed
+    since the version they are at instead of the whole partition. The
+    changelog keeps the latest `changelog_size` changed subscriptions.
+    All the keys share the hash slot of the partition hash.
     """
 
     KEY_TEMPLATE = "subscriptions:{}:{}"
 
     def __init__(
-        self, client: RedisClientType, entity: EntityKey, partition_id: PartitionId
+        self,
+        client: RedisClientType,
+        entity: EntityKey,
+        partition_id: PartitionId,
+        changelog_size: int = settings.SUBSCRIPTIONS_CHANGELOG_SIZE,
     ):
         self.client = client
         self.codec = SubscriptionDataCodec(entity)
         self.__key = f"subscriptions:{entity.value}:{partition_id}"
+        self.__keys = [
+            self.__key,
+            f"{{{self.__key}}}:version",
+            f"{{{self.__key}}}:changelog",
+            f"{{{self.__key}}}:trimmed",
+        ]
+        self.__changelog_size = changelog_size
+
+        self.__script_update = client.register_script(
+            resource_string("snuba", "subscriptions/scripts/update.lua")
+        )
+        self.__script_changes = client.register_script(
+            resource_string("snuba", "subscriptions/scripts/changes.lua")
+        )
 
     def create(self, key: UUID, data: SubscriptionData) -> None:
         """
         Stores subscription data in Redis. Will overwrite any existing
         subscriptions with the same id.
         """
-        self.client.hset(self.__key, key.hex.encode("utf-8"), self.codec.encode(data))
+        self.__script_update(
+            self.__keys,
+            [self.__changelog_size, key.hex.encode("utf-8"), self.codec.encode(data)],
+        )
 
     def delete(self, key: UUID) -> None:
         """
         Removes a subscription from the Redis store.
         """
-        self.client.hdel(self.__key, key.hex.encode("utf-8"))
+        self.__script_update(
+            self.__keys, [self.__changelog_size, key.hex.encode("utf-8")]
+        )
 
     def all(self) -> Iterable[Tuple[UUID, SubscriptionData]]:
         """
@@ -71,3 +123,27 @@ class RedisSubscriptionDataStore(SubscriptionDataStore):
             (UUID(key.decode("utf-8")), self.codec.decode(val))
             for key, val in self.client.hgetall(self.__key).items()
         ]
+
+    def snapshot(self) -> Tuple[Optional[int], Iterable[Tuple[UUID, SubscriptionData]]]:
+        # The version is read first. Changes made while the subscriptions
+        # are fetched are fetched again with the next changes, which is
+        # harmless.
+        version = int(self.client.get(self.__keys[1]) or 0)
+        return version, self.all()
+
+    def changes(self, since: int) -> Optional[SubscriptionChanges]:
+        result = self.__script_changes(self.__keys, [since])
+        if len(result) == 1:
+            return None
+
+        version, keys, values = result
+        return (
+            int(version),
+            [
+                (
+                    UUID(key.decode("utf-8")),
+                    self.codec.decode(value) if value is not None else None,
+                )
+                for key, value in zip(keys, values)
+            ],
+        )
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import Future
+from threading import Thread
+from typing import Any, Coroutine, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class EventLoopThread:
+    """
+    Runs an asyncio event loop on a dedicated thread. Coroutines are
+    submitted from any other thread and their results are returned
+    through regular `concurrent.futures.Future` objects, which can be
+    polled without knowing anything about asyncio.
+    """
+
+    def __init__(self, name: str = "event-loop") -> None:
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__run, name=name, daemon=True)
+        self.__thread.start()
+
+    def __run(self) -> None:
+        asyncio.set_event_loop(self.__loop)
+        try:
+            self.__loop.run_forever()
+        finally:
+            self.__loop.close()
+
+    async def __cancel_tasks(self) -> None:
+        tasks = [
+            task for task in asyncio.all_tasks() if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> Future[T]:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop)
+
+    def close(
+        self,
+        coroutine: Optional[Coroutine[Any, Any, Any]] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Stops the loop once the optional `coroutine`, usually releasing
+        the resources used by the coroutines submitted so far, has run.
+        The coroutines still running are cancelled.
+        """
+        if not self.__thread.is_alive():
+            return
+
+        if coroutine is not None:
+            try:
+                self.submit(coroutine).result(timeout)
+            except Exception:
+                logger.warning("Failed to clean up the event loop", exc_info=True)
+
+        try:
+            self.submit(self.__cancel_tasks()).result(timeout)
+        except Exception:
+            logger.warning("Failed to cancel the pending tasks", exc_info=True)
+
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join(timeout)
@@ -4,7 +4,7 @@ from typing import Any, Mapping, NamedTuple
 
 from mypy_extensions import TypedDict
 
-from snuba.reader import Column, Result, Row, transform_rows
+from snuba.reader import Column, LazyRows, Result, Row, transform_rows
 from snuba.utils.serializable_exception import SerializableException
 
 
@@ -56,7 +56,13 @@ def transform_column_names(
                 new_row[c] = value
         return new_row
 
-    transform_rows(result.result, transformer)
+    data = result.result["data"]
+    if isinstance(data, LazyRows):
+        data.rename_columns(mapping)
+        if "totals" in result.result:
+            result.result["totals"] = transformer(result.result["totals"])
+    else:
+        transform_rows(result.result, transformer)
 
     new_meta = []
     for c in result.result["meta"]:
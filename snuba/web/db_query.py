@@ -1,11 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import logging
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial, reduce
 from hashlib import md5
+from itertools import islice
 from threading import Lock
-from typing import Any, Mapping, MutableMapping, Optional, Set, Union, cast
+from typing import (
+    Any,
+    Callable,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Set,
+    Type,
+    Union,
+    cast,
+)
 
 import rapidjson
 import sentry_sdk
@@ -14,6 +26,7 @@ from sentry_sdk import Hub
 from sentry_sdk.api import configure_scope
 
 from snuba import environment, settings, state
+from snuba.clickhouse.async_http import AsyncHTTPReader
 from snuba.clickhouse.errors import ClickhouseError
 from snuba.clickhouse.formatter.nodes import FormattedQuery
 from snuba.clickhouse.formatter.query import format_query_anonymized
@@ -30,15 +43,18 @@ from snuba.querylog.query_metadata import (
     QueryStatus,
     SnubaQueryMetadata,
 )
-from snuba.reader import Reader, Result
+from snuba.reader import Column, LazyRows, Reader, Result, SharedRows, dump_result
 from snuba.redis import redis_client
 from snuba.request.request_settings import RequestSettings
 from snuba.state.cache.abstract import (
+    RESULT_VALUE,
+    RESULT_WAIT,
     Cache,
     ExecutionTimeoutError,
     TigerExecutionTimeoutError,
 )
-from snuba.state.cache.redis.backend import RESULT_VALUE, RESULT_WAIT, RedisCache
+from snuba.state.cache.local import LocalCache
+from snuba.state.cache.redis.backend import RedisCache
 from snuba.state.rate_limit import (
     GLOBAL_RATE_LIMIT_NAME,
     ORGANIZATION_RATE_LIMIT_NAME,
@@ -64,7 +80,7 @@ metrics = MetricsWrapper(environment.metrics, "db_query")
 
 class ResultCacheCodec(ExceptionAwareCodec[bytes, Result]):
     def encode(self, value: Result) -> bytes:
-        return cast(str, rapidjson.dumps(value)).encode("utf-8")
+        return dump_result(value, rapidjson.dumps).encode("utf-8")
 
     def decode(self, value: bytes) -> Result:
         ret = rapidjson.loads(value)
@@ -78,17 +94,93 @@ class ResultCacheCodec(ExceptionAwareCodec[bytes, Result]):
         return cast(str, rapidjson.dumps(value.to_dict())).encode("utf-8")
 
 
+# Number of rows serialized to estimate the size of a result.
+RESULT_SIZE_SAMPLE_ROWS = 10
+
+
+def get_result_size(result: Result) -> int:
+    """
+    Approximates the memory taken by a result with the size of its
+    serialization. Only the first rows are serialized and the size of
+    the others is extrapolated from them, since rows of a result hold
+    the same columns.
+    """
+    rows = result["data"]
+    sample = list(
+        islice(
+            rows.iter_rows() if isinstance(rows, LazyRows) else rows,
+            RESULT_SIZE_SAMPLE_ROWS,
+        )
+    )
+    size = len(rapidjson.dumps({k: v for k, v in result.items() if k != "data"}))
+    if sample:
+        size += len(rapidjson.dumps(sample)) * len(rows) // len(sample)
+    return size
+
+
+def copy_result(result: Result) -> Result:
+    """
+    Copies a result down to the rows, which is as deep as the query
+    pipeline mutates results.
+    """
+    rows = result["data"]
+    copy = cast(Result, {**result})
+    copy["data"] = [
+        {**row} for row in (rows.iter_rows() if isinstance(rows, LazyRows) else rows)
+    ]
+    copy["meta"] = [cast(Column, {**column}) for column in result["meta"]]
+    if "totals" in result:
+        copy["totals"] = {**result["totals"]}
+    return copy
+
+
+def share_result(result: Result) -> Result:
+    """
+    Returns a result that can be mutated without changing the given one,
+    whose rows are only copied when they are built.
+    """
+    share = cast(Result, {**result})
+    share["data"] = SharedRows(result["data"])
+    share["meta"] = [cast(Column, {**column}) for column in result["meta"]]
+    if "totals" in result:
+        share["totals"] = {**result["totals"]}
+    return share
+
+
+def _build_cache_partition(
+    partition_id: str, prefix: str, timeout_exception: Type[Exception]
+) -> Cache[Result]:
+    cache: Cache[Result] = RedisCache(
+        redis_client,
+        prefix,
+        ResultCacheCodec(),
+        ThreadPoolExecutor(),
+        timeout_exception,
+    )
+    if settings.LOCAL_RESULT_CACHE_MAX_BYTES > 0:
+        cache = LocalCache(
+            cache,
+            settings.LOCAL_RESULT_CACHE_MAX_BYTES,
+            get_result_size,
+            copy_result,
+            share_result,
+            MetricsWrapper(
+                environment.metrics,
+                "local_result_cache",
+                tags={"partition_id": partition_id},
+            ),
+        )
+    return cache
+
+
 DEFAULT_CACHE_PARTITION_ID = "default"
 
 # We are not initializing all the cache partitions here and instead relying on lazy
 # initialization because this module only learn of cache partitions ids from the
 # reader when running a query.
 cache_partitions: MutableMapping[str, Cache[Result]] = {
-    DEFAULT_CACHE_PARTITION_ID: RedisCache(
-        redis_client,
-        "snuba-query-cache:",
-        ResultCacheCodec(),
-        ThreadPoolExecutor(),
+    DEFAULT_CACHE_PARTITION_ID: _build_cache_partition(
+        DEFAULT_CACHE_PARTITION_ID, "snuba-query-cache:", ExecutionTimeoutError
     )
 }
 # This lock prevents us from initializing the cache twice. The cache is initialized
@@ -96,6 +188,11 @@ cache_partitions: MutableMapping[str, Cache[Result]] = {
 # is a waste.
 cache_partitions_lock = Lock()
 
+# Readers executing the queries that were given an id by their request
+# settings, so they can be killed by `kill_query` while they run.
+running_queries: MutableMapping[str, Reader] = {}
+running_queries_lock = Lock()
+
 logger = logging.getLogger("snuba.query")
 
 
@@ -223,24 +320,21 @@ def update_query_metadata_and_stats(
     return stats
 
 
-@with_span(op="db")
-def execute_query(
-    # TODO: Passing the whole clickhouse query here is needed as long
-    # as the execute method depends on it. Otherwise we can make this
-    # file rely either entirely on clickhouse query or entirely on
-    # the formatter.
+def _get_query_settings() -> MutableMapping[str, Any]:
+    all_confs = state.get_all_configs()
+    return {
+        k.split("/", 1)[1]: v
+        for k, v in all_confs.items()
+        if k.startswith("query_settings/")
+    }
+
+
+def _update_query_settings(
     clickhouse_query: Union[Query, CompositeQuery[Table]],
     request_settings: RequestSettings,
-    formatted_query: FormattedQuery,
-    reader: Reader,
-    timer: Timer,
     stats: MutableMapping[str, Any],
     query_settings: MutableMapping[str, Any],
-    robust: bool,
-) -> Result:
-    """
-    Execute a query and return a result.
-    """
+) -> None:
     # Experiment, if we are going to grab more than X columns worth of data,
     # don't use uncompressed_cache in ClickHouse.
     uc_max = state.get_config("uncompressed_cache_max_cols", 5)
@@ -259,12 +353,49 @@ def execute_query(
         query_settings["load_balancing"] = "in_order"
         query_settings["max_threads"] = 1
 
-    result = reader.execute(
-        formatted_query,
-        query_settings,
-        with_totals=clickhouse_query.has_totals(),
-        robust=robust,
-    )
+
+@with_span(op="db")
+def execute_query(
+    # TODO: Passing the whole clickhouse query here is needed as long
+    # as the execute method depends on it. Otherwise we can make this
+    # file rely either entirely on clickhouse query or entirely on
+    # the formatter.
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+    formatted_query: FormattedQuery,
+    reader: Reader,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    query_settings: MutableMapping[str, Any],
+    robust: bool,
+) -> Result:
+    """
+    Execute a query and return a result.
+    """
+    _update_query_settings(clickhouse_query, request_settings, stats, query_settings)
+
+    if _use_streamed_rows(clickhouse_query, request_settings):
+        result = reader.execute_stream(formatted_query, query_settings)
+        timer.mark("execute")
+        # The rows have not been read yet.
+        stats.update({"result_cols": len(result["meta"])})
+        return result
+
+    query_id = request_settings.get_query_id()
+    if query_id is not None:
+        with running_queries_lock:
+            running_queries[query_id] = reader
+    try:
+        result = reader.execute(
+            formatted_query,
+            query_settings,
+            with_totals=clickhouse_query.has_totals(),
+            robust=robust,
+        )
+    finally:
+        if query_id is not None:
+            with running_queries_lock:
+                running_queries.pop(query_id, None)
 
     timer.mark("execute")
     stats.update(
@@ -274,6 +405,17 @@ def execute_query(
     return result
 
 
+def kill_query(query_id: str) -> None:
+    """
+    Kills the query executed with the id provided by its request settings.
+    Queries that are not running yet, or anymore, are not affected.
+    """
+    with running_queries_lock:
+        reader = running_queries.get(query_id)
+    if reader is not None:
+        reader.kill_query(query_id)
+
+
 def _record_rate_limit_metrics(
     rate_limit_stats_container: RateLimitStatsContainer,
     reader: Reader,
@@ -326,6 +468,39 @@ def _record_rate_limit_metrics(
         )
 
 
+def _apply_rate_limit_stats(
+    rate_limit_stats_container: RateLimitStatsContainer,
+    request_settings: RequestSettings,
+    reader: Reader,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    query_settings: MutableMapping[str, Any],
+) -> None:
+    stats.update(rate_limit_stats_container.to_dict())
+    timer.mark("rate_limit")
+
+    project_rate_limit_stats = rate_limit_stats_container.get_stats(
+        PROJECT_RATE_LIMIT_NAME
+    )
+
+    thread_quota = request_settings.get_resource_quota()
+    if (
+        ("max_threads" in query_settings or thread_quota is not None)
+        and project_rate_limit_stats is not None
+        and project_rate_limit_stats.concurrent > 1
+    ):
+        maxt = (
+            query_settings["max_threads"]
+            if thread_quota is None
+            else thread_quota.max_threads
+        )
+        query_settings["max_threads"] = max(
+            1, maxt - project_rate_limit_stats.concurrent + 1
+        )
+
+    _record_rate_limit_metrics(rate_limit_stats_container, reader, stats)
+
+
 @with_span(op="db")
 def execute_query_with_rate_limits(
     clickhouse_query: Union[Query, CompositeQuery[Table]],
@@ -348,30 +523,15 @@ def execute_query_with_rate_limits(
     with RateLimitAggregator(
         request_settings.get_rate_limit_params()
     ) as rate_limit_stats_container:
-        stats.update(rate_limit_stats_container.to_dict())
-        timer.mark("rate_limit")
-
-        project_rate_limit_stats = rate_limit_stats_container.get_stats(
-            PROJECT_RATE_LIMIT_NAME
+        _apply_rate_limit_stats(
+            rate_limit_stats_container,
+            request_settings,
+            reader,
+            timer,
+            stats,
+            query_settings,
         )
 
-        thread_quota = request_settings.get_resource_quota()
-        if (
-            ("max_threads" in query_settings or thread_quota is not None)
-            and project_rate_limit_stats is not None
-            and project_rate_limit_stats.concurrent > 1
-        ):
-            maxt = (
-                query_settings["max_threads"]
-                if thread_quota is None
-                else thread_quota.max_threads
-            )
-            query_settings["max_threads"] = max(
-                1, maxt - project_rate_limit_stats.concurrent + 1
-            )
-
-        _record_rate_limit_metrics(rate_limit_stats_container, reader, stats)
-
         return execute_query(
             clickhouse_query,
             request_settings,
@@ -405,12 +565,8 @@ def _get_cache_partition(reader: Reader) -> Cache[Result]:
                     if "tiger" in partition_id
                     else ExecutionTimeoutError
                 )
-                cache_partitions[partition_id] = RedisCache(
-                    redis_client,
-                    f"snuba-query-cache:{partition_id}:",
-                    ResultCacheCodec(),
-                    ThreadPoolExecutor(),
-                    exception,
+                cache_partitions[partition_id] = _build_cache_partition(
+                    partition_id, f"snuba-query-cache:{partition_id}:", exception
                 )
 
     return cache_partitions[
@@ -418,8 +574,32 @@ def _get_cache_partition(reader: Reader) -> Cache[Result]:
     ]
 
 
+def _use_result_cache(clickhouse_query: Union[Query, CompositeQuery[Table]]) -> bool:
+    # XXX: ``uncompressed_cache_max_cols`` is used to control both the result
+    # cache, as well as the uncompressed cache. These should be independent.
+    use_cache, uc_max = state.get_configs(
+        [("use_cache", settings.USE_RESULT_CACHE), ("uncompressed_cache_max_cols", 5)]
+    )
+
+    column_counter = ReferencedColumnsCounter()
+    column_counter.visit(clickhouse_query.get_from_clause())
+    assert isinstance(uc_max, int)
+    if column_counter.count_columns() > uc_max:
+        return False
+    return bool(use_cache)
+
+
+def _use_streamed_rows(
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+) -> bool:
+    # The totals are received after the rows, too late to be sent in the
+    # head of a streamed response.
+    return request_settings.get_stream_response() and not clickhouse_query.has_totals()
+
+
 @with_span(op="db")
-def execute_query_with_caching(
+def execute_query_with_streaming(
     clickhouse_query: Union[Query, CompositeQuery[Table]],
     request_settings: RequestSettings,
     formatted_query: FormattedQuery,
@@ -429,17 +609,39 @@ def execute_query_with_caching(
     query_settings: MutableMapping[str, Any],
     robust: bool,
 ) -> Result:
-    # XXX: ``uncompressed_cache_max_cols`` is used to control both the result
-    # cache, as well as the uncompressed cache. These should be independent.
-    use_cache, uc_max = state.get_configs(
-        [("use_cache", settings.USE_RESULT_CACHE), ("uncompressed_cache_max_cols", 5)]
+    """
+    Executes a query whose rows are read while the response is sent, so
+    there is no result to cache. The rate limits only cover the query until
+    its first rows are received, streams being sent are not counted as
+    concurrent queries.
+    """
+    query_settings["query_id"] = (
+        request_settings.get_query_id() or get_query_cache_key(formatted_query)
+    )
+    return execute_query_with_rate_limits(
+        clickhouse_query,
+        request_settings,
+        formatted_query,
+        reader,
+        timer,
+        stats,
+        query_settings,
+        robust=robust,
     )
 
-    column_counter = ReferencedColumnsCounter()
-    column_counter.visit(clickhouse_query.get_from_clause())
-    assert isinstance(uc_max, int)
-    if column_counter.count_columns() > uc_max:
-        use_cache = False
+
+@with_span(op="db")
+def execute_query_with_caching(
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+    formatted_query: FormattedQuery,
+    reader: Reader,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    query_settings: MutableMapping[str, Any],
+    robust: bool,
+) -> Result:
+    use_cache = _use_result_cache(clickhouse_query)
 
     execute = partial(
         execute_query_with_rate_limits,
@@ -455,7 +657,7 @@ def execute_query_with_caching(
 
     with sentry_sdk.start_span(description="execute", op="db") as span:
         key = get_query_cache_key(formatted_query)
-        query_settings["query_id"] = key
+        query_settings["query_id"] = request_settings.get_query_id() or key
         if use_cache:
             cache_partition = _get_cache_partition(reader)
             result = cache_partition.get(key)
@@ -552,6 +754,43 @@ def _get_cache_wait_timeout(
     return cache_wait_timeout
 
 
+def _record_query_error(
+    cause: Exception,
+    sql: str,
+    update_with_status: Callable[..., MutableMapping[str, Any]],
+) -> MutableMapping[str, Any]:
+    if isinstance(cause, RateLimitExceeded):
+        return update_with_status(QueryStatus.RATE_LIMITED)
+
+    error_code = None
+    with configure_scope() as scope:
+        if isinstance(cause, ClickhouseError):
+            error_code = cause.code
+            scope.fingerprint = ["{{default}}", str(cause.code)]
+            if scope.span:
+                if cause.code == errors.ErrorCodes.TOO_SLOW:
+                    sentry_sdk.set_tag("timeout", "predicted")
+                elif cause.code == errors.ErrorCodes.TIMEOUT_EXCEEDED:
+                    sentry_sdk.set_tag("timeout", "query_timeout")
+                elif cause.code in (
+                    errors.ErrorCodes.SOCKET_TIMEOUT,
+                    errors.ErrorCodes.NETWORK_ERROR,
+                ):
+                    sentry_sdk.set_tag("timeout", "network")
+        elif isinstance(
+            cause,
+            (TimeoutError, ExecutionTimeoutError, TigerExecutionTimeoutError),
+        ):
+            if scope.span:
+                sentry_sdk.set_tag("timeout", "cache_timeout")
+
+        if error_code == errors.ErrorCodes.QUERY_WAS_CANCELLED:
+            logger.warning("Query was killed: %s", sql)
+        else:
+            logger.exception("Error running query: %s\n%s", sql, cause)
+    return update_with_status(QueryStatus.ERROR, error_code=error_code)
+
+
 def raw_query(
     # TODO: Passing the whole clickhouse query here is needed as long
     # as the execute method depends on it. Otherwise we can make this
@@ -573,12 +812,7 @@ def raw_query(
     This function is not supposed to depend on anything higher level than the clickhouse
     query. If this function ends up depending on the dataset, something is wrong.
     """
-    all_confs = state.get_all_configs()
-    query_settings: MutableMapping[str, Any] = {
-        k.split("/", 1)[1]: v
-        for k, v in all_confs.items()
-        if k.startswith("query_settings/")
-    }
+    query_settings = _get_query_settings()
 
     timer.mark("get_configs")
 
@@ -595,11 +829,16 @@ def raw_query(
         trace_id,
     )
 
-    execute_query_strategy = (
-        execute_query_with_readthrough_caching
-        if state.get_config("use_readthrough_query_cache", 1)
-        else execute_query_with_caching
-    )
+    if _use_streamed_rows(clickhouse_query, request_settings):
+        execute_query_strategy = execute_query_with_streaming
+    elif request_settings.get_query_id() is None and state.get_config(
+        "use_readthrough_query_cache", 1
+    ):
+        # Queries with an id of their own can be killed, sharing them through
+        # the readthrough cache would fail the requests waiting for them.
+        execute_query_strategy = execute_query_with_readthrough_caching
+    else:
+        execute_query_strategy = execute_query_with_caching
 
     try:
         result = execute_query_strategy(
@@ -613,33 +852,7 @@ def raw_query(
             robust=robust,
         )
     except Exception as cause:
-        if isinstance(cause, RateLimitExceeded):
-            stats = update_with_status(QueryStatus.RATE_LIMITED)
-        else:
-            error_code = None
-            with configure_scope() as scope:
-                if isinstance(cause, ClickhouseError):
-                    error_code = cause.code
-                    scope.fingerprint = ["{{default}}", str(cause.code)]
-                    if scope.span:
-                        if cause.code == errors.ErrorCodes.TOO_SLOW:
-                            sentry_sdk.set_tag("timeout", "predicted")
-                        elif cause.code == errors.ErrorCodes.TIMEOUT_EXCEEDED:
-                            sentry_sdk.set_tag("timeout", "query_timeout")
-                        elif cause.code in (
-                            errors.ErrorCodes.SOCKET_TIMEOUT,
-                            errors.ErrorCodes.NETWORK_ERROR,
-                        ):
-                            sentry_sdk.set_tag("timeout", "network")
-                elif isinstance(
-                    cause,
-                    (TimeoutError, ExecutionTimeoutError, TigerExecutionTimeoutError),
-                ):
-                    if scope.span:
-                        sentry_sdk.set_tag("timeout", "cache_timeout")
-
-                logger.exception("Error running query: %s\n%s", sql, cause)
-            stats = update_with_status(QueryStatus.ERROR, error_code=error_code)
+        stats = _record_query_error(cause, sql, update_with_status)
         raise QueryException(
             {
                 "stats": stats,
@@ -657,3 +870,181 @@ def raw_query(
                 "experiments": clickhouse_query.get_experiments(),
             },
         )
+
+
+def prepare_raw_query(
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+    formatted_query: FormattedQuery,
+    stats: MutableMapping[str, Any],
+) -> MutableMapping[str, Any]:
+    """
+    Returns the settings `raw_query_async` executes the query with. They
+    depend on the runtime configuration, which cannot be read from the
+    event loop executing the query without blocking it.
+    """
+    query_settings = _get_query_settings()
+    _update_query_settings(clickhouse_query, request_settings, stats, query_settings)
+    query_settings["query_id"] = get_query_cache_key(formatted_query)
+    return query_settings
+
+
+def _get_async_result_cache(
+    clickhouse_query: Union[Query, CompositeQuery[Table]], reader: Reader
+) -> Optional[Cache[Result]]:
+    """
+    Returns the cache `raw_query_async` stores the result in, if any. The
+    result is cached whenever `raw_query` would cache it.
+    """
+    if state.get_config("use_readthrough_query_cache", 1) or _use_result_cache(
+        clickhouse_query
+    ):
+        return _get_cache_partition(reader)
+    return None
+
+
+def _acquire_rate_limits(
+    request_settings: RequestSettings,
+    reader: Reader,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    query_settings: MutableMapping[str, Any],
+) -> RateLimitAggregator:
+    """
+    Enters the rate limits of the query like `execute_query_with_rate_limits`
+    does. The caller is responsible for exiting them.
+    """
+    request_settings.add_rate_limit(get_global_rate_limit_params())
+    rate_limiter = RateLimitAggregator(request_settings.get_rate_limit_params())
+    _apply_rate_limit_stats(
+        rate_limiter.__enter__(),
+        request_settings,
+        reader,
+        timer,
+        stats,
+        query_settings,
+    )
+    return rate_limiter
+
+
+async def _execute_query_async(
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+    formatted_query: FormattedQuery,
+    reader: AsyncHTTPReader,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    query_settings: MutableMapping[str, Any],
+) -> Result:
+    loop = asyncio.get_running_loop()
+    key = query_settings["query_id"]
+
+    cache = await loop.run_in_executor(
+        None, _get_async_result_cache, clickhouse_query, reader
+    )
+    if cache is not None:
+        result = await loop.run_in_executor(None, cache.get, key)
+        timer.mark("cache_get")
+        if result is not None:
+            stats["cache_hit"] = 1
+            return result
+
+    rate_limiter = await loop.run_in_executor(
+        None,
+        _acquire_rate_limits,
+        request_settings,
+        reader,
+        timer,
+        stats,
+        query_settings,
+    )
+    try:
+        result = await reader.execute(
+            formatted_query,
+            query_settings,
+            with_totals=clickhouse_query.has_totals(),
+        )
+    except BaseException as error:
+        await loop.run_in_executor(
+            None, rate_limiter.__exit__, type(error), error, error.__traceback__
+        )
+        raise
+    await loop.run_in_executor(None, rate_limiter.__exit__, None, None, None)
+
+    timer.mark("execute")
+    stats.update(
+        {"result_rows": len(result["data"]), "result_cols": len(result["meta"])}
+    )
+
+    if cache is not None:
+        await loop.run_in_executor(None, cache.set, key, result)
+        timer.mark("cache_set")
+    return result
+
+
+async def raw_query_async(
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+    formatted_query: FormattedQuery,
+    reader: AsyncHTTPReader,
+    timer: Timer,
+    query_metadata: SnubaQueryMetadata,
+    stats: MutableMapping[str, Any],
+    query_settings: MutableMapping[str, Any],
+) -> QueryResult:
+    """
+    Same as `raw_query`, for queries executed by an asynchronous reader
+    with the settings returned by `prepare_raw_query`.
+
+    The rate limits, including the max_threads adjustments, and the result
+    cache go through Redis with blocking calls, which run on the default
+    executor of the event loop. The cache is not read through: waiting for
+    an identical query to complete would hold an executor thread for as
+    long as the query runs, so identical queries may run concurrently.
+    """
+    sql = formatted_query.get_sql()
+
+    update_with_status = partial(
+        update_query_metadata_and_stats,
+        clickhouse_query,
+        sql,
+        timer,
+        stats,
+        query_metadata,
+        query_settings,
+        None,
+    )
+
+    try:
+        result = await _execute_query_async(
+            clickhouse_query,
+            request_settings,
+            formatted_query,
+            reader,
+            timer,
+            stats,
+            query_settings,
+        )
+    except Exception as cause:
+        # The thread of the event loop runs many queries with the same
+        # Sentry hub, the tags and fingerprint of this error are kept in a
+        # scope of their own so that they do not leak into the others.
+        with sentry_sdk.push_scope():
+            stats = _record_query_error(cause, sql, update_with_status)
+        raise QueryException(
+            {
+                "stats": stats,
+                "sql": sql,
+                "experiments": clickhouse_query.get_experiments(),
+            }
+        ) from cause
+
+    stats = update_with_status(QueryStatus.SUCCESS, result["profile"])
+    return QueryResult(
+        result,
+        {
+            "stats": stats,
+            "sql": sql,
+            "experiments": clickhouse_query.get_experiments(),
+        },
+    )
@@ -1,15 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from dataclasses import replace
+from dataclasses import dataclass, replace
 from functools import partial
 from math import floor
-from typing import MutableMapping, Optional, Set, Union
+from typing import Any, List, Mapping, MutableMapping, Optional, Set, Tuple, Union
 
 import sentry_sdk
 
 from snuba import environment
 from snuba import settings as snuba_settings
+from snuba.clickhouse.async_http import AsyncHTTPReader
+from snuba.clickhouse.formatter.nodes import FormattedQuery
 from snuba.clickhouse.formatter.query import format_query
 from snuba.clickhouse.query import Query
 from snuba.clickhouse.query_dsl.accessors import (
@@ -27,7 +30,7 @@ from snuba.query.data_source.simple import Entity, Table
 from snuba.query.data_source.visitor import DataSourceVisitor
 from snuba.query.logical import Query as LogicalQuery
 from snuba.querylog import record_query
-from snuba.querylog.query_metadata import SnubaQueryMetadata
+from snuba.querylog.query_metadata import SnubaQueryMetadata, current_query_metadata
 from snuba.reader import Reader
 from snuba.request import Request
 from snuba.request.request_settings import RequestSettings
@@ -42,7 +45,7 @@ from snuba.web import (
     QueryTooLongException,
     transform_column_names,
 )
-from snuba.web.db_query import raw_query
+from snuba.web.db_query import prepare_raw_query, raw_query, raw_query_async
 
 logger = logging.getLogger("snuba.query")
 
@@ -115,27 +118,7 @@ def parse_and_run_query(
     """
     Runs a Snuba Query, then records the metadata about each split query that was run.
     """
-    # from_clause = request.query.get_from_clause()
-    start, end = None, None
-    entity_name = "unknown"
-    if isinstance(request.query, LogicalQuery):
-        entity_key = request.query.get_from_clause().key
-        entity = get_entity(entity_key)
-        entity_name = entity_key.value
-        if entity.required_time_column is not None:
-            start, end = get_time_range(request.query, entity.required_time_column)
-
-    query_metadata = SnubaQueryMetadata(
-        request=request,
-        start_timestamp=start,
-        end_timestamp=end,
-        dataset=get_dataset_name(dataset),
-        entity=entity_name,
-        timer=timer,
-        query_list=[],
-        projects=ProjectsFinder().visit(request.query),
-        snql_anonymized=request.snql_anonymized,
-    )
+    query_metadata = _build_query_metadata(dataset, request, timer)
 
     try:
         result = _run_query_pipeline(
@@ -157,6 +140,156 @@ def parse_and_run_query(
     return result
 
 
+@dataclass(frozen=True)
+class PreparedQuery:
+    """
+    A storage query formatted by the query pipeline and ready to be
+    executed, along with everything needed to record its execution.
+    """
+
+    request: Request
+    timer: Timer
+    query_metadata: SnubaQueryMetadata
+    clickhouse_query: Union[Query, CompositeQuery[Table]]
+    request_settings: RequestSettings
+    formatted_query: FormattedQuery
+    reader: Reader
+    stats: MutableMapping[str, Any]
+    query_settings: MutableMapping[str, Any]
+
+
+def prepare_query(
+    dataset: Dataset, request: Request, timer: Timer
+) -> Optional[PreparedQuery]:
+    """
+    Runs the query pipeline up to the formatted storage query, without
+    executing it, so that it can be executed asynchronously by
+    `run_prepared_query`.
+
+    Returns None if the request needs more than one storage query, like
+    split queries do. The pipeline has processed the request by then, so
+    it has to be built again to be executed by `parse_and_run_query`.
+    """
+    query_metadata = _build_query_metadata(dataset, request, timer)
+    prepared: List[PreparedQuery] = []
+
+    def prepare(
+        clickhouse_query: Union[Query, CompositeQuery[Table]],
+        request_settings: RequestSettings,
+        reader: Reader,
+    ) -> QueryResult:
+        formatted_query, stats = _format_storage_query(
+            timer, request.referrer, clickhouse_query, request_settings
+        )
+        prepared.append(
+            PreparedQuery(
+                request,
+                timer,
+                query_metadata,
+                clickhouse_query,
+                request_settings,
+                formatted_query,
+                reader,
+                stats,
+                prepare_raw_query(
+                    clickhouse_query, request_settings, formatted_query, stats
+                ),
+            )
+        )
+        # What the pipeline does with this result is discarded.
+        return QueryResult(
+            {"data": [], "meta": []},
+            {
+                "stats": stats,
+                "sql": formatted_query.get_sql(),
+                "experiments": clickhouse_query.get_experiments(),
+            },
+        )
+
+    try:
+        dataset.get_query_pipeline_builder().build_execution_pipeline(
+            request, prepare
+        ).execute()
+    except QueryException as error:
+        _set_query_final(request, error.extra)
+        record_query(request, timer, query_metadata, error.extra)
+        raise error
+
+    return prepared[0] if len(prepared) == 1 else None
+
+
+async def run_prepared_query(
+    prepared: PreparedQuery, reader: AsyncHTTPReader
+) -> QueryResult:
+    """
+    Executes a query returned by `prepare_query` and records it, like
+    `parse_and_run_query` does. Recording the query produces it to Kafka
+    and stores it in Redis, so it runs on the default executor of the
+    event loop.
+    """
+    loop = asyncio.get_running_loop()
+    request = prepared.request
+    try:
+        result = await raw_query_async(
+            prepared.clickhouse_query,
+            prepared.request_settings,
+            prepared.formatted_query,
+            reader,
+            prepared.timer,
+            prepared.query_metadata,
+            prepared.stats,
+            prepared.query_settings,
+        )
+    except QueryException as error:
+        _set_query_final(request, error.extra)
+        await loop.run_in_executor(
+            None,
+            record_query,
+            request,
+            prepared.timer,
+            prepared.query_metadata,
+            error.extra,
+        )
+        raise error
+
+    transform_column_names(result, _get_alias_name_mapping(prepared.clickhouse_query))
+    _set_query_final(request, result.extra)
+    await loop.run_in_executor(
+        None,
+        record_query,
+        request,
+        prepared.timer,
+        prepared.query_metadata,
+        result.extra,
+    )
+    return result
+
+
+def _build_query_metadata(
+    dataset: Dataset, request: Request, timer: Timer
+) -> SnubaQueryMetadata:
+    start, end = None, None
+    entity_name = "unknown"
+    if isinstance(request.query, LogicalQuery):
+        entity_key = request.query.get_from_clause().key
+        entity = get_entity(entity_key)
+        entity_name = entity_key.value
+        if entity.required_time_column is not None:
+            start, end = get_time_range(request.query, entity.required_time_column)
+
+    return SnubaQueryMetadata(
+        request=request,
+        start_timestamp=start,
+        end_timestamp=end,
+        dataset=get_dataset_name(dataset),
+        entity=entity_name,
+        timer=timer,
+        query_list=[],
+        projects=ProjectsFinder().visit(request.query),
+        snql_anonymized=request.snql_anonymized,
+    )
+
+
 def _set_query_final(request: Request, extra: QueryExtraData) -> None:
     if "final" in extra["stats"]:
         request.query.set_final(extra["stats"]["final"])
@@ -200,11 +333,15 @@ def _run_query_pipeline(
             concurrent_queries_gauge,
         )
 
-    return (
-        dataset.get_query_pipeline_builder()
-        .build_execution_pipeline(request, query_runner)
-        .execute()
-    )
+    token = current_query_metadata.set(query_metadata)
+    try:
+        return (
+            dataset.get_query_pipeline_builder()
+            .build_execution_pipeline(request, query_runner)
+            .execute()
+        )
+    finally:
+        current_query_metadata.reset(token)
 
 
 def _dry_run_query_runner(
@@ -244,6 +381,11 @@ def _run_and_apply_column_names(
     those aliases now are needed to produce the names the user expects
     in the output.
     """
+    # Queries executed on other threads on behalf of the request may be
+    # recorded in metadata of their own, see `current_query_metadata`.
+    recorded_metadata = current_query_metadata.get()
+    if recorded_metadata is not None and recorded_metadata is not query_metadata:
+        query_metadata, timer = recorded_metadata, recorded_metadata.timer
 
     result = _format_storage_query_and_run(
         timer,
@@ -256,6 +398,13 @@ def _run_and_apply_column_names(
         concurrent_queries_gauge,
     )
 
+    transform_column_names(result, _get_alias_name_mapping(clickhouse_query))
+    return result
+
+
+def _get_alias_name_mapping(
+    clickhouse_query: Union[Query, CompositeQuery[Table]]
+) -> Mapping[str, List[str]]:
     alias_name_mapping: MutableMapping[str, list[str]] = {}
     for select_col in clickhouse_query.get_selected_columns():
         alias = select_col.expression.alias
@@ -274,8 +423,7 @@ def _run_and_apply_column_names(
         else:
             alias_name_mapping[alias] = [name]
 
-    transform_column_names(result, alias_name_mapping)
-    return result
+    return alias_name_mapping
 
 
 def _format_storage_query_and_run(
@@ -291,6 +439,43 @@ def _format_storage_query_and_run(
     """
     Formats the Storage Query and pass it to the DB specific code for execution.
     """
+    formatted_query, stats = _format_storage_query(
+        timer, referrer, clickhouse_query, request_settings
+    )
+
+    with sentry_sdk.start_span(description=formatted_query.get_sql(), op="db") as span:
+        span.set_tag("table", stats["clickhouse_table"])
+
+        def execute() -> QueryResult:
+            return raw_query(
+                clickhouse_query,
+                request_settings,
+                formatted_query,
+                reader,
+                timer,
+                query_metadata,
+                stats,
+                span.trace_id,
+                robust=robust,
+            )
+
+        if concurrent_queries_gauge is not None:
+            with concurrent_queries_gauge:
+                return execute()
+        else:
+            return execute()
+
+
+def _format_storage_query(
+    timer: Timer,
+    referrer: str,
+    clickhouse_query: Union[Query, CompositeQuery[Table]],
+    request_settings: RequestSettings,
+) -> Tuple[FormattedQuery, MutableMapping[str, Any]]:
+    """
+    Formats the Storage Query and builds the stats recorded with its
+    execution. Raises a QueryException if the query is too long.
+    """
     from_clause = clickhouse_query.get_from_clause()
     visitor = TablesCollector()
     visitor.visit(from_clause)
@@ -307,7 +492,7 @@ def _format_storage_query_and_run(
 
     timer.mark("prepare_query")
 
-    stats = {
+    stats: MutableMapping[str, Any] = {
         "clickhouse_table": table_names,
         "final": visitor.any_final(),
         "referrer": referrer,
@@ -327,27 +512,7 @@ def _format_storage_query_and_run(
             f"Max size is {MAX_QUERY_SIZE_BYTES} bytes."
         )
 
-    with sentry_sdk.start_span(description=formatted_query.get_sql(), op="db") as span:
-        span.set_tag("table", table_names)
-
-        def execute() -> QueryResult:
-            return raw_query(
-                clickhouse_query,
-                request_settings,
-                formatted_query,
-                reader,
-                timer,
-                query_metadata,
-                stats,
-                span.trace_id,
-                robust=robust,
-            )
-
-        if concurrent_queries_gauge is not None:
-            with concurrent_queries_gauge:
-                return execute()
-        else:
-            return execute()
+    return formatted_query, stats
 
 
 def get_query_size_group(query_size_bytes: int) -> str:
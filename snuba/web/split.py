@@ -1,9 +1,16 @@
 import copy
 import logging
 import math
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
 from dataclasses import replace
-from datetime import timedelta
-from typing import Optional
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Iterable, List, MutableMapping, NamedTuple, Optional, Tuple
+
+from sentry_sdk import Hub
 
 from snuba import environment, settings, state, util
 from snuba.clickhouse.query import Query
@@ -24,9 +31,12 @@ from snuba.query.expressions import Expression
 from snuba.query.expressions import FunctionCall as FunctionCallExpr
 from snuba.query.expressions import Literal as LiteralExpr
 from snuba.query.matchers import AnyExpression, Column, FunctionCall, Or, Param, String
+from snuba.querylog.query_metadata import SnubaQueryMetadata, current_query_metadata
 from snuba.request.request_settings import RequestSettings
+from snuba.utils.metrics.timer import Timer
 from snuba.utils.metrics.wrapper import MetricsWrapper
 from snuba.web import QueryResult
+from snuba.web.db_query import kill_query
 
 logger = logging.getLogger("snuba.query.split")
 metrics = MetricsWrapper(environment.metrics, "query.splitter")
@@ -37,6 +47,56 @@ metrics = MetricsWrapper(environment.metrics, "query.splitter")
 # queries before hitting the 90d limit (2+20+200+2000 hours == 92 days).
 STEP_GROWTH = 10
 
+# Pool shared by all the time split queries that run the windows they expect
+# to need next while the current one is still executing.
+_speculation_executor = ThreadPoolExecutor(
+    max_workers=settings.SPLIT_SPECULATION_THREADS,
+    thread_name_prefix="split-speculation",
+)
+
+# (start, end, limit) of a time split window.
+Window = Tuple[datetime, datetime, int]
+
+
+class Speculation(NamedTuple):
+    """
+    A window running ahead of time. It records its execution in metadata of
+    its own, which is merged into the metadata of the request only if the
+    window is used, and runs with a query id of its own so it can be killed
+    if it is discarded.
+    """
+
+    future: "Future[QueryResult]"
+    query_metadata: Optional[SnubaQueryMetadata]
+    query_id: str
+
+
+class SpeculationBudget:
+    """
+    Counts the speculative split queries each referrer has in flight so a
+    single referrer cannot take over the whole speculation pool.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__in_flight: MutableMapping[str, int] = defaultdict(int)
+
+    def acquire(self, referrer: str, budget: int) -> bool:
+        with self.__lock:
+            if self.__in_flight[referrer] >= budget:
+                return False
+            self.__in_flight[referrer] += 1
+            return True
+
+    def release(self, referrer: str) -> None:
+        with self.__lock:
+            self.__in_flight[referrer] -= 1
+            if self.__in_flight[referrer] <= 0:
+                del self.__in_flight[referrer]
+
+
+_speculation_budget = SpeculationBudget()
+
 
 def _replace_ast_condition(
     query: Query, field: str, operator: str, new_operand: Expression
@@ -75,7 +135,9 @@ def _replace_ast_condition(
 class TimeSplitQueryStrategy(QuerySplitStrategy):
     """
     A strategy that breaks the time window into smaller ones and executes
-    them in sequence.
+    them in sequence. When the split_speculative_windows runtime config is
+    set, the windows that would follow an empty one are started in advance
+    on a bounded pool.
     """
 
     def __init__(self, timestamp_col: str) -> None:
@@ -125,67 +187,229 @@ class TimeSplitQueryStrategy(QuerySplitStrategy):
         assert isinstance(split_step, int)
         remaining_offset = query.get_offset()
 
+        speculative_windows, referrer_budget = state.get_configs(
+            [
+                ("split_speculative_windows", 0),
+                ("split_speculation_referrer_budget", 4),
+            ]
+        )
+        assert isinstance(speculative_windows, int)
+        assert isinstance(referrer_budget, int)
+        speculation: MutableMapping[Window, Speculation] = {}
+
         overall_result: Optional[QueryResult] = None
         split_end = to_date_ast
         split_start = max(split_end - timedelta(seconds=split_step), from_date_ast)
         total_results = 0
-        while split_start < split_end and total_results < limit:
-            # We need to make a copy to use during the query execution because we replace
-            # the start-end conditions on the query at each iteration of this loop.
-            split_query = copy.deepcopy(query)
+        try:
+            while split_start < split_end and total_results < limit:
+                # Because its paged, we have to ask for (limit+offset) results
+                # and set offset=0 so we can then trim them ourselves.
+                window = (
+                    split_start,
+                    split_end,
+                    limit - total_results + remaining_offset,
+                )
+                speculative = speculation.pop(window, None)
+                result: Optional[QueryResult] = None
+                if speculative_windows:
+                    self.__speculate(
+                        query,
+                        request_settings,
+                        runner,
+                        window,
+                        split_step,
+                        from_date_ast,
+                        speculative_windows,
+                        referrer_budget,
+                        speculation,
+                    )
 
-            _replace_ast_condition(
-                split_query, self.__timestamp_col, ">=", LiteralExpr(None, split_start)
-            )
-            _replace_ast_condition(
-                split_query, self.__timestamp_col, "<", LiteralExpr(None, split_end)
-            )
+                # At every iteration we only append the "data" key from the results returned by
+                # the runner. The "extra" key is only populated at the first iteration of the
+                # loop and never changed.
+                if speculative is not None:
+                    metrics.increment("time_splitter.speculation_hit")
+                    result = self.__use(speculative)
+                if result is None:
+                    result = runner(
+                        self.__build_window_query(query, window), request_settings
+                    )
+
+                if overall_result is None:
+                    overall_result = result
+                else:
+                    overall_result.result["data"].extend(result.result["data"])
+
+                if remaining_offset > 0 and len(overall_result.result["data"]) > 0:
+                    to_trim = min(remaining_offset, len(overall_result.result["data"]))
+                    overall_result.result["data"] = overall_result.result["data"][
+                        to_trim:
+                    ]
+                    remaining_offset -= to_trim
+
+                total_results = len(overall_result.result["data"])
+
+                if total_results < limit:
+                    if len(result.result["data"]) == 0:
+                        # If we got nothing from the last query, expand the range by a static factor
+                        split_step = split_step * STEP_GROWTH
+                    else:
+                        # If we got some results but not all of them, estimate how big the time
+                        # range should be for the next query based on how many results we got for
+                        # our last query and its time range, and how many we have left to fetch.
+                        remaining = limit - total_results
+                        split_step = split_step * math.ceil(
+                            remaining / float(len(result.result["data"]))
+                        )
+
+                    # Set the start and end of the next query based on the new range.
+                    split_end = split_start
+                    try:
+                        split_start = max(
+                            split_end - timedelta(seconds=split_step), from_date_ast
+                        )
+                    except OverflowError:
+                        split_start = from_date_ast
+        finally:
+            self.__discard(speculation.values())
+
+        return overall_result
 
-            # Because its paged, we have to ask for (limit+offset) results
-            # and set offset=0 so we can then trim them ourselves.
-            split_query.set_offset(0)
-            split_query.set_limit(limit - total_results + remaining_offset)
+    def __build_window_query(self, query: Query, window: Window) -> Query:
+        split_start, split_end, split_limit = window
+        # We need to make a copy to use during the query execution because we replace
+        # the start-end conditions on the query for every window.
+        split_query = query.clone()
 
-            # At every iteration we only append the "data" key from the results returned by
-            # the runner. The "extra" key is only populated at the first iteration of the
-            # loop and never changed.
-            result = runner(split_query, request_settings)
+        _replace_ast_condition(
+            split_query, self.__timestamp_col, ">=", LiteralExpr(None, split_start)
+        )
+        _replace_ast_condition(
+            split_query, self.__timestamp_col, "<", LiteralExpr(None, split_end)
+        )
 
-            if overall_result is None:
-                overall_result = result
-            else:
-                overall_result.result["data"].extend(result.result["data"])
+        split_query.set_offset(0)
+        split_query.set_limit(split_limit)
+        return split_query
 
-            if remaining_offset > 0 and len(overall_result.result["data"]) > 0:
-                to_trim = min(remaining_offset, len(overall_result.result["data"]))
-                overall_result.result["data"] = overall_result.result["data"][to_trim:]
-                remaining_offset -= to_trim
+    def __speculate(
+        self,
+        query: Query,
+        request_settings: RequestSettings,
+        runner: SplitQueryRunner,
+        window: Window,
+        split_step: int,
+        from_date: datetime,
+        windows_count: int,
+        referrer_budget: int,
+        speculation: MutableMapping[Window, Speculation],
+    ) -> None:
+        """
+        Submits the windows that would follow the one provided if it returned
+        no rows, which is the case we want to speed up: sparse data over a
+        large time range. Pending windows that are not predicted anymore are
+        discarded.
+        """
+        predicted: List[Window] = []
+        split_start, _, split_limit = window
+        while len(predicted) < windows_count and split_start > from_date:
+            split_step = split_step * STEP_GROWTH
+            split_end = split_start
+            try:
+                split_start = max(split_end - timedelta(seconds=split_step), from_date)
+            except OverflowError:
+                split_start = from_date
+            predicted.append((split_start, split_end, split_limit))
+
+        self.__discard(
+            [speculation.pop(w) for w in list(speculation) if w not in predicted]
+        )
 
-            total_results = len(overall_result.result["data"])
+        referrer = request_settings.referrer
+        for predicted_window in predicted:
+            if predicted_window in speculation:
+                continue
+            if not _speculation_budget.acquire(referrer, referrer_budget):
+                metrics.increment("time_splitter.speculation_over_budget")
+                break
+
+            speculation[predicted_window] = self.__submit(
+                runner,
+                self.__build_window_query(query, predicted_window),
+                request_settings,
+            )
+            speculation[predicted_window].future.add_done_callback(
+                lambda _: _speculation_budget.release(referrer)
+            )
 
-            if total_results < limit:
-                if len(result.result["data"]) == 0:
-                    # If we got nothing from the last query, expand the range by a static factor
-                    split_step = split_step * STEP_GROWTH
-                else:
-                    # If we got some results but not all of them, estimate how big the time
-                    # range should be for the next query based on how many results we got for
-                    # our last query and its time range, and how many we have left to fetch.
-                    remaining = limit - total_results
-                    split_step = split_step * math.ceil(
-                        remaining / float(len(result.result["data"]))
-                    )
+    def __submit(
+        self,
+        runner: SplitQueryRunner,
+        query: Query,
+        request_settings: RequestSettings,
+    ) -> Speculation:
+        """
+        Runs the window on the speculation pool with a timer, metadata,
+        request settings and Sentry hub of its own, since none of them can
+        be shared with the thread executing the request.
+        """
+        parent_metadata = current_query_metadata.get()
+        query_metadata = (
+            replace(parent_metadata, timer=Timer("split_speculation"), query_list=[])
+            if parent_metadata is not None
+            else None
+        )
+        window_settings = copy.deepcopy(request_settings)
+        query_id = uuid.uuid4().hex
+        window_settings.set_query_id(query_id)
+        hub = Hub(Hub.current)
+
+        def run() -> QueryResult:
+            current_query_metadata.set(query_metadata)
+            with hub:
+                return runner(query, window_settings)
+
+        return Speculation(
+            _speculation_executor.submit(copy_context().run, run),
+            query_metadata,
+            query_id,
+        )
 
-                # Set the start and end of the next query based on the new range.
-                split_end = split_start
-                try:
-                    split_start = max(
-                        split_end - timedelta(seconds=split_step), from_date_ast
-                    )
-                except OverflowError:
-                    split_start = from_date_ast
+    def __use(self, speculative: Speculation) -> Optional[QueryResult]:
+        """
+        Returns the result of the window, or None if it failed, in which case
+        the window has to be run again by the request. The failure may not
+        be worth failing the request for, e.g. the speculation pool could not
+        get a connection or the window ran into the rate limits.
+        """
+        try:
+            result = speculative.future.result()
+        except Exception as e:
+            logger.warning("Speculative window failed: %s", e, exc_info=True)
+            metrics.increment("time_splitter.speculation_error")
+            return None
 
-        return overall_result
+        parent_metadata = current_query_metadata.get()
+        if parent_metadata is not None and speculative.query_metadata is not None:
+            parent_metadata.query_list.extend(speculative.query_metadata.query_list)
+            # The window ran while the previous ones were executing, only
+            # the time spent waiting for it is added to the request.
+            parent_metadata.timer.mark("execute")
+        return result
+
+    def __discard(self, speculations: Iterable[Speculation]) -> None:
+        for speculative in speculations:
+            metrics.increment("time_splitter.speculation_miss")
+            if speculative.future.cancel() or speculative.future.done():
+                continue
+            # The window already started, its query is killed so it does not
+            # keep using ClickHouse for a result that is dropped.
+            try:
+                kill_query(speculative.query_id)
+                metrics.increment("time_splitter.speculation_killed")
+            except Exception as e:
+                logger.warning("Failed to kill speculative window: %s", e, exc_info=True)
 
 
 class ColumnSplitQueryStrategy(QuerySplitStrategy):
@@ -258,7 +482,7 @@ class ColumnSplitQueryStrategy(QuerySplitStrategy):
             metrics.increment("column_splitter.main_query_min_threshold")
             return None
 
-        minimal_query = copy.deepcopy(query)
+        minimal_query = query.clone()
 
         # TODO: provide the table alias name to this splitter if we ever use it
         # in joins.
@@ -313,7 +537,7 @@ class ColumnSplitQueryStrategy(QuerySplitStrategy):
 
         # Making a copy just in case runner returned None (which would drive the execution
         # strategy to ignore the result of this splitter and try the next one).
-        query = copy.deepcopy(query)
+        query = query.clone()
 
         event_ids = list(
             set([event[self.__id_column] for event in result.result["data"]])
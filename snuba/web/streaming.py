@@ -0,0 +1,101 @@
+"""
+Incremental serialization of query results.
+
+A result is serialized as a JSON document that is produced a piece at a
+time: the metadata of the result first, then the rows in chunks, and
+finally the trailing fields like the timing and the stats, which are only
+computed once all the rows have been serialized. The pieces can be sent
+as they are produced, so the whole document never has to be held in
+memory and the first bytes of the response are sent before the last rows
+are serialized. The rows can be read from the database while they are
+serialized, when the result holds `StreamedRows`.
+"""
+from __future__ import annotations
+
+import itertools
+import logging
+from typing import Any, Callable, Iterator, Mapping, Optional
+
+import simplejson as json
+
+from snuba.reader import LazyRows, Result, Row, dump_result
+
+logger = logging.getLogger(__name__)
+
+
+def iterate_result_rows(result: Result) -> Iterator[Row]:
+    rows = result["data"]
+    if isinstance(rows, LazyRows):
+        return rows.iter_rows()
+    return iter(rows)
+
+
+def _serialize_chunk(rows: Iterator[Row], chunk_size: int) -> Optional[str]:
+    chunk = list(itertools.islice(rows, chunk_size))
+    if not chunk:
+        return None
+    # Strip the brackets of the list to append the rows to the array.
+    return json.dumps(chunk)[1:-1]
+
+
+def stream_result(
+    result: Result,
+    get_trailer: Callable[[], Mapping[str, Any]],
+    chunk_size: int,
+) -> Iterator[str]:
+    """
+    Produces the JSON serialization of the result followed by the fields
+    returned by `get_trailer`, which is called once the rows have been
+    serialized.
+
+    The metadata and the first chunk of rows are serialized, and read
+    from the database if they are streamed, before this returns. Errors
+    there are raised to the caller while it can still respond with an
+    error status. An error raised while reading or serializing the
+    following rows is logged and raised again from the iterator, which
+    leaves the document unterminated. The server then aborts the response,
+    so the client sees a failed transfer instead of a successful one.
+    """
+    assert chunk_size > 0
+
+    head = ["{"]
+    for key, value in result.items():
+        if key != "data":
+            head.append(
+                f"{json.dumps(key)}: {dump_result(value, json.dumps)}, "
+            )
+    head.append('"data": [')
+    rows = iterate_result_rows(result)
+    first_chunk = _serialize_chunk(rows, chunk_size)
+    if first_chunk is not None:
+        head.append(first_chunk)
+
+    return _stream_rows(
+        "".join(head), first_chunk is not None, rows, get_trailer, chunk_size
+    )
+
+
+def _stream_rows(
+    head: str,
+    has_rows: bool,
+    rows: Iterator[Row],
+    get_trailer: Callable[[], Mapping[str, Any]],
+    chunk_size: int,
+) -> Iterator[str]:
+    yield head
+    separator = ", " if has_rows else ""
+    try:
+        while True:
+            chunk = _serialize_chunk(rows, chunk_size)
+            if chunk is None:
+                break
+            yield separator + chunk
+            separator = ", "
+    except Exception:
+        logger.exception("Failed to stream the rows of a result")
+        raise
+    yield "]"
+
+    for key, value in get_trailer().items():
+        yield f", {json.dumps(key)}: {json.dumps(value)}"
+    yield "}"
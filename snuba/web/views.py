@@ -10,6 +10,7 @@ from typing import (
     Any,
     Callable,
     Dict,
+    Iterator,
     Mapping,
     MutableMapping,
     MutableSequence,
@@ -36,7 +37,6 @@ from werkzeug.exceptions import InternalServerError
 
 from snuba import environment, settings, state, util
 from snuba.clickhouse.errors import ClickhouseError
-from snuba.clickhouse.http import JSONRowEncoder
 from snuba.clusters.cluster import ClickhouseClientSettings, ConnectionId
 from snuba.consumers.types import KafkaMessageMetadata
 from snuba.datasets.dataset import Dataset
@@ -50,6 +50,7 @@ from snuba.datasets.factory import (
 )
 from snuba.datasets.schemas.tables import TableSchema
 from snuba.query.exceptions import InvalidQueryException
+from snuba.reader import dump_result
 from snuba.redis import redis_client
 from snuba.request.exceptions import InvalidJsonRequestException, JsonDecodeException
 from snuba.request.request_settings import HTTPRequestSettings
@@ -64,9 +65,10 @@ from snuba.subscriptions.subscription import SubscriptionCreator, SubscriptionDe
 from snuba.util import with_span
 from snuba.utils.metrics.timer import Timer
 from snuba.utils.metrics.wrapper import MetricsWrapper
-from snuba.web import QueryException, QueryTooLongException
+from snuba.web import QueryException, QueryResult, QueryTooLongException
 from snuba.web.converters import DatasetConverter, EntityConverter
 from snuba.web.query import parse_and_run_query
+from snuba.web.streaming import stream_result
 from snuba.writer import BatchWriterEncoderWrapper, WriterTableRow
 
 metrics = MetricsWrapper(environment.metrics, "api")
@@ -444,6 +446,32 @@ CLICKHOUSE_TYPING_ERROR_CODES = {
 }
 
 
+def _start_streaming(
+    result: QueryResult, timer: Timer, include_stats: bool
+) -> Iterator[str]:
+    """
+    Starts the streamed response of a query. The rows are read from
+    ClickHouse while they are sent, the first ones are read here so that
+    a query that fails right away gets an error response like any other.
+    An error on the following rows cannot change the status anymore, the
+    response is aborted before the end of the document instead, so the
+    client sees a failed transfer rather than a truncated result.
+    """
+
+    def get_trailer() -> Mapping[str, Any]:
+        trailer: MutableMapping[str, Any] = {"timing": timer.for_json()}
+        if include_stats:
+            trailer.update(result.extra)
+        return trailer
+
+    try:
+        return stream_result(
+            result.result, get_trailer, settings.STREAMING_RESPONSE_CHUNK_ROWS
+        )
+    except Exception as cause:
+        raise QueryException(result.extra) from cause
+
+
 @with_span()
 def dataset_query(
     dataset: Dataset, body: MutableMapping[str, Any], timer: Timer
@@ -470,8 +498,13 @@ def dataset_query(
         body, parse_snql_query, HTTPRequestSettings, schema, dataset, timer, referrer
     )
 
+    include_stats = settings.STATS_IN_RESPONSE or request.settings.get_debug()
+
+    stream: Optional[Iterator[str]] = None
     try:
         result = parse_and_run_query(dataset, request, timer)
+        if request.settings.get_stream_response():
+            stream = _start_streaming(result, timer, include_stats)
     except QueryException as exception:
         status = 500
         details: Mapping[str, Any]
@@ -518,12 +551,19 @@ def dataset_query(
             {"Content-Type": "application/json"},
         )
 
+    if stream is not None:
+        return Response(stream, 200, {"Content-Type": "application/json"})
+
     payload: MutableMapping[str, Any] = {**result.result, "timing": timer.for_json()}
 
-    if settings.STATS_IN_RESPONSE or request.settings.get_debug():
+    if include_stats:
         payload.update(result.extra)
 
-    return Response(json.dumps(payload), 200, {"Content-Type": "application/json"})
+    return Response(
+        dump_result(payload, json.dumps),
+        200,
+        {"Content-Type": "application/json"},
+    )
 
 
 @application.errorhandler(InvalidSubscriptionError)
@@ -608,9 +648,11 @@ if application.debug or application.testing:
                 assert isinstance(processed_message, InsertBatch)
                 rows.extend(processed_message.rows)
 
+        from snuba.consumers.consumer import get_insert_row_encoder
+
         BatchWriterEncoderWrapper(
             table_writer.get_batch_writer(metrics),
-            JSONRowEncoder(),
+            get_insert_row_encoder(writable_storage.get_storage_key()),
         ).write(rows)
 
         return ("ok", 200, {"Content-Type": "text/plain"})
@@ -648,13 +690,21 @@ if application.debug or application.testing:
                 KafkaConsumerStrategyFactory,
             )
 
-            from snuba.consumers.consumer import build_batch_writer, process_message
+            from snuba.consumers.consumer import (
+                build_batch_writer,
+                get_insert_row_encoder,
+                process_message,
+            )
 
             table_writer = storage.get_table_writer()
             stream_loader = table_writer.get_stream_loader()
             strategy = KafkaConsumerStrategyFactory(
                 stream_loader.get_pre_filter(),
-                functools.partial(process_message, stream_loader.get_processor()),
+                functools.partial(
+                    process_message,
+                    stream_loader.get_processor(),
+                    row_encoder=get_insert_row_encoder(storage.get_storage_key()),
+                ),
                 build_batch_writer(table_writer, metrics=metrics),
                 max_batch_size=1,
                 max_batch_time=1.0,
@@ -0,0 +1,75 @@
+"""
+Compares the row and the columnar read paths of the NativeDriverReader on
+a 100k rows result shaped like a discover query.
+
+It reports the time spent turning the native driver response into a
+result, and the time including the serialization of the result, which is
+when the columnar path builds the rows.
+
+Run it with:
+
+    SNUBA_SETTINGS=test python -m tests.benchmarks.bench_native_reader
+"""
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Sequence
+from unittest.mock import Mock
+from uuid import uuid4
+
+import rapidjson
+
+from snuba.clickhouse.formatter.nodes import FormattedQuery
+from snuba.clickhouse.native import ClickhouseResult, NativeDriverReader
+from snuba.reader import dump_result
+
+ROWS = 100000
+
+META = [
+    ("event_id", "UUID"),
+    ("timestamp", "DateTime"),
+    ("day", "Date"),
+    ("project_id", "UInt64"),
+    ("title", "String"),
+    ("duration", "Nullable(Float64)"),
+]
+
+
+def _build_rows() -> Sequence[Sequence[Any]]:
+    start = datetime(2022, 1, 1)
+    return [
+        (
+            uuid4(),
+            start + timedelta(seconds=index),
+            date(2022, 1, 1) + timedelta(days=index % 30),
+            index % 100,
+            f"transaction {index % 1000}",
+            None if index % 10 == 0 else index / 3,
+        )
+        for index in range(ROWS)
+    ]
+
+
+def _run(name: str, columnar: bool, results: Sequence[Any]) -> None:
+    client = Mock()
+    client.execute.return_value = ClickhouseResult(results=results, meta=META)
+    reader = NativeDriverReader(None, client, columnar=columnar)
+
+    start = time.perf_counter()
+    result = reader.execute(FormattedQuery([]))
+    read = time.perf_counter() - start
+    dump_result(result, rapidjson.dumps)
+    total = time.perf_counter() - start
+    print(f"  {name:<10} {read * 1000:>10.1f} ms read {total * 1000:>10.1f} ms total")
+
+
+def main() -> None:
+    rows = _build_rows()
+    columns = [list(column) for column in zip(*rows)]
+
+    print(f"{ROWS} rows, {len(META)} columns")
+    _run("rows", False, rows)
+    _run("columnar", True, columns)
+
+
+if __name__ == "__main__":
+    main()
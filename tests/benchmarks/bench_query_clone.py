@@ -0,0 +1,120 @@
+"""
+Compares the cost of copying a large Clickhouse query with a deepcopy and
+with Query.clone, which is what the split strategies and the pipeline
+delegator do before modifying a query.
+
+The query mimics a discover query on the events table with a few hundred
+selected expressions and conditions.
+
+Run it with:
+
+    SNUBA_SETTINGS=test python -m tests.benchmarks.bench_query_clone
+"""
+import copy
+import time
+from datetime import datetime
+from typing import Callable
+
+from snuba.clickhouse.query import Query
+from snuba.datasets.schemas.tables import TableSchema
+from snuba.datasets.storages import StorageKey
+from snuba.datasets.storages.factory import get_storage
+from snuba.query import OrderBy, OrderByDirection, SelectedExpression
+from snuba.query.conditions import (
+    ConditionFunctions,
+    binary_condition,
+    combine_and_conditions,
+)
+from snuba.query.data_source.simple import Table
+from snuba.query.expressions import Column, FunctionCall, Literal
+
+SIZES = [10, 100, 500]
+ITERATIONS = 200
+
+
+def _build_query(size: int) -> Query:
+    schema = get_storage(StorageKey.ERRORS).get_schema()
+    assert isinstance(schema, TableSchema)
+    selected = [
+        SelectedExpression(
+            f"_snuba_f{i}",
+            FunctionCall(
+                f"_snuba_f{i}",
+                "ifNull",
+                (
+                    FunctionCall(
+                        None,
+                        "arrayElement",
+                        (
+                            Column(None, None, "tags.value"),
+                            FunctionCall(
+                                None,
+                                "indexOf",
+                                (
+                                    Column(None, None, "tags.key"),
+                                    Literal(None, f"t{i}"),
+                                ),
+                            ),
+                        ),
+                    ),
+                    Literal(None, ""),
+                ),
+            ),
+        )
+        for i in range(size)
+    ]
+    conditions = [
+        binary_condition(
+            ConditionFunctions.GTE,
+            Column(None, None, "timestamp"),
+            Literal(None, datetime(2022, 1, 1)),
+        ),
+        binary_condition(
+            ConditionFunctions.LT,
+            Column(None, None, "timestamp"),
+            Literal(None, datetime(2022, 3, 1)),
+        ),
+    ] + [
+        binary_condition(
+            ConditionFunctions.NEQ,
+            Column(None, None, f"_snuba_f{i}"),
+            Literal(None, "value"),
+        )
+        for i in range(size // 10)
+    ]
+    return Query(
+        Table(
+            schema.get_table_name(),
+            schema.get_columns(),
+            mandatory_conditions=schema.get_data_source().get_mandatory_conditions(),
+        ),
+        selected_columns=selected,
+        condition=combine_and_conditions(conditions),
+        order_by=[
+            OrderBy(OrderByDirection.DESC, Column(None, None, "timestamp")),
+        ],
+        limit=100,
+    )
+
+
+def _measure(copy_func: Callable[[Query], Query], query: Query) -> float:
+    begin = time.perf_counter()
+    for _ in range(ITERATIONS):
+        copy_func(query)
+    return (time.perf_counter() - begin) / ITERATIONS
+
+
+def main() -> None:
+    for size in SIZES:
+        query = _build_query(size)
+        deepcopy_time = _measure(copy.deepcopy, query)
+        clone_time = _measure(lambda q: q.clone(), query)
+        print(
+            f"{size:>4} expressions  deepcopy {deepcopy_time * 1000:>8.3f} ms"
+            f"  clone {clone_time * 1000:>8.3f} ms"
+            f"  ({deepcopy_time / clone_time:.0f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
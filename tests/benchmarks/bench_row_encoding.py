@@ -0,0 +1,132 @@
+"""
+Compares the JSONEachRow and the RowBinary row encoders on the output of
+the errors and transactions processors.
+
+It reports the size of the encoded rows, which is what is sent on the
+wire to Clickhouse, and the encoding throughput.
+
+It also compares the VALUES encoding of the rows produced by the metrics
+aggregate processors through the generic expression formatter with the
+batched ValuesRowEncoder.
+
+Run it with:
+
+    SNUBA_SETTINGS=test python -m tests.benchmarks.bench_row_encoding
+"""
+import time
+from datetime import datetime
+from typing import Callable, Sequence
+
+from snuba import settings
+from snuba.clickhouse.formatter.expression import ClickhouseExpressionFormatter
+from snuba.clickhouse.http import JSONRowEncoder, RowBinaryRowEncoder, ValuesRowEncoder
+from snuba.consumers.types import KafkaMessageMetadata
+from snuba.datasets.metrics_aggregate_processor import DistributionsAggregateProcessor
+from snuba.datasets.storages import StorageKey
+from snuba.datasets.storages.factory import get_writable_storage
+from snuba.processor import AggregateInsertBatch, InsertBatch
+from snuba.utils.codecs import Encoder
+from snuba.writer import WriterTableRow
+from tests.fixtures import get_raw_error_message, get_raw_transaction_message
+
+ROWS = 20000
+
+
+def _build_rows(storage_key: StorageKey, message: object) -> Sequence[WriterTableRow]:
+    processor = (
+        get_writable_storage(storage_key)
+        .get_table_writer()
+        .get_stream_loader()
+        .get_processor()
+    )
+    batch = processor.process_message(
+        message, KafkaMessageMetadata(1000, 1, datetime.now())
+    )
+    assert isinstance(batch, InsertBatch)
+    return [batch.rows[0]] * ROWS
+
+
+def _run(
+    name: str, encoder: Encoder[bytes, WriterTableRow], rows: Sequence[WriterTableRow]
+) -> None:
+    start = time.perf_counter()
+    size = sum(len(encoder.encode(row)) for row in rows)
+    duration = time.perf_counter() - start
+    print(
+        f"  {name:<10} {size / len(rows):>10.1f} bytes/row "
+        f"{len(rows) / duration:>12.0f} rows/sec"
+    )
+
+
+def _build_aggregate_rows() -> Sequence[WriterTableRow]:
+    settings.WRITE_METRICS_AGG_DIRECTLY = True
+    batch = DistributionsAggregateProcessor().process_message(
+        {
+            "org_id": 1,
+            "project_id": 2,
+            "metric_id": 1232341,
+            "type": "d",
+            "timestamp": time.time(),
+            "tags": {"10": 11, "20": 22, "30": 33},
+            "value": [324.12, 345.23, 4564.56, 567567],
+            "retention_days": 30,
+        },
+        KafkaMessageMetadata(1000, 1, datetime.now()),
+    )
+    assert isinstance(batch, AggregateInsertBatch)
+    return list(batch.rows) * (ROWS // len(batch.rows))
+
+
+def _run_batch(
+    name: str,
+    encode_batch: Callable[[Sequence[WriterTableRow]], bytes],
+    rows: Sequence[WriterTableRow],
+) -> None:
+    start = time.perf_counter()
+    size = len(encode_batch(rows))
+    duration = time.perf_counter() - start
+    print(
+        f"  {name:<10} {size / len(rows):>10.1f} bytes/row "
+        f"{len(rows) / duration:>12.0f} rows/sec"
+    )
+
+
+def main() -> None:
+    for storage_key, message in (
+        (StorageKey.ERRORS, get_raw_error_message()),
+        (StorageKey.TRANSACTIONS, get_raw_transaction_message()),
+    ):
+        rows = _build_rows(storage_key, message)
+        table_writer = get_writable_storage(storage_key).get_table_writer()
+
+        print(f"{storage_key.value}:")
+        _run("json", JSONRowEncoder(), rows)
+        _run(
+            "rowbinary",
+            RowBinaryRowEncoder(table_writer.get_writeable_flattened_columns()),
+            rows,
+        )
+
+    rows = _build_aggregate_rows()
+    columns = (
+        get_writable_storage(StorageKey.METRICS_DISTRIBUTIONS)
+        .get_table_writer()
+        .get_writeable_columns()
+    )
+    formatter = ClickhouseExpressionFormatter()
+
+    def encode_with_visitor(rows: Sequence[WriterTableRow]) -> bytes:
+        return b"".join(
+            "({})".format(
+                ",".join(row[column].accept(formatter) for column in columns)
+            ).encode("utf-8")
+            for row in rows
+        )
+
+    print("metrics_distributions:")
+    _run_batch("visitor", encode_with_visitor, rows)
+    _run_batch("values", ValuesRowEncoder(columns).encode_batch, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import asyncio
+from math import isfinite
+from typing import Any, Iterator, List, MutableSequence, Optional, Sequence, Tuple
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import rapidjson
+
+from snuba.clickhouse.async_http import AsyncClickhousePool, AsyncHTTPReader
+from snuba.clickhouse.errors import ClickhouseError
+from snuba.clickhouse.formatter.nodes import FormattedQuery, StringNode
+from snuba.clickhouse.native import ClickhouseResult, NativeDriverReader
+from snuba.utils.event_loop import EventLoopThread
+
+Response = Tuple[int, Sequence[Tuple[str, str]], bytes]
+
+
+class FakeClickhouse:
+    """
+    Answers the requests sent to the HTTP interface with the responses
+    queued in `responses`, and records the requests it received.
+    """
+
+    def __init__(self) -> None:
+        self.responses: MutableSequence[Response] = []
+        self.requests: List[Tuple[str, bytes]] = []
+        self.connections = 0
+        # Closes the connections after each response, without telling
+        # the client.
+        self.drop_connections = False
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b"\r\n":
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            body = await reader.readexactly(length)
+            self.requests.append((request_line.decode("latin-1").split(" ")[1], body))
+
+            status, headers, content = self.responses.pop(0)
+            head = f"HTTP/1.1 {status} Whatever\r\n" + "".join(
+                f"{name}: {value}\r\n" for name, value in headers
+            )
+            # Sent in two chunks, like a streamed response would be.
+            middle = len(content) // 2
+            writer.write(head.encode("latin-1") + b"Transfer-Encoding: chunked\r\n\r\n")
+            for chunk in (content[:middle], content[middle:], b""):
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+            if self.drop_connections:
+                break
+        writer.close()
+
+
+@pytest.fixture
+def loop() -> Iterator[EventLoopThread]:
+    loop = EventLoopThread()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def server(loop: EventLoopThread) -> Iterator[Tuple[FakeClickhouse, int]]:
+    clickhouse = FakeClickhouse()
+    server = loop.submit(
+        asyncio.start_server(clickhouse.handle, "127.0.0.1", 0)  # type: ignore
+    ).result()
+    assert server.sockets is not None
+    yield clickhouse, server.sockets[0].getsockname()[1]
+    server.close()
+
+
+def build_response(
+    meta: Sequence[Tuple[str, str]],
+    data: Sequence[Sequence[object]],
+    totals: Optional[Sequence[object]] = None,
+) -> Response:
+    payload = {
+        "meta": [{"name": name, "type": type} for name, type in meta],
+        "data": data,
+        "rows": len(data),
+        "statistics": {"elapsed": 0.01, "rows_read": 100, "bytes_read": 800},
+    }
+    if totals is not None:
+        payload["totals"] = totals
+    return 200, [], rapidjson.dumps(payload).encode("utf-8")
+
+
+def build_pool(port: int) -> AsyncClickhousePool:
+    return AsyncClickhousePool(
+        "127.0.0.1",
+        port,
+        "default",
+        "",
+        "snuba",
+        2,
+        client_settings={"readonly": 1},
+    )
+
+
+def test_execute(loop: EventLoopThread, server: Tuple[FakeClickhouse, int]) -> None:
+    clickhouse, port = server
+    meta = [("count", "UInt64"), ("time", "DateTime"), ("day", "Nullable(Date)")]
+    clickhouse.responses = [
+        build_response(meta, [[3, "2021-01-01 10:00:00", "2021-01-01"]]),
+        build_response(
+            meta,
+            [[1, "2021-01-01 10:00:00", None], [2, "2021-01-02 11:00:00", None]],
+            totals=[3, "1970-01-01 00:00:00", None],
+        ),
+    ]
+    reader = AsyncHTTPReader(None, build_pool(port))
+
+    result = loop.submit(
+        reader.execute(
+            FormattedQuery([StringNode("SELECT 1")]),
+            {"query_id": "abc", "max_threads": "1"},
+        )
+    ).result()
+    assert result["data"] == [
+        {
+            "count": 3,
+            "time": "2021-01-01T10:00:00+00:00",
+            "day": "2021-01-01T00:00:00+00:00",
+        }
+    ]
+    assert result["meta"] == [{"name": name, "type": type} for name, type in meta]
+    assert result["profile"] == {
+        "bytes": 800,
+        "blocks": 0,
+        "rows": 100,
+        "elapsed": 0.01,
+    }
+
+    result = loop.submit(
+        reader.execute(
+            FormattedQuery([StringNode("SELECT 2")]),
+            with_totals=True,
+        )
+    ).result()
+    assert [row["count"] for row in result["data"]] == [1, 2]
+    assert result["totals"] == {
+        "count": 3,
+        "time": "1970-01-01T00:00:00+00:00",
+        "day": None,
+    }
+
+    # The connection is kept alive between the queries.
+    assert clickhouse.connections == 1
+    (path, body), _ = clickhouse.requests
+    params = parse_qs(urlparse(path).query)
+    assert body == b"SELECT 1"
+    assert params["query_id"] == ["abc"]
+    assert params["database"] == ["snuba"]
+    assert params["max_threads"] == ["1"]
+    assert params["readonly"] == ["1"]
+    assert params["default_format"] == ["JSONCompact"]
+    assert "query_id" not in parse_qs(urlparse(clickhouse.requests[1][0]).query)
+
+    loop.submit(reader.close()).result()
+
+
+def test_execute_denormals(
+    loop: EventLoopThread, server: Tuple[FakeClickhouse, int]
+) -> None:
+    clickhouse, port = server
+    meta = [
+        ("value", "Float64"),
+        ("nullable", "Nullable(Float32)"),
+        ("values", "Array(Float64)"),
+    ]
+    data: Sequence[Sequence[Any]] = [
+        (1.5, None, [1.0, float("nan")]),
+        (float("nan"), float("inf"), []),
+        (float("-inf"), 0.0, [float("inf"), float("-inf")]),
+    ]
+
+    def quote(value: Any) -> Any:
+        # As the server does when asked to, instead of returning null.
+        if isinstance(value, list):
+            return [quote(item) for item in value]
+        if isinstance(value, float) and not isfinite(value):
+            return repr(value)
+        return value
+
+    clickhouse.responses = [
+        build_response(meta, [[quote(value) for value in row] for row in data])
+    ]
+    result = loop.submit(
+        AsyncHTTPReader(None, build_pool(port)).execute(
+            FormattedQuery([StringNode("SELECT 1")])
+        )
+    ).result()
+    (path, _), = clickhouse.requests
+    params = parse_qs(urlparse(path).query)
+    assert params["output_format_json_quote_denormals"] == ["1"]
+
+    client = mock.Mock()
+    client.execute.return_value = ClickhouseResult(results=data, meta=meta)
+    expected = NativeDriverReader(None, client, columnar=False).execute(
+        FormattedQuery([StringNode("SELECT 1")])
+    )
+    # NaN is not equal to itself, the representations are compared.
+    assert repr(result["data"]) == repr(expected["data"])
+    assert result["meta"] == expected["meta"]
+
+
+def test_execute_error(
+    loop: EventLoopThread, server: Tuple[FakeClickhouse, int]
+) -> None:
+    clickhouse, port = server
+    clickhouse.responses = [
+        (
+            500,
+            [("X-ClickHouse-Exception-Code", "60")],
+            b"Code: 60. DB::Exception: Table snuba.missing doesn't exist.\n",
+        ),
+    ]
+    pool = build_pool(port)
+
+    with pytest.raises(ClickhouseError) as error:
+        loop.submit(pool.execute("SELECT * FROM missing")).result()
+    assert error.value.code == 60
+    assert error.value.message == (
+        "Code: 60. DB::Exception: Table snuba.missing doesn't exist."
+    )
+
+
+def test_execute_reconnects(
+    loop: EventLoopThread, server: Tuple[FakeClickhouse, int]
+) -> None:
+    clickhouse, port = server
+    clickhouse.drop_connections = True
+    clickhouse.responses = [
+        build_response([("a", "UInt8")], [[1]]),
+        build_response([("a", "UInt8")], [[2]]),
+    ]
+    pool = build_pool(port)
+
+    assert loop.submit(pool.execute("SELECT 1")).result().results == [[1]]
+    # The idle connection was closed by the server, the query is retried
+    # on a new one.
+    assert loop.submit(pool.execute("SELECT 2")).result().results == [[2]]
+    assert clickhouse.connections == 2
+
+
+def test_execute_unreachable(loop: EventLoopThread) -> None:
+    pool = build_pool(1)
+    with pytest.raises(ClickhouseError) as error:
+        loop.submit(pool.execute("SELECT 1")).result()
+    assert error.value.code == 210
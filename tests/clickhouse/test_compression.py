@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Mapping
+from unittest.mock import Mock
+
+import lz4.frame
+import pytest
+import zstandard
+
+from snuba.clickhouse.compression import (
+    CompressionStats,
+    compress_stream,
+    get_compressor,
+)
+from snuba.clickhouse.http import HTTPWriteBatch, InsertStatement
+
+CHUNKS = [b'{"a": 1}' * 100, b"", b'{"b": "c"}' * 1000]
+
+DECOMPRESSORS: Mapping[str, Callable[[bytes], bytes]] = {
+    "lz4": lz4.frame.decompress,
+    "zstd": lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+}
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd"])
+def test_compress_stream(compression: str) -> None:
+    stats = CompressionStats()
+    compressed = b"".join(compress_stream(CHUNKS, get_compressor(compression), stats))
+
+    assert DECOMPRESSORS[compression](compressed) == b"".join(CHUNKS)
+    assert stats.uncompressed_bytes == sum(len(chunk) for chunk in CHUNKS)
+    assert stats.compressed_bytes == len(compressed)
+    assert stats.get_ratio() > 1
+
+
+def test_unknown_compression() -> None:
+    with pytest.raises(ValueError):
+        get_compressor("brotli")
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd"])
+def test_compressed_write_batch(compression: str) -> None:
+    requests = []
+
+    def urlopen(
+        method: str, url: str, headers: Mapping[str, str], body: Iterable[bytes]
+    ) -> Any:
+        requests.append((headers, b"".join(body)))
+        return Mock(status=200)
+
+    batch = HTTPWriteBatch(
+        ThreadPoolExecutor(),
+        Mock(urlopen=urlopen),
+        "default",
+        "",
+        InsertStatement("table").with_database("default").with_format("JSONEachRow"),
+        None,
+        0,
+        {},
+        chunk_size=2,
+        compression=compression,
+    )
+    for chunk in CHUNKS:
+        batch.append(chunk)
+    batch.close()
+    batch.join()
+
+    [(headers, body)] = requests
+    assert headers["Content-Encoding"] == compression
+    assert DECOMPRESSORS[compression](body) == b"".join(CHUNKS)
+
+    stats = batch.get_compression_stats()
+    assert stats is not None
+    assert stats.compressed_bytes == len(body)
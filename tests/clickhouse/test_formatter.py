@@ -300,3 +300,34 @@ test_escaped = [
 def test_escaping(expression: Expression, expected: str) -> None:
     visitor = ClickhouseExpressionFormatter()
     assert expression.accept(visitor) == expected
+
+
+def test_repeated_subtrees() -> None:
+    tag = FunctionCall(
+        "_snuba_tags[foo]",
+        "arrayElement",
+        (
+            Column(None, None, "tags.value"),
+            FunctionCall(
+                None, "indexOf", (Column(None, None, "tags.key"), Literal(None, "foo"))
+            ),
+        ),
+    )
+    condition = binary_condition(ConditionFunctions.EQ, tag, Literal(None, "bar"))
+
+    formatter = ClickhouseExpressionFormatter()
+    assert (
+        tag.accept(formatter)
+        == "(arrayElement(tags.value, indexOf(tags.key, 'foo')) AS `_snuba_tags[foo]`)"
+    )
+    # The aliased subtree is not formatted again once its alias is defined
+    # and the fragments that do not define aliases are reused.
+    assert condition.accept(formatter) == "equals(`_snuba_tags[foo]`, 'bar')"
+    assert condition.accept(formatter) == "equals(`_snuba_tags[foo]`, 'bar')"
+
+    anonymized = ExpressionFormatterAnonymized()
+    assert (
+        condition.accept(anonymized)
+        == "equals((arrayElement(tags.value, indexOf(tags.key, '$S')) AS `_snuba_tags[$A]`), '$S')"
+    )
+    assert tag.accept(anonymized) == "`_snuba_tags[foo]`"
@@ -1,7 +1,15 @@
+from array import array
+from datetime import date, datetime
+from itertools import accumulate
+from typing import Sequence, Tuple
+
 import pytest
 
-from snuba.clickhouse.http import ValuesRowEncoder
-from snuba.query.expressions import FunctionCall, Literal
+from snuba.clickhouse.formatter.expression import ClickhouseExpressionFormatter
+from snuba.clickhouse.http import JSONRowEncoder, RowEncoder, ValuesRowEncoder
+from snuba.query.conditions import binary_condition
+from snuba.query.expressions import Column, Expression, FunctionCall, Literal
+from snuba.writer import WriterTableRow
 
 
 @pytest.fixture
@@ -29,3 +37,108 @@ def test_encode_preserves_column_order(values_encoder: ValuesRowEncoder) -> None
 def test_encode_fails_on_non_expression(values_encoder: ValuesRowEncoder) -> None:
     with (pytest.raises(TypeError)):
         values_encoder.encode({"col1": "string not wrapped by a literal object"})
+
+
+test_values = [
+    pytest.param(Literal(None, None), id="null"),
+    pytest.param(Literal(None, True), id="boolean"),
+    pytest.param(Literal(None, 10), id="int"),
+    pytest.param(Literal(None, 1.5), id="float"),
+    pytest.param(Literal(None, "it's"), id="escaped string"),
+    pytest.param(Literal(None, datetime(2022, 1, 1, 10, 0, 1, 20)), id="datetime"),
+    pytest.param(Literal(None, date(2022, 1, 1)), id="date"),
+    pytest.param(
+        FunctionCall(None, "array", (Literal(None, 1.0), Literal(None, 2.0))),
+        id="array",
+    ),
+    pytest.param(FunctionCall(None, "array", ()), id="empty array"),
+    pytest.param(
+        FunctionCall(
+            None,
+            "arrayReduce",
+            (
+                Literal(None, "sumState"),
+                FunctionCall(None, "array", (Literal(None, 1.0),)),
+            ),
+        ),
+        id="arrayReduce",
+    ),
+    pytest.param(
+        FunctionCall(None, "toDateTime", (Literal(None, "2022-01-01T10:00:00"),)),
+        id="toDateTime",
+    ),
+    pytest.param(
+        FunctionCall(None, "tuple", (Literal(None, 1), Literal(None, "a"))),
+        id="tuple",
+    ),
+    pytest.param(FunctionCall(None, "tuple", (Literal(None, 1),)), id="single tuple"),
+    pytest.param(
+        binary_condition(
+            "and",
+            binary_condition("equals", Column(None, None, "a"), Literal(None, 1)),
+            binary_condition("equals", Column(None, None, "b"), Literal(None, 2)),
+        ),
+        id="and",
+    ),
+    pytest.param(
+        FunctionCall(None, "weird-name", (Literal("alias", 1),)), id="escaped name"
+    ),
+]
+
+
+@pytest.mark.parametrize("value", test_values)
+def test_encode_value_matches_formatter(value: Expression) -> None:
+    encoder = ValuesRowEncoder(["col1"])
+    assert encoder.encode_value(value) == value.accept(ClickhouseExpressionFormatter())
+
+
+def test_encode_batch(values_encoder: ValuesRowEncoder) -> None:
+    rows = [
+        {
+            "col1": Literal(None, i),
+            "col2": FunctionCall(None, "array", (Literal(None, "a"),)),
+            "col3": Literal(None, None),
+        }
+        for i in range(3)
+    ]
+    assert values_encoder.encode_batch(rows) == b"".join(
+        values_encoder.encode(row) for row in rows
+    )
+
+    json_encoder = JSONRowEncoder()
+    json_rows: Sequence[WriterTableRow] = [
+        {"a": 1, "b": datetime(2022, 1, 1)},
+        {"c": ["d"]},
+    ]
+    assert json_encoder.encode_batch(json_rows) == b"".join(
+        json_encoder.encode(row) for row in json_rows
+    )
+
+
+def test_encode_batch_offsets(values_encoder: ValuesRowEncoder) -> None:
+    rows = [
+        {
+            "col1": Literal(None, "\u00e9"),
+            "col2": Literal(None, 1),
+            "col3": Literal(None, None),
+        },
+        {
+            "col1": Literal(None, "a"),
+            "col2": Literal(None, 2),
+            "col3": Literal(None, None),
+        },
+    ]
+    json_rows: Sequence[WriterTableRow] = [{"a": "\u00e9"}, {"b": 1}]
+    cases: Sequence[Tuple[RowEncoder, Sequence[WriterTableRow]]] = [
+        (values_encoder, rows),
+        (values_encoder, rows[1:]),
+        (JSONRowEncoder(), json_rows),
+    ]
+
+    for encoder, encoder_rows in cases:
+        offsets = array("I")
+        encoded = encoder.encode_batch(encoder_rows, offsets)
+        assert list(offsets) == list(
+            accumulate(len(encoder.encode(row)) for row in encoder_rows)
+        )
+        assert encoded == b"".join(encoder.encode(row) for row in encoder_rows)
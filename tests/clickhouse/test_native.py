@@ -1,7 +1,8 @@
 import queue
-from datetime import datetime, timedelta
-from typing import Any, Callable
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, List, Optional, Tuple
 from unittest import mock
+from uuid import UUID
 
 import pytest
 from clickhouse_driver import errors
@@ -9,7 +10,16 @@ from dateutil.tz import tz
 
 from snuba import state
 from snuba.clickhouse.errors import ClickhouseError
-from snuba.clickhouse.native import ClickhousePool, transform_datetime
+from snuba.clickhouse.formatter.nodes import FormattedQuery
+from snuba.clickhouse.native import (
+    ClickhousePool,
+    ClickhouseResult,
+    NativeDriverReader,
+    ReplicaBalancedPool,
+    transform_datetime,
+)
+from snuba.reader import ColumnarRows, StreamedRows
+from snuba.utils.clock import TestingClock
 
 
 def test_transform_datetime() -> None:
@@ -133,3 +143,208 @@ def test_fallback_logic() -> None:
 def teardown_function(_: Callable[..., Any]) -> None:
     state.delete_config("use_fallback_host_in_native_connection_pool")
     state.delete_config(f"fallback_hosts:{CLUSTER_HOST}:{CLUSTER_PORT}")
+
+
+def _build_reader_result(columnar: bool) -> ClickhouseResult:
+    meta = [
+        ("event_id", "UUID"),
+        ("timestamp", "DateTime"),
+        ("day", "Nullable(Date)"),
+        ("count", "UInt64"),
+    ]
+    rows: List[Tuple[UUID, datetime, Optional[date], int]] = [
+        (UUID(int=index), datetime(2020, 1, 1, 0, 0, index), None, index)
+        for index in range(3)
+    ]
+    rows.append((UUID(int=0), datetime(2020, 1, 1), date(2020, 1, 1), 3))
+    return ClickhouseResult(
+        results=[list(column) for column in zip(*rows)] if columnar else rows,
+        meta=meta,
+    )
+
+
+@pytest.mark.parametrize("with_totals", [True, False])
+def test_columnar_reader(with_totals: bool) -> None:
+    results = {}
+    for columnar in [True, False]:
+        client = mock.Mock()
+        client.execute.return_value = _build_reader_result(columnar)
+        reader = NativeDriverReader(None, client, columnar=columnar)
+        results[columnar] = reader.execute(FormattedQuery([]), with_totals=with_totals)
+        assert client.execute.call_args[1]["columnar"] is columnar
+
+    result = results[True]
+    assert isinstance(result["data"], ColumnarRows)
+    assert not result["data"].is_materialized()
+    assert len(result["data"]) == (3 if with_totals else 4)
+    assert result == results[False]
+    assert result["data"][0] == {
+        "event_id": "00000000-0000-0000-0000-000000000000",
+        "timestamp": "2020-01-01T00:00:00+00:00",
+        "day": None,
+        "count": 0,
+    }
+    if with_totals:
+        assert result["totals"]["day"] == "2020-01-01T00:00:00+00:00"
+
+
+def test_columnar_reader_empty_result() -> None:
+    client = mock.Mock()
+    client.execute.return_value = ClickhouseResult(
+        results=[], meta=[("count", "UInt64")]
+    )
+    result = NativeDriverReader(None, client, columnar=True).execute(FormattedQuery([]))
+    assert len(result["data"]) == 0
+    assert result["data"] == []
+
+
+def test_columnar_reader_runtime_config() -> None:
+    client = mock.Mock()
+    reader = NativeDriverReader(None, client)
+
+    client.execute.return_value = _build_reader_result(False)
+    result = reader.execute(FormattedQuery([]))
+    assert client.execute.call_args[1]["columnar"] is False
+    assert isinstance(result["data"], list)
+
+    state.set_config("native_reader_columnar", 1)
+    try:
+        client.execute.return_value = _build_reader_result(True)
+        result = reader.execute(FormattedQuery([]))
+        assert client.execute.call_args[1]["columnar"] is True
+        assert isinstance(result["data"], ColumnarRows)
+    finally:
+        state.delete_config("native_reader_columnar")
+
+
+def test_stream_reader() -> None:
+    expected = _build_reader_result(False)
+    connection = mock.Mock()
+    connection.execute_iter.return_value = iter([expected.meta, *expected.results])
+
+    pool = ClickhousePool("host", 100, "test", "test", "test")
+    pool.pool = queue.LifoQueue(1)
+    pool.pool.put(connection, block=False)
+
+    client = mock.Mock()
+    client.execute.return_value = expected
+    reader = NativeDriverReader(None, client)
+
+    result = NativeDriverReader(None, pool).execute_stream(
+        FormattedQuery([]), {"query_id": "abc"}
+    )
+    assert connection.execute_iter.call_args[1]["query_id"] == "abc"
+    # The connection is held until the rows have been read.
+    assert pool.pool.empty()
+
+    rows = result["data"]
+    assert isinstance(rows, StreamedRows)
+    assert list(rows.iter_rows()) == reader.execute(FormattedQuery([]))["data"]
+    assert result["meta"] == reader.execute(FormattedQuery([]))["meta"]
+    assert pool.pool.get(block=False) is connection
+    connection.disconnect.assert_not_called()
+
+    # A stream closed before its end leaves data on the connection.
+    pool.pool.put(connection, block=False)
+    connection.execute_iter.return_value = iter([expected.meta, *expected.results])
+    stream = pool.execute_iter("SELECT something")
+    next(stream.rows)
+    stream.rows.close()  # type: ignore
+    connection.disconnect.assert_called_once()
+    assert pool.pool.get(block=False) is connection
+
+    # Errors are raised from the stream and release the connection.
+    pool.pool.put(connection, block=False)
+    connection.execute_iter.side_effect = TestError("oops")
+    with pytest.raises(ClickhouseError):
+        pool.execute_iter("SELECT something")
+    assert pool.pool.get(block=False) is connection
+
+
+def test_replica_balanced_pool() -> None:
+    broken = ClickhousePool(
+        "host1", 100, "test", "test", "test", client_settings={"readonly": 1}
+    )
+    broken.execute = mock.Mock(side_effect=EOFError())  # type: ignore
+    healthy = ClickhousePool(
+        "host2", 100, "test", "test", "test", client_settings={"readonly": 1}
+    )
+    healthy.execute = mock.Mock(return_value=ClickhouseResult())  # type: ignore
+
+    clock = TestingClock()
+    pool = ReplicaBalancedPool(
+        [broken, healthy], clock=clock, ejection_seconds=5, readmission_seconds=30
+    )
+
+    # The queries sent to the broken replica fail over to the healthy one,
+    # then the broken replica stops receiving queries.
+    for _ in range(10):
+        assert pool.execute("SELECT 1") == ClickhouseResult()
+    assert 1 <= broken.execute.call_count <= 3
+    assert healthy.execute.call_count == 10
+
+    # Once the first replica recovers, it takes over from the second one.
+    clock.sleep(35)
+    broken.execute = mock.Mock(return_value=ClickhouseResult())  # type: ignore
+    healthy.execute = mock.Mock(  # type: ignore
+        side_effect=errors.NetworkError("host2 is down")
+    )
+    for _ in range(5):
+        assert pool.execute("SELECT 1") == ClickhouseResult()
+    assert broken.execute.call_count == 5
+
+    # The second replica is ejected by now and errors caused by the query
+    # are not retried.
+    broken.execute = mock.Mock(  # type: ignore
+        side_effect=ClickhouseError("syntax error", extra_data={"code": 62})
+    )
+    healthy.execute = mock.Mock(return_value=ClickhouseResult())  # type: ignore
+    with pytest.raises(ClickhouseError):
+        pool.execute("SELECT 1")
+    assert healthy.execute.call_count == 0
+
+
+def test_replica_balanced_pool_writes() -> None:
+    replicas = [
+        ClickhousePool(host, 100, "test", "test", "test") for host in ("host1", "host2")
+    ]
+    executes = [mock.Mock(side_effect=errors.NetworkError("down")) for _ in replicas]
+    for replica, execute in zip(replicas, executes):
+        replica.execute = execute  # type: ignore
+    pool = ReplicaBalancedPool(replicas, clock=TestingClock())
+
+    # A statement that is not read only may have been applied before the
+    # connection failed, so it is not sent to another replica.
+    with pytest.raises(errors.NetworkError):
+        pool.execute("INSERT INTO table VALUES (1)")
+    assert sum(execute.call_count for execute in executes) == 1
+
+
+def test_replica_balanced_pool_interface() -> None:
+    replicas = [
+        ClickhousePool(
+            host, 100, "test", "test", "test", client_settings={"readonly": 1}
+        )
+        for host in ("host1", "host2")
+    ]
+    for replica in replicas:
+        replica.execute = mock.Mock(return_value=ClickhouseResult())  # type: ignore
+        replica.close = mock.Mock()  # type: ignore
+    replicas[0].execute.side_effect = [  # type: ignore
+        ClickhouseError("down", code=errors.ErrorCodes.NETWORK_ERROR),
+        ClickhouseResult(),
+    ]
+    pool = ReplicaBalancedPool(replicas, clock=TestingClock())
+
+    assert pool.execute_robust("SELECT 1") == ClickhouseResult()
+
+    # The query is killed on every replica, even if one of them is down.
+    pool.kill_query("abc")
+    for replica in replicas:
+        replica.execute.assert_called_with(  # type: ignore
+            "KILL QUERY WHERE query_id = %(query_id)s ASYNC", {"query_id": "abc"}
+        )
+
+    pool.close()
+    for replica in replicas:
+        replica.close.assert_called_once()  # type: ignore
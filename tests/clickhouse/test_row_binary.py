@@ -0,0 +1,138 @@
+import pickle
+from array import array
+from datetime import datetime
+from typing import Sequence
+
+import pytest
+
+from snuba.clickhouse.columns import (
+    UUID,
+    Array,
+    ColumnSet,
+    DateTime,
+    FixedString,
+    Float,
+    IPv4,
+    IPv6,
+    Nested,
+)
+from snuba.clickhouse.columns import SchemaModifiers as Modifiers
+from snuba.clickhouse.columns import String, UInt
+from snuba.clickhouse.http import RowBinaryRowEncoder
+from snuba.writer import WriterTableRow
+
+columns = ColumnSet(
+    [
+        ("project_id", UInt(64)),
+        ("timestamp", DateTime()),
+        ("event_id", UUID()),
+        ("release", String(Modifiers(nullable=True))),
+        ("ip_address_v4", IPv4(Modifiers(nullable=True))),
+        ("ip_address_v6", IPv6(Modifiers(nullable=True))),
+        ("duration", Float(64)),
+        ("code", FixedString(2)),
+        ("tags", Nested([("key", String()), ("value", String())])),
+        ("hashes", Array(UInt(8, Modifiers(nullable=True)))),
+    ]
+)
+
+
+@pytest.fixture
+def encoder() -> RowBinaryRowEncoder:
+    return RowBinaryRowEncoder(list(columns))
+
+
+def test_encode_row(encoder: RowBinaryRowEncoder) -> None:
+    encoded = encoder.encode(
+        {
+            "hashes": [1, None],
+            "tags.value": ["bar"],
+            "tags.key": ["foo"],
+            "code": "it",
+            "duration": 1.5,
+            "ip_address_v6": None,
+            "ip_address_v4": "127.0.0.1",
+            "release": "1.0",
+            "event_id": "00000000-0000-0001-0000-000000000002",
+            "timestamp": datetime(2020, 1, 1),
+            "project_id": 1,
+        }
+    )
+
+    assert encoded == b"".join(
+        [
+            (1).to_bytes(8, "little"),
+            (1577836800).to_bytes(4, "little"),
+            (1).to_bytes(8, "little") + (2).to_bytes(8, "little"),
+            b"\x00\x031.0",
+            b"\x00" + (0x7F000001).to_bytes(4, "little"),
+            b"\x01",
+            bytes.fromhex("000000000000f83f"),
+            b"it",
+            b"\x01\x03foo",
+            b"\x01\x03bar",
+            b"\x02\x00\x01\x01",
+        ]
+    )
+
+
+def test_encode_missing_values(encoder: RowBinaryRowEncoder) -> None:
+    encoded = encoder.encode({"release": None})
+
+    assert encoded == b"".join(
+        [
+            bytes(8),
+            bytes(4),
+            bytes(16),
+            b"\x01",
+            b"\x01",
+            b"\x01",
+            bytes(8),
+            bytes(2),
+            b"\x00",
+            b"\x00",
+            b"\x00",
+        ]
+    )
+
+
+def test_encode_long_string(encoder: RowBinaryRowEncoder) -> None:
+    value = "a" * 300
+    encoded = RowBinaryRowEncoder([columns["release"]]).encode({"release": value})
+    assert encoded == b"\x00\xac\x02" + value.encode("utf-8")
+
+    with pytest.raises(ValueError):
+        RowBinaryRowEncoder([columns["code"]]).encode({"code": "too long"})
+
+
+def test_encode_batch(encoder: RowBinaryRowEncoder) -> None:
+    rows: Sequence[WriterTableRow] = [
+        {"release": "a" * 300, "project_id": 1},
+        {},
+        {"tags.key": ["a", "b"]},
+    ]
+    offsets = array("I")
+    encoded = encoder.encode_batch(rows, offsets)
+
+    assert encoded == b"".join(encoder.encode(row) for row in rows)
+    assert [encoded[start:end] for start, end in zip([0, *offsets], offsets)] == [
+        encoder.encode(row) for row in rows
+    ]
+
+
+def test_encoder_is_picklable(encoder: RowBinaryRowEncoder) -> None:
+    row = {"project_id": 2, "tags.key": ["a"], "tags.value": ["b"]}
+    assert pickle.loads(pickle.dumps(encoder)).encode(row) == encoder.encode(row)
+    assert encoder.get_column_names() == [
+        "project_id",
+        "timestamp",
+        "event_id",
+        "release",
+        "ip_address_v4",
+        "ip_address_v6",
+        "duration",
+        "code",
+        "tags.key",
+        "tags.value",
+        "hashes",
+    ]
@@ -4,7 +4,11 @@ from unittest.mock import patch
 import pytest
 
 from snuba import settings
-from snuba.clickhouse.native import ClickhousePool, ClickhouseResult
+from snuba.clickhouse.native import (
+    ClickhousePool,
+    ClickhouseResult,
+    ReplicaBalancedPool,
+)
 from snuba.clusters import cluster
 from snuba.clusters.storage_sets import StorageSetKey
 from snuba.datasets.storages import StorageKey
@@ -184,3 +188,29 @@ def test_cache_connections() -> None:
     assert cluster_1.get_query_connection(
         cluster.ClickhouseClientSettings.QUERY
     ) != cluster_3.get_query_connection(cluster.ClickhouseClientSettings.QUERY)
+
+
+def test_query_replicas() -> None:
+    replicated_cluster = cluster.ClickhouseCluster(
+        "localhost",
+        8000,
+        "default",
+        "",
+        "default",
+        8001,
+        {"events"},
+        True,
+        query_replicas=["replica_1:9000", "replica_2:9000"],
+    )
+
+    # Only the queries of the reader are spread over the replicas.
+    assert isinstance(replicated_cluster.get_reader_connection(), ReplicaBalancedPool)
+    for client_settings in (
+        cluster.ClickhouseClientSettings.QUERY,
+        cluster.ClickhouseClientSettings.MIGRATE,
+        cluster.ClickhouseClientSettings.REPLACE,
+        cluster.ClickhouseClientSettings.CLEANUP,
+        cluster.ClickhouseClientSettings.OPTIMIZE,
+    ):
+        connection = replicated_cluster.get_query_connection(client_settings)
+        assert (connection.host, connection.port) == ("localhost", 8000)
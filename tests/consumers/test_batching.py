@@ -0,0 +1,66 @@
+from snuba.consumers.batching import (
+    AdaptiveBatchSizePolicy,
+    BatchLimits,
+    BatchObservation,
+)
+from tests.backends.metrics import Gauge, Increment, TestingMetricsBackend
+
+MIN_LIMITS = BatchLimits(100, 0.5)
+MAX_LIMITS = BatchLimits(1000, 4.0)
+
+
+def observation(
+    lag: float = 0.0, latency: float = 1.0, write_time: float = 0.1
+) -> BatchObservation:
+    return BatchObservation(size=100, write_time=write_time, latency=latency, lag=lag)
+
+
+def build_policy(metrics: TestingMetricsBackend) -> AdaptiveBatchSizePolicy:
+    return AdaptiveBatchSizePolicy(MIN_LIMITS, MAX_LIMITS, 5.0, metrics)
+
+
+def test_grows_while_lagging() -> None:
+    metrics = TestingMetricsBackend()
+    policy = build_policy(metrics)
+    assert policy.get_limits() == MIN_LIMITS
+
+    policy.record(observation(lag=60.0))
+    assert policy.get_limits() == BatchLimits(200, 1.0)
+
+    for _ in range(5):
+        policy.record(observation(lag=60.0))
+    assert policy.get_limits() == MAX_LIMITS
+
+    assert (
+        Increment("decision", 1, {"decision": "grow", "reason": "lag"}) in metrics.calls
+    )
+    assert Gauge("max_batch_size", 1000, None) in metrics.calls
+
+
+def test_shrinks_on_latency_once_caught_up() -> None:
+    metrics = TestingMetricsBackend()
+    policy = build_policy(metrics)
+    for _ in range(3):
+        policy.record(observation(lag=60.0))
+    assert policy.get_limits() == BatchLimits(800, 4.0)
+
+    # Caught up and within the target latency.
+    policy.record(observation())
+    assert policy.get_limits() == BatchLimits(800, 4.0)
+
+    policy.record(observation(latency=6.0))
+    assert policy.get_limits() == BatchLimits(400, 2.0)
+
+    # Writes take longer than collecting a batch.
+    policy.record(observation(write_time=3.0))
+    assert policy.get_limits() == BatchLimits(200, 1.0)
+
+    for _ in range(5):
+        policy.record(observation(latency=6.0))
+    assert policy.get_limits() == MIN_LIMITS
+
+    assert [
+        call.tags["reason"]
+        for call in metrics.calls
+        if isinstance(call, Increment) and call.tags is not None
+    ] == ["lag"] * 3 + ["none", "latency", "write_time"] + ["latency"] * 5
@@ -0,0 +1,227 @@
+import threading
+from datetime import datetime
+from typing import Mapping, MutableSequence, Optional
+
+import pytest
+from arroyo import Message, Partition, Topic
+from arroyo.processing.strategies import ProcessingStrategy as ProcessingStep
+from arroyo.types import Position
+
+from snuba.consumers.batching import (
+    AdaptiveBatchSizePolicy,
+    BatchLimits,
+    FixedBatchSizePolicy,
+)
+from snuba.consumers.collect import PipelinedCollectStep
+from tests.backends.metrics import TestingMetricsBackend, Timing
+
+
+class BlockingStep(ProcessingStep[int]):
+    """
+    A batch step whose join does not return until it is released.
+    """
+
+    def __init__(self, fail: bool = False) -> None:
+        self.messages: MutableSequence[Message[int]] = []
+        self.released = threading.Event()
+        self.fail = fail
+
+    def poll(self) -> None:
+        pass
+
+    def submit(self, message: Message[int]) -> None:
+        self.messages.append(message)
+
+    def close(self) -> None:
+        pass
+
+    def terminate(self) -> None:
+        self.released.set()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        assert self.released.wait(5.0)
+        if self.fail:
+            raise ValueError("write failed")
+
+
+partition = Partition(Topic("events"), 0)
+now = datetime(2022, 1, 1)
+
+
+def message(offset: int) -> Message[int]:
+    return Message(partition, offset, offset, now)
+
+
+def limits(max_batch_size: int) -> FixedBatchSizePolicy:
+    return FixedBatchSizePolicy(BatchLimits(max_batch_size, 60.0))
+
+
+def test_pipelined_collect_commits_in_order() -> None:
+    steps: MutableSequence[BlockingStep] = []
+    commits: MutableSequence[Mapping[Partition, Position]] = []
+    metrics = TestingMetricsBackend()
+
+    def build_step() -> BlockingStep:
+        steps.append(BlockingStep())
+        return steps[-1]
+
+    collect = PipelinedCollectStep(
+        build_step, commits.append, limits(2), 2, metrics=metrics
+    )
+
+    for offset in range(4):
+        collect.submit(message(offset))
+        collect.poll()
+
+    # Both batches are being written and the third one has not started.
+    assert len(steps) == 2
+    assert [len(step.messages) for step in steps] == [2, 2]
+    assert commits == []
+
+    # The second batch completes first, nothing can be committed yet.
+    steps[1].released.set()
+    collect.poll()
+    assert commits == []
+
+    steps[0].released.set()
+    collect.join()
+    assert commits == [
+        {partition: Position(2, now)},
+        {partition: Position(4, now)},
+    ]
+
+
+def test_pipelined_collect_backpressure() -> None:
+    steps: MutableSequence[BlockingStep] = []
+    commits: MutableSequence[Mapping[Partition, Position]] = []
+    metrics = TestingMetricsBackend()
+
+    def build_step() -> BlockingStep:
+        steps.append(BlockingStep())
+        return steps[-1]
+
+    collect = PipelinedCollectStep(
+        build_step, commits.append, limits(1), 1, metrics=metrics
+    )
+
+    collect.submit(message(0))
+    collect.poll()
+    collect.submit(message(1))
+
+    timer = threading.Timer(0.1, steps[0].released.set)
+    timer.start()
+    # The second batch cannot be sent until the first one is done.
+    collect.poll()
+    assert commits == [{partition: Position(1, now)}]
+    assert [call.name for call in metrics.calls if isinstance(call, Timing)] == [
+        "backpressure_wait_ms"
+    ]
+
+    steps[1].released.set()
+    collect.close()
+    collect.join()
+    assert commits == [
+        {partition: Position(1, now)},
+        {partition: Position(2, now)},
+    ]
+
+
+def test_pipelined_collect_failed_batch_is_not_committed() -> None:
+    commits: MutableSequence[Mapping[Partition, Position]] = []
+    step = BlockingStep(fail=True)
+    step.released.set()
+
+    collect = PipelinedCollectStep(
+        lambda: step,
+        commits.append,
+        limits(1),
+        2,
+        metrics=TestingMetricsBackend(),
+    )
+    collect.submit(message(0))
+    collect.close()
+
+    with pytest.raises(ValueError):
+        collect.join()
+    assert commits == []
+
+
+def test_pipelined_collect_join_timeout() -> None:
+    commits: MutableSequence[Mapping[Partition, Position]] = []
+    step = BlockingStep()
+
+    collect = PipelinedCollectStep(
+        lambda: step,
+        commits.append,
+        limits(1),
+        2,
+        metrics=TestingMetricsBackend(),
+    )
+    collect.submit(message(0))
+    collect.close()
+
+    # The join returns once the timeout expires, the batch that is still
+    # being written is not committed.
+    collect.join(timeout=0.1)
+    assert commits == []
+
+    collect.terminate()
+    assert commits == []
+
+
+def test_pipelined_collect_terminate_during_join() -> None:
+    commits: MutableSequence[Mapping[Partition, Position]] = []
+    step = BlockingStep()
+
+    collect = PipelinedCollectStep(
+        lambda: step,
+        commits.append,
+        limits(1),
+        2,
+        metrics=TestingMetricsBackend(),
+    )
+    collect.submit(message(0))
+    collect.close()
+
+    timer = threading.Timer(0.1, collect.terminate)
+    timer.start()
+    # Terminating the step releases the write the join is waiting on, which
+    # then returns without committing it.
+    collect.join()
+    timer.join()
+    assert commits == []
+
+
+def test_pipelined_collect_adaptive_batch_size() -> None:
+    steps: MutableSequence[BlockingStep] = []
+    commits: MutableSequence[Mapping[Partition, Position]] = []
+
+    def build_step() -> BlockingStep:
+        steps.append(BlockingStep())
+        steps[-1].released.set()
+        return steps[-1]
+
+    # The messages are years old, so the consumer is lagging and the
+    # batches grow up to the max size.
+    policy = AdaptiveBatchSizePolicy(
+        BatchLimits(1, 60.0), BatchLimits(4, 60.0), 5.0, TestingMetricsBackend()
+    )
+    collect = PipelinedCollectStep(
+        build_step, commits.append, policy, 1, metrics=TestingMetricsBackend()
+    )
+
+    for offset in range(11):
+        collect.submit(message(offset))
+        collect.poll()
+
+    collect.close()
+    collect.join()
+
+    # A batch is reported to the policy once it is written, which can
+    # happen after the following batch has been created, so the exact
+    # sizes depend on how fast the writes complete.
+    sizes = [len(step.messages) for step in steps]
+    assert sum(sizes) == 11
+    assert sizes[0] == 1
+    assert max(sizes) == 4
+    assert policy.get_limits() == BatchLimits(4, 60.0)
@@ -2,7 +2,7 @@ import importlib
 import re
 import uuid
 from datetime import datetime, timedelta
-from typing import Any, Callable, Optional, Tuple, Union
+from typing import Any, Callable, Optional, Sequence, Tuple, Union
 
 import pytest
 import simplejson as json
@@ -495,6 +495,71 @@ class TestReplacer:
         self._clear_redis_and_force_merge()
         assert self._issue_count(self.project_id) == []
 
+    def test_delete_groups_merge(self) -> None:
+        timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+        def delete_groups(project_id: int, group_ids: Sequence[int]) -> Any:
+            return self.replacer.process_message(
+                self._wrap(
+                    (
+                        2,
+                        ReplacementType.END_DELETE_GROUPS,
+                        {
+                            "project_id": project_id,
+                            "group_ids": group_ids,
+                            "datetime": timestamp,
+                        },
+                    )
+                )
+            )
+
+        merged = delete_groups(self.project_id, [1, 2]).merge(
+            delete_groups(self.project_id, [3])
+        )
+        assert merged is not None
+        assert merged.query_args["group_ids"] == "1, 2, 3"
+        assert merged.query_time_flags == (
+            errors_replacer.EXCLUDE_GROUPS,
+            self.project_id,
+            [1, 2, 3],
+        )
+
+        # Replacements of different projects are never merged.
+        assert delete_groups(self.project_id, [1]).merge(delete_groups(2, [3])) is None
+
+    def test_delete_groups_merged_insert(self) -> None:
+        self.event["project_id"] = self.project_id
+        events = []
+        for group_id in (1, 2, 3):
+            event = {**self.event, "group_id": group_id}
+            event["event_id"] = uuid.uuid4().hex
+            events.append(event)
+        write_unprocessed_events(self.storage, events)
+
+        timestamp = datetime.utcnow().strftime(PAYLOAD_DATETIME_FORMAT)
+        replacements = [
+            self.replacer.process_message(
+                self._wrap(
+                    (
+                        2,
+                        ReplacementType.END_DELETE_GROUPS,
+                        {
+                            "project_id": self.project_id,
+                            "group_ids": group_ids,
+                            "datetime": timestamp,
+                        },
+                    )
+                )
+            )
+            for group_ids in ([1], [2])
+        ]
+        self.replacer.flush_batch(replacements)
+
+        assert self._issue_count(self.project_id) == [{"count": 1, "group_id": 3}]
+
+        self._clear_redis_and_force_merge()
+        assert self._issue_count(self.project_id) == [{"count": 1, "group_id": 3}]
+
     def test_reprocessing_flow_insert(self) -> None:
         # We have a group that contains two events, 1 and 2.
         self.event["project_id"] = self.project_id
@@ -1,10 +1,11 @@
 from copy import deepcopy
 from dataclasses import replace
 from datetime import datetime
-from typing import Union
+from typing import List, Union
 
 import pytest
 
+from snuba import state
 from snuba.clickhouse.query import Query as ClickhouseQuery
 from snuba.clickhouse.translators.snuba.mappers import build_mapping_expr
 from snuba.clusters.cluster import get_cluster
@@ -26,6 +27,7 @@ from snuba.query.conditions import (
     BooleanFunctions,
     ConditionFunctions,
     binary_condition,
+    in_condition,
 )
 from snuba.query.data_source.join import (
     IndividualNode,
@@ -41,6 +43,7 @@ from snuba.query.expressions import (
     Literal,
     SubscriptableReference,
 )
+from snuba.query.joins.semi_joins import SemiJoinOptimizer
 from snuba.query.logical import Query as LogicalQuery
 from snuba.query.processors.conditions_enforcer import MandatoryConditionEnforcer
 from snuba.query.processors.mandatory_condition_applier import MandatoryConditionApplier
@@ -548,3 +551,96 @@ def test_composite_planner(
         )
 
     CompositeExecutionPipeline(logical_query, HTTPRequestSettings(), runner).execute()
+
+
+@pytest.mark.parametrize(
+    "max_rows, right_key, inlined",
+    [(10, "id", True), (1, "id", False), (10, "last_seen", False)],
+)
+def test_inline_semi_join(max_rows: int, right_key: str, inlined: bool) -> None:
+    state.set_config("composite_inline_subquery_max_rows", max_rows)
+    query = CompositeQuery(
+        from_clause=JoinClause(
+            left_node=IndividualNode(
+                alias="err",
+                data_source=ClickhouseQuery(
+                    from_clause=events_table,
+                    selected_columns=[
+                        SelectedExpression(
+                            "_snuba_group_id",
+                            Column("_snuba_group_id", None, "group_id"),
+                        ),
+                        SelectedExpression(
+                            "f_release", Column("f_release", None, "release")
+                        ),
+                    ],
+                ),
+            ),
+            right_node=IndividualNode(
+                alias="groups",
+                data_source=ClickhouseQuery(
+                    from_clause=groups_table,
+                    selected_columns=[
+                        SelectedExpression(
+                            "_snuba_id", Column("_snuba_id", None, right_key)
+                        )
+                    ],
+                ),
+            ),
+            keys=[
+                JoinCondition(
+                    left=JoinConditionExpression("err", "_snuba_group_id"),
+                    right=JoinConditionExpression("groups", "_snuba_id"),
+                )
+            ],
+            join_type=JoinType.INNER,
+        ),
+        selected_columns=[
+            SelectedExpression("f_release", Column("f_release", "err", "f_release"))
+        ],
+    )
+
+    queries: List[Union[ClickhouseQuery, CompositeQuery[Table]]] = []
+
+    def runner(
+        query: Union[ClickhouseQuery, CompositeQuery[Table]],
+        request_settings: RequestSettings,
+        reader: Reader,
+    ) -> QueryResult:
+        queries.append(query)
+        return QueryResult(
+            {"data": [{"_snuba_id": 1}, {"_snuba_id": 2}] if len(queries) == 1 else []},
+            {"stats": {}, "sql": "", "experiments": {}},
+        )
+
+    CompositeExecutionStrategy(
+        get_cluster(StorageSetKey.EVENTS),
+        [],
+        {"err": [], "groups": []},
+        [SemiJoinOptimizer()],
+    ).execute(query, HTTPRequestSettings(), runner)
+
+    if right_key == "id":
+        assert len(queries) == 2
+        subquery, main_query = queries
+        assert isinstance(subquery, ClickhouseQuery)
+        assert subquery.get_limit() == max_rows + 1
+    else:
+        # DateTime keys are never inlined, the subquery does not run.
+        assert len(queries) == 1
+        (main_query,) = queries
+    assert isinstance(main_query, CompositeQuery)
+
+    from_clause = main_query.get_from_clause()
+    if inlined:
+        assert isinstance(from_clause, ClickhouseQuery)
+        assert from_clause.get_condition() == in_condition(
+            Column("_snuba_group_id", None, "group_id"),
+            [Literal(None, 1), Literal(None, 2)],
+        )
+        assert main_query.get_selected_columns() == [
+            SelectedExpression("f_release", Column("f_release", None, "f_release"))
+        ]
+    else:
+        assert isinstance(from_clause, JoinClause)
+        assert from_clause.right_node.alias == "groups"
@@ -0,0 +1,187 @@
+from typing import Any, Sequence
+
+import pytest
+
+from snuba.datasets.entities import EntityKey
+from snuba.datasets.entities.factory import get_entity
+from snuba.query.data_source.join import JoinRelationship, JoinType
+from snuba.query.parser.exceptions import ParsingException
+from snuba.query.snql.parse_cache import ParseTemplateCache, normalize_literals
+from snuba.query.snql.parser import parse_snql_query_initial
+from tests.backends.metrics import Increment, TestingMetricsBackend
+from tests.query.snql.test_query import test_cases as query_test_cases
+
+
+@pytest.fixture(autouse=True)
+def join_relationships(monkeypatch: pytest.MonkeyPatch) -> None:
+    mapping = {
+        "contains": (EntityKey.TRANSACTIONS, "event_id"),
+        "assigned": (EntityKey.GROUPASSIGNEE, "group_id"),
+        "bookmark": (EntityKey.GROUPEDMESSAGES, "first_release_id"),
+        "activity": (EntityKey.SESSIONS, "org_id"),
+    }
+
+    def events_mock(relationship: str) -> JoinRelationship:
+        entity_key, rhs_column = mapping[relationship]
+        return JoinRelationship(
+            rhs_entity=entity_key,
+            join_type=JoinType.INNER,
+            columns=[("event_id", rhs_column)],
+            equivalences=[],
+        )
+
+    monkeypatch.setattr(
+        get_entity(EntityKey.EVENTS), "get_join_relationship", events_mock
+    )
+
+
+def build_cache(max_size: int = 10) -> ParseTemplateCache:
+    return ParseTemplateCache(
+        parse_snql_query_initial, max_size, TestingMetricsBackend()
+    )
+
+
+def assert_same_parse(cache: ParseTemplateCache, body: str) -> None:
+    eq, reason = cache.parse(body, "events").equals(parse_snql_query_initial(body))
+    assert eq, reason
+
+
+test_bodies = [
+    pytest.param(case.values[0], id=case.id) for case in query_test_cases
+] + [
+    pytest.param(
+        "MATCH (events) SELECT quantile(0.95)(duration) AS p95, -1.5e+3 * a, c - -2 "
+        "WHERE project_id IN tuple(1, 2, -3) AND x != -4 AND y = 'a\\'b' "
+        "LIMIT 10 OFFSET 20",
+        id="numbers",
+    ),
+    pytest.param(
+        "MATCH (events) SELECT count() AS `count.1`, tags[key.1], c-1, c -1 "
+        "BY g2 WHERE g2 = 2 AND tags[3] = '3' GRANULARITY 3600",
+        id="identifiers",
+    ),
+]
+
+
+@pytest.mark.parametrize("body", test_bodies)
+def test_cached_parse_matches_full_parse(body: str) -> None:
+    cache = build_cache()
+    # The first parse populates the cache, the second one is served by it.
+    assert_same_parse(cache, body)
+    assert_same_parse(cache, body)
+
+
+shapes = [
+    pytest.param(
+        "MATCH (events) SELECT 4-5, c AS `c` WHERE project_id = %s AND "
+        "timestamp >= toDateTime(%s) AND timestamp < toDateTime('2021-01-02') "
+        "AND title IN tuple(%s, 'b')",
+        [("1", "'2021-01-01'", "'a'"), ("2", "'2020-12-01T10:00:00'", "'\\'c'")],
+        id="conditions",
+    ),
+    pytest.param(
+        "MATCH (events) SELECT quantile(%s)(duration) AS q, %s * 2 "
+        "WHERE project_id = 1 AND timestamp >= toDateTime('2021-01-01') "
+        "AND timestamp < toDateTime('2021-01-02')",
+        [("0.5", "3"), ("0.95", "-4.5")],
+        id="selected",
+    ),
+    pytest.param(
+        "MATCH { MATCH (events) SELECT count() AS count BY title "
+        "WHERE project_id = %s AND timestamp >= toDateTime('2021-01-01') "
+        "AND timestamp < toDateTime('2021-01-02') } "
+        "SELECT max(count) AS max_count WHERE max_count > %s",
+        [("1", "10"), ("2", "20")],
+        id="subquery",
+    ),
+]
+
+
+@pytest.mark.parametrize("template, literals", shapes)
+def test_same_shape_different_literals(
+    template: str, literals: Sequence[Sequence[str]]
+) -> None:
+    metrics = TestingMetricsBackend()
+    cache = ParseTemplateCache(parse_snql_query_initial, 10, metrics)
+    for values in literals:
+        assert_same_parse(cache, template % tuple(values))
+
+    assert metrics.calls == [
+        Increment("miss", 1, None),
+        Increment("hit", 1, None),
+    ]
+
+
+normalize_test_cases = [
+    pytest.param(
+        "MATCH (events) SELECT a WHERE b = -1 AND c > 2.5 LIMIT 10",
+        "MATCH (events) SELECT a WHERE b = '\x000' AND c > '\x001' LIMIT 10",
+        [-1, 2.5],
+        id="numbers",
+    ),
+    pytest.param(
+        "MATCH (events SAMPLE 0.1) SELECT a-1, f2(x) WHERE t = 'it\\'s 3'",
+        "MATCH (events SAMPLE 0.1) SELECT a-'\x000', f2(x) WHERE t = '\x001'",
+        [1, "it's 3"],
+        id="strings",
+    ),
+    pytest.param(
+        "MATCH (events) SELECT `a 1` WHERE tags[1] = 'x' GRANULARITY 60",
+        "MATCH (events) SELECT `a 1` WHERE tags[1] = '\x000' GRANULARITY 60",
+        ["x"],
+        id="identifiers",
+    ),
+]
+
+
+@pytest.mark.parametrize("body, template, values", normalize_test_cases)
+def test_normalize_literals(body: str, template: str, values: Sequence[Any]) -> None:
+    normalized = normalize_literals(body)
+    assert normalized is not None
+    assert normalized.template == template
+    assert list(normalized.values) == values
+
+
+def test_not_cacheable() -> None:
+    metrics = TestingMetricsBackend()
+    cache = ParseTemplateCache(parse_snql_query_initial, 10, metrics)
+
+    body = "MATCH (events) SELECT a WHERE b = 1 LIMIT"
+    for _ in range(2):
+        with pytest.raises(ParsingException):
+            cache.parse(body, "events")
+
+    assert normalize_literals("MATCH (events) SELECT a WHERE b = '\x00'") is None
+    assert metrics.calls == [
+        Increment("miss", 1, None),
+        Increment("not_cacheable", 1, None),
+    ]
+
+
+def test_lru_bound() -> None:
+    metrics = TestingMetricsBackend()
+    cache = ParseTemplateCache(parse_snql_query_initial, 2, metrics)
+    bodies = [
+        f"MATCH (events) SELECT {column} WHERE project_id = 1"
+        for column in ("a", "b", "c")
+    ]
+
+    cache.parse(bodies[0], "events")
+    cache.parse(bodies[1], "events")
+    cache.parse(bodies[0], "events")
+    # Evicts the least recently used template, which is the second one.
+    cache.parse(bodies[2], "events")
+    cache.parse(bodies[0], "events")
+    cache.parse(bodies[1], "events")
+    # The same template for another dataset is a different entry.
+    cache.parse(bodies[1], "discover")
+
+    assert [call.name for call in metrics.calls] == [
+        "miss",
+        "miss",
+        "hit",
+        "miss",
+        "hit",
+        "miss",
+        "miss",
+    ]
@@ -1,8 +1,11 @@
+from dataclasses import replace
+
 from snuba.clickhouse.columns import Any, ColumnSet
 from snuba.clickhouse.query import Query
 from snuba.query import LimitBy, SelectedExpression
+from snuba.query.conditions import ConditionFunctions, binary_condition
 from snuba.query.data_source.simple import Table
-from snuba.query.expressions import Column, FunctionCall
+from snuba.query.expressions import Column, FunctionCall, Literal
 
 
 def test_query_parameters() -> None:
@@ -77,3 +80,57 @@ def test_query_experiments() -> None:
 
     query.set_experiments({"optimization3": 0.5})
     assert query.get_experiments() == {"optimization3": 0.5}
+
+
+def test_query_clone() -> None:
+    query = Query(
+        Table("my_table", ColumnSet([])),
+        selected_columns=[
+            SelectedExpression(
+                "col1", Column(alias="col1", table_name=None, column_name="col1")
+            ),
+        ],
+        condition=binary_condition(
+            ConditionFunctions.EQ,
+            Column(alias=None, table_name=None, column_name="col1"),
+            Literal(None, 1),
+        ),
+        prewhere=binary_condition(
+            ConditionFunctions.EQ,
+            Column(alias=None, table_name=None, column_name="col2"),
+            Literal(None, 2),
+        ),
+        limit=100,
+    )
+    query.add_experiment("optimization1", True)
+
+    cloned = query.clone()
+    assert cloned == query
+    assert cloned.get_prewhere_ast() == query.get_prewhere_ast()
+    assert cloned.get_experiments() == query.get_experiments()
+
+    cloned.set_limit(10)
+    cloned.add_condition_to_ast(
+        binary_condition(
+            ConditionFunctions.EQ,
+            Column(alias=None, table_name=None, column_name="col3"),
+            Literal(None, 3),
+        )
+    )
+    cloned.transform_expressions(
+        lambda e: replace(e, alias="col") if isinstance(e, Column) else e
+    )
+    cloned.add_experiment("optimization2", "group1")
+
+    assert query.get_limit() == 100
+    assert query.get_condition() == binary_condition(
+        ConditionFunctions.EQ,
+        Column(alias=None, table_name=None, column_name="col1"),
+        Literal(None, 1),
+    )
+    assert query.get_selected_columns() == [
+        SelectedExpression(
+            "col1", Column(alias="col1", table_name=None, column_name="col1")
+        ),
+    ]
+    assert query.get_experiments() == {"optimization1": True}
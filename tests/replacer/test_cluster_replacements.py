@@ -10,12 +10,13 @@ from typing import (
     Sequence,
     Tuple,
 )
+from unittest.mock import patch
 
 import pytest
 
-from snuba.clickhouse.native import ClickhousePool
+from snuba.clickhouse.native import ClickhousePool, ClickhouseResult
 from snuba.clusters import cluster
-from snuba.clusters.cluster import ClickhouseNode
+from snuba.clusters.cluster import ClickhouseClientSettings, ClickhouseNode
 from snuba.clusters.storage_sets import StorageSetKey
 from snuba.datasets.errors_replacer import NEEDS_FINAL, LegacyReplacement
 from snuba.datasets.events_processor_base import ReplacementType
@@ -89,6 +90,8 @@ FROM errors_local FINAL
 WHERE event_id = '6f0ccc03-6efb-4f7c-8005-d0c992106b31'
 """
 
+LOCAL_COUNT_QUERY = "SELECT count() FROM errors_local FINAL WHERE event_id = '6f0ccc03-6efb-4f7c-8005-d0c992106b31'"
+
 DIST_QUERY = """\
 INSERT INTO errors_dist (project_id, timestamp, event_id)
 SELECT project_id, timestamp, event_id, group_id, primary_hash
@@ -101,12 +104,10 @@ TEST_CASES = [
         "override_cluster",
         "[100,1]",
         {
-            "query_node": [
-                "SELECT count() FROM errors_dist FINAL WHERE event_id = '6f0ccc03-6efb-4f7c-8005-d0c992106b31'",
-            ],
-            "storage-0-0": [LOCAL_QUERY],
-            "storage-1-0": [LOCAL_QUERY],
-            "storage-2-0": [LOCAL_QUERY],
+            "query_node": [],
+            "storage-0-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+            "storage-1-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+            "storage-2-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
         },
         id="Replacements through storage nodes",
     ),
@@ -251,16 +252,13 @@ def test_load_balancing(
     replacer.flush_batch([replacement, replacement])
 
     assert cluster.get_queries() == {
-        "query_node": [
-            "SELECT count() FROM errors_dist FINAL WHERE event_id = '6f0ccc03-6efb-4f7c-8005-d0c992106b31'",
-            "SELECT count() FROM errors_dist FINAL WHERE event_id = '6f0ccc03-6efb-4f7c-8005-d0c992106b31'",
-        ],
-        "storage-0-0": [LOCAL_QUERY],
-        "storage-0-1": [LOCAL_QUERY],
-        "storage-1-0": [LOCAL_QUERY],
-        "storage-1-1": [LOCAL_QUERY],
-        "storage-2-0": [LOCAL_QUERY],
-        "storage-2-1": [LOCAL_QUERY],
+        "query_node": [],
+        "storage-0-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+        "storage-0-1": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+        "storage-1-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+        "storage-1-1": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+        "storage-2-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+        "storage-2-1": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
     }
 
 
@@ -412,3 +410,45 @@ def test_local_executor(
     )
 
     assert queries == expected_queries
+
+
+def test_local_executor_skips_empty_shards(
+    override_cluster: Callable[[bool], FakeClickhouseCluster]
+) -> None:
+    """
+    Test the insert only runs on the shards the count found rows on.
+    """
+    set_config("write_node_replacements_projects", "[1]")
+    cluster = override_cluster(True)
+
+    # The first shard has nothing to replace.
+    empty_connection = cluster.get_node_connection(
+        ClickhouseClientSettings.REPLACE, ClickhouseNode("storage-0-0", 9000, 1, 1)
+    )
+    with patch.object(
+        empty_connection, "execute", return_value=ClickhouseResult([[0]])
+    ):
+        replacer = ReplacerWorker(
+            get_writable_storage(StorageKey.ERRORS),
+            "consumer_group",
+            DummyMetricsBackend(),
+        )
+        replacer.flush_batch(
+            [
+                LegacyReplacement(
+                    COUNT_QUERY_TEMPLATE,
+                    INSERT_QUERY_TEMPLATE,
+                    FINAL_QUERY_TEMPLATE,
+                    (NEEDS_FINAL, 1),
+                    REPLACEMENT_TYPE,
+                    REPLACEMENT_MESSAGE_METADATA,
+                )
+            ]
+        )
+
+    assert cluster.get_queries() == {
+        "query_node": [],
+        "storage-0-0": [],
+        "storage-1-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+        "storage-2-0": [LOCAL_COUNT_QUERY, LOCAL_QUERY],
+    }
@@ -91,6 +91,29 @@ def test_get_readthrough(backend: Cache[bytes]) -> None:
         backend.get_readthrough(key, function, noop, 5) == value
 
 
+@mock.patch("snuba.state.cache.redis.backend.get_config", return_value=60)
+def test_get_with_ttl(get_config: mock.Mock, backend: Cache[bytes]) -> None:
+    assert backend.get_with_ttl("key") == (None, None)
+
+    backend.set("key", b"value")
+    value, ttl = backend.get_with_ttl("key")
+    assert value == b"value"
+    assert ttl is not None and 0 < ttl <= 60
+
+
+@mock.patch("snuba.state.cache.redis.backend.get_config", return_value=60)
+def test_get_readthrough_with_ttl(get_config: mock.Mock, backend: Cache[bytes]) -> None:
+    # The value was just computed, it remains for the configured expiry.
+    assert backend.get_readthrough_with_ttl("key", lambda: b"value", noop, 5) == (
+        b"value",
+        None,
+    )
+
+    value, ttl = backend.get_readthrough_with_ttl("key", lambda: b"other", noop, 5)
+    assert value == b"value"
+    assert ttl is not None and 0 < ttl <= 60
+
+
 def test_get_readthrough_missed_deadline(backend: Cache[bytes]) -> None:
     key = "key"
     value = b"value"
@@ -0,0 +1,149 @@
+from typing import Callable, List, MutableMapping, Optional, Tuple
+from unittest import mock
+
+import pytest
+
+from snuba.state.cache.abstract import RESULT_EXECUTE, RESULT_VALUE, Cache
+from snuba.state.cache.local import LocalCache
+from snuba.utils.metrics.timer import Timer
+from tests.backends.metrics import Gauge, Increment, TestingMetricsBackend
+
+
+class MemoryCache(Cache[List[int]]):
+    def __init__(self) -> None:
+        self.values: MutableMapping[str, List[int]] = {}
+        self.ttls: MutableMapping[str, float] = {}
+        self.reads = 0
+
+    def get(self, key: str) -> Optional[List[int]]:
+        self.reads += 1
+        return self.values.get(key)
+
+    def get_with_ttl(self, key: str) -> Tuple[Optional[List[int]], Optional[float]]:
+        return self.get(key), self.ttls.get(key)
+
+    def set(self, key: str, value: List[int]) -> None:
+        self.values[key] = value
+
+    def get_readthrough(
+        self,
+        key: str,
+        function: Callable[[], List[int]],
+        record_cache_hit_type: Callable[[int], None],
+        timeout: int,
+        timer: Optional[Timer] = None,
+    ) -> List[int]:
+        value, _ = self.get_readthrough_with_ttl(
+            key, function, record_cache_hit_type, timeout, timer
+        )
+        return value
+
+    def get_readthrough_with_ttl(
+        self,
+        key: str,
+        function: Callable[[], List[int]],
+        record_cache_hit_type: Callable[[int], None],
+        timeout: int,
+        timer: Optional[Timer] = None,
+    ) -> Tuple[List[int], Optional[float]]:
+        self.reads += 1
+        if key in self.values:
+            record_cache_hit_type(RESULT_VALUE)
+            return self.values[key], self.ttls.get(key)
+        record_cache_hit_type(RESULT_EXECUTE)
+        value = self.values[key] = function()
+        return value, None
+
+
+def build_cache(
+    inner: MemoryCache, metrics: TestingMetricsBackend, max_size: int = 10
+) -> LocalCache[List[int]]:
+    return LocalCache(inner, max_size, len, list, list, metrics)
+
+
+@mock.patch("snuba.state.cache.local.get_config", return_value=60)
+def test_get_readthrough(get_config: mock.Mock) -> None:
+    inner = MemoryCache()
+    metrics = TestingMetricsBackend()
+    cache = build_cache(inner, metrics)
+    hit_types: List[int] = []
+
+    value = cache.get_readthrough("key", lambda: [1, 2], hit_types.append, 5)
+    assert value == [1, 2]
+    # Values are copied, changes made by the callers are not cached.
+    value.append(3)
+
+    assert cache.get_readthrough("key", lambda: [3], hit_types.append, 5) == [1, 2]
+    # The first call reads through the inner cache with a single lookup.
+    assert inner.reads == 1
+    assert hit_types == [RESULT_EXECUTE, RESULT_VALUE]
+    assert [call for call in metrics.calls if isinstance(call, Increment)] == [
+        Increment("miss", 1, None),
+        Increment("hit", 1, None),
+    ]
+    assert Gauge("size_bytes", 2, None) in metrics.calls
+
+    # Errors are raised by the inner cache and never stored.
+    def fail() -> List[int]:
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        cache.get_readthrough("other", fail, hit_types.append, 5)
+    assert cache.get("other") is None
+
+
+@mock.patch("snuba.state.cache.local.get_config", return_value=0)
+def test_expiry(get_config: mock.Mock) -> None:
+    inner = MemoryCache()
+    cache = build_cache(inner, TestingMetricsBackend())
+
+    cache.set("key", [1])
+    assert cache.get("key") == [1]
+    assert inner.reads == 1
+
+
+@mock.patch("snuba.state.cache.local.get_config", return_value=60)
+def test_size_bound(get_config: mock.Mock) -> None:
+    inner = MemoryCache()
+    metrics = TestingMetricsBackend()
+    cache = build_cache(inner, metrics, max_size=5)
+
+    cache.set("a", [1, 2])
+    cache.set("b", [1, 2])
+    assert cache.get("a") == [1, 2]
+    # Evicts the least recently used value.
+    cache.set("c", [1, 2])
+    # Never kept locally.
+    cache.set("d", [1, 2, 3, 4, 5, 6])
+
+    inner.reads = 0
+    for key in ["a", "c"]:
+        cache.get(key)
+    assert inner.reads == 0
+
+    cache.get("b")
+    assert inner.reads == 1
+
+    assert Increment("eviction", 1, None) in metrics.calls
+    assert Increment("too_large", 1, None) in metrics.calls
+
+
+@mock.patch("snuba.state.cache.local.get_config", return_value=60)
+def test_expiry_capped_by_inner_cache(get_config: mock.Mock) -> None:
+    inner = MemoryCache()
+    cache = build_cache(inner, TestingMetricsBackend())
+    hit_types: List[int] = []
+
+    # The value is about to expire in the inner cache, so it is not kept
+    # locally for the full expiry.
+    inner.values["key"] = [1]
+    inner.ttls["key"] = 0
+    assert cache.get("key") == [1]
+    assert cache.get_readthrough("key", lambda: [2], hit_types.append, 5) == [1]
+    assert hit_types == [RESULT_VALUE]
+    assert inner.reads == 2
+
+    inner.ttls["key"] = 60
+    assert cache.get("key") == [1]
+    assert cache.get("key") == [1]
+    assert inner.reads == 3
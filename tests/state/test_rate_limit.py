@@ -8,6 +8,7 @@ import pytest
 from snuba import state
 from snuba.redis import redis_client as rds
 from snuba.state.rate_limit import (
+    LocalRateLimiter,
     RateLimitAggregator,
     RateLimitExceeded,
     RateLimitParameters,
@@ -116,6 +117,56 @@ class TestRateLimit:
             ):
                 pass
 
+    def test_aggregator_single_pipeline(self) -> None:
+        params = [
+            RateLimitParameters("foo", str(uuid.uuid4()), 1, 5),
+            RateLimitParameters("shoe", str(uuid.uuid4()), None, 5),
+            RateLimitParameters("global", "global", None, 5),
+        ]
+
+        with patch.object(rds, "pipeline", wraps=rds.pipeline) as pipeline:
+            with RateLimitAggregator(params) as stats:
+                assert pipeline.call_count == 1
+                assert stats.get_stats("foo") == RateLimitStats(rate=0, concurrent=1)
+                assert stats.get_stats("global") is not None
+            assert pipeline.call_count == 2
+
+    def test_local_precheck(self) -> None:
+        state.set_config("rate_limit_local_precheck", 1)
+        params = RateLimitParameters("foo", str(uuid.uuid4()), None, 1)
+
+        with RateLimitAggregator([params]):
+            with patch.object(rds, "pipeline") as pipeline:
+                # Rejected without contacting redis
+                with pytest.raises(RateLimitExceeded):
+                    with RateLimitAggregator([params]):
+                        pass
+                assert pipeline.call_count == 0
+
+        with RateLimitAggregator([params]):
+            pass
+
+    def test_local_precheck_rate_limited(self) -> None:
+        state.set_config("rate_limit_local_precheck", 1)
+        params = RateLimitParameters("foo", str(uuid.uuid4()), 1, None)
+        rejecting = RateLimitParameters("shoe", str(uuid.uuid4()), None, 0)
+
+        # Queries rejected by Redis do not use up the local per second
+        # limit, which Redis does not count them against either.
+        for _ in range(state.rate_lookback_s * 2):
+            with pytest.raises(RateLimitExceeded):
+                with RateLimitAggregator([params, rejecting]):
+                    pass
+
+        # Neither do queries rejected by a nested rate limiter.
+        for _ in range(state.rate_lookback_s * 2):
+            with pytest.raises(RateLimitExceeded):
+                with RateLimitAggregator([params]):
+                    raise RateLimitExceeded("nested")
+
+        with RateLimitAggregator([params]):
+            pass
+
     def test_rate_limit_container(self) -> None:
         rate_limit_container = RateLimitStatsContainer()
         rate_limit_stats = RateLimitStats(rate=0.5, concurrent=2)
@@ -159,6 +210,49 @@ class TestRateLimit:
         assert count() == 2
 
 
+def test_local_rate_limiter() -> None:
+    limiter = LocalRateLimiter()
+    per_second = RateLimitParameters("foo", "bar", 1, None)
+    concurrent = RateLimitParameters("shoe", "star", None, 2)
+
+    # Like in Redis, the rate is exceeded once more queries than the limit
+    # allows over the lookback window have completed, so the query after
+    # them is still admitted, being exactly at the limit.
+    for _ in range(state.rate_lookback_s):
+        limiter.acquire([per_second], 0)
+        limiter.release([per_second], 0)
+    limiter.acquire([per_second], 0)
+    # Running queries do not count towards the rate.
+    limiter.acquire([per_second], 0)
+    limiter.release([per_second], 0)
+    with pytest.raises(
+        RateLimitExceeded, match="foo per-second of 1 exceeds limit of 1"
+    ):
+        limiter.acquire([per_second], 0)
+    limiter.release([per_second], 0)
+
+    # Queries are counted from the time they started, over the window.
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire([per_second], state.rate_lookback_s)
+    limiter.acquire([per_second], state.rate_lookback_s + 1)
+    limiter.release([per_second], state.rate_lookback_s + 1)
+
+    limiter.acquire([concurrent], 0)
+    limiter.acquire([concurrent], 0)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire([concurrent, per_second], 2)
+    limiter.release([concurrent], 0)
+    limiter.acquire([concurrent, per_second], 200)
+
+    # A query rate limited after being acquired is not counted.
+    limiter.release([concurrent, per_second], 200, rate_limited=True)
+    for _ in range(state.rate_lookback_s + 1):
+        limiter.acquire([per_second], 200)
+        limiter.release([per_second], 200)
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire([per_second], 200)
+
+
 tests = [
     pytest.param((0, 5, 5)),
     pytest.param((5, 0, 5)),
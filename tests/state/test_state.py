@@ -2,6 +2,7 @@ import random
 import time
 from collections import ChainMap
 from functools import partial
+from unittest.mock import patch
 
 import pytest
 
@@ -89,6 +90,30 @@ class TestState:
         state.set_config("some_key", "some_value", force=True)
         assert state.get_config("some_key") == "some_value"
 
+    def test_config_snapshot(self) -> None:
+        state.set_config("foo", 1)
+        snapshot = state.get_config_snapshot()
+        assert snapshot.configs["foo"] == 1
+
+        # The configs are only read again once their version changes.
+        with patch.object(state.rds, "hgetall", wraps=state.rds.hgetall) as hgetall:
+            assert state.get_config_snapshot().configs is snapshot.configs
+            assert hgetall.call_count == 0
+
+            state.rds.hset(state.config_hash, "foo", b"2")
+            assert state.get_config("foo") == 1
+
+            state.rds.incr(state.config_version_key)
+            assert state.get_config("foo") == 2
+            assert hgetall.call_count == 1
+
+        state.set_config("foo", 3)
+        new_snapshot = state.get_config_snapshot()
+        assert new_snapshot.version == snapshot.version + 2
+        assert new_snapshot.configs["foo"] == 3
+        # Snapshots are never modified.
+        assert snapshot.configs["foo"] == 1
+
     def test_memoize(self) -> None:
         @state.memoize(0.1)
         def rand() -> float:
@@ -5,7 +5,7 @@ import pytest
 
 from snuba.datasets.dataset import Dataset
 from snuba.query.exceptions import InvalidQueryException
-from snuba.subscriptions.data import SubscriptionData
+from snuba.subscriptions.data import GROUPED_PROJECT_ID, SubscriptionData
 from snuba.utils.metrics.timer import Timer
 from snuba.web.query import parse_and_run_query
 from tests.subscriptions import BaseSubscriptionTest
@@ -102,3 +102,70 @@ class TestBuildRequest(BaseSubscriptionTest, TestBuildRequestBase):
         self, subscription: SubscriptionData, exception: Optional[Type[Exception]]
     ) -> None:
         self.compare_conditions(subscription, exception, "count", 10)
+
+    def test_grouped_by_project(self) -> None:
+        subscription = SubscriptionData(
+            project_id=self.project_id,
+            query="MATCH (events) SELECT count() AS count WHERE platform IN tuple('a')",
+            time_window_sec=500 * 60,
+            resolution_sec=60,
+            entity_subscription=create_entity_subscription(),
+        )
+        assert subscription.can_group_by_project()
+
+        timer = Timer("test")
+        request = subscription.build_request(
+            self.dataset,
+            datetime.utcnow(),
+            100,
+            timer,
+            project_ids=[self.project_id, self.project_id + 1],
+        )
+        result = parse_and_run_query(self.dataset, request, timer)
+
+        assert result.result["data"] == [
+            {"count": 10, GROUPED_PROJECT_ID: self.project_id}
+        ]
+
+
+@pytest.mark.parametrize(
+    "query, groupable",
+    [
+        pytest.param("MATCH (events) SELECT count() AS count", True, id="count"),
+        pytest.param(
+            "MATCH (events) SELECT quantile(0.95)(duration) AS p95, uniq(user) "
+            "WHERE platform = 'a'",
+            True,
+            id="aggregations",
+        ),
+        pytest.param(
+            "MATCH (events) SELECT count() AS count BY tags[a]", False, id="groupby"
+        ),
+        pytest.param(
+            "MATCH (events) SELECT count() AS count LIMIT 1 OFFSET 1",
+            False,
+            id="offset",
+        ),
+        pytest.param(
+            "MATCH (events) SELECT count() AS count HAVING count > 1",
+            False,
+            id="having",
+        ),
+        pytest.param("MATCH (events) SELECT platform", False, id="column"),
+        pytest.param(
+            "MATCH (events) SELECT max(project_id) AS project_id",
+            False,
+            id="name clash",
+        ),
+        pytest.param("MATCH (events) SELECT", False, id="invalid"),
+    ],
+)
+def test_can_group_by_project(query: str, groupable: bool) -> None:
+    subscription = SubscriptionData(
+        project_id=1,
+        query=query,
+        time_window_sec=60,
+        resolution_sec=60,
+        entity_subscription=create_entity_subscription(),
+    )
+    assert subscription.can_group_by_project() == groupable
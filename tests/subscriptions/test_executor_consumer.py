@@ -35,6 +35,7 @@ from snuba.subscriptions.entity_subscription import (
     EventsSubscription,
 )
 from snuba.subscriptions.executor_consumer import (
+    AsyncQueryRunner,
     ExecuteQuery,
     ProduceResult,
     build_executor_consumer,
@@ -176,6 +177,7 @@ def test_executor_consumer() -> None:
 def generate_message(
     entity_key: EntityKey,
     subscription_identifier: Optional[SubscriptionIdentifier] = None,
+    project_id: int = 1,
 ) -> Iterator[Message[KafkaPayload]]:
     codec = SubscriptionScheduledTaskEncoder()
     epoch = datetime(1970, 1, 1)
@@ -201,7 +203,7 @@ def generate_message(
                     Subscription(
                         subscription_identifier,
                         SubscriptionData(
-                            project_id=1,
+                            project_id=project_id,
                             time_window_sec=60,
                             resolution_sec=60,
                             query=f"MATCH ({entity_key.value}) SELECT count()",
@@ -259,6 +261,109 @@ def test_execute_query_strategy() -> None:
     strategy.join()
 
 
+def test_execute_query_strategy_async() -> None:
+    state.set_config("subscription_mode_events", "new")
+    dataset = get_dataset("events")
+    max_concurrent_queries = 2
+    executor = ThreadPoolExecutor(max_concurrent_queries)
+    async_runner = AsyncQueryRunner(10)
+    metrics = TestingMetricsBackend()
+    next_step = mock.Mock()
+    commit = mock.Mock()
+
+    strategy = ExecuteQuery(
+        dataset,
+        ["events"],
+        executor,
+        max_concurrent_queries,
+        None,
+        metrics,
+        next_step,
+        commit,
+        async_runner,
+    )
+
+    messages = [
+        next(generate_message(EntityKey.EVENTS, project_id=project_id))
+        for project_id in (1, 2, 3)
+    ]
+    with mock.patch.object(
+        async_runner, "submit", wraps=async_runner.submit
+    ) as async_submit:
+        for message in messages:
+            strategy.submit(message)
+
+        while next_step.submit.call_count < len(messages):
+            time.sleep(0.1)
+            strategy.poll()
+
+    for call in next_step.submit.call_args_list:
+        result = call[0][0].payload.result
+        assert result[1]["data"] == [{"count()": 0}]
+        assert result[1]["meta"] == [{"name": "count()", "type": "UInt64"}]
+
+    # Every query went through the async runner rather than the fallback
+    # executing it on the threads.
+    assert async_submit.call_count == len(messages)
+    assert not any(
+        call.name == "executor.async.fallback"
+        for call in metrics.calls
+        if isinstance(call, Increment)
+    )
+
+    strategy.close()
+    strategy.join()
+    async_runner.close()
+
+
+def test_execute_query_strategy_batched() -> None:
+    state.set_config("subscription_mode_events", "new")
+    state.set_config("executor_batch_queries", 1)
+    state.set_config("executor_batch_window_ms", 0)
+    dataset = get_dataset("events")
+    max_concurrent_queries = 2
+    executor = ThreadPoolExecutor(max_concurrent_queries)
+    metrics = TestingMetricsBackend()
+    next_step = mock.Mock()
+    commit = mock.Mock()
+
+    strategy = ExecuteQuery(
+        dataset,
+        ["events"],
+        executor,
+        max_concurrent_queries,
+        None,
+        metrics,
+        next_step,
+        commit,
+    )
+
+    messages = [
+        next(generate_message(EntityKey.EVENTS, project_id=project_id))
+        for project_id in (1, 2, 3)
+    ]
+    for message in messages:
+        strategy.submit(message)
+
+    while next_step.submit.call_count < len(messages):
+        time.sleep(0.1)
+        strategy.poll()
+
+    for call in next_step.submit.call_args_list:
+        result = call[0][0].payload.result
+        assert result[1]["data"] == [{"count()": 0}]
+        assert result[1]["meta"] == [{"name": "count()", "type": "UInt64"}]
+
+    # One grouped query, and one for the projects without any row.
+    assert Increment("executor.batch.tasks", 3, None) in metrics.calls
+    assert [
+        call for call in metrics.calls if call.name == "executor.batch.queries"
+    ] == [Increment("executor.batch.queries", 1, None)] * 2
+
+    strategy.close()
+    strategy.join()
+
+
 def test_too_many_concurrent_queries() -> None:
     state.set_config("subscription_mode_events", "new")
     state.set_config("executor_queue_size_factor", 1)
@@ -1,6 +1,8 @@
 import uuid
 from datetime import datetime, timedelta
-from typing import Callable, Collection, Optional, Tuple
+from typing import Callable, Collection, Optional, Sequence, Tuple
+
+import pytest
 
 from snuba import state
 from snuba.datasets.entities import EntityKey
@@ -13,7 +15,13 @@ from snuba.subscriptions.data import (
     SubscriptionIdentifier,
     SubscriptionWithMetadata,
 )
-from snuba.subscriptions.scheduler import SubscriptionScheduler
+from snuba.subscriptions.scheduler import (
+    ImmediateTaskBuilder,
+    JitteredTaskBuilder,
+    SubscriptionIndex,
+    SubscriptionScheduler,
+    TaskBuilder,
+)
 from snuba.subscriptions.store import RedisSubscriptionDataStore
 from snuba.subscriptions.utils import Tick
 from snuba.utils.metrics.backends.dummy import DummyMetricsBackend
@@ -207,3 +215,91 @@ class TestSubscriptionScheduler:
             expected=expected,
             sort_key=self.sort_key,
         )
+
+
+def build_subscriptions(count: int) -> Sequence[Subscription]:
+    return [
+        Subscription(
+            SubscriptionIdentifier(PartitionId(1), uuid.uuid4()),
+            SubscriptionData(
+                project_id=1,
+                query="MATCH (events) SELECT count() AS count",
+                time_window_sec=60,
+                resolution_sec=resolution,
+                entity_subscription=create_entity_subscription(),
+            ),
+        )
+        for resolution in (10, 60, 120, 3600)
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize(
+    "builder, jittered, immediate",
+    [
+        pytest.param(JitteredTaskBuilder(), True, False, id="jittered"),
+        pytest.param(ImmediateTaskBuilder(), False, True, id="immediate"),
+    ],
+)
+def test_subscription_index_candidates(
+    builder: TaskBuilder, jittered: bool, immediate: bool
+) -> None:
+    subscriptions = build_subscriptions(20)
+    index = SubscriptionIndex()
+    assert index.update(subscriptions) == (len(subscriptions), 0)
+
+    start = int(datetime(2021, 7, 6).timestamp())
+    for timestamp in range(start, start + 3600):
+        candidates = {
+            subscription.identifier
+            for subscription in index.get_candidates(timestamp, jittered, immediate)
+        }
+        due = {
+            subscription.identifier
+            for subscription in subscriptions
+            if builder.get_task(
+                SubscriptionWithMetadata(EntityKey.EVENTS, subscription, 1),
+                timestamp,
+            )
+            is not None
+        }
+        assert candidates == due
+
+
+def test_subscription_index_update() -> None:
+    subscriptions = build_subscriptions(5)
+    index = SubscriptionIndex()
+    index.update(subscriptions)
+
+    # Subscriptions are matched by uuid, the ones still in the store are
+    # left in their bucket.
+    assert index.update([*subscriptions[5:], *build_subscriptions(1)]) == (4, 5)
+    assert len(index) == len(subscriptions) - 5 + 4
+
+    assert index.update([]) == (0, len(subscriptions) - 1)
+    assert len(index) == 0
+    assert list(index.get_candidates(0, True, True)) == []
+
+
+def test_subscription_index_apply() -> None:
+    subscriptions = build_subscriptions(5)
+    index = SubscriptionIndex()
+    index.update(subscriptions)
+
+    created = build_subscriptions(1)
+    deleted = subscriptions[:3]
+    assert index.apply(
+        [
+            *((subscription.identifier.uuid, subscription) for subscription in created),
+            *((subscription.identifier.uuid, None) for subscription in deleted),
+            # Already deleted.
+            (uuid.uuid4(), None),
+        ]
+    ) == (4, 3)
+    assert len(index) == len(subscriptions) + 1
+
+    assert {
+        subscription.identifier
+        for timestamp in range(3600)
+        for subscription in index.get_candidates(timestamp, True, False)
+    } == {subscription.identifier for subscription in [*subscriptions[3:], *created]}
@@ -77,3 +77,47 @@ class TestRedisSubscriptionStore(BaseSubscriptionTest):
         store_2.create(new_subscription_id, self.subscription[1])
         assert store_1.all() == [(subscription_id, self.subscription[0])]
         assert store_2.all() == [(new_subscription_id, self.subscription[1])]
+
+    def test_changes(self) -> None:
+        store = self.build_store()
+        subscription_id = uuid1()
+        store.create(subscription_id, self.subscription[0])
+
+        version, subscriptions = store.snapshot()
+        assert version == 1
+        assert list(subscriptions) == [(subscription_id, self.subscription[0])]
+        assert store.changes(version) == (version, [])
+
+        new_subscription_id = uuid1()
+        store.create(new_subscription_id, self.subscription[1])
+        store.delete(subscription_id)
+        assert store.changes(version) == (
+            3,
+            [(new_subscription_id, self.subscription[1]), (subscription_id, None)],
+        )
+        assert store.changes(2) == (3, [(subscription_id, None)])
+        # The version is ahead of the store, which was reset.
+        assert store.changes(4) is None
+
+    def test_changes_trimmed(self) -> None:
+        store = RedisSubscriptionDataStore(
+            redis_client, self.entity_key, PartitionId(1), changelog_size=2
+        )
+        subscription_ids = [uuid1() for _ in range(3)]
+        for subscription_id in subscription_ids:
+            store.create(subscription_id, self.subscription[0])
+
+        assert store.changes(0) is None
+        assert store.changes(1) == (
+            3,
+            [
+                (subscription_ids[1], self.subscription[0]),
+                (subscription_ids[2], self.subscription[0]),
+            ],
+        )
+        # Changing a subscription again only keeps its latest version.
+        store.delete(subscription_ids[1])
+        assert store.changes(1) == (
+            4,
+            [(subscription_ids[2], self.subscription[0]), (subscription_ids[1], None)],
+        )
@@ -2,6 +2,9 @@ import functools
 import itertools
 import json
 import pickle
+import threading
+import time
+from array import array
 from datetime import datetime
 from pickle import PickleBuffer
 from typing import MutableSequence, Optional
@@ -16,21 +19,30 @@ from arroyo.processing.strategies.streaming import KafkaConsumerStrategyFactory
 from arroyo.types import Position
 from arroyo.utils.clock import TestingClock
 
+from snuba import settings
 from snuba.clickhouse.errors import ClickhouseWriterError
+from snuba.clickhouse.http import JSONRowEncoder, ValuesRowEncoder
 from snuba.clusters.cluster import ClickhouseClientSettings
 from snuba.consumers.consumer import (
     BytesInsertBatch,
     DeadLetterStep,
     InsertBatchWriter,
+    MultistorageCollector,
     MultistorageConsumerProcessingStrategyFactory,
+    MultistorageKafkaPayload,
     ProcessedMessageBatchWriter,
     ReplacementBatchWriter,
+    build_multistorage_executor,
+    get_values_row_encoder,
     process_message,
+    process_message_multistorage,
 )
+from snuba.consumers.types import KafkaMessageMetadata
 from snuba.datasets.schemas.tables import TableSchema
 from snuba.datasets.storage import Storage
+from snuba.datasets.storages import StorageKey
 from snuba.datasets.storages.factory import get_writable_storage
-from snuba.processor import InsertBatch, ReplacementBatch
+from snuba.processor import AggregateInsertBatch, InsertBatch, ReplacementBatch
 from snuba.utils.metrics.wrapper import MetricsWrapper
 from tests.assertions import assert_changes
 from tests.backends.confluent_kafka import FakeConfluentKafkaProducer
@@ -119,16 +131,71 @@ def test_streaming_consumer_strategy() -> None:
 
 
 def test_json_row_batch_pickle_simple() -> None:
-    batch = BytesInsertBatch([b"foo", b"bar", b"baz"], datetime(2021, 1, 1, 11, 0, 1))
+    batch = BytesInsertBatch(
+        b"foobarbaz", array("I", [3, 6, 9]), datetime(2021, 1, 1, 11, 0, 1)
+    )
     assert pickle.loads(pickle.dumps(batch)) == batch
 
 
 def test_json_row_batch_pickle_out_of_band() -> None:
-    batch = BytesInsertBatch([b"foo", b"bar", b"baz"], datetime(2021, 1, 1, 11, 0, 1))
+    batch = BytesInsertBatch(
+        b"foobarbaz", array("I", [3, 6, 9]), datetime(2021, 1, 1, 11, 0, 1)
+    )
 
     buffers: MutableSequence[PickleBuffer] = []
     data = pickle.dumps(batch, protocol=5, buffer_callback=buffers.append)
-    assert pickle.loads(data, buffers=[b.raw() for b in buffers]) == batch
+    assert len(buffers) == 1
+    unpickled = pickle.loads(data, buffers=[b.raw() for b in buffers])
+    assert unpickled == batch
+    assert list(unpickled.iter_rows()) == [b"foo", b"bar", b"baz"]
+
+
+def test_bytes_insert_batch_encode() -> None:
+    rows = [{"a": 1}, {"b": "\u00e9"}, {}]
+    batch = BytesInsertBatch.encode(JSONRowEncoder(), rows, None)
+    assert batch.row_count == 3
+    assert list(batch.iter_rows()) == [JSONRowEncoder().encode(row) for row in rows]
+
+
+def test_bytes_insert_batch_values_encoder() -> None:
+    counter = {
+        "org_id": 1,
+        "project_id": 2,
+        "metric_id": 3,
+        "type": "c",
+        "timestamp": time.time(),
+        "tags": {"10": 11, "20": 22},
+        "value": 4.5,
+        "retention_days": 30,
+    }
+    message = Message(
+        Partition(Topic("metrics"), 0),
+        1,
+        MultistorageKafkaPayload(
+            [StorageKey.METRICS_COUNTERS],
+            KafkaPayload(None, json.dumps(counter).encode("utf-8"), []),
+        ),
+        datetime.now(),
+    )
+
+    storage = get_writable_storage(StorageKey.METRICS_COUNTERS)
+    processor = storage.get_table_writer().get_stream_loader().get_processor()
+    encoder = get_values_row_encoder(StorageKey.METRICS_COUNTERS)
+
+    with patch.object(settings, "WRITE_METRICS_AGG_DIRECTLY", True):
+        expected = processor.process_message(
+            counter, KafkaMessageMetadata(1, 0, message.timestamp)
+        )
+        # The rows of the batch are encoded at once by the storage encoder,
+        # never one by one.
+        with patch.object(ValuesRowEncoder, "encode", side_effect=AssertionError):
+            [(storage_key, batch)] = process_message_multistorage(message)
+
+    assert storage_key == StorageKey.METRICS_COUNTERS
+    assert isinstance(expected, AggregateInsertBatch)
+    assert isinstance(batch, BytesInsertBatch)
+    assert batch.row_count == len(expected.rows)
+    assert list(batch.iter_rows()) == [encoder.encode(row) for row in expected.rows]
 
 
 def get_row_count(storage: Storage) -> int:
@@ -312,6 +379,127 @@ def test_multistorage_strategy_dead_letter_step(
     )
 
 
+def test_multistorage_collector_writes_concurrently() -> None:
+    from snuba.datasets.storages import StorageKey
+
+    storage_keys = [StorageKey.ERRORS_V2, StorageKey.TRANSACTIONS_V2]
+
+    # Every write waits for all the others to start, which only completes
+    # if the writes of the storages are running at the same time.
+    barrier = threading.Barrier(len(storage_keys), timeout=5.0)
+    steps = {key: Mock(close=Mock(side_effect=barrier.wait)) for key in storage_keys}
+    metrics = TestingMetricsBackend()
+
+    collector = MultistorageCollector(steps, None, metrics=metrics)
+    collector.submit(
+        Message(
+            Partition(Topic("topic"), 0),
+            0,
+            [(key, None) for key in storage_keys],
+            datetime.now(),
+            1,
+        )
+    )
+    collector.close()
+    collector.join(10.0)
+
+    for step in steps.values():
+        step.close.assert_called_once()
+        [(args, _)] = step.join.call_args_list
+        assert 0 < args[0] <= 10.0
+
+    assert {
+        call.tags["storage"]
+        for call in metrics.calls
+        if isinstance(call, Timing) and call.name == "storage_flush_ms"
+    } == {key.value for key in storage_keys}
+
+    # The pool of the collector does not outlive it.
+    assert not any(
+        thread.name.startswith("multistorage-collector")
+        for thread in threading.enumerate()
+    )
+
+
+def test_multistorage_collector_shared_executor() -> None:
+    from snuba.datasets.storages import StorageKey
+
+    storage_keys = [StorageKey.ERRORS_V2, StorageKey.TRANSACTIONS_V2]
+    executor = build_multistorage_executor(len(storage_keys))
+
+    # Consecutive batches are flushed on the same pool, which is left
+    # running by the collectors.
+    for offset in range(2):
+        steps = {key: Mock() for key in storage_keys}
+        collector = MultistorageCollector(steps, None, executor=executor)
+        collector.submit(
+            Message(
+                Partition(Topic("topic"), 0),
+                offset,
+                [(key, None) for key in storage_keys],
+                datetime.now(),
+                offset + 1,
+            )
+        )
+        collector.close()
+        collector.join()
+
+        for step in steps.values():
+            step.close.assert_called_once()
+            step.join.assert_called_once()
+
+    assert executor.submit(lambda: True).result()
+    executor.shutdown()
+
+
+def test_multistorage_collector_write_errors() -> None:
+    from snuba.datasets.storages import StorageKey
+
+    error = ClickhouseWriterError("oops", code=500, row=None)
+    message = Message(
+        Partition(Topic("topic"), 0),
+        0,
+        [(StorageKey.ERRORS_V2, None), (StorageKey.TRANSACTIONS_V2, None)],
+        datetime.now(),
+        1,
+    )
+
+    # The messages of a storage whose errors are ignored go to the dead
+    # letter step, the other storages are still written.
+    dead_letter_step = Mock()
+    transactions_step = Mock()
+    collector = MultistorageCollector(
+        {
+            StorageKey.ERRORS_V2: Mock(close=Mock(side_effect=error)),
+            StorageKey.TRANSACTIONS_V2: transactions_step,
+        },
+        dead_letter_step,
+        ignore_errors={StorageKey.ERRORS_V2},
+    )
+    collector.submit(message)
+    collector.close()
+    collector.join()
+
+    [(args, _)] = dead_letter_step.submit.call_args_list
+    assert args[0].payload == (StorageKey.ERRORS_V2, None)
+    transactions_step.close.assert_called_once()
+    dead_letter_step.join.assert_called_once()
+
+    # Any other error is raised once all the storages have been written.
+    transactions_step = Mock()
+    collector = MultistorageCollector(
+        {
+            StorageKey.ERRORS_V2: Mock(close=Mock(side_effect=error)),
+            StorageKey.TRANSACTIONS_V2: transactions_step,
+        },
+        None,
+    )
+    collector.submit(message)
+    with pytest.raises(ClickhouseWriterError):
+        collector.close()
+    transactions_step.close.assert_called_once()
+
+
 def test_dead_letter_step() -> None:
     from snuba.datasets.storages import StorageKey
 
@@ -343,7 +531,9 @@ def test_dead_letter_step() -> None:
 
     # We only produce to dead letter topic if the payload is an insert
     # so we should see futures with BytesInsertBatch payloads
-    insert_payload = BytesInsertBatch(rows=[b""], origin_timestamp=None)
+    insert_payload = BytesInsertBatch(
+        data=b"", offsets=array("I", [0]), origin_timestamp=None
+    )
     insert_message = Message(
         Partition(Topic("topic"), 0),
         1,
@@ -420,3 +420,41 @@ class TestReplacer:
             # exclude_groups from project setter, start_merge from group setter
             {ReplacementType.EXCLUDE_GROUPS, ReplacementType.START_MERGE},
         )
+
+    def test_query_time_flags_cache(self) -> None:
+        """
+        Tests the flags cached by ProjectsQueryFlags.load_from_cache() are
+        invalidated by the setters.
+        """
+        redis_client.flushdb()
+        cache = errors_replacer.ProjectsQueryFlagsCache()
+        project_ids = [10, 11]
+
+        errors_replacer.set_project_exclude_groups(
+            10, [1, 2], ReplacerState.ERRORS, ReplacementType.EXCLUDE_GROUPS
+        )
+        flags = cache.load(project_ids, ReplacerState.ERRORS, 60)
+        assert (flags.needs_final, flags.group_ids_to_exclude) == (False, {1, 2})
+
+        # Changes made without a replacement are not seen until the flags
+        # expire.
+        redis_client.delete(
+            ProjectsQueryFlags._build_project_exclude_groups_key_and_type_key(
+                10, ReplacerState.ERRORS
+            )[0]
+        )
+        flags = cache.load(project_ids, ReplacerState.ERRORS, 60)
+        assert flags.group_ids_to_exclude == {1, 2}
+        flags = cache.load(project_ids, ReplacerState.ERRORS, 0)
+        assert flags.group_ids_to_exclude == set()
+
+        errors_replacer.set_project_needs_final(
+            11, ReplacerState.ERRORS, ReplacementType.EXCLUDE_GROUPS
+        )
+        flags = cache.load(project_ids, ReplacerState.ERRORS, 60)
+        assert flags == ProjectsQueryFlags.load_from_redis(
+            project_ids, ReplacerState.ERRORS
+        )
+        assert flags.needs_final
+        # Each replacer state has its own flags.
+        assert not cache.load(project_ids, ReplacerState.ERRORS_V2, 60).needs_final
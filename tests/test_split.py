@@ -1,5 +1,7 @@
 from datetime import datetime
-from typing import Any, MutableMapping, Sequence
+from threading import Event, Lock, Semaphore
+from typing import Any, MutableMapping, Sequence, Tuple
+from unittest.mock import Mock, patch
 
 import pytest
 from snuba_sdk.legacy import json_to_snql
@@ -17,8 +19,10 @@ from snuba.query import SelectedExpression
 from snuba.query.data_source.simple import Table
 from snuba.query.expressions import Column
 from snuba.query.snql.parser import parse_snql_query
+from snuba.querylog.query_metadata import SnubaQueryMetadata, current_query_metadata
 from snuba.reader import Reader
 from snuba.request.request_settings import HTTPRequestSettings, RequestSettings
+from snuba.utils.metrics.timer import Timer
 from snuba.web import QueryResult
 from snuba.web.split import ColumnSplitQueryStrategy, TimeSplitQueryStrategy
 
@@ -443,3 +447,272 @@ def test_time_split_ast() -> None:
         ("2019-09-19T01:00:00", "2019-09-19T11:00:00"),
         ("2019-09-18T10:00:00", "2019-09-19T01:00:00"),
     ]
+
+
+def test_time_split_speculation() -> None:
+    """
+    Runs the windows that follow an empty one in advance and checks that the
+    windows and the result are the same as the serial execution.
+    """
+    state.set_config("split_speculative_windows", 2)
+    found_timestamps = []
+    lock = Lock()
+
+    def do_query(
+        query: ClickhouseQuery,
+        request_settings: RequestSettings,
+    ) -> QueryResult:
+        from_date_ast, to_date_ast = get_time_range(query, "timestamp")
+        assert from_date_ast is not None and isinstance(from_date_ast, datetime)
+        assert to_date_ast is not None and isinstance(to_date_ast, datetime)
+
+        with lock:
+            found_timestamps.append(
+                (from_date_ast.isoformat(), to_date_ast.isoformat())
+            )
+
+        data = (
+            [{"event_id": "a"}]
+            if from_date_ast.isoformat() == "2019-09-18T10:00:00"
+            else []
+        )
+        return QueryResult({"data": data}, {})
+
+    body = """
+        MATCH (events)
+        SELECT event_id, level, logger, server_name, transaction, timestamp, project_id
+        WHERE timestamp >= toDateTime('2019-09-18T10:00:00')
+        AND timestamp < toDateTime('2019-09-19T12:00:00')
+        AND project_id IN tuple(1)
+        ORDER BY timestamp DESC
+        LIMIT 10
+        """
+
+    query, _ = parse_snql_query(body, get_dataset("events"))
+    entity = get_entity(query.get_from_clause().key)
+    settings = HTTPRequestSettings()
+    for p in entity.get_query_processors():
+        p.process_query(query, settings)
+
+    clickhouse_query = identity_translate(query)
+    splitter = TimeSplitQueryStrategy("timestamp")
+    result = splitter.execute(clickhouse_query, settings, do_query)
+
+    assert result is not None
+    assert result.result["data"] == [{"event_id": "a"}]
+    assert sorted(found_timestamps, reverse=True) == [
+        ("2019-09-19T11:00:00", "2019-09-19T12:00:00"),
+        ("2019-09-19T01:00:00", "2019-09-19T11:00:00"),
+        ("2019-09-18T10:00:00", "2019-09-19T01:00:00"),
+    ]
+
+
+def test_time_split_speculation_metadata() -> None:
+    """
+    The speculative windows record their execution in metadata of their own,
+    which only makes it into the metadata of the request if they are used.
+    """
+    state.set_config("split_speculative_windows", 2)
+
+    def do_query(
+        query: ClickhouseQuery,
+        request_settings: RequestSettings,
+    ) -> QueryResult:
+        from_date_ast, to_date_ast = get_time_range(query, "timestamp")
+        assert from_date_ast is not None and isinstance(from_date_ast, datetime)
+        assert to_date_ast is not None and isinstance(to_date_ast, datetime)
+
+        query_metadata = current_query_metadata.get()
+        assert query_metadata is not None
+        query_metadata.query_list.append(
+            (from_date_ast.isoformat(), to_date_ast.isoformat())  # type: ignore
+        )
+
+        # The first window returns some rows, so the next one is not the one
+        # predicted after an empty window.
+        data = (
+            [{"event_id": "a"}]
+            if to_date_ast.isoformat() == "2019-09-19T12:00:00"
+            else []
+        )
+        return QueryResult({"data": data}, {})
+
+    body = """
+        MATCH (events)
+        SELECT event_id, level, logger, server_name, transaction, timestamp, project_id
+        WHERE timestamp >= toDateTime('2019-09-18T10:00:00')
+        AND timestamp < toDateTime('2019-09-19T12:00:00')
+        AND project_id IN tuple(1)
+        ORDER BY timestamp DESC
+        LIMIT 2
+        """
+
+    query, _ = parse_snql_query(body, get_dataset("events"))
+    entity = get_entity(query.get_from_clause().key)
+    settings = HTTPRequestSettings()
+    for p in entity.get_query_processors():
+        p.process_query(query, settings)
+
+    clickhouse_query = identity_translate(query)
+    query_metadata = SnubaQueryMetadata(
+        request=Mock(),
+        start_timestamp=None,
+        end_timestamp=None,
+        dataset="events",
+        entity="events",
+        timer=Timer("test"),
+        query_list=[],
+        projects={1},
+        snql_anonymized="",
+    )
+    token = current_query_metadata.set(query_metadata)
+    try:
+        result = TimeSplitQueryStrategy("timestamp").execute(
+            clickhouse_query, settings, do_query
+        )
+    finally:
+        current_query_metadata.reset(token)
+
+    assert result is not None
+    # The windows predicted after the first one are discarded, the ones
+    # predicted after the second one are used.
+    assert query_metadata.query_list == [
+        ("2019-09-19T11:00:00", "2019-09-19T12:00:00"),
+        ("2019-09-19T10:00:00", "2019-09-19T11:00:00"),
+        ("2019-09-19T00:00:00", "2019-09-19T10:00:00"),
+        ("2019-09-18T10:00:00", "2019-09-19T00:00:00"),
+    ]
+
+
+def test_time_split_speculation_error() -> None:
+    """
+    A speculative window that fails is run again by the request instead of
+    failing it.
+    """
+    state.set_config("split_speculative_windows", 2)
+    found_timestamps = []
+    lock = Lock()
+
+    def do_query(
+        query: ClickhouseQuery,
+        request_settings: RequestSettings,
+    ) -> QueryResult:
+        from_date_ast, to_date_ast = get_time_range(query, "timestamp")
+        assert from_date_ast is not None and isinstance(from_date_ast, datetime)
+        assert to_date_ast is not None and isinstance(to_date_ast, datetime)
+
+        if request_settings.get_query_id() is not None:
+            raise Exception("speculative window failed")
+
+        with lock:
+            found_timestamps.append(
+                (from_date_ast.isoformat(), to_date_ast.isoformat())
+            )
+        data = (
+            [{"event_id": "a"}]
+            if from_date_ast.isoformat() == "2019-09-18T10:00:00"
+            else []
+        )
+        return QueryResult({"data": data}, {})
+
+    body = """
+        MATCH (events)
+        SELECT event_id, level, logger, server_name, transaction, timestamp, project_id
+        WHERE timestamp >= toDateTime('2019-09-18T10:00:00')
+        AND timestamp < toDateTime('2019-09-19T12:00:00')
+        AND project_id IN tuple(1)
+        ORDER BY timestamp DESC
+        LIMIT 10
+        """
+
+    query, _ = parse_snql_query(body, get_dataset("events"))
+    entity = get_entity(query.get_from_clause().key)
+    settings = HTTPRequestSettings()
+    for p in entity.get_query_processors():
+        p.process_query(query, settings)
+
+    clickhouse_query = identity_translate(query)
+    splitter = TimeSplitQueryStrategy("timestamp")
+    result = splitter.execute(clickhouse_query, settings, do_query)
+
+    assert result is not None
+    assert result.result["data"] == [{"event_id": "a"}]
+    assert found_timestamps == [
+        ("2019-09-19T11:00:00", "2019-09-19T12:00:00"),
+        ("2019-09-19T01:00:00", "2019-09-19T11:00:00"),
+        ("2019-09-18T10:00:00", "2019-09-19T01:00:00"),
+    ]
+
+
+def test_time_split_speculation_kill() -> None:
+    """
+    The speculative windows that are discarded while they run are killed
+    through the query id they were given.
+    """
+    state.set_config("split_speculative_windows", 2)
+    query_ids: MutableMapping[Tuple[str, str], str] = {}
+    lock = Lock()
+    started = Semaphore(0)
+    killed = Event()
+
+    def do_query(
+        query: ClickhouseQuery,
+        request_settings: RequestSettings,
+    ) -> QueryResult:
+        from_date_ast, to_date_ast = get_time_range(query, "timestamp")
+        assert from_date_ast is not None and isinstance(from_date_ast, datetime)
+        assert to_date_ast is not None and isinstance(to_date_ast, datetime)
+        window = (from_date_ast.isoformat(), to_date_ast.isoformat())
+
+        query_id = request_settings.get_query_id()
+        if query_id is not None:
+            with lock:
+                query_ids[window] = query_id
+            started.release()
+            assert killed.wait(5)
+            return QueryResult({"data": []}, {})
+
+        if window[1] == "2019-09-19T12:00:00":
+            # The first window returns rows once the windows predicted after
+            # it are running, so they are discarded.
+            assert started.acquire(timeout=5)
+            assert started.acquire(timeout=5)
+            return QueryResult({"data": [{"event_id": "a"}]}, {})
+        return QueryResult({"data": []}, {})
+
+    body = """
+        MATCH (events)
+        SELECT event_id, level, logger, server_name, transaction, timestamp, project_id
+        WHERE timestamp >= toDateTime('2019-09-18T10:00:00')
+        AND timestamp < toDateTime('2019-09-19T12:00:00')
+        AND project_id IN tuple(1)
+        ORDER BY timestamp DESC
+        LIMIT 2
+        """
+
+    query, _ = parse_snql_query(body, get_dataset("events"))
+    entity = get_entity(query.get_from_clause().key)
+    settings = HTTPRequestSettings()
+    for p in entity.get_query_processors():
+        p.process_query(query, settings)
+
+    clickhouse_query = identity_translate(query)
+    killed_ids = []
+
+    def kill(query_id: str) -> None:
+        killed_ids.append(query_id)
+        # Both windows stay running until they are killed.
+        if len(killed_ids) == 2:
+            killed.set()
+
+    with patch("snuba.web.split.kill_query", side_effect=kill):
+        result = TimeSplitQueryStrategy("timestamp").execute(
+            clickhouse_query, settings, do_query
+        )
+
+    assert result is not None
+    assert result.result["data"] == [{"event_id": "a"}]
+    assert set(killed_ids[:2]) == {
+        query_ids[("2019-09-19T01:00:00", "2019-09-19T11:00:00")],
+        query_ids[("2019-09-18T10:00:00", "2019-09-19T01:00:00")],
+    }
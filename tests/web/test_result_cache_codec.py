@@ -1,8 +1,9 @@
 import pytest
+import rapidjson
 
-from snuba.reader import Result
+from snuba.reader import ColumnarRows, Result
 from snuba.utils.serializable_exception import SerializableException
-from snuba.web.db_query import ResultCacheCodec
+from snuba.web.db_query import ResultCacheCodec, get_result_size
 
 
 def test_encode_decode() -> None:
@@ -15,6 +16,18 @@ def test_encode_decode() -> None:
     assert codec.decode(codec.encode(payload)) == payload
 
 
+def test_encode_decode_columnar() -> None:
+    payload: Result = {
+        "meta": [{"name": "foo", "type": "bar"}],
+        "data": ColumnarRows(["foo"], [("bar", "baz")], 2),
+    }
+    codec = ResultCacheCodec()
+    assert codec.decode(codec.encode(payload)) == {
+        "meta": [{"name": "foo", "type": "bar"}],
+        "data": [{"foo": "bar"}, {"foo": "baz"}],
+    }
+
+
 def test_encode_decode_exception() -> None:
     class SomeException(SerializableException):
         pass
@@ -23,3 +36,19 @@ def test_encode_decode_exception() -> None:
     encoded_exception = codec.encode_exception(SomeException("some message"))
     with pytest.raises(SomeException):
         codec.decode(encoded_exception)
+
+
+def test_result_size() -> None:
+    payload: Result = {
+        "meta": [{"name": "foo", "type": "bar"}],
+        "data": [{"foo": "bar"}] * 100,
+    }
+    size = len(rapidjson.dumps(payload))
+    assert get_result_size(payload) == pytest.approx(size, rel=0.01)
+
+    rows = ColumnarRows(["foo"], [["bar"] * 100], 100)
+    assert get_result_size({"meta": payload["meta"], "data": rows}) == (
+        get_result_size(payload)
+    )
+    # The rows are not built to estimate the size.
+    assert not rows.is_materialized()
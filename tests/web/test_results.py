@@ -4,8 +4,9 @@ from typing import Mapping
 
 import pytest
 
-from snuba.reader import Column, Result
+from snuba.reader import Column, ColumnarRows, Result, SharedRows
 from snuba.web import QueryExtraData, QueryResult, transform_column_names
+from snuba.web.db_query import copy_result, share_result
 
 TEST_CASES = [
     pytest.param(
@@ -150,6 +151,40 @@ TEST_CASES = [
         {"_snuba_event_id": ["event_id"]},
         id="Incomplete mapping",
     ),
+    pytest.param(
+        QueryResult(
+            result=Result(
+                meta=[
+                    Column(name="_snuba_event_id", type="String"),
+                    Column(name="_snuba_duration", type="UInt32"),
+                ],
+                data=ColumnarRows(
+                    ["_snuba_event_id", "_snuba_duration"],
+                    [("asd", "sdf"), (123, 321)],
+                    2,
+                ),
+                totals={"_snuba_event_id": "", "_snuba_duration": 223},
+            ),
+            extra=QueryExtraData(stats={}, sql="...", experiments={}),
+        ),
+        QueryResult(
+            result=Result(
+                meta=[
+                    Column(name="event_id", type="String"),
+                    Column(name="id", type="String"),
+                    Column(name="_snuba_duration", type="UInt32"),
+                ],
+                data=[
+                    {"event_id": "asd", "id": "asd", "_snuba_duration": 123},
+                    {"event_id": "sdf", "id": "sdf", "_snuba_duration": 321},
+                ],
+                totals={"event_id": "", "id": "", "_snuba_duration": 223},
+            ),
+            extra=QueryExtraData(stats={}, sql="...", experiments={}),
+        ),
+        {"_snuba_event_id": ["event_id", "id"]},
+        id="Columnar result, multiple names",
+    ),
 ]
 
 
@@ -160,3 +195,29 @@ def test_transformation(
     transform_column_names(in_result, mapping)
 
     assert in_result == out_result
+
+
+def test_shared_result() -> None:
+    stored = copy_result(
+        Result(
+            meta=[Column(name="_snuba_event_id", type="String")],
+            data=[{"_snuba_event_id": "asd"}, {"_snuba_event_id": "sdf"}],
+        )
+    )
+    result = QueryResult(
+        result=share_result(stored),
+        extra=QueryExtraData(stats={}, sql="...", experiments={}),
+    )
+    rows = result.result["data"]
+    assert isinstance(rows, SharedRows)
+
+    rows.transform_column("_snuba_event_id", str.upper)
+    transform_column_names(result, {"_snuba_event_id": ["event_id"]})
+    assert not rows.is_materialized()
+    assert list(rows.iter_rows()) == [{"event_id": "ASD"}, {"event_id": "SDF"}]
+
+    rows[0]["event_id"] = "dfg"
+    assert rows == [{"event_id": "dfg"}, {"event_id": "SDF"}]
+    # The stored result is never modified.
+    assert stored["data"] == [{"_snuba_event_id": "asd"}, {"_snuba_event_id": "sdf"}]
+    assert stored["meta"] == [{"name": "_snuba_event_id", "type": "String"}]
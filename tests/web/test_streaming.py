@@ -0,0 +1,108 @@
+import json
+from typing import Any, Iterator, List, Mapping, MutableSequence, Optional, Sequence
+
+import pytest
+
+from snuba.clickhouse.errors import ClickhouseError
+from snuba.reader import ColumnarRows, Result, Row, StreamedRows
+from snuba.web.streaming import stream_result
+
+TRAILER = {"timing": {"duration_ms": 10}, "sql": "SELECT 1"}
+
+
+def build_result(columnar: bool, rows: int) -> Result:
+    data: MutableSequence[Row] = [
+        {"a": index, "b": f"value {index}"} for index in range(rows)
+    ]
+    if columnar:
+        data = ColumnarRows(
+            ["a", "b"],
+            [[row["a"] for row in data], [row["b"] for row in data]],
+            rows,
+        )
+    return {
+        "meta": [{"name": "a", "type": "UInt64"}, {"name": "b", "type": "String"}],
+        "data": data,
+        "totals": {"a": 0, "b": ""},
+    }
+
+
+@pytest.mark.parametrize("columnar", [True, False])
+@pytest.mark.parametrize("rows", [0, 1, 3, 10])
+def test_stream_result(columnar: bool, rows: int) -> None:
+    result = build_result(columnar, rows)
+    chunks: List[str] = []
+
+    def get_trailer() -> Mapping[str, Any]:
+        # The trailer is only built once all the rows have been serialized.
+        assert chunks[-1] == "]"
+        return TRAILER
+
+    for chunk in stream_result(result, get_trailer, chunk_size=3):
+        chunks.append(chunk)
+    document = "".join(chunks)
+
+    assert json.loads(document) == {**build_result(False, rows), **TRAILER}
+
+    if columnar:
+        data = result["data"]
+        assert isinstance(data, ColumnarRows)
+        assert not data.is_materialized()
+
+
+def test_stream_result_error() -> None:
+    result = build_result(False, 10)
+    data = result["data"]
+    assert isinstance(data, list)
+
+    # Errors in the first chunk are raised before anything is sent.
+    data[1]["b"] = object()
+    with pytest.raises(TypeError):
+        stream_result(result, lambda: TRAILER, chunk_size=3)
+
+    # Errors in the following chunks are raised once the first ones have
+    # been sent, leaving the document unterminated.
+    del data[1]["b"]
+    data[5]["b"] = object()
+    chunks: List[str] = []
+    with pytest.raises(TypeError):
+        for chunk in stream_result(result, lambda: TRAILER, chunk_size=3):
+            chunks.append(chunk)
+    assert len(chunks) == 1
+    with pytest.raises(json.JSONDecodeError):
+        json.loads("".join(chunks))
+
+
+def test_stream_result_streamed_rows() -> None:
+    def read_rows(failure: Optional[int]) -> Iterator[Sequence[Any]]:
+        for index in range(10):
+            if index == failure:
+                raise ClickhouseError("Memory limit exceeded", code=241)
+            yield (index, f"value {index}")
+
+    def build_streamed_result(failure: Optional[int]) -> Result:
+        result = build_result(False, 0)
+        del result["totals"]
+        rows = StreamedRows([("a", 0), ("b", 1)], read_rows(failure))
+        rows.transform_column("a", lambda value: value * 2)
+        rows.rename_columns({"b": ["b", "c"]})
+        result["data"] = rows
+        return result
+
+    document = "".join(
+        stream_result(build_streamed_result(None), lambda: TRAILER, chunk_size=3)
+    )
+    assert json.loads(document)["data"] == [
+        {"a": index * 2, "b": f"value {index}", "c": f"value {index}"}
+        for index in range(10)
+    ]
+
+    # An error reading the first rows is raised before anything is sent.
+    with pytest.raises(ClickhouseError):
+        stream_result(build_streamed_result(2), lambda: TRAILER, chunk_size=3)
+
+    # Later ones abort the response.
+    chunks = stream_result(build_streamed_result(5), lambda: TRAILER, chunk_size=3)
+    assert next(chunks)
+    with pytest.raises(ClickhouseError):
+        next(chunks)